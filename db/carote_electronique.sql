@@ -16,6 +16,11 @@ SET FOREIGN_KEY_CHECKS = 0;
 -- Tables
 -- =========================
 
+DROP TABLE IF EXISTS Parametre;
+DROP TABLE IF EXISTS PointSolde;
+DROP TABLE IF EXISTS ConsommateurFlux;
+DROP TABLE IF EXISTS RequeteIdempotente;
+DROP TABLE IF EXISTS TransfertBonus;
 DROP TABLE IF EXISTS Transactions;
 DROP TABLE IF EXISTS Carte;
 DROP TABLE IF EXISTS Compte;
@@ -28,7 +33,8 @@ CREATE TABLE users (
   Prenom        VARCHAR(255)  NOT NULL,
   Password_Hash VARCHAR(255)  NOT NULL,
   Date_Creation DATETIME      NOT NULL DEFAULT CURRENT_TIMESTAMP,
-  PRIMARY KEY (Num_Etudiant)
+  PRIMARY KEY (Num_Etudiant),
+  KEY idx_users_nom (Nom, Prenom)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
 
 CREATE TABLE Agents (
@@ -47,7 +53,8 @@ CREATE TABLE Compte (
   Num_Etudiant   CHAR(8)       NOT NULL,
   Solde_Actuel   DECIMAL(10,2) NOT NULL DEFAULT '0.00',
   Date_Ouverture DATETIME      NOT NULL DEFAULT CURRENT_TIMESTAMP,
-  PRIMARY KEY (Num_Etudiant)
+  PRIMARY KEY (Num_Etudiant),
+  KEY idx_compte_solde (Solde_Actuel)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
 
 CREATE TABLE Carte (
@@ -56,9 +63,11 @@ CREATE TABLE Carte (
   Num_Carte     VARCHAR(15)  NOT NULL,
   Date_Creation DATETIME     NOT NULL DEFAULT CURRENT_TIMESTAMP,
   Actif         TINYINT(1)   NOT NULL DEFAULT 1,
+  Date_Modification DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
   PRIMARY KEY (id),
   UNIQUE KEY uq_carte (Num_Carte),
-  KEY fk_carte_user (Num_Etudiant)
+  KEY fk_carte_user (Num_Etudiant),
+  KEY idx_carte_modif (Date_Modification)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
 
 CREATE TABLE Transactions (
@@ -68,8 +77,74 @@ CREATE TABLE Transactions (
   Type              ENUM('CREDIT','DEBIT') NOT NULL,
   Date_Transaction   DATETIME    NOT NULL DEFAULT CURRENT_TIMESTAMP,
   Commentaire        VARCHAR(255) DEFAULT NULL,
+  Transfert_Bonus    BIGINT       DEFAULT NULL,
+  Reference          CHAR(32)     CHARACTER SET ascii COLLATE ascii_bin DEFAULT NULL,
+  Compacte           TINYINT(1)   NOT NULL DEFAULT 1,
   PRIMARY KEY (id),
-  KEY fk_transaction_compte (Num_Etudiant)
+  KEY idx_transaction_etudiant (Num_Etudiant, Date_Transaction, id),
+  KEY idx_transaction_compactage (Compacte, Num_Etudiant),
+  KEY idx_transfert_bonus (Transfert_Bonus),
+  UNIQUE KEY uq_transaction_reference (Reference)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+-- Transfert des bonus BDD -> carte (Berlicum) : les bonus réservés
+-- pointent vers leur transfert (Transactions.Transfert_Bonus)
+CREATE TABLE TransfertBonus (
+  id               BIGINT        NOT NULL AUTO_INCREMENT,
+  Num_Etudiant     CHAR(8)       NOT NULL,
+  Montant          DECIMAL(10,2) NOT NULL,
+  Etat             ENUM('RESERVE','CONFIRME','ANNULE') NOT NULL DEFAULT 'RESERVE',
+  Date_Reservation DATETIME      NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  Date_Cloture     DATETIME      DEFAULT NULL,
+  PRIMARY KEY (id),
+  KEY fk_transfert_compte (Num_Etudiant)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+-- Clés d'idempotence des API Berlicum (recharge, transfert de bonus) :
+-- une requête rejouée avec la même clé reçoit la réponse enregistrée
+CREATE TABLE RequeteIdempotente (
+  Cle           VARCHAR(64)  CHARACTER SET ascii COLLATE ascii_bin NOT NULL,
+  Route         VARCHAR(64)  NOT NULL,
+  Empreinte     CHAR(64)     NOT NULL,
+  Etat          ENUM('EN_COURS','TERMINEE') NOT NULL DEFAULT 'EN_COURS',
+  Code_HTTP     SMALLINT     DEFAULT NULL,
+  Reponse       TEXT         DEFAULT NULL,
+  Date_Creation DATETIME     NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (Cle),
+  KEY idx_idempotence_date (Date_Creation)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+-- Paramètres de la base. mode_registre :
+--   COMPTE   chaque insertion dans Transactions met à jour Compte (trigger)
+--   JOURNAL  les insertions ne font qu'ajouter (Compacte = 0) ; le solde
+--            vaut Compte.Solde_Actuel + les transactions pas encore
+--            compactées (SoldeCompte), CompacterSoldes les reporte
+CREATE TABLE Parametre (
+  Cle           VARCHAR(64)  CHARACTER SET ascii COLLATE ascii_bin NOT NULL,
+  Valeur        VARCHAR(255) NOT NULL,
+  PRIMARY KEY (Cle)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+-- Points de solde : solde d'un étudiant après une transaction, toutes
+-- les 100 transactions dans l'ordre (Date_Transaction, id). Le solde
+-- courant de l'historique part du dernier point avant la page affichée
+-- au lieu de sommer tout l'historique (voir CreerPointsSolde)
+CREATE TABLE PointSolde (
+  Num_Etudiant     CHAR(8)       NOT NULL,
+  Date_Transaction DATETIME      NOT NULL,
+  Id_Transaction   BIGINT        NOT NULL,
+  Rang             INT           NOT NULL,
+  Solde            DECIMAL(10,2) NOT NULL,
+  PRIMARY KEY (Num_Etudiant, Date_Transaction, Id_Transaction)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+-- Position des consommateurs du flux Transactions (rapprochement,
+-- exports...) : dernier id traité, avancé par le consommateur lui-même
+CREATE TABLE ConsommateurFlux (
+  Nom           VARCHAR(64)  CHARACTER SET ascii COLLATE ascii_bin NOT NULL,
+  Dernier_Id    BIGINT       NOT NULL DEFAULT 0,
+  Date_Maj      DATETIME     NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  PRIMARY KEY (Nom)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
 
 -- =========================
@@ -88,27 +163,48 @@ ALTER TABLE Transactions
   ADD CONSTRAINT fk_transaction_compte
   FOREIGN KEY (Num_Etudiant) REFERENCES Compte (Num_Etudiant);
 
+ALTER TABLE TransfertBonus
+  ADD CONSTRAINT fk_transfert_compte
+  FOREIGN KEY (Num_Etudiant) REFERENCES Compte (Num_Etudiant);
+
 SET FOREIGN_KEY_CHECKS = 1;
 
 -- =========================
 -- Trigger
 -- =========================
 
+DROP TRIGGER IF EXISTS trg_before_insert_transactions;
 DROP TRIGGER IF EXISTS trg_after_insert_transactions;
 
 DELIMITER $$
+-- mode JOURNAL : la ligne est seulement ajoutée, CompacterSoldes
+-- reportera son montant dans Compte
+CREATE TRIGGER trg_before_insert_transactions
+BEFORE INSERT ON Transactions
+FOR EACH ROW
+BEGIN
+  IF (SELECT Valeur FROM Parametre WHERE Cle = 'mode_registre') = 'JOURNAL' THEN
+    SET NEW.Compacte = 0;
+  ELSE
+    SET NEW.Compacte = 1;
+  END IF;
+END $$
+
 CREATE TRIGGER trg_after_insert_transactions
 AFTER INSERT ON Transactions
 FOR EACH ROW
 BEGIN
-  IF NEW.Type = 'CREDIT' THEN
-    UPDATE Compte
-      SET Solde_Actuel = Solde_Actuel + NEW.Montant
-      WHERE Num_Etudiant = NEW.Num_Etudiant;
-  ELSEIF NEW.Type = 'DEBIT' THEN
-    UPDATE Compte
-      SET Solde_Actuel = Solde_Actuel - NEW.Montant
-      WHERE Num_Etudiant = NEW.Num_Etudiant;
+  -- Compacte = 0 : mode JOURNAL, Compte n'est pas touché
+  IF NEW.Compacte = 1 THEN
+    IF NEW.Type = 'CREDIT' THEN
+      UPDATE Compte
+        SET Solde_Actuel = Solde_Actuel + NEW.Montant
+        WHERE Num_Etudiant = NEW.Num_Etudiant;
+    ELSEIF NEW.Type = 'DEBIT' THEN
+      UPDATE Compte
+        SET Solde_Actuel = Solde_Actuel - NEW.Montant
+        WHERE Num_Etudiant = NEW.Num_Etudiant;
+    END IF;
   END IF;
 END $$
 DELIMITER ;
@@ -119,9 +215,42 @@ DELIMITER ;
 
 DROP PROCEDURE IF EXISTS CrediterCompte;
 DROP PROCEDURE IF EXISTS DebiterCompte;
+DROP PROCEDURE IF EXISTS EnregistrerDebitCarte;
+DROP PROCEDURE IF EXISTS CrediterCompteReference;
+DROP PROCEDURE IF EXISTS TransfererBonus;
+DROP PROCEDURE IF EXISTS ConfirmerTransfertBonus;
+DROP PROCEDURE IF EXISTS AnnulerTransfertBonus;
+DROP PROCEDURE IF EXISTS CreerPointsSolde;
+DROP PROCEDURE IF EXISTS CompacterSoldes;
+DROP FUNCTION IF EXISTS SoldeCompte;
 
 DELIMITER $$
 
+-- Solde exact d'un compte dans les deux modes : dernier report dans
+-- Compte + transactions pas encore compactées (aucune en mode COMPTE).
+-- NULL si le compte n'existe pas.
+CREATE FUNCTION SoldeCompte(p_Num_Etudiant CHAR(8))
+RETURNS DECIMAL(10,2)
+READS SQL DATA
+BEGIN
+  DECLARE v_solde DECIMAL(10,2) DEFAULT NULL;
+
+  SELECT Solde_Actuel INTO v_solde
+  FROM Compte
+  WHERE Num_Etudiant = p_Num_Etudiant;
+
+  IF v_solde IS NULL THEN
+    RETURN NULL;
+  END IF;
+
+  RETURN v_solde + (
+    SELECT COALESCE(SUM(IF(Type = 'CREDIT', Montant, -Montant)), 0)
+    FROM Transactions
+    WHERE Compacte = 0
+      AND Num_Etudiant = p_Num_Etudiant
+  );
+END $$
+
 CREATE PROCEDURE CrediterCompte(
   IN p_Num_Etudiant CHAR(8),
   IN p_Montant      DECIMAL(10,2),
@@ -148,30 +277,44 @@ BEGIN
   VALUES (p_Num_Etudiant, p_Montant, 'CREDIT', p_Commentaire);
 END $$
 
+-- Débit en un seul appel : vérification, verrou sur la ligne de Compte,
+-- insertion, puis une ligne de résultat (Nouveau_Solde). Le verrou
+-- sérialise les débits d'un même compte : deux débits simultanés ne
+-- peuvent plus passer tous deux la vérification du solde.
 CREATE PROCEDURE DebiterCompte(
   IN p_Num_Etudiant CHAR(8),
   IN p_Montant      DECIMAL(10,2),
   IN p_Commentaire  VARCHAR(255)
 )
 BEGIN
+  DECLARE v_existe INT DEFAULT 0;
   DECLARE v_solde  DECIMAL(10,2);
-  DECLARE v_exists INT DEFAULT 0;
+  DECLARE EXIT HANDLER FOR SQLEXCEPTION
+  BEGIN
+    ROLLBACK;
+    RESIGNAL;
+  END;
 
-  IF p_Montant <= 0 THEN
+  IF p_Montant IS NULL OR p_Montant <= 0 THEN
     SIGNAL SQLSTATE '45000'
       SET MESSAGE_TEXT = 'Le montant du débit doit être strictement positif';
   END IF;
 
-  SELECT COUNT(*), Solde_Actuel
-  INTO v_exists, v_solde
+  START TRANSACTION;
+
+  SELECT COUNT(*) INTO v_existe
   FROM Compte
-  WHERE Num_Etudiant = p_Num_Etudiant;
+  WHERE Num_Etudiant = p_Num_Etudiant
+  FOR UPDATE;
 
-  IF v_exists = 0 THEN
+  IF v_existe = 0 THEN
     SIGNAL SQLSTATE '45000'
       SET MESSAGE_TEXT = 'Compte inexistant pour cet étudiant';
   END IF;
 
+  -- lu après le verrou : le compactage attend lui aussi la ligne
+  SET v_solde = SoldeCompte(p_Num_Etudiant);
+
   IF v_solde < p_Montant THEN
     SIGNAL SQLSTATE '45000'
       SET MESSAGE_TEXT = 'Solde insuffisant pour effectuer ce débit';
@@ -179,14 +322,342 @@ BEGIN
 
   INSERT INTO Transactions (Num_Etudiant, Montant, Type, Commentaire)
   VALUES (p_Num_Etudiant, p_Montant, 'DEBIT', p_Commentaire);
+
+  COMMIT;
+
+  SELECT v_solde - p_Montant AS Nouveau_Solde;
+END $$
+
+-- Crédit rejouable : une même référence (opération du journal de
+-- Berlicum) n'est créditée qu'une fois. Deux appels simultanés : le
+-- second échoue sur uq_transaction_reference (erreur 1062).
+CREATE PROCEDURE CrediterCompteReference(
+  IN p_Num_Etudiant CHAR(8),
+  IN p_Montant      DECIMAL(10,2),
+  IN p_Commentaire  VARCHAR(255),
+  IN p_Reference    CHAR(32)
+)
+BEGIN
+  DECLARE v_exists INT DEFAULT 0;
+
+  IF p_Montant <= 0 THEN
+    SIGNAL SQLSTATE '45000'
+      SET MESSAGE_TEXT = 'Le montant du crédit doit être strictement positif';
+  END IF;
+
+  SELECT COUNT(*) INTO v_exists
+  FROM Compte
+  WHERE Num_Etudiant = p_Num_Etudiant;
+
+  IF v_exists = 0 THEN
+    SIGNAL SQLSTATE '45000'
+      SET MESSAGE_TEXT = 'Compte inexistant pour cet étudiant';
+  END IF;
+
+  IF NOT EXISTS (SELECT 1 FROM Transactions WHERE Reference = p_Reference) THEN
+    INSERT INTO Transactions (Num_Etudiant, Montant, Type, Commentaire, Reference)
+    VALUES (p_Num_Etudiant, p_Montant, 'CREDIT', p_Commentaire, p_Reference);
+  END IF;
+END $$
+
+-- Transfert des bonus en deux temps, autour de l'APDU de crédit carte :
+--   1. TransfererBonus réserve les bonus en attente (verrou FOR UPDATE,
+--      transaction courte) et renvoie l'identifiant et le montant exact
+--   2. ConfirmerTransfertBonus si la carte a été créditée,
+--      AnnulerTransfertBonus sinon (les bonus redeviennent disponibles)
+-- Deux bornes qui lisent le même étudiant se suivent : la seconde attend
+-- la fin de la réservation et ne trouve plus rien. Une réservation jamais
+-- close reste RESERVE : le bonus n'est pas perdu ni payé deux fois.
+-- Confirmer / annuler un transfert déjà dans cet état est sans effet
+-- (rejeu du journal de Berlicum).
+CREATE PROCEDURE TransfererBonus(
+  IN  p_Num_Etudiant CHAR(8),
+  OUT p_Id_Transfert BIGINT,
+  OUT p_Montant      DECIMAL(10,2)
+)
+BEGIN
+  DECLARE EXIT HANDLER FOR SQLEXCEPTION
+  BEGIN
+    ROLLBACK;
+    RESIGNAL;
+  END;
+
+  SET p_Id_Transfert = NULL;
+
+  START TRANSACTION;
+
+  SELECT COALESCE(SUM(Montant), 0) INTO p_Montant
+  FROM Transactions
+  WHERE Num_Etudiant = p_Num_Etudiant
+    AND Type = 'CREDIT'
+    AND Commentaire LIKE 'Bonus%'
+    AND Commentaire NOT LIKE '%transféré%'
+    AND Transfert_Bonus IS NULL
+  FOR UPDATE;
+
+  IF p_Montant > 0 THEN
+    INSERT INTO TransfertBonus (Num_Etudiant, Montant)
+    VALUES (p_Num_Etudiant, p_Montant);
+    SET p_Id_Transfert = LAST_INSERT_ID();
+
+    UPDATE Transactions
+      SET Transfert_Bonus = p_Id_Transfert
+      WHERE Num_Etudiant = p_Num_Etudiant
+        AND Type = 'CREDIT'
+        AND Commentaire LIKE 'Bonus%'
+        AND Commentaire NOT LIKE '%transféré%'
+        AND Transfert_Bonus IS NULL;
+  END IF;
+
+  COMMIT;
+END $$
+
+CREATE PROCEDURE ConfirmerTransfertBonus(
+  IN p_Id_Transfert BIGINT
+)
+BEGIN
+  DECLARE v_etat VARCHAR(10) DEFAULT NULL;
+  DECLARE EXIT HANDLER FOR SQLEXCEPTION
+  BEGIN
+    ROLLBACK;
+    RESIGNAL;
+  END;
+
+  START TRANSACTION;
+
+  SELECT Etat INTO v_etat
+  FROM TransfertBonus
+  WHERE id = p_Id_Transfert
+  FOR UPDATE;
+
+  IF v_etat IS NULL THEN
+    SIGNAL SQLSTATE '45000'
+      SET MESSAGE_TEXT = 'Transfert de bonus inexistant';
+  END IF;
+
+  IF v_etat = 'ANNULE' THEN
+    SIGNAL SQLSTATE '45000'
+      SET MESSAGE_TEXT = 'Transfert de bonus annulé';
+  END IF;
+
+  -- déjà confirmé (rejeu du journal de Berlicum) : rien à faire
+  IF v_etat = 'RESERVE' THEN
+    -- même marque que les transferts historiques (affichage, anciens outils)
+    UPDATE Transactions
+      SET Commentaire = LEFT(CONCAT(Commentaire, ' (transféré)'), 255)
+      WHERE Transfert_Bonus = p_Id_Transfert;
+
+    UPDATE TransfertBonus
+      SET Etat = 'CONFIRME', Date_Cloture = CURRENT_TIMESTAMP
+      WHERE id = p_Id_Transfert;
+  END IF;
+
+  COMMIT;
+END $$
+
+CREATE PROCEDURE AnnulerTransfertBonus(
+  IN p_Id_Transfert BIGINT
+)
+BEGIN
+  DECLARE v_etat VARCHAR(10) DEFAULT NULL;
+  DECLARE EXIT HANDLER FOR SQLEXCEPTION
+  BEGIN
+    ROLLBACK;
+    RESIGNAL;
+  END;
+
+  START TRANSACTION;
+
+  SELECT Etat INTO v_etat
+  FROM TransfertBonus
+  WHERE id = p_Id_Transfert
+  FOR UPDATE;
+
+  IF v_etat IS NULL THEN
+    SIGNAL SQLSTATE '45000'
+      SET MESSAGE_TEXT = 'Transfert de bonus inexistant';
+  END IF;
+
+  IF v_etat = 'CONFIRME' THEN
+    SIGNAL SQLSTATE '45000'
+      SET MESSAGE_TEXT = 'Transfert de bonus déjà confirmé';
+  END IF;
+
+  -- déjà annulé (rejeu du journal de Berlicum) : rien à faire
+  IF v_etat = 'RESERVE' THEN
+    UPDATE Transactions
+      SET Transfert_Bonus = NULL
+      WHERE Transfert_Bonus = p_Id_Transfert;
+
+    UPDATE TransfertBonus
+      SET Etat = 'ANNULE', Date_Cloture = CURRENT_TIMESTAMP
+      WHERE id = p_Id_Transfert;
+  END IF;
+
+  COMMIT;
+END $$
+
+-- Points de solde des étudiants qui ont de nouvelles transactions depuis
+-- le dernier passage (position 'points_solde' dans ConsommateurFlux).
+-- Pour chacun, reprise au dernier point : rang et solde cumulés dans
+-- l'ordre (Date_Transaction, id), un point toutes les 100 transactions.
+-- Seules les transactions de plus d'une minute sont prises : une
+-- transaction validée en retard ne peut pas s'insérer avant un point.
+CREATE PROCEDURE CreerPointsSolde()
+BEGIN
+  DECLARE v_depuis BIGINT DEFAULT 0;
+  DECLARE v_jusqu  BIGINT DEFAULT NULL;
+  DECLARE v_limite DATETIME DEFAULT (NOW() - INTERVAL 1 MINUTE);
+
+  SELECT COALESCE(MAX(Dernier_Id), 0) INTO v_depuis
+  FROM ConsommateurFlux
+  WHERE Nom = 'points_solde';
+
+  SELECT MAX(id) INTO v_jusqu
+  FROM Transactions
+  WHERE id > v_depuis
+    AND Date_Transaction < v_limite;
+
+  IF v_jusqu IS NOT NULL THEN
+    INSERT IGNORE INTO PointSolde (Num_Etudiant, Date_Transaction, Id_Transaction, Rang, Solde)
+    SELECT Num_Etudiant, Date_Transaction, id, Rang, Solde
+    FROM (
+      SELECT t.Num_Etudiant, t.Date_Transaction, t.id,
+             COALESCE(p.Rang, 0) + ROW_NUMBER() OVER w AS Rang,
+             COALESCE(p.Solde, 0)
+               + SUM(IF(t.Type = 'CREDIT', t.Montant, -t.Montant)) OVER w AS Solde
+      FROM (
+        SELECT DISTINCT Num_Etudiant
+        FROM Transactions
+        WHERE id > v_depuis AND id <= v_jusqu
+      ) e
+      LEFT JOIN LATERAL (
+        SELECT ps.Date_Transaction, ps.Id_Transaction, ps.Rang, ps.Solde
+        FROM PointSolde ps
+        WHERE ps.Num_Etudiant = e.Num_Etudiant
+        ORDER BY ps.Date_Transaction DESC, ps.Id_Transaction DESC
+        LIMIT 1
+      ) p ON TRUE
+      JOIN Transactions t
+        ON t.Num_Etudiant = e.Num_Etudiant
+       AND t.Date_Transaction < v_limite
+       AND (p.Rang IS NULL
+            OR t.Date_Transaction > p.Date_Transaction
+            OR (t.Date_Transaction = p.Date_Transaction AND t.id > p.Id_Transaction))
+      WINDOW w AS (PARTITION BY t.Num_Etudiant
+                   ORDER BY t.Date_Transaction, t.id
+                   ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW)
+    ) x
+    WHERE Rang % 100 = 0;
+
+    INSERT INTO ConsommateurFlux (Nom, Dernier_Id)
+    VALUES ('points_solde', v_jusqu)
+    ON DUPLICATE KEY UPDATE Dernier_Id = GREATEST(Dernier_Id, VALUES(Dernier_Id));
+  END IF;
+END $$
+
+-- Report des transactions du mode JOURNAL dans Compte, par lots de
+-- p_lot lignes (une transaction par lot). Les lignes du lot sont
+-- verrouillées puis copiées : une ligne validée pendant le report attend
+-- le lot suivant, elle n'est jamais marquée sans être reportée. En
+-- READ COMMITTED, sans verrou d'intervalle : les insertions continuent.
+CREATE PROCEDURE CompacterSoldes(IN p_lot INT)
+BEGIN
+  DECLARE v_nb INT DEFAULT 0;
+  DECLARE v_isolation VARCHAR(32) DEFAULT @@SESSION.transaction_isolation;
+  DECLARE EXIT HANDLER FOR SQLEXCEPTION
+  BEGIN
+    ROLLBACK;
+    SET SESSION transaction_isolation = v_isolation;
+    DROP TEMPORARY TABLE IF EXISTS tmp_compactage;
+    RESIGNAL;
+  END;
+
+  CREATE TEMPORARY TABLE IF NOT EXISTS tmp_compactage (
+    id           BIGINT        NOT NULL,
+    Num_Etudiant CHAR(8)       NOT NULL,
+    Delta        DECIMAL(10,2) NOT NULL,
+    PRIMARY KEY (id)
+  ) ENGINE=MEMORY;
+
+  -- niveau de session : modifiable même si l'appelant a une transaction ouverte
+  SET SESSION transaction_isolation = 'READ-COMMITTED';
+
+  REPEAT
+    START TRANSACTION;
+    DELETE FROM tmp_compactage;
+
+    INSERT INTO tmp_compactage (id, Num_Etudiant, Delta)
+    SELECT id, Num_Etudiant, IF(Type = 'CREDIT', Montant, -Montant)
+    FROM Transactions
+    WHERE Compacte = 0
+    ORDER BY Compacte, Num_Etudiant
+    LIMIT p_lot
+    FOR UPDATE;
+
+    SET v_nb = ROW_COUNT();
+
+    UPDATE Compte c
+    JOIN (
+      SELECT Num_Etudiant, SUM(Delta) AS Delta
+      FROM tmp_compactage
+      GROUP BY Num_Etudiant
+    ) d ON d.Num_Etudiant = c.Num_Etudiant
+    SET c.Solde_Actuel = c.Solde_Actuel + d.Delta;
+
+    UPDATE Transactions t
+    JOIN tmp_compactage x ON x.id = t.id
+    SET t.Compacte = 1;
+
+    COMMIT;
+  UNTIL v_nb < p_lot END REPEAT;
+
+  SET SESSION transaction_isolation = v_isolation;
+  DROP TEMPORARY TABLE IF EXISTS tmp_compactage;
 END $$
 
 DELIMITER ;
 
 -- =========================
--- Data: Agents uniquement
+-- Events
+-- =========================
+
+-- Les clés d'idempotence ne servent qu'aux nouvelles tentatives
+-- rapprochées : les réponses de plus d'un jour sont purgées. Une clé
+-- restée EN_COURS (borne arrêtée pendant la requête) expire au bout
+-- d'une heure : le client reçoit 409 jusque-là, puis sa requête est
+-- traitée à nouveau. Une réponse que la borne n'a pas pu enregistrer
+-- est rejouée depuis son journal bien avant.
+DROP EVENT IF EXISTS purge_requetes_idempotentes;
+
+CREATE EVENT purge_requetes_idempotentes
+  ON SCHEDULE EVERY 10 MINUTE
+  DO
+    DELETE FROM RequeteIdempotente
+    WHERE (Etat = 'TERMINEE' AND Date_Creation < NOW() - INTERVAL 1 DAY)
+       OR (Etat = 'EN_COURS' AND Date_Creation < NOW() - INTERVAL 1 HOUR);
+
+DROP EVENT IF EXISTS compactage_soldes;
+
+-- Sans effet en mode COMPTE (aucune ligne à compacter)
+CREATE EVENT compactage_soldes
+  ON SCHEDULE EVERY 1 MINUTE
+  DO
+    CALL CompacterSoldes(5000);
+
+DROP EVENT IF EXISTS points_solde;
+
+CREATE EVENT points_solde
+  ON SCHEDULE EVERY 10 MINUTE
+  DO
+    CALL CreerPointsSolde();
+
+-- =========================
+-- Data: paramètres et Agents
 -- =========================
 
+INSERT INTO Parametre (Cle, Valeur) VALUES ('mode_registre', 'COMPTE');
+
 INSERT INTO Agents (id, Identifiant, Nom, Prenom, Password_Hash, Role, Date_Creation) VALUES
 (1,'admin.uvsq','UVSQ','Admin','$2b$12$1na3/amynQF.0gV7b1yiIO4nCy1tcQS.wnDI6DVw9lq.z0mIqL5Lu','ADMIN','2025-11-25 11:20:18'),
 (2,'marina.krasnicki','KRASNICKI','Marina','$2b$12$1na3/amynQF.0gV7b1yiIO4nCy1tcQS.wnDI6DVw9lq.z0mIqL5Lu','AGENT','2025-11-25 11:24:41'),
@@ -4,8 +4,16 @@
 import smartcard.System as scardsys
 import smartcard.util as scardutil
 import smartcard.Exceptions as scardexcp
+from smartcard.CardRequest import CardRequest
 
 import mysql.connector
+import purple_dragon
+import perso_carte
+import registre_cartes
+import journal_operations
+import argparse
+import os
+import time
 from decimal import Decimal
 
 # =========================
@@ -23,6 +31,28 @@ DB_CONFIG = {
 cnx = None          # connexion MySQL
 conn_reader = None  # connexion lecteur de carte
 
+# Capacités annoncées par la carte dans l'ATR (voir rubro_v2.c)
+CAP_ETAT = 0x01     # 82 08 : solde + compteur + essais PIN + taille perso
+CAP_SESSION = 0x02  # 82 04 P1 : session PIN de P1 opérations
+
+# Taille de session demandée à la carte, et copie locale du nombre
+# d'opérations sensibles encore autorisées (la carte fait foi : 69 82
+# remet la copie à zéro)
+PIN_SESSION = 4
+pin_session = 0
+
+# Journal des opérations carte + BDD (voir journal_operations.py)
+journal = journal_operations.JournalOperations(
+    os.environ.get("BERLICUM_JOURNAL", "journal_operations_cli.jsonl"))
+
+# Registre des cartes (table Carte), voir registre_cartes.py
+registre = registre_cartes.RegistreCartes(
+    ttl_s=int(os.environ.get("BERLICUM_REGISTRE_TTL_S", "60")))
+
+# Mode borne (--kiosque) : étapes jouées à chaque insertion, dans l'ordre
+ETAPES_KIOSQUE = ("infos", "bonus", "compte")
+FLUX_KIOSQUE = os.environ.get("BERLICUM_FLUX", ",".join(ETAPES_KIOSQUE))
+
 
 # =========================
 #  INIT SMARTCARD / BDD
@@ -51,13 +81,20 @@ def init_smart_card():
 
 
 def init_db():
-    """Initialise la connexion MySQL."""
+    """
+    Initialise la connexion MySQL. BDD injoignable : la borne démarre
+    quand même (mode dégradé, fonctions carte seules) et verifier_db()
+    retente la connexion au prochain besoin.
+    """
     global cnx
     try:
-        cnx = mysql.connector.connect(**DB_CONFIG)
+        cnx = purple_dragon.connect(**DB_CONFIG)
+        return True
     except mysql.connector.Error as err:
         print("Erreur de connexion MySQL :", err)
-        exit(1)
+        print("Mode dégradé : la BDD sera recontactée au prochain besoin.")
+        cnx = None
+        return False
 
 
 # =========================
@@ -115,7 +152,8 @@ def print_version():
 def _read_perso_raw():
     """
     Lecture des données perso brutes (sans affichage).
-    Retourne la chaîne "num;nom;prenom" ou None.
+    Retourne la liste des octets (format historique "num;nom;prenom" ou
+    compact, voir perso_carte), "" si la carte n'est pas attribuée, ou None.
     
     CORRECTION : On garde TOUS les octets retournés par la carte,
     sans jeter le premier octet.
@@ -146,10 +184,8 @@ def _read_perso_raw():
     perso_bytes = data[:]
     if not perso_bytes:
         return ""
-    
-    # Conversion des octets en chaîne de caractères
-    perso_str = "".join(chr(b) for b in perso_bytes)
-    return perso_str
+
+    return perso_bytes
 
 
 def print_data():
@@ -162,61 +198,79 @@ def print_data():
         print("  Carte non attribuée : aucune donnée de personnalisation.\n")
         return
 
-    parts = perso.split(";")
-    num = parts[0].strip() if len(parts) > 0 else ""
-    nom = parts[1].strip() if len(parts) > 1 else ""
-    prenom = parts[2].strip() if len(parts) > 2 else ""
+    num, nom, prenom = perso_carte.decoder_perso(perso)
 
     print("  Numéro étudiant        : %s" % (num or "(inconnu)"))
     print("  Nom de l'étudiant(e)   : %s" % (nom or "(inconnu)"))
     print("  Prénom de l'étudiant(e): %s\n" % (prenom or "(inconnu)"))
 
 
+def identifier_carte():
+    """
+    Étudiant d'après le registre Carte (numéro de série 81 04, recherche
+    indexée gardée en cache) : (num, None) pour une carte active,
+    (None, message) pour une carte désactivée, (None, None) si la carte
+    est inconnue ou sans numéro de série (la perso fait foi).
+    """
+    try:
+        serie, err = perso_carte.lire_serie(conn_reader)
+    except scardexcp.CardConnectionException as e:
+        print("Erreur lecture numéro de série :", e)
+        return None, None
+    if serie is None:
+        return None, None
+    try:
+        carte = registre.resoudre(serie, lambda: cnx if verifier_db() else None)
+    except (mysql.connector.Error, ConnectionError) as e:
+        print("Registre des cartes indisponible :", e)
+        return None, None
+    if carte is None:
+        return None, None
+    if not carte["actif"]:
+        return None, "Carte désactivée : adressez-vous à l'accueil."
+    return carte["num"], None
+
+
 def get_student_number_from_card():
     """
-    Récupère le Num_Etudiant à partir de la perso.
-    Format attendu : 'num;nom;prenom'
+    Récupère le Num_Etudiant : registre Carte si la carte y est (None si
+    elle est désactivée), sinon 81 03 (4 octets BCD) si la carte le permet,
+    sinon à partir de la perso, dans l'un ou l'autre format.
     Retourne une chaîne CHAR(8) (zéro-pad, ex: '00000001') ou None.
     """
-    perso = _read_perso_raw()
-    if perso is None:
+    etu_num, refus = identifier_carte()
+    if refus:
+        print("[ERREUR] %s\n" % refus)
         return None
-    if perso == "":
-        print("[ERREUR] Carte non attribuée (pas de données perso).\n")
-        return None
-
-    parts = perso.split(";")
-    if len(parts) < 1:
-        print("[ERREUR] Format perso inattendu :", perso, "\n")
+    if etu_num is not None:
+        return etu_num
+    try:
+        etu_num, err = perso_carte.lire_num_etudiant(conn_reader)
+    except scardexcp.CardConnectionException as e:
+        print("Erreur lecture numéro étudiant :", e)
         return None
-
-    raw_num = parts[0].strip()
-    if not raw_num.isdigit():
-        print("[ERREUR] Numéro étudiant invalide dans la perso :", raw_num, "\n")
+    if err:
+        print("[ERREUR] %s\n" % err)
         return None
-
-    etu_num = raw_num.zfill(8)
     return etu_num
 
 
 def get_student_info_from_card():
-    """Retourne (Num_Etudiant, Nom, Prenom)."""
-    perso = _read_perso_raw()
-    if perso is None or perso == "":
+    """Retourne (Num_Etudiant, Nom, Prenom) ; le registre Carte prime sur la perso."""
+    num_registre, refus = identifier_carte()
+    if refus:
+        print("[ERREUR] %s\n" % refus)
         return None, None, None
 
-    parts = perso.split(";")
-    if len(parts) < 3:
+    perso = _read_perso_raw()
+    if perso is None or perso == "":
         return None, None, None
 
-    raw_num = parts[0].strip()
-    nom = parts[1].strip()
-    prenom = parts[2].strip()
-
-    if not raw_num.isdigit():
+    etu_num, nom, prenom = perso_carte.decoder_perso(perso)
+    if num_registre is not None:
+        etu_num = num_registre
+    if etu_num is None:
         return None, None, None
-
-    etu_num = raw_num.zfill(8)
     return etu_num, nom, prenom
 
 def _ask_pin_octets(message):
@@ -233,12 +287,20 @@ def _ask_pin_octets(message):
 
 
 def verify_pin_interactive():
+    """Demande le PIN et le vérifie auprès de la carte (verifier_pin)."""
+    return verifier_pin(_ask_pin_octets("PIN"))
+
+
+def verifier_pin(pin_bytes):
     """
     Vérifie le PIN auprès de la carte.
-    APDU : 82 04 00 00 04 [PIN(4 octets)]
+    APDU : 82 04 P1 00 04 [PIN(4 octets)]
+    P1 = PIN_SESSION si la carte gère les sessions, 0 sinon (une opération).
     """
-    pin_bytes = _ask_pin_octets("PIN")
-    apdu = [0x82, 0x04, 0x00, 0x00, 0x04] + pin_bytes
+    global pin_session
+    session = PIN_SESSION if card_capabilities() & CAP_SESSION else 0
+    apdu = [0x82, 0x04, session, 0x00, 0x04] + pin_bytes
+    pin_session = 0
 
     try:
         data, sw1, sw2 = conn_reader.transmit(apdu)
@@ -249,6 +311,7 @@ def verify_pin_interactive():
 
     if sw1 == 0x90 and sw2 == 0x00:
         print("PIN correct, authentification réussie.")
+        pin_session = session or 1
         return True
     elif sw1 == 0x63:
         print("PIN incorrect. Essais restants : %d" % sw2)
@@ -264,6 +327,36 @@ def verify_pin_interactive():
         return False
 
 
+def ensure_pin():
+    """
+    Garantit une session PIN ouverte pour la prochaine opération sensible :
+    le PIN n'est redemandé que si la session locale est épuisée.
+    """
+    if pin_session > 0:
+        return True
+    return verify_pin_interactive()
+
+
+def consume_pin(sw1, sw2):
+    """Décompte une opération sensible, d'après la réponse de la carte."""
+    global pin_session
+    if sw1 == 0x69 and sw2 == 0x82:
+        pin_session = 0
+    elif sw1 == 0x90 and sw2 == 0x00 and pin_session > 0:
+        pin_session -= 1
+
+
+def close_pin_session():
+    """Ferme la session PIN côté carte (82 04 FF 00 00)."""
+    global pin_session
+    if pin_session and card_capabilities() & CAP_SESSION:
+        try:
+            conn_reader.transmit([0x82, 0x04, 0xFF, 0x00, 0x00])
+        except scardexcp.CardConnectionException:
+            pass
+    pin_session = 0
+
+
 def read_counter():
     """
     Lecture du compteur anti-rejoue.
@@ -287,6 +380,42 @@ def read_counter():
     return ctr
 
 
+def card_capabilities():
+    """Capacités de la carte (ATR), 0 pour les anciennes cartes."""
+    return perso_carte.capacites(conn_reader)
+
+
+def read_state():
+    """
+    Lecture d'état groupée, en supposant PIN déjà vérifié.
+    APDU : 82 08 00 00 06
+    La session PIN n'est pas décomptée par la carte.
+    Retourne {solde, compteur, essais_pin, taille_perso} ou None.
+    """
+    apdu = [0x82, 0x08, 0x00, 0x00, 0x06]
+    try:
+        data, sw1, sw2 = conn_reader.transmit(apdu)
+        print("Lecture état - sw1 : 0x%02X | sw2 : 0x%02X" % (sw1, sw2))
+    except scardexcp.CardConnectionException as e:
+        print("error : ", e)
+        return None
+
+    if sw1 != 0x90 or sw2 != 0x00 or not data or len(data) < 6:
+        if sw1 == 0x69 and sw2 == 0x82:
+            consume_pin(sw1, sw2)
+            print("PIN non vérifié (security status not satisfied).")
+        else:
+            print("Erreur lors de la lecture de l'état de la carte.")
+        return None
+
+    return {
+        "solde": int(data[0]) | (int(data[1]) << 8),
+        "compteur": int(data[2]) | (int(data[3]) << 8),
+        "essais_pin": int(data[4]),
+        "taille_perso": int(data[5]),
+    }
+
+
 def _read_sold_core():
     """
     Lecture bas niveau du solde, en supposant PIN déjà vérifié.
@@ -300,6 +429,7 @@ def _read_sold_core():
     except scardexcp.CardConnectionException as e:
         print("error : ", e)
         return None
+    consume_pin(sw1, sw2)
 
     if sw1 != 0x90 or sw2 != 0x00:
         if sw1 == 0x69 and sw2 == 0x82:
@@ -319,11 +449,15 @@ def _read_sold_core():
 def read_sold():
     """Consultation du solde de la carte (avec vérif PIN)."""
     print("=== Consultation du solde carte ===")
-    if not verify_pin_interactive():
+    if not ensure_pin():
         print("Impossible de lire le solde : PIN non vérifié.")
         return
 
-    cents = _read_sold_core()
+    if card_capabilities() & CAP_ETAT:
+        state = read_state()
+        cents = state["solde"] if state else None
+    else:
+        cents = _read_sold_core()
     if cents is None:
         return
 
@@ -331,24 +465,56 @@ def read_sold():
     print("Solde disponible sur la carte : %.2f €" % euros)
 
 
-def credit_card_amount(euros_amount):
+def lire_compteur_solde():
+    """
+    (compteur, solde) de la carte, PIN vérifié ; None si illisible.
+    Sans 82 08, la lecture du solde (82 01) consomme la vérification du
+    PIN : la vérifier à nouveau avant une APDU sensible.
+    """
+    if card_capabilities() & CAP_ETAT:
+        state = read_state()
+        if not state:
+            return None, None
+        return state["compteur"], state["solde"]
+    ctr = read_counter()
+    if ctr is None:
+        return None, None
+    return ctr, _read_sold_core()
+
+
+def credit_card_amount(euros_amount, op=None):
     """
     Crédite la carte du montant 'euros_amount' (Decimal ou float).
     - Vérifie le PIN
-    - Lit le compteur
+    - Lit le compteur et le solde (sans l'état groupé 82 08, la lecture
+      du solde consomme le PIN : le même PIN est vérifié à nouveau)
+    - Journalise l'intention si op est fourni (journal.nouvelle_operation)
     - APDU 82 02 P1 P2 02 [montant_LSB][montant_MSB]
+    - Journalise l'issue : op["etape"] = 'carte' ou 'refus', reste
+      'intention' si la réponse de la carte est perdue
     """
     print("=== Crédit de la carte ===")
 
-    # 1) Vérif PIN
-    if not verify_pin_interactive():
+    # 1) Vérif PIN : sans état groupé, le PIN saisi sert deux fois
+    etat_groupe = card_capabilities() & CAP_ETAT
+    pin_bytes = None
+    if etat_groupe:
+        pin_ok = ensure_pin()       # sauf si la session en cours le couvre encore
+    else:
+        pin_bytes = _ask_pin_octets("PIN")
+        pin_ok = verifier_pin(pin_bytes)
+    if not pin_ok:
         print("Impossible de créditer : PIN non vérifié.")
         return False
 
-    # 2) Lecture compteur anti-rejoue
-    ctr = read_counter()
-    if ctr is None:
-        print("Impossible de créditer : compteur indisponible.")
+    # 2) Lecture compteur anti-rejoue et solde avant le crédit : une réponse
+    #    perdue reste décidable (journal.resoudre)
+    ctr, solde = lire_compteur_solde()
+    if ctr is None or solde is None:
+        print("Impossible de créditer : compteur ou solde indisponible.")
+        return False
+    if not etat_groupe and not verifier_pin(pin_bytes):
+        print("Impossible de créditer : PIN non vérifié.")
         return False
 
     # 3) Conversion du montant en centimes
@@ -369,12 +535,21 @@ def credit_card_amount(euros_amount):
 
     apdu = [0x82, 0x02, p1, p2, 0x02, montant_lsb, montant_msb]
 
+    # 4) Intention sur disque avant l'APDU
+    if op is not None:
+        journal.intention(op, ctr, solde)
+
     try:
         data, sw1, sw2 = conn_reader.transmit(apdu)
         print("Crédit - sw1 : 0x%02X | sw2 : 0x%02X" % (sw1, sw2))
     except scardexcp.CardConnectionException as e:
         print("error : ", e)
         return False
+    consume_pin(sw1, sw2)
+
+    if op is not None:
+        journal.etape(op, "carte" if (sw1, sw2) == (0x90, 0x00) else "refus",
+                      "SW %02X%02X" % (sw1, sw2))
 
     if sw1 == 0x90 and sw2 == 0x00:
         print("Crédit effectué : %.2f €" % (cents / 100.0))
@@ -404,19 +579,18 @@ def get_bonus_disponible(etu_num):
       - Type = 'CREDIT'
       - Commentaire commence par 'Bonus'
       - Commentaire ne contient pas encore 'transféré'
+      - pas de transfert en cours (Transfert_Bonus vide)
     """
     sql = """
         SELECT COALESCE(SUM(Montant), 0)
         FROM Transactions
         WHERE Num_Etudiant = %s
           AND Type = 'CREDIT'
-          AND Commentaire LIKE 'Bonus%%'
-          AND Commentaire NOT LIKE '%%transféré%%'
+          AND Commentaire LIKE 'Bonus%'
+          AND Commentaire NOT LIKE '%transféré%'
+          AND Transfert_Bonus IS NULL
     """
-    cursor = cnx.cursor()
-    cursor.execute(sql, (etu_num,))
-    row = cursor.fetchone()
-    cursor.close()
+    row = cnx.executer(sql, (etu_num,)).fetchone()
 
     if row is None or row[0] is None:
         return Decimal("0.00")
@@ -424,46 +598,87 @@ def get_bonus_disponible(etu_num):
     return Decimal(str(row[0]))
 
 
-def marquer_bonus_transfere(etu_num):
+def reserver_bonus(etu_num):
     """
-    Marque tous les bonus non transférés de cet étudiant comme 'transférés'
-    en suffixant le commentaire.
+    Réserve les bonus en attente de l'étudiant (procédure TransfererBonus).
 
-    On reste dans la table Transactions (aucun changement de schéma).
-    """
-    sql = """
-        UPDATE Transactions
-        SET Commentaire = CONCAT(Commentaire, ' (transféré)')
-        WHERE Num_Etudiant = %s
-          AND Type = 'CREDIT'
-          AND Commentaire LIKE 'Bonus%%'
-          AND Commentaire NOT LIKE '%%transféré%%'
+    La procédure verrouille ces bonus (SELECT ... FOR UPDATE) le temps
+    d'une transaction courte et renvoie le montant exact réservé :
+    (id_transfert, montant), ou (None, 0) s'il n'y a rien à transférer.
     """
     cursor = cnx.cursor()
-    cursor.execute(sql, (etu_num,))
-    cnx.commit()
-    nb = cursor.rowcount
+    res = cursor.callproc("TransfererBonus", [etu_num, 0, Decimal("0.00")])
     cursor.close()
-    return nb
+    return res[1], Decimal(str(res[2] or 0))
 
 
-def debiter_compte_recharge(etu_num, montant):
-    """
-    Crédite le compte en BDD (fonds propres) via la procédure CrediterCompte.
-    Commentaire : 'Recharge CB Berlicum'.
-    """
+def annuler_transfert_bonus(id_transfert):
+    """Rend une réservation de bonus quand la carte n'a pas été sollicitée."""
     try:
         cursor = cnx.cursor()
-        cursor.callproc("CrediterCompte", [etu_num, float(montant), "Recharge CB Berlicum"])
-        cnx.commit()
+        cursor.callproc("AnnulerTransfertBonus", [id_transfert])
         cursor.close()
-        print(f"Compte BDD crédité de {montant:.2f} € pour {etu_num}.")
+    except mysql.connector.Error as e:
+        print(f"ERREUR BDD (annulation du transfert n°{id_transfert}) :", e)
+
+
+def terminer_operation(op):
+    """
+    Étape BDD d'une opération dont la carte a répondu : crédit du compte
+    (CrediterCompteReference), confirmation ou annulation du transfert
+    de bonus. En cas d'erreur l'opération reste dans le journal et sera
+    rejouée (recuperer_journal).
+    """
+    if op.get("etape") not in ("carte", "refus"):
+        return False
+    if not verifier_db():
+        print("BDD indisponible : écriture différée, elle sera rejouée automatiquement.")
+        return False
+    try:
+        journal.appliquer_bdd(op, cnx)
         return True
     except mysql.connector.Error as e:
-        print("ERREUR : la carte a été créditée, mais le crédit BDD a échoué :", e)
+        print("ERREUR BDD : écriture différée, elle sera rejouée automatiquement :", e)
         return False
 
 
+def trancher_operations(etu_num):
+    """
+    Opérations de cet étudiant dont la réponse de la carte a été perdue :
+    tranchées avec le compteur et le solde relus avant toute nouvelle
+    opération, puis étape BDD. Aucun échange carte s'il n'y en a pas.
+    """
+    if not any(op.get("etape") == "intention" and op.get("etu") == etu_num
+               for op in journal.en_cours()):
+        return
+    print("Opération précédente interrompue : vérification sur la carte.")
+    if not ensure_pin():
+        return
+    ctr, solde = lire_compteur_solde()
+    if ctr is None:
+        return
+    journal.resoudre(etu_num, ctr, solde)
+    for op in journal.en_cours():
+        if op.get("etu") == etu_num:
+            terminer_operation(op)
+
+
+def recuperer_journal():
+    """Rejoue les étapes BDD interrompues (au lancement et après chaque commande)."""
+    if not journal.a_rejouer():
+        journal.compacter()     # seulement si une opération est arrivée à 'fin'
+        return
+    if not verifier_db():
+        return
+    try:
+        nb = journal.recuperer(cnx)
+    except Exception as e:
+        print("Journal des opérations : rejeu impossible :", e)
+        return
+    if nb:
+        print(f"Journal des opérations : {nb} écriture(s) BDD rejouée(s).")
+
+
 # =========================
 #  LOGIQUE BERLICUM
 # =========================
@@ -475,7 +690,9 @@ def consulter_et_transferer_bonus():
       (Transactions.Type='CREDIT' & Commentaire 'Bonus...' pas encore 'transféré')
     - Affiche ce montant
     - Propose de le transférer sur la carte
-    - Si OK : crédite la carte puis marque ces bonus comme transférés en BDD
+    - Si OK : réserve les bonus (TransfererBonus), crédite la carte puis
+      confirme le transfert (ou l'annule si le crédit échoue), chaque
+      étape étant journalisée (journal_operations)
     """
     print("=== Consultation / Transfert des bonus BDD -> carte ===")
 
@@ -485,6 +702,9 @@ def consulter_et_transferer_bonus():
 
     print(f"Numéro étudiant trouvé sur la carte : {etu_num}")
 
+    if not verifier_db():
+        print("BDD indisponible, réessayez plus tard.")
+        return
     montant_bonus = get_bonus_disponible(etu_num)
     if montant_bonus <= 0:
         print("Aucun bonus disponible en base pour cet étudiant.")
@@ -497,14 +717,33 @@ def consulter_et_transferer_bonus():
         print("Transfert annulé.")
         return
 
+    trancher_operations(etu_num)
+
+    # Réservation : le montant crédité est exactement celui des bonus
+    # verrouillés, même si un bonus a été accordé depuis l'affichage
+    try:
+        id_transfert, montant_bonus = reserver_bonus(etu_num)
+    except mysql.connector.Error as e:
+        print("ERREUR BDD lors de la réservation des bonus :", e)
+        return
+    if id_transfert is None or montant_bonus <= 0:
+        print("Les bonus ne sont plus disponibles (transférés depuis une autre borne ?).")
+        return
+
     # Créditer la carte
-    if not credit_card_amount(montant_bonus):
+    op = journal.nouvelle_operation(journal_operations.BONUS, etu_num,
+                                    int((montant_bonus * 100).to_integral_value()), ref=id_transfert)
+    if not credit_card_amount(montant_bonus, op):
+        if "etape" not in op:
+            annuler_transfert_bonus(id_transfert)
+        else:
+            terminer_operation(op)
         print("Transfert annulé suite à une erreur de crédit sur la carte.")
         return
 
-    # Mise à jour BDD : marquer bonus comme transférés
-    nb = marquer_bonus_transfere(etu_num)
-    print(f"Bonus transférés en base de données (lignes mises à jour : {nb}).")
+    # Mise à jour BDD : confirmer le transfert
+    if terminer_operation(op):
+        print(f"Bonus transférés : {montant_bonus:.2f} € (transfert n°{id_transfert}).")
 
 
 # =========================
@@ -528,6 +767,9 @@ def consulter_mes_bonus():
     etu_num = get_student_number_from_card()
     if etu_num is None:
         return
+    if not verifier_db():
+        print("BDD indisponible, réessayez plus tard.")
+        return
     montant = get_bonus_disponible(etu_num)
     print(f"Bonus disponibles pour {etu_num} : {montant:.2f} €")
 
@@ -539,8 +781,8 @@ def recharger_avec_cb():
     Logique :
       - lit Num_Etudiant sur la carte
       - demande un montant
-      - crédite la carte (APDU)
-      - crédite la BDD via CrediterCompte
+      - crédite la carte (APDU), intention et issue journalisées
+      - crédite la BDD via CrediterCompteReference (rejouable)
     """
     print("=== Recharge par carte bancaire ===")
     etu_num = get_student_number_from_card()
@@ -565,22 +807,185 @@ def recharger_avec_cb():
         print("Recharge annulée.")
         return
 
+    trancher_operations(etu_num)
+
     # 1) Créditer la carte
-    if not credit_card_amount(montant):
+    op = journal.nouvelle_operation(journal_operations.RECHARGE, etu_num,
+                                    int((montant * 100).to_integral_value()))
+    if not credit_card_amount(montant, op):
+        terminer_operation(op)
         print("Recharge annulée suite à une erreur de crédit sur la carte.")
         return
 
     # 2) Créditer la BDD
-    debiter_compte_recharge(etu_num, montant)
+    if terminer_operation(op):
+        print(f"Compte BDD crédité de {montant:.2f} € pour {etu_num}.")
+
+
+# =========================
+#  MODE BORNE (KIOSQUE)
+# =========================
+
+def get_bonus_et_solde_compte(etu_num):
+    """
+    (bonus disponibles, solde du compte BDD) en un seul aller-retour ;
+    solde None si l'étudiant n'a pas de compte.
+    """
+    sql = """
+        SELECT (SELECT COALESCE(SUM(Montant), 0)
+                FROM Transactions
+                WHERE Num_Etudiant = %s
+                  AND Type = 'CREDIT'
+                  AND Commentaire LIKE 'Bonus%'
+                  AND Commentaire NOT LIKE '%transféré%'
+                  AND Transfert_Bonus IS NULL),
+               SoldeCompte(%s)
+    """
+    bonus, solde = cnx.executer(sql, (etu_num, etu_num)).fetchone()
+    return (Decimal(str(bonus or 0)),
+            Decimal(str(solde)) if solde is not None else None)
+
+
+def verifier_db():
+    """
+    Garde la connexion MySQL du processus : ping, et reconnexion de la
+    même connexion seulement si le serveur l'a fermée (un seul essai, sans
+    attente : la carte suivante retentera). Sans connexion (lancement en
+    mode dégradé), nouvelle connexion.
+    """
+    if cnx is None:
+        return init_db()
+    try:
+        cnx.ping(reconnect=True, attempts=1, delay=0)
+        return True
+    except mysql.connector.Error as e:
+        print("BDD indisponible :", e)
+        return False
+
+
+def attendre_carte(nouvelle):
+    """
+    Bloque jusqu'à la présence d'une carte dans le premier lecteur et s'y
+    connecte. nouvelle=True ignore la carte déjà insérée : elle doit être
+    retirée (ou remplacée) avant le prochain passage.
+    """
+    global conn_reader, pin_session
+    if conn_reader is not None:
+        try:
+            conn_reader.disconnect()
+        except scardexcp.SmartcardException:
+            pass
+        conn_reader = None
+    pin_session = 0
+
+    while True:
+        try:
+            lst_readers = scardsys.readers()
+        except scardexcp.SmartcardException as e:
+            lst_readers = []
+            print("Erreur lecteurs :", e)
+        if lst_readers:
+            break
+        time.sleep(1)
+
+    requete = CardRequest(readers=[lst_readers[0]], timeout=None, newcardonly=nouvelle)
+    service = requete.waitforcard()
+    try:
+        service.connection.connect()
+    except scardexcp.SmartcardException as e:
+        print("Carte retirée pendant la connexion :", e)
+        return False
+    conn_reader = service.connection
+    return True
+
+
+def servir_carte(etapes):
+    """Étapes du mode borne pour la carte insérée (aucune saisie, pas de PIN)."""
+    if "infos" in etapes:
+        etu_num, nom, prenom = get_student_info_from_card()
+    else:
+        # 81 03 : 4 octets au lieu de la perso complète
+        etu_num, nom, prenom = get_student_number_from_card(), None, None
+    if etu_num is None:
+        print("Carte illisible ou non attribuée.")
+        return
+
+    bonus = solde = None
+    if ("bonus" in etapes or "compte" in etapes) and verifier_db():
+        try:
+            bonus, solde = get_bonus_et_solde_compte(etu_num)
+        except mysql.connector.Error as e:
+            print("ERREUR BDD :", e)
+
+    print("=============================================")
+    for etape in etapes:
+        if etape == "infos":
+            print(f"  Numéro étudiant : {etu_num}")
+            print(f"  Nom             : {nom}")
+            print(f"  Prénom          : {prenom}")
+        elif etape == "bonus":
+            print("  Bonus disponibles : %s" % (f"{bonus:.2f} €" if bonus is not None else "indisponible"))
+        elif etape == "compte":
+            if solde is None:
+                print("  Solde du compte   : %s" % ("aucun compte" if bonus is not None else "indisponible"))
+            else:
+                print(f"  Solde du compte   : {solde:.2f} €")
+    print("=============================================")
+
+
+def boucle_kiosque(etapes):
+    """
+    Borne sans clavier : attend chaque insertion, joue les étapes, puis
+    attend la carte suivante. Le processus et sa connexion BDD servent
+    toutes les cartes ; la carte présente au lancement est servie aussi.
+    """
+    print_hello_message()
+    print("Mode borne : " + ", ".join(etapes))
+    nouvelle = False
+    while True:
+        print("\nInsérez votre carte...")
+        try:
+            if not attendre_carte(nouvelle):
+                continue
+        except KeyboardInterrupt:
+            print("\nArrêt de la borne.")
+            break
+        nouvelle = True
+        debut = time.monotonic()
+        try:
+            print("ATR : ", scardutil.toHexString(conn_reader.getATR()))
+            servir_carte(etapes)
+        except scardexcp.SmartcardException as e:
+            print("Carte retirée pendant la lecture :", e)
+        print("(%.0f ms)" % ((time.monotonic() - debut) * 1000))
 
 
 # =========================
 #  MAIN LOOP
 # =========================
 
-def main():
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="berlicum.py",
+                                     description="Borne de recharge Berlicum")
+    parser.add_argument("--kiosque", action="store_true",
+                        help="mode borne sans clavier : une lecture par insertion de carte")
+    parser.add_argument("--flux", default=FLUX_KIOSQUE,
+                        help="étapes du mode borne, parmi %s (%s)"
+                             % (", ".join(ETAPES_KIOSQUE), FLUX_KIOSQUE))
+    args = parser.parse_args(argv)
+
+    if args.kiosque:
+        etapes = [e.strip() for e in args.flux.split(",") if e.strip()]
+        inconnues = [e for e in etapes if e not in ETAPES_KIOSQUE]
+        if inconnues or not etapes:
+            parser.error("étapes inconnues : %s" % ", ".join(inconnues or [args.flux]))
+        init_db()
+        boucle_kiosque(etapes)
+        return
+
     init_smart_card()
     init_db()
+    recuperer_journal()
     print_hello_message()
 
     while True:
@@ -602,11 +1007,14 @@ def main():
         elif cmd == 5:
             recharger_avec_cb()
         elif cmd == 6:
+            close_pin_session()
             print("Au revoir.")
             break
         else:
             print("Commande inconnue !")
 
+        recuperer_journal()
+
         try:
             input("\nAppuyez sur Entrée pour revenir au menu...")
         except KeyboardInterrupt:
@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Berlicum ASGI - variante asynchrone de la borne
+-----------------------------------------------
+Mêmes routes et même page que berlicum_web.py, servies par Quart
+(API de Flask, sur une boucle asyncio) :
+
+    hypercorn berlicum_asgi:app --bind 0.0.0.0:5000
+
+Les fonctions carte et BDD de berlicum_web sont réutilisées telles
+quelles, mais aucune ne tourne sur la boucle :
+- carte : un thread dédié par lecteur (Berlicum n'en pilote qu'un, le
+  premier) ; les APDU restent strictement en série
+- BDD : un groupe de BERLICUM_BDD_THREADS threads et un pool de
+  connexions mysql.connector de la même taille (plus une marge pour les
+  EXPLAIN de purple_dragon) : plus de connect() bloquant par requête
+
+Comme berlicum_web, la borne suit les insertions (CardMonitor) : la
+perso est lue (sur le thread du lecteur) et la BDD interrogée dès
+l'insertion, avant que la page ne sonde /api/infos.
+
+Chaque requête a un délai (par route, réductible par l'en-tête
+X-Timeout-Ms) : au-delà, la borne reçoit 504 et la boucle est libérée.
+Un échange carte déjà parti n'est jamais interrompu (une APDU coupée
+laisserait la carte dans un état inconnu) : pour la recharge et le
+transfert de bonus, l'opération continue en arrière-plan, l'étape BDD
+reste couverte par le journal des opérations, et la réponse finale est
+enregistrée sous la clé d'idempotence (un nouvel essai avec la même clé
+reçoit 409 tant qu'elle tourne, puis cette réponse).
+"""
+
+import asyncio
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+from quart import Quart, request, jsonify
+
+import journal_operations
+import berlicum_web as bw
+
+BDD_THREADS = int(os.environ.get("BERLICUM_BDD_THREADS", "8"))
+
+# délais par défaut (secondes) : lectures simples, PIN, opérations
+DELAI_LECTURE_S = 5
+DELAI_PIN_S = 10
+DELAI_OPERATION_S = 20
+
+# pool de connexions : get_db_connection() de berlicum_web passe par
+# purple_dragon.connect(**DB_CONFIG), qui transmet pool_name / pool_size
+bw.DB_CONFIG.update(pool_name="berlicum_asgi", pool_size=BDD_THREADS + 4)
+
+# journal distinct de celui de berlicum_web (un seul écrivain par fichier)
+bw.journal = journal_operations.JournalOperations(
+    os.environ.get("BERLICUM_JOURNAL", "journal_operations_asgi.jsonl"))
+
+_executeur_carte = ThreadPoolExecutor(max_workers=1, thread_name_prefix="carte")
+_executeur_bdd = ThreadPoolExecutor(max_workers=BDD_THREADS, thread_name_prefix="bdd")
+
+# préchargement à l'insertion : en série avec les autres APDU ; sa tâche
+# est gardée dans la session pour que /api/infos l'attende sur la boucle
+def _lancer_prechargement(session):
+    session['tache'] = _executeur_carte.submit(bw.prechargement_carte, session)
+
+bw.lancer_prechargement = _lancer_prechargement
+
+# opérations qui continuent après un 504 (gardées jusqu'à leur fin)
+_en_arriere_plan = set()
+
+app = Quart(__name__)
+
+
+# =========================
+#  EXÉCUTEURS
+# =========================
+
+async def carte(fonction, *args):
+    """Exécute une fonction carte de berlicum_web sur le thread du lecteur."""
+    return await asyncio.get_running_loop().run_in_executor(_executeur_carte, fonction, *args)
+
+
+async def bdd(fonction, *args):
+    """Exécute une fonction BDD de berlicum_web sur le groupe de threads BDD."""
+    return await asyncio.get_running_loop().run_in_executor(_executeur_bdd, fonction, *args)
+
+
+def delai(defaut_s):
+    """Délai de la requête : celui de la route, ou moins via X-Timeout-Ms."""
+    try:
+        demande = int(request.headers.get("X-Timeout-Ms", "")) / 1000.0
+    except ValueError:
+        return defaut_s
+    return max(0.1, min(demande, defaut_s))
+
+
+def reponse(corps, code=200):
+    return jsonify(corps), code
+
+
+async def avec_delai(coro, defaut_s):
+    """Réponse de coro, ou 504 si le délai expire (coro est alors annulée)."""
+    try:
+        return await asyncio.wait_for(coro, delai(defaut_s))
+    except asyncio.TimeoutError:
+        return {'success': False, 'message': 'Délai dépassé, réessayez'}, 504
+
+
+async def prechargement_pret(session):
+    """
+    Attend la fin du préchargement (au plus DELAI_PRECHARGEMENT_S) sur la
+    boucle, sans occuper de thread BDD. False si le délai expire.
+    """
+    tache = session.get('tache')
+    if tache is None:   # session publiée, tâche pas encore soumise
+        return session['pret'].is_set()
+    try:
+        # shield : le délai n'annule pas un préchargement encore en file
+        await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(tache)),
+                               bw.DELAI_PRECHARGEMENT_S)
+    except asyncio.TimeoutError:
+        return False
+    except Exception:
+        pass
+    return session['pret'].is_set()
+
+
+# =========================
+#  TRAITEMENTS
+# =========================
+
+async def infos():
+    # carte suivie depuis son insertion (voir bw.prechargement_carte)
+    session = bw.session_active()
+    if session is not None and await prechargement_pret(session):
+        if session['refus']:
+            return {'success': False, 'message': session['refus'], 'refusee': True}, 200
+        if session['num'] is not None:
+            return {'success': True, 'num_etudiant': session['num'], 'nom': session['nom'],
+                    'prenom': session['prenom'], **bw.donnees_prechargees(session)}, 200
+
+    etu_num, nom, prenom = await carte(bw.get_student_info_from_card)
+    if etu_num is None:
+        return {'success': False, 'message': 'Erreur lecture carte'}, 200
+    return {'success': True, 'num_etudiant': etu_num, 'nom': nom, 'prenom': prenom}, 200
+
+
+async def bonus():
+    session = bw.session_active()
+    futur = session.get('bonus') if session is not None else None
+    if futur is not None:
+        montant = await asyncio.wrap_future(futur)
+        if montant is not None:
+            return {'success': True, 'montant': f"{montant:.2f}"}, 200
+
+    etu_num = await carte(bw.get_student_number_from_card)
+    if etu_num is None:
+        return {'success': False, 'message': 'Erreur lecture carte'}, 200
+    montant = await bdd(bw.get_bonus_disponible, etu_num)
+    if montant is None:
+        return {'success': False, 'message': 'Erreur BDD'}, 200
+    return {'success': True, 'montant': f"{montant:.2f}"}, 200
+
+
+def _lire_solde(pin):
+    """Séquence carte de /api/solde (un seul passage sur le thread du lecteur)."""
+    ok, msg = bw.verify_pin(pin)
+    if not ok:
+        return None, msg
+    if bw.card_capabilities() & bw.CAP_ETAT:
+        state = bw.read_state()
+        return (state['solde'] if state else None), 'Erreur lecture solde'
+    return bw._read_sold_core(), 'Erreur lecture solde'
+
+
+async def solde(data):
+    pin = data.get('pin')
+    if not pin:
+        return {'success': False, 'message': 'PIN requis'}, 200
+    cents, msg = await carte(_lire_solde, pin)
+    if cents is None:
+        return {'success': False, 'message': msg}, 200
+    return {'success': True, 'solde': f"{cents/100.0:.2f}"}, 200
+
+
+def _identifier(pin):
+    """
+    Début de séquence carte des opérations : numéro étudiant, puis
+    opérations interrompues de cet étudiant tranchées (avec le PIN).
+    """
+    etu_num = bw.get_student_number_from_card()
+    if etu_num is not None:
+        bw.trancher_operations(etu_num, pin)
+        bw.invalider_prechargement()
+    return etu_num
+
+
+def _crediter(type_op, etu_num, montant, pin, ref=None):
+    """Séquence carte du crédit : opération ouverte au journal, puis crédit."""
+    op = bw.journal.nouvelle_operation(type_op, etu_num, bw.en_centimes(montant), ref=ref)
+    ok, msg = bw.credit_card_amount(montant, pin, op)
+    return op, ok, msg
+
+
+def _sequence_recharge(montant, pin):
+    """Séquence carte complète de /api/recharge (un seul passage)."""
+    etu_num = _identifier(pin)
+    if etu_num is None:
+        return None, False, 'Erreur lecture carte'
+    return _crediter(journal_operations.RECHARGE, etu_num, montant, pin)
+
+
+async def transfert_bonus(data):
+    pin = data.get('pin')
+    if not pin:
+        return {'success': False, 'message': 'PIN requis'}, 200
+
+    # deux séquences carte, séparées par la réservation des bonus en BDD
+    etu_num = await carte(_identifier, pin)
+    if etu_num is None:
+        return {'success': False, 'message': 'Erreur lecture carte'}, 200
+
+    id_transfert, montant = await bdd(bw.reserver_bonus, etu_num)
+    if montant is None:
+        return {'success': False, 'message': 'Erreur BDD'}, 200
+    if id_transfert is None or montant <= 0:
+        return {'success': False, 'message': 'Aucun bonus disponible'}, 200
+
+    op, ok, msg = await carte(_crediter, journal_operations.BONUS, etu_num, montant,
+                              pin, id_transfert)
+    if not ok:
+        if 'etape' not in op:
+            await bdd(bw.annuler_transfert_bonus, id_transfert)
+        else:
+            await bdd(bw.terminer_operation, op)
+        return {'success': False, 'message': msg}, 200
+
+    if not await bdd(bw.terminer_operation, op):
+        return {'success': True,
+                'message': f"Transfert réussi: {montant:.2f} € (transfert n°{id_transfert}, "
+                           f"enregistrement BDD différé)"}, 200
+    return {'success': True,
+            'message': f"Transfert réussi: {montant:.2f} € (transfert n°{id_transfert})"}, 200
+
+
+async def recharge(data):
+    montant_str = data.get('montant')
+    pin = data.get('pin')
+    if not pin:
+        return {'success': False, 'message': 'PIN requis'}, 200
+    if not montant_str:
+        return {'success': False, 'message': 'Montant requis'}, 200
+    try:
+        montant = Decimal(montant_str)
+        if montant <= 0:
+            return {'success': False, 'message': 'Montant invalide'}, 200
+    except Exception:
+        return {'success': False, 'message': 'Montant invalide'}, 200
+
+    op, ok, msg = await carte(_sequence_recharge, montant, pin)
+    if op is None:
+        return {'success': False, 'message': msg}, 200
+    if not ok:
+        await bdd(bw.terminer_operation, op)
+        return {'success': False, 'message': msg}, 200
+
+    if not await bdd(bw.terminer_operation, op):
+        return {'success': True,
+                'message': f"Recharge réussie: {montant:.2f} € (enregistrement BDD différé)"}, 200
+    return {'success': True, 'message': f"Recharge réussie: {montant:.2f} €"}, 200
+
+
+async def operation_idempotente(traitement, data):
+    """
+    Recharge / transfert : clé d'idempotence comme berlicum_web.idempotent,
+    et traitement protégé de l'annulation. Au-delà du délai, la borne
+    reçoit 504 ; le traitement continue et sa réponse est enregistrée
+    sous la clé pour le prochain essai.
+
+    Comme berlicum_web : BDD injoignable, traitement sans clé ; réponse
+    impossible à enregistrer, elle passe par le journal ; exception, la
+    clé n'est rendue que si le compteur de la carte n'a pas bougé.
+    """
+    cle = request.headers.get('Idempotency-Key')
+    if cle:
+        if not bw.CLE_IDEMPOTENCE.match(cle):
+            return {'success': False, 'message': "Clé d'idempotence invalide"}, 400
+        etat, enregistree = await bdd(bw.reserver_cle_idempotence, cle, request.path,
+                                      bw.empreinte_requete(request.path, data))
+        if etat == 'terminee':
+            code, corps = enregistree
+            return json.loads(corps), code or 200
+        if etat == 'en_cours':
+            return {'success': False, 'message': 'Opération déjà en cours, patientez'}, 409
+        if etat == 'conflit':
+            return {'success': False, 'message': "Clé d'idempotence déjà utilisée"}, 422
+        if etat == 'erreur':
+            print(f"[DEBUG] operation_idempotente: BDD injoignable, {request.path} traitée sans clé")
+            cle = None
+
+    async def executer():
+        ctr_avant = await carte(bw.read_counter) if cle else None
+        try:
+            corps, code = await traitement(data)
+        except Exception:
+            # carte créditée : la clé reste EN_COURS jusqu'à la purge
+            if ctr_avant is not None and await carte(bw.read_counter) == ctr_avant:
+                await bdd(bw.liberer_cle_idempotence, cle)
+            raise
+        if cle:
+            texte = json.dumps(corps, ensure_ascii=False)
+            if not await bdd(bw.terminer_cle_idempotence, cle, code, texte):
+                bw.journal.reponse(cle, code, texte)
+        return corps, code
+
+    tache = asyncio.ensure_future(executer())
+    _en_arriere_plan.add(tache)
+    tache.add_done_callback(_en_arriere_plan.discard)
+    # shield : le délai et la déconnexion du client n'annulent que l'attente
+    return await avec_delai(asyncio.shield(tache), DELAI_OPERATION_S)
+
+
+# =========================
+#  RÉCUPÉRATION DU JOURNAL
+# =========================
+
+async def _boucle_recuperation():
+    while True:
+        try:
+            await bdd(bw.recuperer_journal)
+        except Exception as e:
+            print(f"Erreur recuperer_journal: {e}")
+        await asyncio.sleep(bw.RECUPERATION_S)
+
+
+@app.before_serving
+async def demarrer():
+    app.add_background_task(_boucle_recuperation)
+    bw.demarrer_surveillance_carte()
+
+
+@app.after_serving
+async def arreter():
+    _executeur_carte.shutdown(wait=False)
+    _executeur_bdd.shutdown(wait=False)
+
+
+# =========================
+#  ROUTES
+# =========================
+
+@app.route('/')
+async def index():
+    return bw.HTML_TEMPLATE
+
+@app.route('/api/bdd/etat')
+async def api_bdd_etat():
+    return reponse(*bw.etat_bdd())
+
+@app.route('/api/infos')
+async def api_infos():
+    return reponse(*await avec_delai(infos(), DELAI_LECTURE_S))
+
+@app.route('/api/bonus')
+async def api_bonus():
+    return reponse(*await avec_delai(bonus(), DELAI_LECTURE_S))
+
+@app.route('/api/solde', methods=['POST'])
+async def api_solde():
+    data = await request.get_json(silent=True) or {}
+    return reponse(*await avec_delai(solde(data), DELAI_PIN_S))
+
+@app.route('/api/transfert_bonus', methods=['POST'])
+async def api_transfert_bonus():
+    data = await request.get_json(silent=True) or {}
+    return reponse(*await operation_idempotente(transfert_bonus, data))
+
+@app.route('/api/recharge', methods=['POST'])
+async def api_recharge():
+    data = await request.get_json(silent=True) or {}
+    return reponse(*await operation_idempotente(recharge, data))
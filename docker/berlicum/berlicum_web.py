@@ -3,9 +3,23 @@
 
 from flask import Flask, render_template_string, request, jsonify
 import smartcard.System as scardsys
+from smartcard.CardMonitoring import CardMonitor, CardObserver
 import mysql.connector
+from mysql.connector import errorcode
+import purple_dragon
+import perso_carte
+import registre_cartes
+import journal_operations
+from concurrent.futures import ThreadPoolExecutor
 from decimal import Decimal
+import functools
+import hashlib
+import json
+import os
+import re
 import secrets
+import threading
+import time
 
 app = Flask(__name__)
 app.secret_key = secrets.token_hex(32)
@@ -24,6 +38,23 @@ DB_CONFIG = {
 
 conn_reader = None
 
+# Capacités annoncées par la carte dans l'ATR (voir rubro_v2.c)
+CAP_ETAT = 0x01  # 82 08 : solde + compteur + essais PIN + taille perso
+
+# Clé d'idempotence envoyée par la page (en-tête Idempotency-Key)
+CLE_IDEMPOTENCE = re.compile(r"^[A-Za-z0-9_-]{16,64}$")
+
+# Journal des opérations carte + BDD (voir journal_operations.py) et
+# période du rejeu des étapes BDD interrompues
+journal = journal_operations.JournalOperations(
+    os.environ.get("BERLICUM_JOURNAL", "journal_operations_web.jsonl"))
+RECUPERATION_S = int(os.environ.get("BERLICUM_RECUPERATION_S", "60"))
+
+# Registre des cartes (table Carte) : cache local du numéro de série vers
+# l'étudiant, rafraîchi au plus tard après BERLICUM_REGISTRE_TTL_S secondes
+registre = registre_cartes.RegistreCartes(
+    ttl_s=int(os.environ.get("BERLICUM_REGISTRE_TTL_S", "60")))
+
 # =========================
 #  INIT SMARTCARD
 # =========================
@@ -56,7 +87,7 @@ def get_card_connection():
 def get_db_connection():
     """Obtient une connexion MySQL."""
     try:
-        cnx = mysql.connector.connect(**DB_CONFIG)
+        cnx = purple_dragon.connect(**DB_CONFIG)
         print(f"[DEBUG] Connexion MySQL OK vers {DB_CONFIG['host']} / {DB_CONFIG['database']}")
         return cnx
     except mysql.connector.Error as err:
@@ -68,7 +99,7 @@ def get_db_connection():
 # =========================
 
 def _read_perso_raw():
-    """Lecture des données perso brutes."""
+    """Lecture des données perso brutes (octets, l'un ou l'autre format)."""
     conn = get_card_connection()
     if not conn:
         print("[DEBUG] _read_perso_raw: pas de connexion carte")
@@ -102,39 +133,98 @@ def _read_perso_raw():
             print("[DEBUG] _read_perso_raw: perso_bytes vide après traitement")
             return ""
 
-        perso_str = "".join(chr(e) for e in perso_bytes)
-        print(f"[DEBUG] perso_str={repr(perso_str)}")
-        return perso_str
+        return perso_bytes
     except Exception as e:
         print(f"Erreur lecture perso: {e}")
         return None
 
-def get_student_info_from_card():
-    """Retourne (Num_Etudiant, Nom, Prenom)."""
+def identifier_carte():
+    """
+    Étudiant d'après le registre Carte (numéro de série 81 04, recherche
+    indexée gardée en cache) : (num, None) pour une carte active,
+    (None, message) pour une carte désactivée, (None, None) si la carte
+    n'a pas de numéro de série, n'est pas enregistrée ou si la BDD ne
+    répond pas : la perso fait alors foi.
+    """
+    conn = get_card_connection()
+    if not conn:
+        return None, None
+    try:
+        serie, err = perso_carte.lire_serie(conn)
+    except Exception as e:
+        print(f"Erreur lecture série: {e}")
+        return None, None
+    if serie is None:
+        if err:
+            print(f"[DEBUG] identifier_carte: {err}")
+        return None, None
+    try:
+        carte = registre.resoudre(serie, get_db_connection, fermer=True)
+    except Exception as e:
+        print(f"Erreur registre cartes ({serie}): {e}")
+        return None, None
+    print(f"[DEBUG] identifier_carte: serie={serie}, carte={carte}")
+    if carte is None:
+        return None, None
+    if not carte['actif']:
+        return None, "Carte désactivée, adressez-vous à l'accueil"
+    return carte['num'], None
+
+def get_student_info_from_card(identification=None):
+    """
+    Retourne (Num_Etudiant, Nom, Prenom). identification : résultat
+    d'identifier_carte() s'il est déjà connu.
+    """
+    num_registre, refus = identification or identifier_carte()
+    if refus:
+        print(f"[DEBUG] get_student_info_from_card: {refus}")
+        return None, None, None
+
     perso = _read_perso_raw()
     print(f"[DEBUG] get_student_info_from_card: perso={repr(perso)}")
     if perso is None or perso == "":
         return None, None, None
 
-    parts = perso.split(";")
-    print(f"[DEBUG] get_student_info_from_card: parts={parts}")
-    if len(parts) < 3:
-        print("[DEBUG] get_student_info_from_card: moins de 3 champs dans perso")
+    # "num;nom;prenom" ou perso compacte (voir perso_carte)
+    etu_num, nom, prenom = perso_carte.decoder_perso(perso)
+    print(f"[DEBUG] etu_num={repr(etu_num)}, nom={repr(nom)}, prenom={repr(prenom)}")
+    if num_registre is not None and num_registre != etu_num:
+        # la carte a été réattribuée : le registre fait foi
+        print(f"[DEBUG] get_student_info_from_card: registre {num_registre} != perso {etu_num}")
+        etu_num = num_registre
+    if etu_num is None:
+        print("[DEBUG] get_student_info_from_card: numéro étudiant illisible")
         return None, None, None
 
-    raw_num = parts[0].strip()
-    nom = parts[1].strip()
-    prenom = parts[2].strip()
-
-    print(f"[DEBUG] raw_num={repr(raw_num)}, nom={repr(nom)}, prenom={repr(prenom)}")
+    return etu_num, nom, prenom
 
-    if not raw_num.isdigit():
-        print("[DEBUG] raw_num n'est pas composé uniquement de chiffres")
-        return None, None, None
+def get_student_number_from_card(identification=None):
+    """
+    Num_Etudiant seul (CHAR(8)) ou None : registre Carte si la carte y est
+    (None si elle est désactivée), sinon 81 03 (4 octets BCD) si la carte
+    le permet, sinon lecture de la perso complète.
+    """
+    num_registre, refus = identification or identifier_carte()
+    if refus:
+        print(f"[DEBUG] get_student_number_from_card: {refus}")
+        return None
+    if num_registre is not None:
+        return num_registre
 
-    etu_num = raw_num.zfill(8)
-    print(f"[DEBUG] etu_num après zfill(8) = {repr(etu_num)}")
-    return etu_num, nom, prenom
+    conn = get_card_connection()
+    if not conn:
+        print("[DEBUG] get_student_number_from_card: pas de connexion carte")
+        return None
+    try:
+        etu_num, err = perso_carte.lire_num_etudiant(conn)
+    except Exception as e:
+        print(f"Erreur lecture numéro étudiant: {e}")
+        return None
+    if err:
+        print(f"[DEBUG] get_student_number_from_card: {err}")
+        return None
+    print(f"[DEBUG] get_student_number_from_card: etu_num={repr(etu_num)}")
+    return etu_num
 
 def verify_pin(pin_str):
     """Vérifie le PIN."""
@@ -181,6 +271,38 @@ def read_counter():
         print(f"[DEBUG] read_counter exception: {e}")
         return None
 
+def card_capabilities():
+    """Capacités de la carte : octet qui suit "rubro" dans l'ATR (0 si ancienne carte)."""
+    conn = get_card_connection()
+    if not conn:
+        return 0
+    return perso_carte.capacites(conn)
+
+def read_state():
+    """
+    Lecture d'état groupée (PIN déjà vérifié, ticket PIN non consommé).
+    Retourne {solde, compteur, essais_pin, taille_perso} ou None.
+    """
+    conn = get_card_connection()
+    if not conn:
+        return None
+
+    apdu = [0x82, 0x08, 0x00, 0x00, 0x06]
+    try:
+        data, sw1, sw2 = conn.transmit(apdu)
+        print(f"[DEBUG] read_state: data={data}, sw1={hex(sw1)}, sw2={hex(sw2)}")
+        if sw1 != 0x90 or sw2 != 0x00 or not data or len(data) < 6:
+            return None
+        return {
+            'solde': int(data[0]) | (int(data[1]) << 8),
+            'compteur': int(data[2]) | (int(data[3]) << 8),
+            'essais_pin': int(data[4]),
+            'taille_perso': int(data[5]),
+        }
+    except Exception as e:
+        print(f"[DEBUG] read_state exception: {e}")
+        return None
+
 def _read_sold_core():
     """Lecture du solde (en cents)."""
     conn = get_card_connection()
@@ -200,8 +322,35 @@ def _read_sold_core():
         print(f"[DEBUG] _read_sold_core exception: {e}")
         return None
 
-def credit_card_amount(euros_amount, pin_str):
-    """Crédite la carte."""
+def lire_compteur_solde():
+    """
+    (compteur, solde) après vérification du PIN ; None si illisible.
+    Sans 82 08, la lecture du solde (82 01) consomme la vérification du
+    PIN : la vérifier à nouveau avant une APDU sensible.
+    """
+    if card_capabilities() & CAP_ETAT:
+        state = read_state()
+        if not state:
+            return None, None
+        return state['compteur'], state['solde']
+    ctr = read_counter()
+    if ctr is None:
+        return None, None
+    return ctr, _read_sold_core()
+
+def en_centimes(euros_amount):
+    """Montant en euros (Decimal ou float) -> centimes."""
+    if isinstance(euros_amount, Decimal):
+        return int((euros_amount * 100).to_integral_value())
+    return int(round(float(euros_amount) * 100))
+
+def credit_card_amount(euros_amount, pin_str, op=None):
+    """
+    Crédite la carte. Avec op (journal.nouvelle_operation), l'intention
+    est journalisée avant l'APDU et l'issue juste après : op['etape']
+    vaut alors 'carte', 'refus', ou reste 'intention' si la réponse de
+    la carte n'a pas été reçue.
+    """
     conn = get_card_connection()
     if not conn:
         return False, "Erreur de connexion à la carte"
@@ -210,18 +359,26 @@ def credit_card_amount(euros_amount, pin_str):
     if not ok:
         return False, msg
 
-    ctr = read_counter()
+    # compteur et solde avant le crédit : une réponse perdue reste
+    # décidable (journal.resoudre). Sans 82 08, la lecture du solde (82 01)
+    # consomme le PIN : il est vérifié à nouveau pour le crédit
+    ctr, solde = lire_compteur_solde()
     if ctr is None:
         return False, "Compteur indisponible"
-
-    if isinstance(euros_amount, Decimal):
-        cents = int((euros_amount * 100).to_integral_value())
-    else:
-        cents = int(round(float(euros_amount) * 100))
-
+    if solde is None:
+        return False, "Solde indisponible"
+    if not card_capabilities() & CAP_ETAT:
+        ok, msg = verify_pin(pin_str)
+        if not ok:
+            return False, msg
+
+    cents = en_centimes(euros_amount)
     if cents <= 0:
         return False, "Montant invalide"
 
+    if op is not None:
+        journal.intention(op, ctr, solde)
+
     montant_lsb = cents & 0xFF
     montant_msb = (cents >> 8) & 0xFF
     p1 = ctr & 0xFF
@@ -233,112 +390,545 @@ def credit_card_amount(euros_amount, pin_str):
     try:
         data, sw1, sw2 = conn.transmit(apdu)
         print(f"[DEBUG] credit_card_amount: data={data}, sw1={hex(sw1)}, sw2={hex(sw2)}")
-        if sw1 == 0x90 and sw2 == 0x00:
-            return True, f"Crédit effectué: {cents/100.0:.2f} €"
-        elif sw1 == 0x61 and sw2 == 0x00:
-            return False, "Capacité maximale dépassée"
-        elif sw1 == 0x69 and sw2 == 0x82:
-            return False, "Statut de sécurité non satisfait"
-        elif sw1 == 0x69 and sw2 == 0x84:
-            return False, "Erreur anti-rejoue"
-        elif sw1 == 0x6C:
-            return False, f"Erreur de longueur (la carte attend {sw2} octets)"
-        else:
-            return False, "Erreur lors du crédit"
     except Exception as e:
         return False, f"Erreur: {e}"
 
+    if op is not None:
+        journal.etape(op, "carte" if (sw1, sw2) == (0x90, 0x00) else "refus",
+                      f"SW {sw1:02X}{sw2:02X}")
+
+    if sw1 == 0x90 and sw2 == 0x00:
+        return True, f"Crédit effectué: {cents/100.0:.2f} €"
+    elif sw1 == 0x61 and sw2 == 0x00:
+        return False, "Capacité maximale dépassée"
+    elif sw1 == 0x69 and sw2 == 0x82:
+        return False, "Statut de sécurité non satisfait"
+    elif sw1 == 0x69 and sw2 == 0x84:
+        return False, "Erreur anti-rejoue"
+    elif sw1 == 0x6C:
+        return False, f"Erreur de longueur (la carte attend {sw2} octets)"
+    else:
+        return False, "Erreur lors du crédit"
+
 # =========================
 #  FONCTIONS BDD
 # =========================
 
+def etat_bdd():
+    """
+    Disjoncteur de la BDD (purple_dragon) et crédits en attente de rejeu :
+    (corps JSON, code HTTP), 503 tant que le disjoncteur est ouvert.
+    """
+    etat = purple_dragon.etat_bdd()
+    code = 503 if etat['etat'] == 'OUVERT' else 200
+    return {
+        'success': code == 200,
+        'bdd': etat,
+        'operations_a_rejouer': len(journal.a_rejouer()),
+    }, code
+
+# Connexion du total des bonus gardée ouverte (lu à chaque insertion de
+# carte) : la requête n'est préparée qu'une fois par executer(). Reconnexion
+# après une inactivité plus longue que celle-ci plutôt qu'un ping par lecture
+BONUS_INACTIVITE_MAX_S = 600
+_bonus_verrou = threading.Lock()
+_bonus_cnx = None
+_bonus_dernier = 0.0
+
+# requête préparée (executer) : pas de %% à doubler
+_SQL_BONUS = """
+    SELECT COALESCE(SUM(Montant), 0)
+    FROM Transactions
+    WHERE Num_Etudiant = %s
+      AND Type = 'CREDIT'
+      AND Commentaire LIKE 'Bonus%'
+      AND Commentaire NOT LIKE '%transféré%'
+      AND Transfert_Bonus IS NULL
+"""
+
+def _fermer_bonus():
+    global _bonus_cnx
+    try:
+        if _bonus_cnx is not None:
+            _bonus_cnx.close()
+    except Exception:
+        pass
+    _bonus_cnx = None
+
 def get_bonus_disponible(etu_num):
     """Retourne le total des bonus non transférés."""
+    global _bonus_cnx, _bonus_dernier
+    with _bonus_verrou:
+        if _bonus_cnx is not None and time.monotonic() - _bonus_dernier > BONUS_INACTIVITE_MAX_S:
+            _fermer_bonus()
+        if _bonus_cnx is None:
+            _bonus_cnx = get_db_connection()
+            if not _bonus_cnx:
+                return None
+        try:
+            print(f"[DEBUG] get_bonus_disponible: etu_num={repr(etu_num)}")
+            row = _bonus_cnx.executer(_SQL_BONUS, (etu_num,)).fetchone()
+            # fin de la transaction de lecture : le total suivant voit les
+            # bonus insérés depuis
+            _bonus_cnx.commit()
+            _bonus_dernier = time.monotonic()
+        except Exception as e:
+            print(f"Erreur get_bonus_disponible: {e}")
+            _fermer_bonus()
+            return None
+
+    if row is None or row[0] is None:
+        return Decimal("0.00")
+    montant = Decimal(str(row[0]))
+    print(f"[DEBUG] get_bonus_disponible: montant={montant}")
+    return montant
+
+def reserver_bonus(etu_num):
+    """
+    Réserve les bonus en attente (procédure TransfererBonus) :
+    (id_transfert, montant), (None, 0) s'il n'y a rien à transférer,
+    (None, None) en cas d'erreur BDD.
+    """
     cnx = get_db_connection()
     if not cnx:
-        return None
+        return None, None
 
-    sql = """
-        SELECT COALESCE(SUM(Montant), 0)
-        FROM Transactions
-        WHERE Num_Etudiant = %s
-          AND Type = 'CREDIT'
-          AND Commentaire LIKE 'Bonus%%'
-          AND Commentaire NOT LIKE '%%transféré%%'
-    """
     try:
         cursor = cnx.cursor()
-        print(f"[DEBUG] get_bonus_disponible: etu_num={repr(etu_num)}")
-        cursor.execute(sql, (etu_num,))
-        row = cursor.fetchone()
+        res = cursor.callproc("TransfererBonus", [etu_num, 0, Decimal("0.00")])
         cursor.close()
         cnx.close()
+        id_transfert = res[1]
+        montant = Decimal(str(res[2] or 0))
+        print(f"[DEBUG] reserver_bonus: etu_num={repr(etu_num)}, id={id_transfert}, montant={montant}")
+        return id_transfert, montant
+    except mysql.connector.Error as e:
+        print(f"Erreur BDD reserver_bonus: {e}")
+        try:
+            cnx.close()
+        except Exception:
+            pass
+        return None, None
 
-        if row is None or row[0] is None:
-            return Decimal("0.00")
-        montant = Decimal(str(row[0]))
-        print(f"[DEBUG] get_bonus_disponible: montant={montant}")
-        return montant
-    except Exception as e:
-        print(f"Erreur get_bonus_disponible: {e}")
-        if cnx:
+def annuler_transfert_bonus(id_transfert):
+    """Rend une réservation de bonus quand la carte n'a pas été sollicitée."""
+    cnx = get_db_connection()
+    if not cnx:
+        return False
+
+    try:
+        cursor = cnx.cursor()
+        cursor.callproc("AnnulerTransfertBonus", [id_transfert])
+        cursor.close()
+        return True
+    except mysql.connector.Error as e:
+        print(f"Erreur BDD annuler_transfert_bonus: {e}")
+        return False
+    finally:
+        try:
             cnx.close()
-        return None
+        except Exception:
+            pass
 
-def marquer_bonus_transfere(etu_num):
-    """Marque les bonus comme transférés."""
+def terminer_operation(op):
+    """
+    Étape BDD d'une opération journalisée dont la carte a répondu
+    (crédit du compte, ou confirmation / annulation du transfert de
+    bonus). False si elle reste à faire : le rejeu du journal s'en
+    chargera.
+    """
+    if op.get('etape') not in ("carte", "refus"):
+        return False
     cnx = get_db_connection()
     if not cnx:
-        return 0
+        return False
+
+    try:
+        journal.appliquer_bdd(op, cnx)
+        print(f"[DEBUG] terminer_operation: {op['type']} {op['id']} OK")
+        return True
+    except mysql.connector.Error as e:
+        print(f"Erreur BDD terminer_operation ({op['id']}): {e}")
+        return False
+    finally:
+        try:
+            cnx.close()
+        except Exception:
+            pass
+
+def trancher_operations(etu_num, pin_str):
+    """
+    Opérations de cet étudiant interrompues pendant l'APDU (réponse de la
+    carte jamais reçue) : tranchées avec le compteur et le solde relus,
+    avant que le compteur ne bouge à nouveau, puis étape BDD.
+    Sans effet (aucun échange carte) s'il n'y en a pas.
+    """
+    if not any(op.get('etape') == "intention" and op.get('etu') == etu_num
+               for op in journal.en_cours()):
+        return
+    ok, _ = verify_pin(pin_str)
+    if not ok:
+        return
+    ctr, solde = lire_compteur_solde()
+    if ctr is None:
+        return
+    journal.resoudre(etu_num, ctr, solde)
+    for op in journal.en_cours():
+        if op.get('etu') == etu_num:
+            terminer_operation(op)
+
+def recuperer_journal():
+    """Rejoue les étapes BDD interrompues (arrêt de la borne, BDD indisponible)."""
+    if not journal.a_rejouer(age_min_s=30):
+        journal.compacter()     # seulement si une opération est arrivée à 'fin'
+        return
+    cnx = get_db_connection()
+    if not cnx:
+        return
+    try:
+        journal.recuperer(cnx, age_min_s=30)
+    finally:
+        try:
+            cnx.close()
+        except Exception:
+            pass
+
+def _boucle_recuperation():
+    while True:
+        try:
+            recuperer_journal()
+        except Exception as e:
+            print(f"Erreur recuperer_journal: {e}")
+        time.sleep(RECUPERATION_S)
+
+_recuperation = None
+
+@app.before_request
+def demarrer_recuperation():
+    """
+    Premier appel : rejeu immédiat du journal puis toutes les
+    RECUPERATION_S secondes. Lancé à la première requête plutôt qu'à
+    l'import pour ne pas tourner dans le processus de surveillance du
+    rechargement automatique (un seul écrivain par journal).
+    """
+    global _recuperation
+    if _recuperation is None:
+        _recuperation = threading.Thread(target=_boucle_recuperation, daemon=True)
+        _recuperation.start()
+
+# =========================
+#  PRÉCHARGEMENT À L'INSERTION
+# =========================
+
+def get_statut_compte(etu_num):
+    """
+    État du compte : {'solde': Decimal, 'cartes_actives': int}, ou
+    {'solde': None, ...} si l'étudiant n'a pas de compte ; None en cas
+    d'erreur BDD.
+    """
+    cnx = get_db_connection()
+    if not cnx:
+        return None
 
     sql = """
-        UPDATE Transactions
-        SET Commentaire = CONCAT(Commentaire, ' (transféré)')
-        WHERE Num_Etudiant = %s
-          AND Type = 'CREDIT'
-          AND Commentaire LIKE 'Bonus%%'
-          AND Commentaire NOT LIKE '%%transféré%%'
+        SELECT SoldeCompte(%s),
+               (SELECT COUNT(*) FROM Carte WHERE Num_Etudiant = %s AND Actif = 1)
     """
     try:
         cursor = cnx.cursor()
-        print(f"[DEBUG] marquer_bonus_transfere: etu_num={repr(etu_num)}")
-        cursor.execute(sql, (etu_num,))
-        cnx.commit()
-        nb = cursor.rowcount
+        cursor.execute(sql, (etu_num, etu_num))
+        solde, cartes = cursor.fetchone()
         cursor.close()
-        cnx.close()
-        print(f"[DEBUG] marquer_bonus_transfere: nb={nb}")
-        return nb
+        statut = {
+            'solde': Decimal(str(solde)) if solde is not None else None,
+            'cartes_actives': int(cartes or 0),
+        }
+        print(f"[DEBUG] get_statut_compte: etu_num={repr(etu_num)}, statut={statut}")
+        return statut
+    except mysql.connector.Error as e:
+        print(f"Erreur get_statut_compte: {e}")
+        return None
+    finally:
+        try:
+            cnx.close()
+        except Exception:
+            pass
+
+# Requêtes BDD lancées pendant que la carte relit sa perso
+_executeur_prechargement = ThreadPoolExecutor(max_workers=2, thread_name_prefix="prechargement")
+
+# Insertion en cours (une seule carte : Berlicum ne pilote que le premier
+# lecteur), remplacée à chaque insertion et effacée au retrait
+session_carte = None
+_verrou_session = threading.Lock()
+
+# Attente maximale de la lecture de la perso par /api/infos (secondes)
+DELAI_PRECHARGEMENT_S = 5
+
+def _lancer_requetes_bdd(session, etu_num):
+    session['bonus'] = _executeur_prechargement.submit(get_bonus_disponible, etu_num)
+    session['statut'] = _executeur_prechargement.submit(get_statut_compte, etu_num)
+
+def prechargement_carte(session):
+    """
+    Séquence lancée à l'insertion, avant tout clic : numéro étudiant
+    (registre Carte, sinon 81 03, 4 octets) puis, pendant que la carte
+    renvoie la perso complète, bonus et état du compte en BDD. Les
+    anciennes cartes (sans 81 03) lancent les requêtes après l'unique
+    lecture de la perso. Une carte désactivée s'arrête là.
+    """
+    try:
+        identification = identifier_carte()
+        if identification[1]:
+            session['refus'] = identification[1]
+            return
+        conn = get_card_connection()
+        if identification[0] is not None or \
+                (conn and perso_carte.capacites(conn) & perso_carte.CAP_NUM_ETU):
+            etu_num = get_student_number_from_card(identification)
+            if etu_num is not None:
+                _lancer_requetes_bdd(session, etu_num)
+
+        etu_num, nom, prenom = get_student_info_from_card(identification)
+        session.update(num=etu_num, nom=nom, prenom=prenom)
+        if etu_num is not None and session['bonus'] is None:
+            _lancer_requetes_bdd(session, etu_num)
     except Exception as e:
-        print(f"Erreur marquer_bonus_transfere: {e}")
-        if cnx:
+        print(f"Erreur prechargement_carte: {e}")
+    finally:
+        session['pret'].set()
+        print(f"[DEBUG] prechargement_carte: session {session['id']} prête "
+              f"({time.time() - session['date']:.3f} s)")
+
+def lancer_prechargement(session):
+    """Thread de préchargement (berlicum_asgi le passe sur le thread du lecteur)."""
+    threading.Thread(target=prechargement_carte, args=(session,), daemon=True).start()
+
+def session_active():
+    with _verrou_session:
+        return session_carte
+
+def invalider_prechargement():
+    """Bonus et solde préchargés périmés (transfert, recharge)."""
+    session = session_active()
+    if session is not None:
+        session['bonus'] = session['statut'] = None
+
+def donnees_prechargees(session):
+    """Résultats BDD déjà arrivés, sans attendre les autres."""
+    donnees = {}
+    bonus, statut = session.get('bonus'), session.get('statut')
+    if bonus is not None and bonus.done() and bonus.result() is not None:
+        donnees['bonus'] = f"{bonus.result():.2f}"
+    if statut is not None and statut.done() and statut.result() is not None:
+        compte = statut.result()
+        donnees['compte'] = {
+            'solde': f"{compte['solde']:.2f}" if compte['solde'] is not None else None,
+            'cartes_actives': compte['cartes_actives'],
+        }
+    return donnees
+
+class ObservateurCarte(CardObserver):
+    """Insertion : nouvelle session et préchargement ; retrait : fin de session."""
+
+    def update(self, observable, actions):
+        global session_carte, conn_reader
+        ajoutees, retirees = actions
+        try:
+            lecteur = str(scardsys.readers()[0])
+        except Exception:
+            lecteur = None
+        for carte in retirees:
+            if str(carte.reader) == lecteur:
+                print(f"[DEBUG] Carte retirée ({lecteur})")
+                with _verrou_session:
+                    session_carte = None
+                conn_reader = None
+        for carte in ajoutees:
+            if str(carte.reader) != lecteur:
+                continue
+            session = {
+                'id': secrets.token_hex(8),
+                'atr': bytes(carte.atr).hex().upper(),
+                'date': time.time(),
+                'num': None, 'nom': None, 'prenom': None,
+                'bonus': None, 'statut': None, 'refus': None,
+                'pret': threading.Event(),
+            }
+            print(f"[DEBUG] Carte insérée ({lecteur}) : session {session['id']}")
+            with _verrou_session:
+                session_carte = session
+            conn_reader = None  # connexion de la carte précédente
+            lancer_prechargement(session)
+
+_surveillance = None
+
+@app.before_request
+def demarrer_surveillance_carte():
+    """Surveillance des insertions, lancée à la première requête (voir ci-dessus)."""
+    global _surveillance
+    if _surveillance is None:
+        try:
+            _surveillance = CardMonitor()
+            _surveillance.addObserver(ObservateurCarte())
+        except Exception as e:
+            # pas de surveillance : /api/infos relit la carte à chaque appel
+            print(f"Erreur surveillance carte: {e}")
+            _surveillance = False
+
+# =========================
+#  IDEMPOTENCE
+# =========================
+
+def empreinte_requete(route, corps):
+    """SHA-256 de la route et du corps JSON, sans le PIN : détecte une clé réutilisée pour une autre requête."""
+    corps = dict(corps or {})
+    corps.pop('pin', None)
+    brut = route + json.dumps(corps, sort_keys=True, default=str)
+    return hashlib.sha256(brut.encode('utf-8')).hexdigest()
+
+def reserver_cle_idempotence(cle, route, empreinte):
+    """
+    Enregistre la clé avant tout accès carte ou BDD. Retourne :
+      ('nouvelle', None)          clé libre, la requête doit être traitée
+      ('terminee', (code, json))  réponse déjà envoyée pour cette clé
+      ('en_cours', None)          premier essai pas encore fini
+      ('conflit', None)           clé déjà utilisée pour une autre requête
+      ('erreur', None)            BDD indisponible
+    """
+    cnx = get_db_connection()
+    if not cnx:
+        return 'erreur', None
+
+    try:
+        cursor = cnx.cursor()
+        try:
+            cursor.execute(
+                "INSERT INTO RequeteIdempotente (Cle, Route, Empreinte) VALUES (%s, %s, %s)",
+                (cle, route, empreinte),
+            )
+            cnx.commit()
+            cursor.close()
+            return 'nouvelle', None
+        except mysql.connector.Error as e:
+            if e.errno != errorcode.ER_DUP_ENTRY:
+                raise
+            cnx.rollback()
+
+        cursor.execute(
+            "SELECT Empreinte, Etat, Code_HTTP, Reponse FROM RequeteIdempotente WHERE Cle = %s",
+            (cle,),
+        )
+        row = cursor.fetchone()
+        cursor.close()
+        print(f"[DEBUG] reserver_cle_idempotence: cle={cle} déjà vue, etat={row[1] if row else None}")
+        if row is None:
+            return 'en_cours', None          # purgée entre-temps : le client réessaiera
+        if row[0] != empreinte:
+            return 'conflit', None
+        if row[1] == 'TERMINEE':
+            return 'terminee', (row[2], row[3])
+        return 'en_cours', None
+    except mysql.connector.Error as e:
+        print(f"Erreur BDD reserver_cle_idempotence: {e}")
+        return 'erreur', None
+    finally:
+        try:
             cnx.close()
-        return 0
+        except Exception:
+            pass
 
-def crediter_compte_bdd(etu_num, montant):
-    """Crédite le compte en BDD via la procédure stockée CrediterCompte."""
-    print(f"[DEBUG] crediter_compte_bdd: etu_num={repr(etu_num)}, montant={montant}")
+def terminer_cle_idempotence(cle, code, corps):
+    """Enregistre la réponse envoyée pour la clé (code HTTP, corps JSON)."""
     cnx = get_db_connection()
     if not cnx:
-        print("[DEBUG] crediter_compte_bdd: connexion BDD impossible")
         return False
 
     try:
         cursor = cnx.cursor()
-        cursor.callproc("CrediterCompte", [etu_num, float(montant), "Recharge CB Berlicum"])
+        cursor.execute(
+            "UPDATE RequeteIdempotente SET Etat = 'TERMINEE', Code_HTTP = %s, Reponse = %s "
+            "WHERE Cle = %s",
+            (code, corps, cle),
+        )
         cnx.commit()
         cursor.close()
-        cnx.close()
-        print("[DEBUG] crediter_compte_bdd: OK (procédure exécutée)")
         return True
     except mysql.connector.Error as e:
-        print(f"Erreur BDD crediter_compte_bdd: {e}")
-        if cnx:
-            try:
-                cnx.close()
-            except:
-                pass
+        print(f"Erreur BDD terminer_cle_idempotence: {e}")
         return False
+    finally:
+        try:
+            cnx.close()
+        except Exception:
+            pass
+
+def liberer_cle_idempotence(cle):
+    """Supprime une clé dont la requête a échoué sans toucher à la carte."""
+    cnx = get_db_connection()
+    if not cnx:
+        return
+    try:
+        cursor = cnx.cursor()
+        cursor.execute("DELETE FROM RequeteIdempotente WHERE Cle = %s AND Etat = 'EN_COURS'", (cle,))
+        cnx.commit()
+        cursor.close()
+    except mysql.connector.Error as e:
+        print(f"Erreur BDD liberer_cle_idempotence: {e}")
+    finally:
+        try:
+            cnx.close()
+        except Exception:
+            pass
+
+def idempotent(vue):
+    """
+    Route rejouable : avec un en-tête Idempotency-Key, une requête déjà
+    traitée renvoie la réponse enregistrée sans toucher à la carte ni à
+    la BDD. Sans en-tête, la route se comporte comme avant.
+
+    BDD injoignable : la requête est traitée sans clé, le journal des
+    opérations protège alors la carte. Réponse impossible à enregistrer :
+    elle passe par le journal, rejouée avec les crédits (sinon la clé
+    resterait EN_COURS). Exception pendant la requête : la clé n'est
+    rendue que si le compteur de la carte n'a pas bougé.
+    """
+    @functools.wraps(vue)
+    def enveloppe(*args, **kwargs):
+        cle = request.headers.get('Idempotency-Key')
+        if not cle:
+            return vue(*args, **kwargs)
+        if not CLE_IDEMPOTENCE.match(cle):
+            return jsonify({'success': False, 'message': "Clé d'idempotence invalide"}), 400
+
+        etat, enregistree = reserver_cle_idempotence(
+            cle, request.path, empreinte_requete(request.path, request.get_json(silent=True)))
+        if etat == 'terminee':
+            code, corps = enregistree
+            return app.response_class(corps, status=code or 200, mimetype='application/json')
+        if etat == 'en_cours':
+            return jsonify({'success': False, 'message': 'Opération déjà en cours, patientez'}), 409
+        if etat == 'conflit':
+            return jsonify({'success': False, 'message': "Clé d'idempotence déjà utilisée"}), 422
+        if etat == 'erreur':
+            print(f"[DEBUG] idempotent: BDD injoignable, {request.path} traitée sans clé")
+            return vue(*args, **kwargs)
+
+        ctr_avant = read_counter()
+        try:
+            reponse = app.make_response(vue(*args, **kwargs))
+        except Exception:
+            # exception avant toute réponse : la clé n'est rendue (nouvel
+            # essai possible) que si la carte n'a pas été créditée ; sinon
+            # elle reste EN_COURS jusqu'à la purge
+            if ctr_avant is not None and read_counter() == ctr_avant:
+                liberer_cle_idempotence(cle)
+            raise
+        corps = reponse.get_data(as_text=True)
+        if not terminer_cle_idempotence(cle, reponse.status_code, corps):
+            journal.reponse(cle, reponse.status_code, corps)
+        return reponse
+    return enveloppe
 
 # =========================
 #  TEMPLATE HTML
@@ -569,6 +1159,14 @@ HTML_TEMPLATE = """
                         <strong>PRÉNOM</strong>
                         <span id="displayPrenom">-</span>
                     </div>
+                    <div class="info-item">
+                        <strong>BONUS DISPONIBLES</strong>
+                        <span id="displayBonus">-</span>
+                    </div>
+                    <div class="info-item">
+                        <strong>SOLDE DU COMPTE</strong>
+                        <span id="displaySoldeCompte">-</span>
+                    </div>
                 </div>
 
                 <div id="result" class="result"></div>
@@ -643,6 +1241,8 @@ HTML_TEMPLATE = """
                         if (!cardPresent) {
                             cardPresent = true;
                             handleCardInserted(data);
+                        } else {
+                            afficherPrechargement(data);
                         }
                     } else {
                         if (cardPresent) {
@@ -650,6 +1250,9 @@ HTML_TEMPLATE = """
                             location.reload();
                             return;
                         }
+                        // carte désactivée (registre Carte) : message jusqu'au retrait
+                        document.getElementById('insertPrompt').textContent =
+                            data.refusee ? `⛔ ${data.message}` : '👇 Insérez votre carte étudiante';
                     }
                 } catch (e) {
                     console.log('Erreur pollCard', e);
@@ -692,9 +1295,27 @@ HTML_TEMPLATE = """
                 document.getElementById('displayNumEtu').textContent = data.num_etudiant;
                 document.getElementById('displayNom').textContent = data.nom;
                 document.getElementById('displayPrenom').textContent = data.prenom;
+                afficherPrechargement(data);
             }, 3500);
         }
 
+        // Bonus et solde BDD préchargés à l'insertion (absents tant que la
+        // BDD n'a pas répondu : le sondage suivant les apporte)
+        function afficherPrechargement(data) {
+            if (data.bonus !== undefined) {
+                document.getElementById('displayBonus').textContent = `${data.bonus} €`;
+            }
+            if (data.compte && data.compte.solde !== null) {
+                document.getElementById('displaySoldeCompte').textContent = `${data.compte.solde} €`;
+            }
+        }
+
+        // après un transfert ou une recharge, les valeurs de l'insertion sont périmées
+        function effacerPrechargement() {
+            document.getElementById('displayBonus').textContent = '-';
+            document.getElementById('displaySoldeCompte').textContent = '-';
+        }
+
         function toggleInfos() {
             const panel = document.getElementById('infoPanel');
             panel.style.display = (panel.style.display === 'none' || panel.style.display === '') ? 'block' : 'none';
@@ -710,6 +1331,46 @@ HTML_TEMPLATE = """
             }, 5000);
         }
 
+        // Clé d'idempotence : une par opération, réutilisée à chaque nouvel
+        // essai pour que le serveur ne crédite jamais deux fois
+        function nouvelleCle() {
+            const octets = new Uint8Array(16);
+            crypto.getRandomValues(octets);
+            return Array.from(octets, b => b.toString(16).padStart(2, '0')).join('');
+        }
+
+        // POST avec délai court et nouveaux essais (même clé) en cas de
+        // délai dépassé, d'erreur réseau ou d'opération encore en cours
+        async function postIdempotent(url, body, essais = 4, delaiMs = 8000) {
+            const cle = nouvelleCle();
+            let derniereErreur = null;
+            for (let i = 0; i < essais; i++) {
+                const ctrl = new AbortController();
+                const minuteur = setTimeout(() => ctrl.abort(), delaiMs);
+                try {
+                    const response = await fetch(url, {
+                        method: 'POST',
+                        headers: {'Content-Type': 'application/json', 'Idempotency-Key': cle},
+                        body: JSON.stringify(body),
+                        signal: ctrl.signal
+                    });
+                    if (response.status !== 409) {
+                        return await response.json();
+                    }
+                    derniereErreur = await response.json();
+                } catch (e) {
+                    derniereErreur = e;
+                } finally {
+                    clearTimeout(minuteur);
+                }
+                await new Promise(r => setTimeout(r, 1000 * (i + 1)));
+            }
+            if (derniereErreur && derniereErreur.message && derniereErreur.success === false) {
+                return derniereErreur;
+            }
+            throw derniereErreur;
+        }
+
         function showModal(modalId) {
             document.getElementById(modalId).classList.add('active');
         }
@@ -762,13 +1423,9 @@ HTML_TEMPLATE = """
             if (currentAction === 'transfert') {
                 showResult('Transfert en cours...', 'info');
                 try {
-                    const response = await fetch('/api/transfert_bonus', {
-                        method: 'POST',
-                        headers: {'Content-Type': 'application/json'},
-                        body: JSON.stringify({pin: pin})
-                    });
-                    const data = await response.json();
+                    const data = await postIdempotent('/api/transfert_bonus', {pin: pin});
                     showResult(data.message, data.success ? 'success' : 'error');
+                    effacerPrechargement();
                 } catch (error) {
                     showResult('Erreur de communication', 'error');
                 }
@@ -810,16 +1467,12 @@ HTML_TEMPLATE = """
             } else if (currentAction === 'recharge_confirm' && currentData.montant) {
                 showResult('Recharge en cours...', 'info');
                 try {
-                    const response = await fetch('/api/recharge', {
-                        method: 'POST',
-                        headers: {'Content-Type': 'application/json'},
-                        body: JSON.stringify({
-                            montant: currentData.montant,
-                            pin: pin
-                        })
+                    const data = await postIdempotent('/api/recharge', {
+                        montant: currentData.montant,
+                        pin: pin
                     });
-                    const data = await response.json();
                     showResult(data.message, data.success ? 'success' : 'error');
+                    effacerPrechargement();
                     currentData = {};
                     currentAction = null;
                 } catch (error) {
@@ -862,8 +1515,28 @@ HTML_TEMPLATE = """
 def index():
     return render_template_string(HTML_TEMPLATE)
 
+@app.route('/api/bdd/etat')
+def api_bdd_etat():
+    corps, code = etat_bdd()
+    return jsonify(corps), code
+
 @app.route('/api/infos')
 def api_infos():
+    # carte suivie depuis son insertion : perso déjà lue, BDD interrogée
+    session = session_active()
+    if session is not None and session['pret'].wait(DELAI_PRECHARGEMENT_S) \
+            and session['refus']:
+        return jsonify({'success': False, 'message': session['refus'], 'refusee': True})
+    if session is not None and session['pret'].is_set() and session['num'] is not None:
+        print(f"[DEBUG] /api/infos: session {session['id']}, etu_num={repr(session['num'])}")
+        return jsonify({
+            'success': True,
+            'num_etudiant': session['num'],
+            'nom': session['nom'],
+            'prenom': session['prenom'],
+            **donnees_prechargees(session)
+        })
+
     etu_num, nom, prenom = get_student_info_from_card()
     print(f"[DEBUG] /api/infos: etu_num={repr(etu_num)}, nom={repr(nom)}, prenom={repr(prenom)}")
     if etu_num is None:
@@ -877,7 +1550,16 @@ def api_infos():
 
 @app.route('/api/bonus')
 def api_bonus():
-    etu_num, _, _ = get_student_info_from_card()
+    # total demandé à l'insertion, s'il n'est pas périmé
+    session = session_active()
+    futur = session.get('bonus') if session is not None else None
+    if futur is not None:
+        montant = futur.result()
+        print(f"[DEBUG] /api/bonus: session {session['id']}, montant={montant}")
+        if montant is not None:
+            return jsonify({'success': True, 'montant': f"{montant:.2f}"})
+
+    etu_num = get_student_number_from_card()
     print(f"[DEBUG] /api/bonus: etu_num={repr(etu_num)}")
     if etu_num is None:
         return jsonify({'success': False, 'message': 'Erreur lecture carte'})
@@ -903,7 +1585,11 @@ def api_solde():
     if not ok:
         return jsonify({'success': False, 'message': msg})
 
-    cents = _read_sold_core()
+    if card_capabilities() & CAP_ETAT:
+        state = read_state()
+        cents = state['solde'] if state else None
+    else:
+        cents = _read_sold_core()
     if cents is None:
         return jsonify({'success': False, 'message': 'Erreur lecture solde'})
 
@@ -913,6 +1599,7 @@ def api_solde():
     })
 
 @app.route('/api/transfert_bonus', methods=['POST'])
+@idempotent
 def api_transfert_bonus():
     data = request.json
     pin = data.get('pin')
@@ -920,29 +1607,50 @@ def api_transfert_bonus():
     if not pin:
         return jsonify({'success': False, 'message': 'PIN requis'})
 
-    etu_num, _, _ = get_student_info_from_card()
+    etu_num = get_student_number_from_card()
     print(f"[DEBUG] /api/transfert_bonus: etu_num={repr(etu_num)}")
     if etu_num is None:
         return jsonify({'success': False, 'message': 'Erreur lecture carte'})
 
-    montant = get_bonus_disponible(etu_num)
+    trancher_operations(etu_num, pin)
+    invalider_prechargement()
+
+    # Réservation (verrou court en BDD), crédit carte, puis confirmation :
+    # un bonus accordé entre-temps n'est pas marqué, et une autre borne
+    # ne peut pas transférer les mêmes bonus
+    id_transfert, montant = reserver_bonus(etu_num)
     if montant is None:
         return jsonify({'success': False, 'message': 'Erreur BDD'})
 
-    if montant <= 0:
+    if id_transfert is None or montant <= 0:
         return jsonify({'success': False, 'message': 'Aucun bonus disponible'})
 
-    ok, msg = credit_card_amount(montant, pin)
+    op = journal.nouvelle_operation(journal_operations.BONUS, etu_num,
+                                    en_centimes(montant), ref=id_transfert)
+    ok, msg = credit_card_amount(montant, pin, op)
     if not ok:
+        if 'etape' not in op:
+            # échec avant l'APDU (PIN, lecture compteur) : rien de journalisé
+            annuler_transfert_bonus(id_transfert)
+        else:
+            # refus : annulation ; réponse perdue : tranchée plus tard
+            terminer_operation(op)
         return jsonify({'success': False, 'message': msg})
 
-    nb = marquer_bonus_transfere(etu_num)
+    if not terminer_operation(op):
+        return jsonify({
+            'success': True,
+            'message': f"Transfert réussi: {montant:.2f} € (transfert n°{id_transfert}, "
+                       f"enregistrement BDD différé)"
+        })
+
     return jsonify({
         'success': True,
-        'message': f"Transfert réussi: {montant:.2f} € ({nb} bonus transférés)"
+        'message': f"Transfert réussi: {montant:.2f} € (transfert n°{id_transfert})"
     })
 
 @app.route('/api/recharge', methods=['POST'])
+@idempotent
 def api_recharge():
     data = request.json
     montant_str = data.get('montant')
@@ -961,20 +1669,26 @@ def api_recharge():
     except Exception:
         return jsonify({'success': False, 'message': 'Montant invalide'})
 
-    etu_num, _, _ = get_student_info_from_card()
+    etu_num = get_student_number_from_card()
     print(f"[DEBUG] /api/recharge: etu_num={repr(etu_num)}, montant={montant}")
     if etu_num is None:
         return jsonify({'success': False, 'message': 'Erreur lecture carte'})
 
-    ok, msg = credit_card_amount(montant, pin)
+    trancher_operations(etu_num, pin)
+    invalider_prechargement()
+
+    op = journal.nouvelle_operation(journal_operations.RECHARGE, etu_num, en_centimes(montant))
+    ok, msg = credit_card_amount(montant, pin, op)
     if not ok:
+        terminer_operation(op)
         return jsonify({'success': False, 'message': msg})
 
-    ok_bdd = crediter_compte_bdd(etu_num, montant)
-    if not ok_bdd:
+    if not terminer_operation(op):
+        # la carte est créditée ; le crédit du compte est dans le journal
+        # et sera rejoué dès que la BDD répondra
         return jsonify({
             'success': True,
-            'message': f"Carte créditée ({montant:.2f} €) mais erreur BDD. Contactez l'administrateur."
+            'message': f"Recharge réussie: {montant:.2f} € (enregistrement BDD différé)"
         })
 
     return jsonify({
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Journal des opérations carte + BDD de Berlicum
+----------------------------------------------
+Une recharge (ou un transfert de bonus) se fait en deux temps : crédit de
+la carte (APDU 82 02), puis écriture en BDD. Si la borne s'arrête ou si
+la BDD ne répond pas entre les deux, la carte et la BDD divergent.
+
+Chaque opération est donc écrite dans un journal local (une ligne JSON
+par étape, fsync avant de continuer) :
+
+    intention  avant l'APDU : étudiant, montant, compteur avant / après,
+               solde avant si connu
+    carte      la carte a répondu 90 00
+    refus      la carte a refusé (ou n'a pas été créditée)
+    fin        l'étape BDD est faite (ou n'a pas lieu d'être)
+
+recuperer() rejoue l'étape BDD des opérations 'carte' et 'refus' ; elle
+est idempotente (CrediterCompteReference ne crédite qu'une fois une même
+référence, ConfirmerTransfertBonus / AnnulerTransfertBonus sont sans
+effet sur un transfert déjà clos). Une opération restée 'intention'
+(arrêt pendant l'APDU) est tranchée par resoudre() à la prochaine
+lecture du compteur de la même carte.
+
+Le journal garde aussi les réponses des API idempotentes que la BDD n'a
+pas pu enregistrer (type 'reponse', créées directement à l'étape
+'carte') : recuperer() les écrit dans RequeteIdempotente, sans quoi la
+clé resterait EN_COURS et chaque nouvel essai du client recevrait 409.
+
+Chaque processus a son propre fichier (berlicum_web, berlicum CLI) :
+un seul écrivain, protégé par un verrou de thread.
+"""
+
+import datetime
+import json
+import os
+import threading
+import uuid
+from decimal import Decimal
+
+import mysql.connector
+from mysql.connector import errorcode
+
+RECHARGE = "recharge"
+BONUS = "bonus"
+REPONSE = "reponse"
+
+COMMENTAIRE_RECHARGE = "Recharge CB Berlicum"
+
+# étapes après lesquelles il reste une écriture BDD à faire
+_A_REJOUER = ("carte", "refus")
+
+
+def _maintenant():
+    return datetime.datetime.now().isoformat(timespec="seconds")
+
+
+class JournalOperations:
+    """Journal append-only d'un processus, relu et compacté par recuperer()."""
+
+    def __init__(self, chemin):
+        self.chemin = chemin
+        self._verrou = threading.RLock()
+        # une opération est arrivée à 'fin' depuis le dernier compactage
+        # (au démarrage : le fichier peut en contenir de l'exécution précédente)
+        self._a_compacter = True
+
+    # -------------------------
+    #  ÉCRITURE
+    # -------------------------
+
+    def _ecrire(self, entree):
+        """Ajoute une ligne et attend qu'elle soit sur disque."""
+        ligne = json.dumps(entree, ensure_ascii=False) + "\n"
+        with self._verrou:
+            with open(self.chemin, "a", encoding="utf-8") as f:
+                f.write(ligne)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def nouvelle_operation(self, type_op, etu_num, cents, ref=None):
+        """Opération à journaliser (pas encore écrite : voir intention())."""
+        return {
+            "id": uuid.uuid4().hex,
+            "type": type_op,
+            "etu": etu_num,
+            "cents": int(cents),
+            "ref": ref,
+        }
+
+    def reponse(self, cle, code, corps):
+        """Réponse d'une clé d'idempotence à enregistrer en BDD par recuperer()."""
+        op = {
+            "id": uuid.uuid4().hex,
+            "type": REPONSE,
+            "cle": cle,
+            "code": code,
+            "corps": corps,
+            "etape": "carte",
+        }
+        self._ecrire(dict(op, date=_maintenant()))
+        return op
+
+    def intention(self, op, ctr_avant, solde_avant=None):
+        """Juste avant l'APDU de crédit : compteur lu, solde si connu."""
+        op["ctr_avant"] = ctr_avant
+        op["ctr_apres"] = (ctr_avant + 1) & 0xFFFF
+        op["solde_avant"] = solde_avant
+        op["etape"] = "intention"
+        self._ecrire(dict(op, date=_maintenant()))
+
+    def etape(self, op, etape, detail=None):
+        """carte / refus / fin."""
+        entree = {"id": op["id"], "etape": etape, "date": _maintenant()}
+        if detail:
+            entree["detail"] = detail
+        self._ecrire(entree)
+        op["etape"] = etape
+        if etape == "fin":
+            self._a_compacter = True
+
+    # -------------------------
+    #  RELECTURE
+    # -------------------------
+
+    def _lire(self):
+        """{id: opération avec sa dernière étape}, dans l'ordre du journal."""
+        ops = {}
+        try:
+            with open(self.chemin, "r", encoding="utf-8") as f:
+                for ligne in f:
+                    try:
+                        e = json.loads(ligne)
+                    except ValueError:
+                        continue    # dernière ligne tronquée par un arrêt brutal
+                    op = ops.setdefault(e["id"], {})
+                    op.update(e)
+        except FileNotFoundError:
+            pass
+        return ops
+
+    def en_cours(self):
+        """Opérations pas encore 'fin'."""
+        with self._verrou:
+            return [op for op in self._lire().values() if op.get("etape") != "fin"]
+
+    def compacter(self):
+        """
+        Réécrit le journal avec les seules opérations en cours ; sans effet
+        si aucune opération n'est arrivée à 'fin' depuis la dernière fois.
+        """
+        with self._verrou:
+            if not self._a_compacter:
+                return
+            self._a_compacter = False
+            ops = [op for op in self._lire().values() if op.get("etape") != "fin"]
+            tmp = self.chemin + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                for op in ops:
+                    f.write(json.dumps(op, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.chemin)
+            dossier = os.open(os.path.dirname(os.path.abspath(self.chemin)), os.O_RDONLY)
+            try:
+                os.fsync(dossier)
+            finally:
+                os.close(dossier)
+
+    # -------------------------
+    #  RÉCUPÉRATION
+    # -------------------------
+
+    def resoudre(self, etu_num, ctr, solde=None):
+        """
+        Tranche les opérations 'intention' de cet étudiant à partir du
+        compteur (et du solde) que la carte présente maintenant, avant
+        toute nouvelle opération :
+          - compteur inchangé : l'APDU n'a pas été exécutée -> refus
+          - compteur + 1, solde + montant : carte créditée -> carte
+          - compteur + 1, solde inchangé : crédit refusé -> refus
+        Sinon (carte utilisée ailleurs depuis, solde inconnu) l'opération
+        reste en intention et est signalée.
+        """
+        for op in self.en_cours():
+            if op.get("etape") != "intention" or op.get("etu") != etu_num:
+                continue
+            if ctr == op["ctr_avant"]:
+                self.etape(op, "refus", "compteur inchangé")
+            elif ctr == op["ctr_apres"] and solde is not None and op.get("solde_avant") is not None:
+                if solde == op["solde_avant"] + op["cents"]:
+                    self.etape(op, "carte", "compteur et solde relus")
+                elif solde == op["solde_avant"]:
+                    self.etape(op, "refus", "solde inchangé")
+                else:
+                    print(f"[journal] opération {op['id']} indécidable (solde {solde})")
+            else:
+                print(f"[journal] opération {op['id']} indécidable (compteur {ctr})")
+
+    def appliquer_bdd(self, op, cnx):
+        """
+        Étape BDD d'une opération 'carte' ou 'refus', puis 'fin'.
+        Lève mysql.connector.Error si la BDD refuse : l'opération reste
+        à rejouer.
+        """
+        cursor = cnx.cursor()
+        try:
+            if op["type"] == REPONSE:
+                cursor.execute(
+                    "UPDATE RequeteIdempotente SET Etat = 'TERMINEE', Code_HTTP = %s, "
+                    "Reponse = %s WHERE Cle = %s",
+                    (op["code"], op["corps"], op["cle"]),
+                )
+            elif op["type"] == RECHARGE and op["etape"] == "carte":
+                montant = Decimal(op["cents"]) / 100
+                try:
+                    cursor.callproc("CrediterCompteReference",
+                                    [op["etu"], montant, COMMENTAIRE_RECHARGE, op["id"]])
+                except mysql.connector.Error as e:
+                    # deux rejeux simultanés : l'autre a déjà inséré
+                    if e.errno != errorcode.ER_DUP_ENTRY:
+                        raise
+            elif op["type"] == BONUS and op.get("ref") is not None:
+                procedure = ("ConfirmerTransfertBonus" if op["etape"] == "carte"
+                             else "AnnulerTransfertBonus")
+                cursor.callproc(procedure, [op["ref"]])
+            cnx.commit()
+        finally:
+            cursor.close()
+        self.etape(op, "fin")
+
+    def a_rejouer(self, age_min_s=0):
+        """
+        Opérations 'carte' ou 'refus' dont l'étape BDD reste à faire ;
+        age_min_s laisse aux requêtes en cours le temps de la faire
+        elles-mêmes.
+        """
+        limite = datetime.datetime.now() - datetime.timedelta(seconds=age_min_s)
+        return [op for op in self.en_cours()
+                if op.get("etape") in _A_REJOUER
+                and datetime.datetime.fromisoformat(op["date"]) <= limite]
+
+    def recuperer(self, cnx, age_min_s=0):
+        """
+        Rejoue l'étape BDD des opérations interrompues sur la connexion
+        cnx (non fermée), puis compacte le journal. Retourne le nombre
+        d'opérations terminées.
+        """
+        nb = 0
+        for op in self.a_rejouer(age_min_s):
+            try:
+                self.appliquer_bdd(op, cnx)
+                nb += 1
+                print(f"[journal] opération {op['id']} ({op['type']}, "
+                      f"{op.get('etu') or op.get('cle')}) rejouée")
+            except mysql.connector.Error as e:
+                print(f"[journal] opération {op['id']} toujours en attente : {e}")
+        self.compacter()
+        return nb
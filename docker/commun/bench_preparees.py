@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Banc des requêtes préparées - texte contre préparé (purple_dragon)
+------------------------------------------------------------------
+Lecture seule : on peut le lancer sur la base de développement remplie.
+
+    docker compose exec rodelika-web python -m bench_preparees
+    docker compose exec rodelika-web python -m bench_preparees -n 5000 --etudiant 22000001
+
+Chaque requête fréquente des services (total des bonus, bonus + solde de
+la borne, suite du flux des transactions) est exécutée n fois de trois
+façons :
+
+    nouvelle cnx   connexion ouverte et fermée à chaque requête (pages web)
+    texte          cursor.execute() sur une connexion gardée
+    préparée       cnx.executer() sur une connexion gardée
+
+Le banc affiche la latence moyenne, p50 et p99 de chaque façon, puis le
+taux de réutilisation des requêtes préparées (stats_preparees()).
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import purple_dragon
+
+DB_CONFIG = {
+    "host": os.environ.get("DB_HOST", "purple-dragon-db"),
+    "port": int(os.environ.get("DB_PORT", "3306")),
+    "user": os.environ.get("DB_USER", "rodelika"),
+    "password": os.environ.get("DB_PASSWORD", "rodelika"),
+    "database": os.environ.get("DB_NAME", "carote_electronique"),
+}
+
+# (nom, SQL au format du curseur texte, paramètres en fonction de l'étudiant)
+REQUETES = [
+    ("bonus", """
+        SELECT COALESCE(SUM(Montant), 0)
+        FROM Transactions
+        WHERE Num_Etudiant = %s
+          AND Type = 'CREDIT'
+          AND Commentaire LIKE 'Bonus%%'
+          AND Commentaire NOT LIKE '%%transféré%%'
+          AND Transfert_Bonus IS NULL
+    """, lambda num: (num,)),
+    ("bonus+solde", """
+        SELECT (SELECT COALESCE(SUM(Montant), 0)
+                FROM Transactions
+                WHERE Num_Etudiant = %s
+                  AND Type = 'CREDIT'
+                  AND Commentaire LIKE 'Bonus%%'
+                  AND Commentaire NOT LIKE '%%transféré%%'
+                  AND Transfert_Bonus IS NULL),
+               SoldeCompte(%s)
+    """, lambda num: (num, num)),
+    ("flux", """
+        SELECT t.id, t.Num_Etudiant, t.Montant, t.Type, t.Date_Transaction,
+               t.Commentaire, t.Transfert_Bonus, t.Reference,
+               u.Nom, u.Prenom,
+               TIMESTAMPDIFF(SECOND, t.Date_Transaction, NOW()) AS Age_S
+        FROM Transactions t
+        LEFT JOIN users u ON u.Num_Etudiant = t.Num_Etudiant
+        WHERE t.id > %s
+        ORDER BY t.id
+        LIMIT %s
+    """, lambda num: (2 ** 62, 500)),     # à la tête : la plupart des passages ne trouvent rien
+]
+
+
+def premier_etudiant(cnx):
+    cursor = cnx.cursor()
+    cursor.execute("SELECT Num_Etudiant FROM Compte ORDER BY Num_Etudiant LIMIT 1")
+    row = cursor.fetchone()
+    cursor.close()
+    return row[0] if row else "00000000"
+
+
+def mesurer(fonction, n):
+    """Durées (s) de n appels, triées."""
+    durees = []
+    for _ in range(n):
+        debut = time.perf_counter()
+        fonction()
+        durees.append(time.perf_counter() - debut)
+    return sorted(durees)
+
+
+def nouvelle_connexion(sql, params):
+    def une():
+        cnx = purple_dragon.connect(**DB_CONFIG)
+        cursor = cnx.cursor()
+        cursor.execute(sql, params)
+        cursor.fetchall()
+        cursor.close()
+        cnx.close()
+    return une
+
+
+def texte(cnx, sql, params):
+    def une():
+        cursor = cnx.cursor()
+        cursor.execute(sql, params)
+        cursor.fetchall()
+        cursor.close()
+    return une
+
+
+def preparee(cnx, sql, params):
+    sql = sql.replace("%%", "%")    # pas d'échappement en mode préparé
+
+    def une():
+        cnx.executer(sql, params).fetchall()
+    return une
+
+
+def ligne(nom, facon, durees):
+    moyenne = sum(durees) / len(durees)
+    p50 = durees[len(durees) // 2]
+    p99 = durees[min(len(durees) - 1, int(len(durees) * 0.99))]
+    print(f"{nom:12} {facon:13} {moyenne * 1000:9.3f} {p50 * 1000:9.3f} {p99 * 1000:9.3f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m bench_preparees",
+        description="Latence des requêtes fréquentes : texte contre préparé",
+    )
+    parser.add_argument("-n", type=int, default=2000, help="exécutions par mesure (2000)")
+    parser.add_argument("--etudiant", help="Num_Etudiant interrogé (premier compte par défaut)")
+    parser.add_argument("--sans-connexion", action="store_true",
+                        help="ne pas mesurer une connexion par requête (n/10 exécutions, lent)")
+    args = parser.parse_args(argv)
+
+    cnx = purple_dragon.connect(autocommit=True, **DB_CONFIG)
+    num = args.etudiant or premier_etudiant(cnx)
+    print(f"[bench] étudiant {num}, {args.n} exécutions par mesure\n")
+    print(f"{'requête':12} {'façon':13} {'moy. ms':>9} {'p50 ms':>9} {'p99 ms':>9}")
+
+    try:
+        for nom, sql, parametres in REQUETES:
+            params = parametres(num)
+            # une exécution de chaque pour chauffer le cache InnoDB
+            texte(cnx, sql, params)()
+            if not args.sans_connexion:
+                n = max(1, args.n // 10)
+                ligne(nom, "nouvelle cnx", mesurer(nouvelle_connexion(sql, params), n))
+            ligne(nom, "texte", mesurer(texte(cnx, sql, params), args.n))
+            ligne(nom, "préparée", mesurer(preparee(cnx, sql, params), args.n))
+    finally:
+        cnx.close()
+
+    stats = purple_dragon.stats_preparees()
+    print(f"\nrequêtes préparées : {stats['preparations']} préparation(s), "
+          f"{stats['executions']} exécution(s), "
+          f"réutilisation {stats['taux_reutilisation']:.2%}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
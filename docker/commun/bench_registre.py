@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Banc de contention - mode COMPTE contre mode JOURNAL
+----------------------------------------------------
+À lancer sur une BDD de développement uniquement : le banc bascule
+Parametre.mode_registre (pour toute la base, le temps du test), crée des
+étudiants 9999xxxx et les supprime à la fin.
+
+    docker compose exec rodelika-web python -m bench_registre --mode les-deux
+    docker compose exec rodelika-web python -m bench_registre --threads 16 --comptes 1
+
+N threads, chacun avec sa connexion, insèrent des transactions de 0,01
+(CREDIT puis DEBIT) sur --comptes comptes pendant --duree secondes, une
+validation par opération (ou par lot de --lot lignes). Avec un seul
+compte, tous les threads se disputent la même ligne de Compte en mode
+COMPTE ; en mode JOURNAL, ils ne font qu'ajouter des lignes.
+
+Pour chaque mode : opérations/s, latence p50/p99 d'une validation,
+attentes de verrou InnoDB (Innodb_row_lock_waits / _time, compteurs
+globaux : à lancer sur une base au repos), puis durée de
+CompacterSoldes et vérification que le solde de chaque compte a bougé
+exactement de la somme des transactions insérées.
+"""
+
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+from decimal import Decimal
+
+import mysql.connector
+from mysql.connector import errorcode
+
+DB_CONFIG = {
+    "host": os.environ.get("DB_HOST", "purple-dragon-db"),
+    "port": int(os.environ.get("DB_PORT", "3306")),
+    "user": os.environ.get("DB_USER", "rodelika"),
+    "password": os.environ.get("DB_PASSWORD", "rodelika"),
+    "database": os.environ.get("DB_NAME", "carote_electronique"),
+}
+
+PREFIXE = "9999"
+NOM_BANC = "Banc"
+MONTANT = Decimal("0.01")
+
+_SQL_INSERT = """
+    INSERT INTO Transactions (Num_Etudiant, Montant, Type, Commentaire)
+    VALUES (%s, %s, %s, 'Banc registre')
+"""
+
+# interblocage / attente de verrou dépassée : l'opération est rejouée
+_A_REJOUER = (errorcode.ER_LOCK_DEADLOCK, errorcode.ER_LOCK_WAIT_TIMEOUT)
+
+
+def connecter():
+    return mysql.connector.connect(**DB_CONFIG)
+
+
+# =========================
+#  PRÉPARATION
+# =========================
+
+def comptes_banc(nb):
+    return [f"{PREFIXE}{i:04d}" for i in range(nb)]
+
+
+def preparer(cnx, comptes):
+    """Crée les étudiants du banc ; refuse si le préfixe est déjà pris."""
+    cursor = cnx.cursor()
+    cursor.execute(
+        "SELECT COUNT(*) FROM users WHERE Num_Etudiant LIKE %s AND Nom <> %s",
+        (PREFIXE + "%", NOM_BANC),
+    )
+    (pris,) = cursor.fetchone()
+    if pris:
+        cursor.close()
+        raise SystemExit(f"{pris} étudiant(s) {PREFIXE}xxxx existent déjà : banc annulé")
+    cursor.executemany(
+        "INSERT IGNORE INTO users (Num_Etudiant, Nom, Prenom, Password_Hash) "
+        "VALUES (%s, %s, 'Registre', '!')",
+        [(num, NOM_BANC) for num in comptes],
+    )
+    cursor.executemany(
+        "INSERT IGNORE INTO Compte (Num_Etudiant) VALUES (%s)",
+        [(num,) for num in comptes],
+    )
+    cnx.commit()
+    cursor.close()
+
+
+def nettoyer(cnx):
+    cursor = cnx.cursor()
+    motif = PREFIXE + "%"
+    # compactage d'abord : plus aucune ligne du banc à reporter
+    cursor.callproc("CompacterSoldes", (5000,))
+    for table in ("PointSolde", "Transactions", "Carte", "Compte", "users"):
+        cursor.execute(f"DELETE FROM {table} WHERE Num_Etudiant LIKE %s", (motif,))
+    cnx.commit()
+    cursor.close()
+
+
+def lire_mode(cnx):
+    cursor = cnx.cursor()
+    cursor.execute("SELECT Valeur FROM Parametre WHERE Cle = 'mode_registre'")
+    row = cursor.fetchone()
+    cursor.close()
+    return row[0] if row else "COMPTE"
+
+
+def changer_mode(cnx, mode):
+    cursor = cnx.cursor()
+    cursor.execute(
+        "INSERT INTO Parametre (Cle, Valeur) VALUES ('mode_registre', %s) "
+        "ON DUPLICATE KEY UPDATE Valeur = VALUES(Valeur)",
+        (mode,),
+    )
+    cnx.commit()
+    cursor.close()
+
+
+def soldes(cnx, comptes):
+    """{num: (Solde_Actuel, SoldeCompte)}"""
+    cursor = cnx.cursor()
+    marques = ", ".join(["%s"] * len(comptes))
+    cursor.execute(
+        f"SELECT Num_Etudiant, Solde_Actuel, SoldeCompte(Num_Etudiant) "
+        f"FROM Compte WHERE Num_Etudiant IN ({marques})",
+        comptes,
+    )
+    resultat = {num: (actuel, exact) for num, actuel, exact in cursor.fetchall()}
+    cursor.close()
+    cnx.commit()
+    return resultat
+
+
+def verrous(cnx):
+    """(Innodb_row_lock_waits, Innodb_row_lock_time en ms)"""
+    cursor = cnx.cursor()
+    cursor.execute("SHOW GLOBAL STATUS LIKE 'Innodb_row_lock_%'")
+    etat = dict(cursor.fetchall())
+    cursor.close()
+    return int(etat["Innodb_row_lock_waits"]), int(etat["Innodb_row_lock_time"])
+
+
+# =========================
+#  CHARGE
+# =========================
+
+class Resultat:
+    def __init__(self, comptes):
+        self.latences = []
+        self.rejeux = 0
+        self.erreurs = 0
+        self.deltas = {num: Decimal("0") for num in comptes}
+        self.verrou = threading.Lock()
+
+
+def travailleur(comptes, lot, fin, resultat):
+    cnx = connecter()
+    cursor = cnx.cursor()
+    latences, rejeux, erreurs = [], 0, 0
+    deltas = {num: Decimal("0") for num in comptes}
+    credit = True
+    try:
+        while time.monotonic() < fin:
+            lignes = []
+            for _ in range(lot):
+                type_ = "CREDIT" if credit else "DEBIT"
+                credit = not credit
+                lignes.append((random.choice(comptes), MONTANT, type_))
+            debut = time.perf_counter()
+            try:
+                cursor.executemany(_SQL_INSERT, lignes)
+                cnx.commit()
+            except mysql.connector.Error as e:
+                cnx.rollback()
+                if e.errno in _A_REJOUER:
+                    rejeux += 1
+                else:
+                    erreurs += 1
+                    print(f"[bench] {e}")
+                continue
+            latences.append(time.perf_counter() - debut)
+            for num, montant, type_ in lignes:
+                deltas[num] += montant if type_ == "CREDIT" else -montant
+    finally:
+        cursor.close()
+        cnx.close()
+
+    with resultat.verrou:
+        resultat.latences += latences
+        resultat.rejeux += rejeux
+        resultat.erreurs += erreurs
+        for num, delta in deltas.items():
+            resultat.deltas[num] += delta
+
+
+def percentile(valeurs, p):
+    if not valeurs:
+        return 0.0
+    return valeurs[min(len(valeurs) - 1, int(len(valeurs) * p))]
+
+
+def banc(cnx, mode, comptes, threads, duree, lot):
+    """Une mesure dans `mode` ; retourne le dict des résultats."""
+    changer_mode(cnx, mode)
+    avant = soldes(cnx, comptes)
+    waits0, temps0 = verrous(cnx)
+
+    resultat = Resultat(comptes)
+    fin = time.monotonic() + duree
+    debut = time.monotonic()
+    pool = [threading.Thread(target=travailleur, args=(comptes, lot, fin, resultat))
+            for _ in range(threads)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    ecoule = time.monotonic() - debut
+
+    waits1, temps1 = verrous(cnx)
+
+    cnx.commit()
+    cursor = cnx.cursor()
+    t0 = time.perf_counter()
+    cursor.callproc("CompacterSoldes", (5000,))
+    cnx.commit()
+    compactage = time.perf_counter() - t0
+    cursor.close()
+
+    apres = soldes(cnx, comptes)
+    ecarts = [
+        num for num in comptes
+        if apres[num][0] != apres[num][1]
+        or apres[num][0] - avant[num][0] != resultat.deltas[num]
+    ]
+
+    latences = sorted(resultat.latences)
+    return {
+        "mode": mode,
+        "ops_s": len(latences) * lot / ecoule,
+        "p50_ms": percentile(latences, 0.50) * 1000,
+        "p99_ms": percentile(latences, 0.99) * 1000,
+        "attentes": waits1 - waits0,
+        "attente_ms": temps1 - temps0,
+        "rejeux": resultat.rejeux,
+        "erreurs": resultat.erreurs,
+        "compactage_s": compactage,
+        "ecarts": ecarts,
+    }
+
+
+def afficher(resultats, threads, nb_comptes, lot):
+    print(f"\n{threads} threads, {nb_comptes} compte(s), {lot} ligne(s) par validation\n")
+    print(f"{'mode':8} {'lignes/s':>10} {'p50 ms':>8} {'p99 ms':>8} "
+          f"{'attentes':>9} {'verrou ms':>10} {'rejeux':>7} {'compact. s':>11}  soldes")
+    for r in resultats:
+        verif = "OK" if not r["ecarts"] else f"{len(r['ecarts'])} écart(s)"
+        print(f"{r['mode']:8} {r['ops_s']:10.0f} {r['p50_ms']:8.2f} {r['p99_ms']:8.2f} "
+              f"{r['attentes']:9d} {r['attente_ms']:10d} {r['rejeux']:7d} "
+              f"{r['compactage_s']:11.3f}  {verif}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m bench_registre",
+        description="Contention des insertions : mode COMPTE contre mode JOURNAL "
+                    "(BDD de développement uniquement)",
+    )
+    parser.add_argument("--mode", choices=("compte", "journal", "les-deux"), default="les-deux")
+    parser.add_argument("--threads", type=int, default=8, help="connexions simultanées (8)")
+    parser.add_argument("--duree", type=float, default=10, help="secondes par mode (10)")
+    parser.add_argument("--comptes", type=int, default=1,
+                        help="comptes visés ; 1 = un seul compte très sollicité (1)")
+    parser.add_argument("--lot", type=int, default=1, help="lignes par validation (1)")
+    args = parser.parse_args(argv)
+
+    modes = {"compte": ["COMPTE"], "journal": ["JOURNAL"],
+             "les-deux": ["COMPTE", "JOURNAL"]}[args.mode]
+    comptes = comptes_banc(max(1, min(args.comptes, 9999)))
+
+    cnx = connecter()
+    mode_initial = lire_mode(cnx)
+    preparer(cnx, comptes)
+    resultats = []
+    try:
+        for mode in modes:
+            print(f"[bench] mode {mode} : {args.duree:g} s ...")
+            resultats.append(banc(cnx, mode, comptes, args.threads, args.duree,
+                                  max(1, args.lot)))
+    finally:
+        changer_mode(cnx, mode_initial)
+        nettoyer(cnx)
+        cnx.close()
+
+    afficher(resultats, args.threads, len(comptes), max(1, args.lot))
+    return 1 if any(r["ecarts"] or r["erreurs"] for r in resultats) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Flux des transactions - suivi de la table Transactions par id croissant
+-----------------------------------------------------------------------
+Module partagé, monté sous /opt/commun comme purple_dragon. Rodelika Web
+l'expose en HTTP (attente longue et SSE) ; un consommateur (rapprochement,
+exports, tableau de bord) ne lit que les lignes qu'il n'a pas encore vues.
+
+Un seul thread par processus interroge la BDD (clé primaire, id > tête)
+toutes les intervalle_s secondes et garde les `tampon` dernières lignes
+en mémoire ; les consommateurs attendent sur une condition et sont servis
+depuis ce tampon, quel que soit leur nombre. Un consommateur plus en
+retard que le tampon est servi par lots directement depuis la BDD.
+
+    flux = FluxTransactions(connecter)
+    flux.demarrer()
+    lignes, dernier_id = flux.lire(apres_id, limite=100, attente_s=25)
+
+Les id AUTO_INCREMENT sont attribués à l'insertion mais visibles au
+commit : l'id 12 peut apparaître avant l'id 11. Le thread de suivi tient
+donc les trous ouverts (id manquants sous la ligne suivante) avec
+l'instant où il les a vus pour la première fois, et s'arrête devant eux.
+Un trou vu depuis DELAI_TROU_S secondes est revérifié dans la table, sur
+une nouvelle lecture, avant d'être sauté : l'id est alors tenu pour une
+transaction annulée. L'âge compte depuis l'observation, pas depuis
+l'insertion de la ligne suivante (une longue transaction peut valider une
+ligne insérée bien avant). Un consommateur qui reprend à dernier_id ne
+saute donc aucune ligne validée dans ce délai.
+
+La position de chaque consommateur nommé est gardée dans la table
+ConsommateurFlux (lire_position / enregistrer_position) ; elle n'avance
+que quand le consommateur l'enregistre, après traitement.
+"""
+
+import collections
+import threading
+import time
+
+DELAI_TROU_S = 10
+LOT_MAX = 500
+
+_COLONNES = """
+    SELECT t.id, t.Num_Etudiant, t.Montant, t.Type, t.Date_Transaction,
+           t.Commentaire, t.Transfert_Bonus, t.Reference,
+           u.Nom, u.Prenom
+    FROM Transactions t
+    LEFT JOIN users u ON u.Num_Etudiant = t.Num_Etudiant
+"""
+
+_SQL_SUITE = _COLONNES + """
+    WHERE t.id > %s
+    ORDER BY t.id
+    LIMIT %s
+"""
+
+_SQL_TROU = """
+    SELECT id FROM Transactions
+    WHERE id > %s AND id < %s
+    LIMIT 1
+"""
+
+_SQL_DERNIERES = _COLONNES + """
+    ORDER BY t.id DESC
+    LIMIT %s
+"""
+
+_SQL_ENREGISTRER_POSITION = """
+    INSERT INTO ConsommateurFlux (Nom, Dernier_Id)
+    VALUES (%s, %s)
+    ON DUPLICATE KEY UPDATE Dernier_Id = GREATEST(Dernier_Id, VALUES(Dernier_Id))
+"""
+
+
+def _ligne_json(row):
+    """Ligne du curseur -> dict sérialisable (montant en chaîne, date ISO)."""
+    return {
+        "id": row["id"],
+        "num_etudiant": row["Num_Etudiant"],
+        "nom": row["Nom"],
+        "prenom": row["Prenom"],
+        "montant": f"{row['Montant']:.2f}",
+        "type": row["Type"],
+        "date": row["Date_Transaction"].isoformat(),
+        "commentaire": row["Commentaire"],
+        "transfert_bonus": row["Transfert_Bonus"],
+        "reference": row["Reference"],
+    }
+
+
+def lire_suite(cnx, apres_id, limite, trous=None):
+    """
+    Lignes validées d'id > apres_id, dans l'ordre, au plus `limite`.
+    Requête préparée (purple_dragon) : le thread de suivi la répète sur
+    la même connexion toutes les intervalle_s secondes.
+
+    trous : {id manquant: time.monotonic() de sa première observation},
+    gardé par l'appelant d'un appel à l'autre. La lecture s'arrête devant
+    un trou vu depuis moins de DELAI_TROU_S, ou dont un id est apparu à
+    la revérification (il sera lu au passage suivant). Sans trous (None),
+    toutes les lignes sont rendues : lecture sous une tête déjà publiée.
+    """
+    cursor = cnx.executer(_SQL_SUITE, (apres_id, limite))
+    rows = [dict(zip(cursor.column_names, r)) for r in cursor.fetchall()]
+    if trous is None:
+        return [_ligne_json(row) for row in rows]
+
+    maintenant = time.monotonic()
+    lignes = []
+    precedent = apres_id
+    for row in rows:
+        manquants = range(precedent + 1, row["id"])
+        if manquants:
+            for i in manquants:
+                trous.setdefault(i, maintenant)
+            if any(maintenant - trous[i] < DELAI_TROU_S for i in manquants):
+                break
+            if _trou_comble(cnx, precedent, row["id"]):
+                break
+            for i in manquants:
+                del trous[i]
+        lignes.append(_ligne_json(row))
+        precedent = row["id"]
+    return lignes
+
+
+def _trou_comble(cnx, apres_id, avant_id):
+    """Un id entre les deux est-il validé depuis ? (nouvelle lecture)"""
+    cnx.commit()    # REPEATABLE READ : sinon la même vue que la lecture
+    return cnx.executer(_SQL_TROU, (apres_id, avant_id)).fetchone() is not None
+
+
+def lire_dernieres(cnx, nb):
+    """Les nb dernières lignes, dans l'ordre des id (amorçage du tampon)."""
+    cursor = cnx.cursor(dictionary=True)
+    try:
+        cursor.execute(_SQL_DERNIERES, (nb,))
+        rows = cursor.fetchall()
+    finally:
+        cursor.close()
+    return [_ligne_json(row) for row in reversed(rows)]
+
+
+# =========================
+#  POSITION DES CONSOMMATEURS
+# =========================
+
+def lire_position(cnx, nom):
+    """Dernier id traité par le consommateur `nom` (0 s'il est nouveau)."""
+    cursor = cnx.cursor()
+    try:
+        cursor.execute("SELECT Dernier_Id FROM ConsommateurFlux WHERE Nom = %s", (nom,))
+        row = cursor.fetchone()
+    finally:
+        cursor.close()
+    return row[0] if row else 0
+
+
+def enregistrer_position(cnx, nom, dernier_id):
+    """Avance la position de `nom` (jamais en arrière), validée ici."""
+    cursor = cnx.cursor()
+    try:
+        cursor.execute(_SQL_ENREGISTRER_POSITION, (nom, dernier_id))
+        cnx.commit()
+    finally:
+        cursor.close()
+
+
+# =========================
+#  SUIVI EN TÂCHE DE FOND
+# =========================
+
+class FluxTransactions:
+    """Tête du flux et tampon des dernières lignes, partagés par le processus."""
+
+    def __init__(self, connecter, intervalle_s=0.5, tampon=1000):
+        self.connecter = connecter
+        self.intervalle_s = intervalle_s
+        self.tete = None            # dernier id publié (None : pas encore amorcé)
+        self._trous = {}            # id manquants au-delà de la tête (thread de suivi)
+        self._tampon = collections.deque(maxlen=tampon)
+        self._condition = threading.Condition()
+        self._abonnes = []
+        self._thread = None
+
+    def demarrer(self):
+        """Lance le thread de suivi (une fois)."""
+        with self._condition:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._boucle, daemon=True)
+                self._thread.start()
+
+    def abonner(self, rappel):
+        """
+        rappel(lignes) est appelé par le thread de suivi pour chaque lot
+        publié (après l'amorçage) ; il doit rendre la main rapidement.
+        """
+        self._abonnes.append(rappel)
+
+    # -------------------------
+    #  THREAD DE SUIVI
+    # -------------------------
+
+    def _boucle(self):
+        cnx = None
+        while True:
+            try:
+                if cnx is None:
+                    cnx = self.connecter()
+                self._avancer(cnx)
+            except Exception as e:
+                print(f"[flux] suivi Transactions impossible : {e}")
+                try:
+                    if cnx is not None:
+                        cnx.close()
+                except Exception:
+                    pass
+                cnx = None
+            time.sleep(self.intervalle_s)
+
+    def _avancer(self, cnx):
+        # lecture cohérente à chaque passage (sinon REPEATABLE READ fige la vue)
+        cnx.commit()
+        if self.tete is None:
+            lignes = lire_dernieres(cnx, self._tampon.maxlen)
+            # aucun trou n'a encore été observé : l'amorçage s'arrête au
+            # premier, lire_suite publiera la suite quand il sera tranché
+            for n in range(1, len(lignes)):
+                if lignes[n]["id"] != lignes[n - 1]["id"] + 1:
+                    del lignes[n:]
+                    break
+            with self._condition:
+                self._tampon.extend(lignes)
+                self.tete = lignes[-1]["id"] if lignes else 0
+                self._condition.notify_all()
+            return
+
+        while True:
+            lignes = lire_suite(cnx, self.tete, LOT_MAX, self._trous)
+            if not lignes:
+                return
+            with self._condition:
+                self._tampon.extend(lignes)
+                self.tete = lignes[-1]["id"]
+                self._condition.notify_all()
+            # trous comblés entre-temps (leur ligne est passée)
+            for i in [i for i in self._trous if i <= self.tete]:
+                del self._trous[i]
+            for rappel in self._abonnes:
+                try:
+                    rappel(lignes)
+                except Exception as e:
+                    print(f"[flux] abonné en erreur : {e}")
+            if len(lignes) < LOT_MAX:
+                return
+
+    # -------------------------
+    #  LECTURE
+    # -------------------------
+
+    def dernieres(self, nb):
+        """Les nb dernières lignes publiées, les plus récentes en dernier."""
+        with self._condition:
+            return list(self._tampon)[-nb:] if nb > 0 else []
+
+    def lire(self, apres_id, limite=100, attente_s=0):
+        """
+        (lignes d'id > apres_id, dernier id à reprendre). Sans ligne
+        nouvelle, attend au plus attente_s secondes qu'il en arrive.
+        Lève l'exception de mysql.connector si un consommateur en retard
+        doit être servi depuis la BDD et qu'elle ne répond pas.
+        """
+        limite = max(1, min(limite, LOT_MAX))
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self.tete is not None and self.tete > apres_id,
+                timeout=attente_s,
+            )
+            if self.tete is None or self.tete <= apres_id:
+                return [], apres_id
+            if self._tampon and self._tampon[0]["id"] <= apres_id + 1:
+                lignes = [l for l in self._tampon if l["id"] > apres_id][:limite]
+                return lignes, lignes[-1]["id"]
+            tete = self.tete
+
+        # en retard sur le tampon : lecture par lot, sans dépasser la tête
+        cnx = self.connecter()
+        try:
+            lignes = [l for l in lire_suite(cnx, apres_id, limite) if l["id"] <= tete]
+        finally:
+            cnx.close()
+        if not lignes:
+            return [], apres_id
+        return lignes, lignes[-1]["id"]
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Liste d'opposition - cartes désactivées (Carte.Actif = 0)
+---------------------------------------------------------
+Module partagé, monté sous /opt/commun comme purple_dragon. Utilisé par
+Lunar White, qui ne peut pas payer un aller-retour BDD par boisson.
+
+Chaque machine garde en mémoire l'ensemble des numéros de série
+(Num_Carte, voir perso_carte.lire_serie) des cartes désactivées :
+
+    opposition = ListeOpposition("opposition.json")
+    opposition.synchroniser(connecter)   # en tâche de fond
+    if serie in opposition: ...          # refus, sans BDD
+
+La synchronisation est incrémentale : seules les lignes de Carte dont
+Date_Modification a bougé depuis la dernière synchronisation sont lues
+(index idx_carte_modif), avec un recouvrement de RECOUVREMENT_S secondes
+pour les transactions validées après coup. La liste est écrite sur disque
+après chaque changement et relue au démarrage : sans BDD, la machine
+refuse les cartes connues comme désactivées à la dernière synchronisation.
+
+La consultation ne prend pas de verrou : l'ensemble est remplacé d'un
+bloc (copie puis affectation), jamais modifié en place.
+"""
+
+import datetime
+import json
+import os
+import threading
+
+RECOUVREMENT_S = 5
+
+_FORMAT_DATE = "%Y-%m-%d %H:%M:%S"
+
+_SQL_DELTA = """
+    SELECT Num_Carte, Actif, Date_Modification
+    FROM Carte
+    WHERE Date_Modification >= %s
+    ORDER BY Date_Modification
+"""
+
+_SQL_COMPLET = """
+    SELECT Num_Carte, Actif, Date_Modification
+    FROM Carte
+    WHERE Actif = 0
+"""
+
+
+class ListeOpposition:
+    """Ensemble des Num_Carte désactivés, répliqué depuis la table Carte."""
+
+    def __init__(self, chemin):
+        self.chemin = chemin
+        self.depuis = None          # Date_Modification la plus récente vue
+        self.derniere_synchro = None
+        self._cartes = frozenset()
+        self._verrou = threading.Lock()     # un seul synchroniser() à la fois
+        self._charger()
+
+    def __contains__(self, num_carte):
+        return num_carte in self._cartes
+
+    def __len__(self):
+        return len(self._cartes)
+
+    # -------------------------
+    #  FICHIER LOCAL
+    # -------------------------
+
+    def _charger(self):
+        try:
+            with open(self.chemin, "r", encoding="utf-8") as f:
+                etat = json.load(f)
+        except FileNotFoundError:
+            return
+        except ValueError as e:
+            # fichier abîmé : resynchronisation complète au prochain passage
+            print(f"[opposition] {self.chemin} illisible ({e}), ignoré")
+            return
+        self._cartes = frozenset(etat.get("cartes", []))
+        if etat.get("depuis"):
+            self.depuis = datetime.datetime.strptime(etat["depuis"], _FORMAT_DATE)
+
+    def _sauver(self):
+        etat = {
+            "depuis": self.depuis.strftime(_FORMAT_DATE) if self.depuis else None,
+            "cartes": sorted(self._cartes),
+        }
+        tmp = self.chemin + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(etat, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.chemin)
+
+    # -------------------------
+    #  SYNCHRONISATION
+    # -------------------------
+
+    def synchroniser(self, connecter):
+        """
+        Applique les changements de la table Carte depuis la dernière
+        synchronisation (liste complète la première fois). connecter()
+        fournit une connexion, fermée ensuite. Retourne le nombre de cartes
+        ajoutées ou retirées ; lève l'exception de mysql.connector (ou
+        ConnectionError) si la BDD ne répond pas, la liste restant telle
+        quelle.
+        """
+        with self._verrou:
+            cnx = connecter()
+            if cnx is None:
+                raise ConnectionError("BDD indisponible")
+            try:
+                cursor = cnx.cursor()
+                depuis = self.depuis
+                if depuis is None:
+                    # heure du serveur BDD : pas de décalage d'horloge possible
+                    cursor.execute("SELECT NOW()")
+                    (depuis,) = cursor.fetchone()
+                    cursor.execute(_SQL_COMPLET)
+                else:
+                    cursor.execute(_SQL_DELTA,
+                                   (depuis - datetime.timedelta(seconds=RECOUVREMENT_S),))
+                lignes = cursor.fetchall()
+                cursor.close()
+            finally:
+                cnx.close()
+
+            cartes = set(self._cartes) if self.depuis is not None else set()
+            for num_carte, actif, modif in lignes:
+                if actif:
+                    cartes.discard(num_carte)
+                else:
+                    cartes.add(num_carte)
+                if modif > depuis:
+                    depuis = modif
+
+            nb = len(cartes ^ self._cartes)
+            self._cartes = frozenset(cartes)
+            self.derniere_synchro = datetime.datetime.now()
+            if nb or depuis != self.depuis:
+                self.depuis = depuis
+                self._sauver()
+            return nb
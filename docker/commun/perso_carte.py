@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Perso carte - formats de personnalisation Rubrovitamin
+------------------------------------------------------
+Module partagé par Lubiana, Berlicum et Lunar White, monté sous
+/opt/commun comme purple_dragon.
+
+Deux formats cohabitent dans la zone perso de la carte (81 01 / 81 02) :
+- historique : ASCII "num;nom;prenom" (20 octets pour 22001234;DUPONT;Jean)
+- compact v1 : C1 | numéro étudiant BCD (4 octets) | longueur du nom | nom
+  | prénom, nom et prénom en latin-1 (16 octets pour le même étudiant)
+Le premier octet suffit à les distinguer : une perso historique commence
+par un chiffre ASCII.
+
+Les cartes qui annoncent CAP_NUM_ETU dans l'ATR renvoient le numéro seul,
+en BCD (81 03 00 00 04), quel que soit le format stocké : 4 octets au lieu
+de la perso complète (et de sa relecture après 6C).
+
+Les cartes qui annoncent CAP_SERIE ont un numéro de série de 6 octets,
+écrit une fois par Lubiana (81 05) et relu par 81 04 ; en hexadécimal
+(12 caractères) c'est la clé Num_Carte de la table Carte (voir
+registre_cartes).
+"""
+
+import secrets
+
+# Capacité annoncée dans l'ATR (voir rubro_v2.c)
+CAP_NUM_ETU = 0x04  # 81 03 : numéro étudiant seul, en BCD
+CAP_SERIE = 0x08    # 81 04 / 81 05 : numéro de série de la carte
+
+PERSO_V1 = 0xC1     # premier octet d'une perso compacte
+MAX_PERSO = 32      # taille de la zone perso de la carte
+SERIE_LEN = 6       # octets du numéro de série
+
+
+# =========================
+#  CODAGE
+# =========================
+
+def num_vers_bcd(num):
+    """'22001234' -> [0x22, 0x00, 0x12, 0x34] (8 chiffres au plus, zéros à gauche)."""
+    num = str(num).strip()
+    if not num.isdigit() or len(num) > 8:
+        raise ValueError(f"numéro étudiant invalide : {num!r}")
+    num = num.zfill(8)
+    return [int(num[i]) << 4 | int(num[i + 1]) for i in range(0, 8, 2)]
+
+
+def bcd_vers_num(data):
+    """[0x22, 0x00, 0x12, 0x34] -> '22001234' ; None si un quartet n'est pas un chiffre."""
+    if len(data) != 4:
+        return None
+    chiffres = []
+    for b in data:
+        for q in (b >> 4, b & 0x0F):
+            if q > 9:
+                return None
+            chiffres.append(str(q))
+    return "".join(chiffres)
+
+
+def encoder_perso(num, nom, prenom, compact=True):
+    """
+    Octets de perso à envoyer par 81 01. Lève ValueError si le numéro
+    n'est pas valide ou si la perso dépasse la zone de la carte.
+    """
+    if compact:
+        nom_b = nom.encode("latin-1", errors="replace")
+        prenom_b = prenom.encode("latin-1", errors="replace")
+        if len(nom_b) > 255:
+            raise ValueError("nom trop long")
+        octets = [PERSO_V1] + num_vers_bcd(num) + [len(nom_b)] + list(nom_b) + list(prenom_b)
+    else:
+        octets = [ord(c) & 0xFF for c in f"{num};{nom};{prenom}"]
+    if len(octets) > MAX_PERSO:
+        raise ValueError(f"perso trop longue ({len(octets)} octets, {MAX_PERSO} au plus)")
+    return octets
+
+
+def decoder_perso(data):
+    """
+    Octets lus par 81 02 (l'un ou l'autre format) -> (num, nom, prenom).
+    num est une chaîne CHAR(8) ou None s'il est illisible ; ("", "", "")
+    pour une carte non attribuée.
+    """
+    data = list(data or [])
+    if not data:
+        return "", "", ""
+
+    if data[0] == PERSO_V1:
+        if len(data) < 6 or 6 + data[5] > len(data):
+            return None, "", ""
+        fin_nom = 6 + data[5]
+        num = bcd_vers_num(data[1:5])
+        nom = bytes(data[6:fin_nom]).decode("latin-1")
+        prenom = bytes(data[fin_nom:]).decode("latin-1")
+        return num, nom.strip(), prenom.strip()
+
+    s = "".join(chr(b) for b in data).rstrip("\x00")
+    parts = s.split(";")
+    raw_num = parts[0].strip()
+    nom = parts[1].strip() if len(parts) > 1 else ""
+    prenom = parts[2].strip() if len(parts) > 2 else ""
+    num = raw_num.zfill(8) if raw_num.isdigit() and len(raw_num) <= 8 else None
+    return num, nom, prenom
+
+
+# =========================
+#  LECTURE CARTE
+# =========================
+
+def capacites(conn):
+    """Octet qui suit "rubro" dans l'historique de l'ATR (0 = anciennes cartes)."""
+    try:
+        atr = bytes(conn.getATR())
+    except Exception:
+        return 0
+    i = atr.find(b"rubro")
+    if i < 0 or i + 5 >= len(atr):
+        return 0
+    return atr[i + 5]
+
+
+def lire_perso(conn):
+    """81 02 avec reprise sur 6C : (octets, None) ou (None, erreur)."""
+    apdu = [0x81, 0x02, 0x00, 0x00, 0x05]
+    data, sw1, sw2 = conn.transmit(apdu)
+    if sw1 == 0x6C:
+        apdu[4] = sw2
+        data, sw1, sw2 = conn.transmit(apdu)
+    if sw1 != 0x90 or sw2 != 0x00:
+        return None, f"Erreur lecture perso: SW1={sw1:02X} SW2={sw2:02X}"
+    return list(data or []), None
+
+
+def lire_num_etudiant(conn):
+    """
+    Numéro étudiant CHAR(8) : (num, None) ou (None, erreur).
+    81 03 si la carte le permet, sinon lecture et décodage de la perso.
+    Les exceptions de transmission sont laissées à l'appelant.
+    """
+    if capacites(conn) & CAP_NUM_ETU:
+        data, sw1, sw2 = conn.transmit([0x81, 0x03, 0x00, 0x00, 0x04])
+        if sw1 == 0x90 and sw2 == 0x00:
+            num = bcd_vers_num(list(data))
+            if num is None:
+                return None, f"Numéro étudiant BCD invalide: {bytes(data).hex().upper()}"
+            return num, None
+        if sw1 == 0x6A and sw2 == 0x88:
+            return None, "Carte non attribuée (aucune perso)"
+        return None, f"Erreur lecture numéro: SW1={sw1:02X} SW2={sw2:02X}"
+
+    data, err = lire_perso(conn)
+    if err:
+        return None, err
+    if not data:
+        return None, "Carte non attribuée (aucune perso)"
+    num, _, _ = decoder_perso(data)
+    if num is None:
+        return None, f"Numéro étudiant invalide dans la perso: {bytes(data).hex().upper()}"
+    return num, None
+
+
+# =========================
+#  NUMÉRO DE SÉRIE
+# =========================
+
+def lire_serie(conn):
+    """
+    Numéro de série en hexadécimal majuscule : (serie, None), (None, None)
+    si la carte n'en a pas (ancienne carte ou série pas encore écrite),
+    (None, erreur) sinon. Les exceptions de transmission sont laissées à
+    l'appelant.
+    """
+    if not capacites(conn) & CAP_SERIE:
+        return None, None
+    data, sw1, sw2 = conn.transmit([0x81, 0x04, 0x00, 0x00, SERIE_LEN])
+    if sw1 == 0x90 and sw2 == 0x00:
+        return bytes(data).hex().upper(), None
+    if sw1 == 0x6A and sw2 == 0x88:
+        return None, None
+    return None, f"Erreur lecture série: SW1={sw1:02X} SW2={sw2:02X}"
+
+
+def ecrire_serie(conn, serie=None):
+    """
+    Écrit le numéro de série (hexadécimal, tiré au hasard par défaut) si la
+    carte n'en a pas encore : (serie de la carte, None) ou (None, erreur).
+    Une carte qui en a déjà un garde le sien.
+    """
+    actuelle, err = lire_serie(conn)
+    if actuelle or err:
+        return actuelle, err
+    if not capacites(conn) & CAP_SERIE:
+        return None, "Carte sans numéro de série (capacité 08 absente)"
+    while serie is None or serie == "FF" * SERIE_LEN:
+        serie = secrets.token_hex(SERIE_LEN).upper()
+    octets = list(bytes.fromhex(serie))
+    _, sw1, sw2 = conn.transmit([0x81, 0x05, 0x00, 0x00, SERIE_LEN] + octets)
+    if sw1 != 0x90 or sw2 != 0x00:
+        return None, f"Erreur écriture série: SW1={sw1:02X} SW2={sw2:02X}"
+    return serie.upper(), None
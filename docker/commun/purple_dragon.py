@@ -0,0 +1,519 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Purple Dragon - couche d'accès BDD commune
+------------------------------------------
+Module partagé par tous les services (Rodelika, Berlicum, Lunar White...).
+Il est monté dans chaque conteneur sous /opt/commun (voir docker-compose.yml).
+
+- connect(**DB_CONFIG) : remplace mysql.connector.connect(**DB_CONFIG)
+- chaque execute() / callproc() est chronométré
+- au-delà du seuil (PD_SEUIL_LENT_MS, 200 ms par défaut), la requête est
+  enregistrée dans un fichier local tournant (PD_JOURNAL_LENT) :
+    * SQL normalisé (littéraux remplacés par ?)
+    * forme des paramètres (types, pas les valeurs)
+    * route appelante (route Flask ou script:fonction pour les CLI)
+    * plan EXPLAIN
+- résumé des pires requêtes (temps total cumulé) :
+    $ python -m purple_dragon top [-n 10] [fichier]
+- cnx.executer(sql, params) : requête préparée côté serveur (protocole
+  binaire), préparée une fois par connexion puis réutilisée ; à réserver
+  aux requêtes fréquentes sur une connexion gardée ouverte. Taux de
+  réutilisation : stats_preparees()
+- disjoncteur : après PD_DISJONCTEUR_ECHECS échecs réseau consécutifs,
+  connect() et ping() lèvent BddIndisponible sans attendre pendant
+  PD_DISJONCTEUR_OUVERT_S secondes, puis une seule connexion d'essai
+  décide de la reprise. État : etat_bdd()
+"""
+
+import argparse
+import collections
+import datetime
+import glob
+import inspect
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from logging.handlers import RotatingFileHandler
+
+import mysql.connector
+
+SEUIL_LENT_MS = float(os.environ.get("PD_SEUIL_LENT_MS", "200"))
+JOURNAL_LENT = os.environ.get("PD_JOURNAL_LENT", "requetes_lentes.log")
+JOURNAL_TAILLE_MAX = 5 * 1024 * 1024  # 5 Mo par fichier
+JOURNAL_NB_ARCHIVES = 3
+PREPAREES_MAX = int(os.environ.get("PD_PREPAREES_MAX", "32"))  # par connexion
+
+# Délais réseau (secondes) appliqués par connect() si la config n'en donne pas
+DELAI_CONNEXION_S = int(os.environ.get("PD_DELAI_CONNEXION_S", "3"))
+DELAI_LECTURE_S = int(os.environ.get("PD_DELAI_LECTURE_S", "10")) or None  # 0 : sans
+
+DISJONCTEUR_ECHECS = int(os.environ.get("PD_DISJONCTEUR_ECHECS", "3"))
+DISJONCTEUR_OUVERT_S = float(os.environ.get("PD_DISJONCTEUR_OUVERT_S", "10"))
+
+# Erreurs client "serveur injoignable / connexion perdue" ; les autres
+# (accès refusé, erreur SQL...) prouvent que le serveur répond
+_ERREURS_RESEAU = {2002, 2003, 2005, 2006, 2013, 2055}
+
+# Seules ces instructions acceptent un EXPLAIN sous MySQL 8
+_EXPLICABLES = ("SELECT", "INSERT", "UPDATE", "DELETE", "REPLACE")
+
+_journal = None
+
+# texte SQL -> {"preparations": n, "executions": n}, tous threads confondus
+_preparees = {}
+_verrou_preparees = threading.Lock()
+
+
+# =========================
+#  JOURNAL DES REQUÊTES LENTES
+# =========================
+
+def _get_journal():
+    """Logger dédié (fichier tournant), créé au premier usage."""
+    global _journal
+    if _journal is None:
+        _journal = logging.getLogger("purple_dragon.lent")
+        _journal.setLevel(logging.INFO)
+        _journal.propagate = False
+        handler = RotatingFileHandler(
+            JOURNAL_LENT,
+            maxBytes=JOURNAL_TAILLE_MAX,
+            backupCount=JOURNAL_NB_ARCHIVES,
+            encoding="utf-8",
+        )
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        _journal.addHandler(handler)
+    return _journal
+
+
+def normaliser_sql(sql):
+    """
+    Réduit une requête à sa forme canonique pour pouvoir regrouper
+    les exécutions identiques : littéraux et marqueurs -> ?,
+    listes IN (...) repliées, espaces compactés.
+    """
+    s = sql.strip()
+    s = re.sub(r"'(?:[^'\\]|\\.|'')*'", "?", s)
+    s = re.sub(r'"(?:[^"\\]|\\.)*"', "?", s)
+    s = s.replace("%%", "%")
+    s = re.sub(r"%\(\w+\)s|%s", "?", s)
+    s = re.sub(r"\b\d+(?:\.\d+)?\b", "?", s)
+    s = re.sub(r"\(\s*\?(?:\s*,\s*\?)+\s*\)", "(?+)", s)
+    s = re.sub(r"\s+", " ", s)
+    return s
+
+
+def forme_parametres(params):
+    """Types des paramètres, jamais leurs valeurs (données personnelles)."""
+    if params is None:
+        return None
+    if isinstance(params, dict):
+        return {k: type(v).__name__ for k, v in params.items()}
+    return [type(v).__name__ for v in params]
+
+
+def route_appelante():
+    """Route Flask en cours, sinon 'script:fonction' du premier appelant."""
+    try:
+        from flask import has_request_context, request
+        if has_request_context():
+            regle = request.url_rule.rule if request.url_rule else request.path
+            return f"{request.method} {regle}"
+    except ImportError:
+        pass
+
+    for frame in inspect.stack()[1:]:
+        if frame.filename != __file__:
+            return f"{os.path.basename(frame.filename)}:{frame.function}"
+    return "?"
+
+
+def _expliquer(config, sql, params):
+    """
+    EXPLAIN sur une connexion séparée : le curseur appelant peut avoir
+    des résultats non lus, on ne touche donc pas à sa connexion.
+    """
+    if sql.lstrip().split(None, 1)[0].upper() not in _EXPLICABLES:
+        return None
+    cnx = None
+    try:
+        cnx = _surveiller(mysql.connector.connect, **config)
+        cursor = cnx.cursor(dictionary=True)
+        cursor.execute("EXPLAIN " + sql, params)
+        plan = cursor.fetchall()
+        cursor.close()
+        return [{k: (v if isinstance(v, (int, float, type(None))) else str(v))
+                 for k, v in ligne.items()} for ligne in plan]
+    except mysql.connector.Error as e:
+        return f"EXPLAIN impossible : {e}"
+    finally:
+        if cnx is not None:
+            try:
+                cnx.close()
+            except Exception:
+                pass
+
+
+def _mesurer(config, sql, params, duree_ms, procedure=False):
+    """Enregistre la requête si elle dépasse le seuil."""
+    if duree_ms < SEUIL_LENT_MS:
+        return
+    entree = {
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "duree_ms": round(duree_ms, 2),
+        "sql": ("CALL " + sql) if procedure else normaliser_sql(sql),
+        "params": forme_parametres(params),
+        "route": route_appelante(),
+        "explain": None if procedure else _expliquer(config, sql, params),
+    }
+    try:
+        _get_journal().info(json.dumps(entree, ensure_ascii=False))
+    except Exception as e:
+        print(f"[purple_dragon] journal des requêtes lentes indisponible : {e}")
+
+
+# =========================
+#  DISJONCTEUR
+# =========================
+
+class BddIndisponible(mysql.connector.errors.OperationalError):
+    """Refus immédiat, sans accès réseau : le disjoncteur est ouvert."""
+
+
+class Disjoncteur:
+    """
+    FERME : tout passe ; les échecs réseau consécutifs sont comptés.
+    OUVERT : tout est refusé (BddIndisponible) pendant ouvert_s secondes.
+    DEMI_OUVERT : une seule connexion d'essai passe, les autres sont
+    refusées ; son succès referme le disjoncteur, son échec le rouvre.
+    """
+
+    def __init__(self, echecs_max=DISJONCTEUR_ECHECS, ouvert_s=DISJONCTEUR_OUVERT_S):
+        self.echecs_max = echecs_max
+        self.ouvert_s = ouvert_s
+        self.etat = "FERME"
+        self.echecs = 0
+        self.depuis = time.time()
+        self.derniere_erreur = None
+        self.refus = 0              # appels refusés depuis l'ouverture
+        self._reessai = 0.0         # time.monotonic() du prochain essai
+        self._sonde = False         # essai en cours (DEMI_OUVERT)
+        self._verrou = threading.Lock()
+
+    def _changer(self, etat):
+        if etat != self.etat:
+            print(f"[purple_dragon] disjoncteur BDD : {self.etat} -> {etat}")
+            self.etat = etat
+            self.depuis = time.time()
+
+    def avant(self):
+        """À appeler avant un accès réseau : lève BddIndisponible si refusé."""
+        with self._verrou:
+            if self.etat == "FERME":
+                return
+            if self.etat == "OUVERT" and time.monotonic() >= self._reessai:
+                self._changer("DEMI_OUVERT")
+                self._sonde = False
+            if self.etat == "DEMI_OUVERT" and not self._sonde:
+                self._sonde = True
+                return
+            self.refus += 1
+            attente = max(0.0, self._reessai - time.monotonic())
+        raise BddIndisponible(
+            msg=f"BDD indisponible (disjoncteur {self.etat}, essai dans {attente:.0f} s)",
+            errno=2003,
+        )
+
+    def succes(self):
+        with self._verrou:
+            self.echecs = 0
+            self._sonde = False
+            if self.etat != "FERME":
+                self.refus = 0
+                self._changer("FERME")
+
+    def rendre_sonde(self):
+        """Essai interrompu sans verdict (exception hors MySQL)."""
+        with self._verrou:
+            self._sonde = False
+
+    def echec(self, erreur):
+        """Erreur d'un accès réseau ; seules les erreurs réseau comptent."""
+        if getattr(erreur, "errno", None) not in _ERREURS_RESEAU:
+            self.succes()       # erreur SQL, accès refusé... : le serveur répond
+            return
+        with self._verrou:
+            self.echecs += 1
+            self.derniere_erreur = str(erreur)
+            self._sonde = False
+            if self.etat == "DEMI_OUVERT" or self.echecs >= self.echecs_max:
+                self._reessai = time.monotonic() + self.ouvert_s
+                self._changer("OUVERT")
+
+    def etat_json(self):
+        with self._verrou:
+            return {
+                "etat": self.etat,
+                "depuis": datetime.datetime.fromtimestamp(self.depuis).isoformat(timespec="seconds"),
+                "echecs_consecutifs": self.echecs,
+                "refus": self.refus,
+                "prochain_essai_s": (round(max(0.0, self._reessai - time.monotonic()), 1)
+                                     if self.etat == "OUVERT" else None),
+                "derniere_erreur": self.derniere_erreur,
+            }
+
+
+_disjoncteur = Disjoncteur()
+
+
+def etat_bdd():
+    """État du disjoncteur de ce processus (pour une page de statut)."""
+    return _disjoncteur.etat_json()
+
+
+def _surveiller(appel, *args, **kwargs):
+    """Appel réseau sous le disjoncteur (connexion, ping, requête)."""
+    _disjoncteur.avant()
+    termine = False
+    try:
+        resultat = appel(*args, **kwargs)
+        termine = True
+    except mysql.connector.Error as e:
+        _disjoncteur.echec(e)
+        raise
+    finally:
+        # autre exception (TypeError, KeyboardInterrupt...) : l'essai
+        # DEMI_OUVERT est rendu, sinon plus aucun appel ne passerait
+        if not termine:
+            _disjoncteur.rendre_sonde()
+    _disjoncteur.succes()
+    return resultat
+
+
+# =========================
+#  CONNEXION / CURSEUR CHRONOMÉTRÉS
+# =========================
+
+class _CurseurChrono:
+    """Enveloppe un curseur mysql.connector et chronomètre ses requêtes."""
+
+    def __init__(self, curseur, config):
+        self._curseur = curseur
+        self._config = config
+
+    def execute(self, operation, params=None, *args, **kwargs):
+        # seules les requêtes abouties sont mesurées : un échec (BDD
+        # injoignable) n'ouvre pas de connexion d'EXPLAIN
+        debut = time.perf_counter()
+        resultat = _surveiller(self._curseur.execute, operation, params, *args, **kwargs)
+        duree_ms = (time.perf_counter() - debut) * 1000.0
+        _mesurer(self._config, operation, params, duree_ms)
+        return resultat
+
+    def callproc(self, procname, args=()):
+        debut = time.perf_counter()
+        resultat = _surveiller(self._curseur.callproc, procname, args)
+        duree_ms = (time.perf_counter() - debut) * 1000.0
+        _mesurer(self._config, procname, args, duree_ms, procedure=True)
+        return resultat
+
+    def __iter__(self):
+        return iter(self._curseur)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._curseur.close()
+        return False
+
+    def __getattr__(self, nom):
+        return getattr(self._curseur, nom)
+
+
+class _ConnexionChrono:
+    """Enveloppe une connexion : seuls les curseurs sont instrumentés."""
+
+    def __init__(self, cnx, config):
+        self._cnx = cnx
+        self._config = config
+        self._curseurs_prepares = collections.OrderedDict()   # sql -> curseur
+        self._id_prepares = None
+
+    def cursor(self, *args, **kwargs):
+        return _CurseurChrono(self._cnx.cursor(*args, **kwargs), self._config)
+
+    def executer(self, sql, params=()):
+        """
+        Exécute sql en requête préparée, avec un curseur gardé pour ce
+        texte SQL : la préparation (analyse côté serveur) n'a lieu qu'à la
+        première exécution sur cette connexion. Retourne le curseur
+        (fetchone / fetchall / rowcount / lastrowid), à lire avant la
+        requête suivante et à ne pas fermer. Paramètres en %s ; pas de %%
+        à doubler dans le SQL.
+        """
+        # reconnexion (ping(reconnect=True)) : le serveur a oublié les requêtes
+        if self._id_prepares != self._cnx.connection_id:
+            self._fermer_prepares()
+            self._id_prepares = self._cnx.connection_id
+
+        curseur = self._curseurs_prepares.get(sql)
+        nouvelle = curseur is None
+        if nouvelle:
+            if len(self._curseurs_prepares) >= PREPAREES_MAX:
+                _, ancien = self._curseurs_prepares.popitem(last=False)
+                _fermer_curseur(ancien)
+            curseur = self.cursor(prepared=True)
+            self._curseurs_prepares[sql] = curseur
+        else:
+            self._curseurs_prepares.move_to_end(sql)
+        _compter_preparee(sql, nouvelle)
+        curseur.execute(sql, params)
+        return curseur
+
+    def _fermer_prepares(self):
+        for curseur in self._curseurs_prepares.values():
+            _fermer_curseur(curseur)
+        self._curseurs_prepares.clear()
+
+    def ping(self, *args, **kwargs):
+        # ping(reconnect=True, attempts=3, delay=1) attendrait plusieurs délais
+        return _surveiller(self._cnx.ping, *args, **kwargs)
+
+    def close(self):
+        self._fermer_prepares()
+        self._cnx.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def __getattr__(self, nom):
+        return getattr(self._cnx, nom)
+
+
+def _fermer_curseur(curseur):
+    """Ferme un curseur préparé (libère la requête côté serveur)."""
+    try:
+        curseur.close()
+    except Exception:
+        pass
+
+
+def _compter_preparee(sql, nouvelle):
+    with _verrou_preparees:
+        s = _preparees.setdefault(sql, {"preparations": 0, "executions": 0})
+        s["executions"] += 1
+        if nouvelle:
+            s["preparations"] += 1
+
+
+def stats_preparees():
+    """
+    Requêtes passées par executer() dans ce processus : préparations,
+    exécutions et part des exécutions servies sans nouvelle préparation.
+    """
+    with _verrou_preparees:
+        requetes = [dict(s, sql=normaliser_sql(sql)) for sql, s in _preparees.items()]
+    preparations = sum(s["preparations"] for s in requetes)
+    executions = sum(s["executions"] for s in requetes)
+    for s in requetes:
+        s["taux_reutilisation"] = round(1 - s["preparations"] / s["executions"], 4)
+    return {
+        "preparations": preparations,
+        "executions": executions,
+        "taux_reutilisation": round(1 - preparations / executions, 4) if executions else None,
+        "requetes": sorted(requetes, key=lambda s: s["executions"], reverse=True),
+    }
+
+
+def connect(**config):
+    """
+    Équivalent de mysql.connector.connect(), avec chronométrage, délais
+    réseau par défaut (PD_DELAI_CONNEXION_S, PD_DELAI_LECTURE_S) et
+    disjoncteur : lève BddIndisponible tout de suite s'il est ouvert.
+    """
+    config.setdefault("connection_timeout", DELAI_CONNEXION_S)
+    if DELAI_LECTURE_S:
+        config.setdefault("read_timeout", DELAI_LECTURE_S)
+        config.setdefault("write_timeout", DELAI_LECTURE_S)
+    return _ConnexionChrono(_surveiller(mysql.connector.connect, **config), config)
+
+
+# =========================
+#  RÉSUMÉ : python -m purple_dragon top
+# =========================
+
+def _lire_journal(fichier):
+    """Lit le journal courant et ses archives (.1, .2, ...)."""
+    for chemin in sorted(glob.glob(glob.escape(fichier) + "*")):
+        with open(chemin, "r", encoding="utf-8") as f:
+            for ligne in f:
+                try:
+                    yield json.loads(ligne)
+                except ValueError:
+                    continue
+
+
+def resume(fichier=JOURNAL_LENT, n=10):
+    """Agrège le journal par SQL normalisé, trié par temps total décroissant."""
+    stats = {}
+    for e in _lire_journal(fichier):
+        s = stats.setdefault(e["sql"], {
+            "sql": e["sql"], "nb": 0, "total_ms": 0.0, "max_ms": 0.0,
+            "routes": set(), "explain": None,
+        })
+        s["nb"] += 1
+        s["total_ms"] += e["duree_ms"]
+        s["max_ms"] = max(s["max_ms"], e["duree_ms"])
+        s["routes"].add(e.get("route") or "?")
+        if e.get("explain"):
+            s["explain"] = e["explain"]
+    return sorted(stats.values(), key=lambda s: s["total_ms"], reverse=True)[:n]
+
+
+def _afficher_resume(lignes):
+    if not lignes:
+        print("Aucune requête lente enregistrée.")
+        return
+    for i, s in enumerate(lignes, 1):
+        print("=" * 78)
+        print(f"#{i}  total={s['total_ms']:.0f} ms | nb={s['nb']} | "
+              f"moy={s['total_ms'] / s['nb']:.1f} ms | max={s['max_ms']:.1f} ms")
+        print(f"    routes : {', '.join(sorted(s['routes']))}")
+        print(f"    sql    : {s['sql']}")
+        if isinstance(s["explain"], list):
+            for p in s["explain"]:
+                print(f"    plan   : table={p.get('table')} type={p.get('type')} "
+                      f"key={p.get('key')} rows={p.get('rows')} extra={p.get('Extra')}")
+        elif s["explain"]:
+            print(f"    plan   : {s['explain']}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m purple_dragon",
+        description="Outils de la couche BDD Purple Dragon",
+    )
+    sous = parser.add_subparsers(dest="commande", required=True)
+    top = sous.add_parser("top", help="requêtes lentes les plus coûteuses")
+    top.add_argument("fichier", nargs="?", default=JOURNAL_LENT)
+    top.add_argument("-n", type=int, default=10, help="nombre de requêtes (10)")
+
+    args = parser.parse_args(argv)
+    if args.commande == "top":
+        _afficher_resume(resume(args.fichier, args.n))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
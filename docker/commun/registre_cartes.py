@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Registre des cartes - table Carte
+---------------------------------
+Module partagé par Lubiana (enregistrement à l'émission) et les bornes
+(Berlicum), monté sous /opt/commun comme purple_dragon.
+
+Une carte qui annonce CAP_SERIE porte un numéro de série (voir
+perso_carte.lire_serie) ; Lubiana l'enregistre dans Carte.Num_Carte
+avec l'étudiant à qui elle est remise. Les bornes retrouvent l'étudiant
+par une recherche sur la clé unique uq_carte, gardée en cache local :
+
+    registre = RegistreCartes(ttl_s=60)
+    carte = registre.resoudre(serie, connecter)
+    # None              : carte inconnue, la perso fait foi
+    # carte["actif"]    : False -> carte désactivée, à refuser
+
+Le cache garde aussi les cartes inconnues et désactivées : une carte
+refusée ne coûte aucun aller-retour BDD tant que l'entrée est fraîche.
+Une désactivation est donc vue par les bornes au plus ttl_s secondes
+plus tard.
+"""
+
+import threading
+import time
+
+_SQL_RESOUDRE = """
+    SELECT Num_Etudiant, Actif
+    FROM Carte
+    WHERE Num_Carte = %s
+"""
+
+# Réémission d'une carte (--forcer dans Lubiana) : même série, nouvel étudiant
+_SQL_ENREGISTRER = """
+    INSERT INTO Carte (Num_Etudiant, Num_Carte, Actif)
+    VALUES (%s, %s, 1)
+    ON DUPLICATE KEY UPDATE Num_Etudiant = VALUES(Num_Etudiant),
+                            Actif = 1,
+                            Date_Creation = CURRENT_TIMESTAMP
+"""
+
+
+def enregistrer(cnx, num_carte, etu_num):
+    """
+    Carte active de l'étudiant ; ses autres cartes sont désactivées.
+    Une seule transaction, validée ici (rollback et exception en cas
+    d'erreur).
+    """
+    cursor = cnx.cursor()
+    try:
+        cursor.execute("UPDATE Carte SET Actif = 0 "
+                       "WHERE Num_Etudiant = %s AND Num_Carte <> %s AND Actif = 1",
+                       (etu_num, num_carte))
+        cursor.execute(_SQL_ENREGISTRER, (etu_num, num_carte))
+        cnx.commit()
+    except Exception:
+        cnx.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+class RegistreCartes:
+    """Cache local {Num_Carte: carte ou None} devant la table Carte."""
+
+    def __init__(self, ttl_s=60):
+        self.ttl_s = ttl_s
+        self._cache = {}
+        self._verrou = threading.Lock()
+
+    def resoudre(self, num_carte, connecter, fermer=False):
+        """
+        {'num': Num_Etudiant, 'actif': bool} ou None si la carte n'est pas
+        enregistrée. connecter() fournit la connexion (fermée ensuite si
+        fermer=True) ; elle n'est appelée qu'en l'absence d'entrée fraîche.
+        Lève l'exception de mysql.connector si la BDD ne répond pas.
+        """
+        maintenant = time.monotonic()
+        with self._verrou:
+            entree = self._cache.get(num_carte)
+        if entree is not None and maintenant - entree[0] < self.ttl_s:
+            return entree[1]
+
+        cnx = connecter()
+        if cnx is None:
+            raise ConnectionError("BDD indisponible")
+        try:
+            cursor = cnx.cursor()
+            cursor.execute(_SQL_RESOUDRE, (num_carte,))
+            row = cursor.fetchone()
+            cursor.close()
+        finally:
+            if fermer:
+                cnx.close()
+
+        carte = {"num": row[0], "actif": bool(row[1])} if row else None
+        with self._verrou:
+            self._cache[num_carte] = (maintenant, carte)
+        return carte
+
+    def oublier(self, num_carte=None):
+        """Retire une carte du cache (toutes si num_carte est None)."""
+        with self._verrou:
+            if num_carte is None:
+                self._cache.clear()
+            else:
+                self._cache.pop(num_carte, None)
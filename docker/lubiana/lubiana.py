@@ -1,9 +1,42 @@
 import smartcard.System as scardsys
 import smartcard.util as scardutil
 import smartcard.Exceptions as scardexcp
+from smartcard.CardRequest import CardRequest
+
+import mysql.connector
+import purple_dragon
+import perso_carte
+import registre_cartes
+import argparse
+import csv
+import datetime
+import hashlib
+import os
+import time
+from decimal import Decimal, InvalidOperation
 
 conn_reader = None
 
+# =========================
+#  CONFIG BDD (émission par lot)
+# =========================
+
+DB_CONFIG = {
+    "host": "purple-dragon-db",
+    "port": 3306,
+    "user": "rodelika",
+    "password": "rodelika",
+    "database": "carote_electronique",
+}
+
+cnx = None  # connexion MySQL, ouverte par le mode lot seulement
+
+# Capacités annoncées par la carte dans l'ATR (voir rubro_v2.c)
+CAP_ETAT = 0x01     # 82 08 : lecture d'état groupée
+CAP_SESSION = 0x02  # 82 04 P1 : session PIN de P1 opérations
+CAP_NUM_ETU = perso_carte.CAP_NUM_ETU  # 81 03 : perso compacte + numéro BCD
+CAP_SERIE = perso_carte.CAP_SERIE      # 81 04 / 81 05 : numéro de série
+
 
 # =========================
 #  OUTILS AFFICHAGE
@@ -54,6 +87,11 @@ def init_smart_card():
     return
 
 
+def card_capabilities():
+    """Capacités de la carte (ATR), 0 pour les anciennes cartes."""
+    return perso_carte.capacites(conn_reader)
+
+
 # =========================
 #  UI
 # =========================
@@ -144,13 +182,11 @@ def print_data():
         print("  Carte non attribuée : aucune donnée de personnalisation.\n")
         return
 
-    s = "".join(chr(e) for e in perso_bytes)
-    parts = s.split(";")
-
-    num = parts[0].strip() if len(parts) > 0 else ""
-    nom = parts[1].strip() if len(parts) > 1 else ""
-    prenom = parts[2].strip() if len(parts) > 2 else ""
+    # format historique "num;nom;prenom" ou compact (voir perso_carte)
+    num, nom, prenom = perso_carte.decoder_perso(perso_bytes)
+    compacte = perso_bytes[0] == perso_carte.PERSO_V1
 
+    print("  Format                 :", "compact v1" if compacte else "historique (ASCII)")
     print("  Numéro étudiant        :", num or "(inconnu)")
     print("  Nom de l'étudiant(e)   :", nom or "(inconnu)")
     print("  Prénom de l'étudiant(e):", prenom or "(inconnu)")
@@ -169,16 +205,18 @@ def assign_card():
     nom = input("  Nom               : ").strip()
     prenom = input("  Prénom            : ").strip()
 
-    infos = f"{num};{nom};{prenom}"
-    length = len(infos)
-
-    if length > 255:
-        print("[ERREUR] Chaîne de personnalisation trop longue.\n")
+    # Format compact (numéro BCD) si la carte sait relire le numéro seul
+    # (81 03) ; sinon, ou si le numéro n'est pas numérique, format historique
+    compact = bool(card_capabilities() & CAP_NUM_ETU) and num.isdigit() and len(num) <= 8
+    try:
+        infos = perso_carte.encoder_perso(num, nom, prenom, compact=compact)
+    except ValueError as e:
+        print(f"[ERREUR] Personnalisation impossible : {e}.\n")
         return
+    print(f"  Format : {'compact v1' if compact else 'historique (ASCII)'}, {len(infos)} octets")
 
-    apdu.append(length)
-    for c in infos:
-        apdu.append(ord(c))
+    apdu.append(len(infos))
+    apdu.extend(infos)
 
     try:
         data, sw1, sw2 = conn_reader.transmit(apdu)
@@ -208,10 +246,14 @@ def _ask_pin_octets(message):
         return [int(ch) & 0xFF for ch in raw]
 
 
-def verify_pin_interactive():
+def verify_pin_interactive(session=0):
+    """
+    APDU : 82 04 P1 00 04 [PIN(4 octets)]
+    session = nombre d'opérations sensibles autorisées (P1), 0 = une seule.
+    """
     print("\n=== Vérification du code PIN ===")
     pin_bytes = _ask_pin_octets("  PIN")
-    apdu = [0x82, 0x04, 0x00, 0x00, 0x04] + pin_bytes
+    apdu = [0x82, 0x04, session & 0xFF, 0x00, 0x04] + pin_bytes
 
     try:
         data, sw1, sw2 = conn_reader.transmit(apdu)
@@ -290,8 +332,11 @@ def _read_sold_core():
 def assign_inital_sold():
     print("\n=== Mise du solde initial à 1.00 € ===")
 
+    # Carte à sessions : un seul PIN pour la lecture du solde et le crédit
+    session = card_capabilities() & CAP_SESSION
+
     print("[1/3] Vérification du PIN pour lire le solde...")
-    if not verify_pin_interactive():
+    if not verify_pin_interactive(session=2 if session else 0):
         print("[ERREUR] PIN non vérifié.\n")
         return
 
@@ -305,10 +350,13 @@ def assign_inital_sold():
 
     print("[OK] Solde = 0.00 € -> crédit initial autorisé.\n")
 
-    print("[2/3] Vérification du PIN pour le crédit...")
-    if not verify_pin_interactive():
-        print("[ERREUR] PIN non vérifié.\n")
-        return
+    if session:
+        print("[2/3] Session PIN en cours, pas de nouvelle vérification.")
+    else:
+        print("[2/3] Vérification du PIN pour le crédit...")
+        if not verify_pin_interactive():
+            print("[ERREUR] PIN non vérifié.\n")
+            return
 
     print("\n--- Test anti-rejoue : compteur AVANT / APRÈS crédit ---")
     ctr_before = read_counter_with_response(label="AVANT")
@@ -399,11 +447,361 @@ def change_pin():
         print("[ERREUR] Échec changement de PIN.\n")
 
 
+# =========================
+#  ÉMISSION PAR LOT (--lot)
+# =========================
+
+# PIN remis par la perso (81 01), voir DEFAULT_PIN* dans rubro_v2.c
+PIN_DEFAUT = [1, 2, 3, 4]
+
+# Colonnes du compte rendu, relu au relancement pour reprendre le lot
+COLONNES_RAPPORT = ["date", "num", "num_carte", "statut", "detail",
+                    "perso_ms", "solde_ms", "pin_ms", "verif_ms", "bdd_ms", "total_ms"]
+
+
+class EchecEmission(Exception):
+    """Étape refusée par la carte : la carte est à reprendre."""
+
+
+def _transmettre(apdu, etape):
+    try:
+        data, sw1, sw2 = conn_reader.transmit(apdu)
+    except scardexcp.CardConnectionException as e:
+        raise EchecEmission(f"{etape} : carte retirée ({e})")
+    return list(data or []), sw1, sw2
+
+
+def _exiger_9000(sw1, sw2, etape):
+    if sw1 != 0x90 or sw2 != 0x00:
+        raise EchecEmission(f"{etape} : SW1={sw1:02X} SW2={sw2:02X}")
+
+
+def lire_lot(chemin, solde_defaut):
+    """
+    CSV des étudiants (séparateur , ou ;), en-tête obligatoire :
+      num, nom, prenom, pin          (pin : 4 chiffres)
+      solde                          (facultatif, euros ; sinon solde_defaut)
+      num_carte                      (facultatif ; sinon num-AAMMJJ)
+    num_carte ne sert qu'aux cartes sans numéro de série : sinon Num_Carte
+    est le numéro de série de la carte.
+    Retourne la liste des étudiants ; lève ValueError sur une ligne invalide.
+    """
+    with open(chemin, newline="", encoding="utf-8-sig") as f:
+        debut = f.read(4096)
+        f.seek(0)
+        dialecte = csv.Sniffer().sniff(debut, delimiters=",;")
+        lignes = list(csv.DictReader(f, dialect=dialecte))
+
+    date = datetime.date.today().strftime("%y%m%d")
+    etudiants = []
+    for n, ligne in enumerate(lignes, start=2):
+        ligne = {(k or "").strip().lower(): (v or "").strip() for k, v in ligne.items()}
+        num, pin = ligne.get("num", ""), ligne.get("pin", "")
+        if not num.isdigit() or len(num) > 8:
+            raise ValueError(f"ligne {n} : numéro étudiant invalide {num!r}")
+        if len(pin) != 4 or not pin.isdigit():
+            raise ValueError(f"ligne {n} : PIN invalide (4 chiffres) pour {num}")
+        try:
+            solde = Decimal((ligne.get("solde") or solde_defaut).replace(",", "."))
+        except InvalidOperation:
+            raise ValueError(f"ligne {n} : solde invalide pour {num}")
+        cents = int((solde * 100).to_integral_value())
+        if not 0 <= cents <= 0xFFFF:
+            raise ValueError(f"ligne {n} : solde hors limites pour {num}")
+        num = num.zfill(8)
+        try:
+            perso_carte.encoder_perso(num, ligne.get("nom", ""), ligne.get("prenom", ""))
+        except ValueError as e:
+            raise ValueError(f"ligne {n} : {e}")
+        num_carte = ligne.get("num_carte") or f"{num}-{date}"
+        if len(num_carte) > 15:
+            raise ValueError(f"ligne {n} : num_carte trop long (15 caractères) pour {num}")
+        etudiants.append({
+            "num": num,
+            "nom": ligne.get("nom", ""),
+            "prenom": ligne.get("prenom", ""),
+            "pin": [int(c) for c in pin],
+            "cents": cents,
+            "num_carte": num_carte,
+            "num_carte_lot": num_carte,
+        })
+    return etudiants
+
+
+def lire_rapport(chemin):
+    """{num: dernier statut} des lignes déjà traitées (reprise du lot)."""
+    statuts = {}
+    try:
+        with open(chemin, newline="", encoding="utf-8") as f:
+            for ligne in csv.DictReader(f, delimiter=";"):
+                statuts[ligne["num"]] = ligne
+    except FileNotFoundError:
+        pass
+    return statuts
+
+
+def ecrire_rapport(chemin, ligne):
+    nouveau = not os.path.exists(chemin)
+    with open(chemin, "a", newline="", encoding="utf-8") as f:
+        w = csv.DictWriter(f, fieldnames=COLONNES_RAPPORT, delimiter=";")
+        if nouveau:
+            w.writeheader()
+        w.writerow(ligne)
+        f.flush()
+
+
+def etudiants_inconnus(etudiants):
+    """Numéros absents de users (Carte.Num_Etudiant y fait référence)."""
+    nums = [e["num"] for e in etudiants]
+    if not nums:
+        return set()
+    cursor = cnx.cursor()
+    cursor.execute("SELECT Num_Etudiant FROM users WHERE Num_Etudiant IN (%s)"
+                   % ", ".join(["%s"] * len(nums)), nums)
+    connus = {row[0] for row in cursor.fetchall()}
+    cursor.close()
+    return set(nums) - connus
+
+
+def enregistrer_carte(etudiant):
+    """
+    Carte active de l'étudiant dans Carte (ses cartes précédentes sont
+    désactivées), puis solde initial crédité sur le compte : la carte et
+    le compte partent du même montant. Le crédit porte une référence
+    tirée de Num_Carte (CrediterCompteReference) : la reprise d'un
+    enregistrement ne le compte pas deux fois.
+    """
+    cnx.ping(reconnect=True, attempts=3, delay=1)
+    registre_cartes.enregistrer(cnx, etudiant["num_carte"], etudiant["num"])
+    if not etudiant["cents"]:
+        return
+    reference = hashlib.md5(f"emission:{etudiant['num_carte']}".encode()).hexdigest()
+    cursor = cnx.cursor()
+    try:
+        cursor.callproc("CrediterCompteReference",
+                        [etudiant["num"], Decimal(etudiant["cents"]) / 100,
+                         f"Solde initial (carte {etudiant['num_carte']})", reference])
+        cnx.commit()
+    except Exception:
+        cnx.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+def attendre_carte_vierge(nouvelle):
+    """
+    Attend une carte dans le premier lecteur et s'y connecte. nouvelle=True
+    ignore la carte déjà présente (celle qu'on vient d'émettre).
+    Retourne True si la carte est vierge (perso vide).
+    """
+    global conn_reader
+    if conn_reader is not None:
+        try:
+            conn_reader.disconnect()
+        except scardexcp.SmartcardException:
+            pass
+        conn_reader = None
+
+    lecteur = scardsys.readers()[0]
+    service = CardRequest(readers=[lecteur], timeout=None, newcardonly=nouvelle).waitforcard()
+    service.connection.connect()
+    conn_reader = service.connection
+    data, sw1, sw2 = _transmettre([0x81, 0x02, 0x00, 0x00, 0x00], "lecture perso")
+    # carte vierge : perso de taille 0, rien à renvoyer
+    return (sw1, sw2) == (0x90, 0x00) and not data
+
+
+def emettre_carte(etudiant, mesures):
+    """
+    Série, perso, solde initial, PIN de l'étudiant, puis relecture.
+    La perso remet PIN (1234), compteur et solde à zéro : le crédit initial
+    porte le compteur 0 sans le relire. mesures reçoit la durée de chaque
+    étape (ms).
+    """
+    t = time.monotonic()
+    caps = card_capabilities()
+    compact = bool(caps & CAP_NUM_ETU)
+    # numéro de série (écrit une fois, gardé à la réémission) = Num_Carte
+    etudiant["num_carte"] = etudiant["num_carte_lot"]
+    if caps & CAP_SERIE:
+        try:
+            serie, err = perso_carte.ecrire_serie(conn_reader)
+        except scardexcp.CardConnectionException as e:
+            raise EchecEmission(f"numéro de série : carte retirée ({e})")
+        if err:
+            raise EchecEmission(err)
+        etudiant["num_carte"] = serie
+    perso = perso_carte.encoder_perso(etudiant["num"], etudiant["nom"],
+                                      etudiant["prenom"], compact=compact)
+    _, sw1, sw2 = _transmettre([0x81, 0x01, 0x00, 0x00, len(perso)] + perso, "perso")
+    _exiger_9000(sw1, sw2, "perso")
+    mesures["perso_ms"] = (time.monotonic() - t) * 1000
+
+    t = time.monotonic()
+    cents = etudiant["cents"]
+    if cents:
+        _, sw1, sw2 = _transmettre([0x82, 0x04, 0x00, 0x00, 0x04] + PIN_DEFAUT, "PIN par défaut")
+        _exiger_9000(sw1, sw2, "PIN par défaut")
+        _, sw1, sw2 = _transmettre([0x82, 0x02, 0x00, 0x00, 0x02, cents & 0xFF, cents >> 8],
+                                   "solde initial")
+        _exiger_9000(sw1, sw2, "solde initial")
+    mesures["solde_ms"] = (time.monotonic() - t) * 1000
+
+    t = time.monotonic()
+    _, sw1, sw2 = _transmettre([0x82, 0x05, 0x00, 0x00, 0x08] + PIN_DEFAUT + etudiant["pin"],
+                               "changement de PIN")
+    _exiger_9000(sw1, sw2, "changement de PIN")
+    mesures["pin_ms"] = (time.monotonic() - t) * 1000
+
+    # relecture : perso, nouveau PIN, solde
+    t = time.monotonic()
+    data, sw1, sw2 = _transmettre([0x81, 0x02, 0x00, 0x00, len(perso)], "relecture perso")
+    _exiger_9000(sw1, sw2, "relecture perso")
+    if data != perso:
+        raise EchecEmission("relecture perso : données différentes")
+    _, sw1, sw2 = _transmettre([0x82, 0x04, 0x00, 0x00, 0x04] + etudiant["pin"], "vérification PIN")
+    _exiger_9000(sw1, sw2, "vérification PIN")
+    if caps & CAP_ETAT:
+        data, sw1, sw2 = _transmettre([0x82, 0x08, 0x00, 0x00, 0x06], "relecture état")
+    else:
+        data, sw1, sw2 = _transmettre([0x82, 0x01, 0x00, 0x00, 0x02], "relecture solde")
+    _exiger_9000(sw1, sw2, "relecture solde")
+    if len(data) < 2 or (data[0] | data[1] << 8) != cents:
+        raise EchecEmission("relecture solde : montant différent")
+    mesures["verif_ms"] = (time.monotonic() - t) * 1000
+
+
+def emission_par_lot(chemin_csv, chemin_rapport, solde_defaut, forcer=False):
+    """
+    Émet une carte par étudiant du CSV, dans l'ordre, à chaque insertion.
+    Les étudiants déjà 'OK' dans le compte rendu sont sautés ; ceux en
+    'BDD' (carte émise, Carte ou solde initial non enregistré) sont
+    seulement enregistrés.
+    """
+    global cnx
+    try:
+        etudiants = lire_lot(chemin_csv, solde_defaut)
+    except (OSError, ValueError, csv.Error) as e:
+        print(f"[ERREUR] Lot illisible : {e}")
+        return
+
+    try:
+        cnx = purple_dragon.connect(**DB_CONFIG)
+        inconnus = etudiants_inconnus(etudiants)
+    except mysql.connector.Error as e:
+        print(f"[ERREUR] BDD : {e}")
+        return
+    for num in sorted(inconnus):
+        print(f"[WARN] {num} absent de la table users : ignoré.")
+
+    deja = lire_rapport(chemin_rapport)
+    a_faire = []
+    for e in etudiants:
+        if e["num"] in inconnus:
+            continue
+        precedent = deja.get(e["num"])
+        if precedent and precedent["statut"] == "OK":
+            continue
+        if precedent and precedent["statut"] == "BDD":
+            e["num_carte"] = precedent["num_carte"]
+            try:
+                enregistrer_carte(e)
+                ecrire_rapport(chemin_rapport, dict(date=_horodatage(), num=e["num"],
+                                                    num_carte=e["num_carte"], statut="OK",
+                                                    detail="enregistrement BDD repris"))
+                print(f"[OK] {e['num']} : carte {e['num_carte']} enregistrée (reprise).")
+            except mysql.connector.Error as err:
+                print(f"[ERREUR] {e['num']} : BDD toujours indisponible ({err}).")
+            continue
+        a_faire.append(e)
+
+    print(f"[INFO] {len(a_faire)} carte(s) à émettre sur {len(etudiants)} ; "
+          f"compte rendu : {chemin_rapport}\n")
+    if not a_faire:
+        return
+
+    emises, debut_lot, nouvelle = 0, time.monotonic(), False
+    i = 0
+    try:
+        while i < len(a_faire):
+            e = a_faire[i]
+            print(f"-> Insérez une carte vierge pour {e['num']} {e['nom']} {e['prenom']} "
+                  f"({i + 1}/{len(a_faire)})")
+            try:
+                vierge = attendre_carte_vierge(nouvelle)
+            except (scardexcp.SmartcardException, EchecEmission) as err:
+                print(f"[WARN] Carte illisible : {err}")
+                nouvelle = True
+                continue
+            nouvelle = True
+            if not vierge and not forcer:
+                print("[WARN] Carte déjà personnalisée : retirez-la (--forcer pour la réémettre).")
+                continue
+
+            mesures = {}
+            ligne = dict(date=_horodatage(), num=e["num"], num_carte=e["num_carte"])
+            t0 = time.monotonic()
+            try:
+                emettre_carte(e, mesures)
+            except (EchecEmission, ValueError) as err:
+                ligne.update(statut="ECHEC", detail=str(err))
+                print(f"[ERREUR] {e['num']} : {err} -> carte à reprendre, insérez-en une autre.")
+            else:
+                t = time.monotonic()
+                try:
+                    enregistrer_carte(e)
+                    ligne.update(statut="OK", detail="")
+                except mysql.connector.Error as err:
+                    # la carte est bonne : seul l'enregistrement sera repris
+                    ligne.update(statut="BDD", detail=str(err))
+                    print(f"[WARN] {e['num']} : carte émise, BDD non à jour ({err}).")
+                mesures["bdd_ms"] = (time.monotonic() - t) * 1000
+                emises += 1
+                i += 1
+            mesures["total_ms"] = (time.monotonic() - t0) * 1000
+            ligne["num_carte"] = e["num_carte"]
+            ligne.update({k: f"{v:.0f}" for k, v in mesures.items()})
+            ecrire_rapport(chemin_rapport, ligne)
+            print("   " + " | ".join(f"{k[:-3]} {v:.0f} ms" for k, v in mesures.items()))
+            if ligne["statut"] != "ECHEC":
+                print(f"[OK] {e['num']} : carte {e['num_carte']} émise. Retirez-la.\n")
+    except KeyboardInterrupt:
+        print("\n[INFO] Lot interrompu : relancez la même commande pour reprendre.")
+
+    duree = time.monotonic() - debut_lot
+    if emises:
+        print(f"[INFO] {emises} carte(s) émise(s) en {duree:.0f} s "
+              f"({emises * 3600 / duree:.0f} cartes/heure, attente des insertions comprise).")
+
+
+def _horodatage():
+    return datetime.datetime.now().isoformat(timespec="seconds")
+
+
 # =========================
 #  Boucle principale
 # =========================
 
-def main():
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="lubiana.py",
+                                     description="Logiciel de personnalisation Lubiana")
+    parser.add_argument("--lot", metavar="CSV",
+                        help="émission par lot : une carte vierge par étudiant du CSV")
+    parser.add_argument("--rapport", metavar="CSV",
+                        help="compte rendu du lot (défaut : <lot>.rapport.csv)")
+    parser.add_argument("--solde", default="1.00",
+                        help="solde initial en euros si le CSV n'en donne pas (1.00)")
+    parser.add_argument("--forcer", action="store_true",
+                        help="réémettre aussi les cartes déjà personnalisées")
+    args = parser.parse_args(argv)
+
+    if args.lot:
+        print_hello_message()
+        rapport = args.rapport or os.path.splitext(args.lot)[0] + ".rapport.csv"
+        emission_par_lot(args.lot, rapport, args.solde, forcer=args.forcer)
+        return
+
     init_smart_card()
     print_hello_message()
 
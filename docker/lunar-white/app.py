@@ -11,7 +11,12 @@ from smartcard.System import readers
 from smartcard.util import toHexString, toBytes
 import datetime
 import os
+import threading
+import time
 import mysql.connector
+import purple_dragon
+import perso_carte
+import liste_opposition
 from decimal import Decimal
 
 app = Flask(__name__)
@@ -25,9 +30,16 @@ BOISSONS = {
     4: {"nom": "Cappuccino", "emoji": "🥤"},
 }
 
+# Capacités annoncées par la carte dans l'ATR (voir rubro_v2.c)
+CAP_ETAT = 0x01  # 82 08 : solde + compteur + essais PIN + taille perso
+
 # Fichier de log
 LOG_FILE = "log.txt"
 
+# Liste d'opposition locale (cartes désactivées) et période de synchronisation
+OPPOSITION_FILE = "opposition.json"
+OPPOSITION_SYNCHRO_S = int(os.environ.get("LUNAR_OPPOSITION_S", "30"))
+
 # Config BDD (serveur où tourne Rodelika Web)
 DB_CONFIG = {
     "host": "purple-dragon-db",
@@ -37,10 +49,14 @@ DB_CONFIG = {
     "database": "carote_electronique",
 }
 
+# Connexion du débit gardée ouverte ; reconnexion après une inactivité plus
+# longue que celle-ci plutôt qu'un ping par achat
+DEBIT_INACTIVITE_MAX_S = 600
+
 
 def get_db():
     """Retourne une connexion MySQL."""
-    return mysql.connector.connect(**DB_CONFIG)
+    return purple_dragon.connect(**DB_CONFIG)
 
 
 def log_transaction(message):
@@ -50,6 +66,62 @@ def log_transaction(message):
         f.write(f"[{timestamp}] {message}\n")
 
 
+# =========================
+#  LISTE D'OPPOSITION
+# =========================
+
+opposition = liste_opposition.ListeOpposition(OPPOSITION_FILE)
+_synchro_opposition = None
+
+
+def _boucle_opposition():
+    """Synchronisation incrémentale ; en cas d'échec la liste locale reste valable."""
+    while True:
+        try:
+            nb = opposition.synchroniser(get_db)
+            if nb:
+                log_transaction(f"Liste d'opposition: {nb} changement(s), "
+                                f"{len(opposition)} carte(s) désactivée(s)")
+        except Exception as e:
+            print(f"[DEBUG] synchro opposition impossible: {e}")
+        time.sleep(OPPOSITION_SYNCHRO_S)
+
+
+@app.before_request
+def demarrer_synchro_opposition():
+    """
+    Lancée à la première requête plutôt qu'à l'import, pour ne pas tourner
+    dans le processus de surveillance du rechargement automatique.
+    """
+    global _synchro_opposition
+    if _synchro_opposition is None:
+        _synchro_opposition = threading.Thread(target=_boucle_opposition, daemon=True)
+        _synchro_opposition.start()
+
+
+def verifier_opposition(conn):
+    """
+    Refuse une carte désactivée avant tout échange PIN ou débit : seul le
+    numéro de série est lu (81 04), la recherche se fait en mémoire.
+    Retourne None si la carte peut être utilisée, sinon le message d'erreur.
+    Une carte sans numéro de série n'est pas vérifiable et passe.
+    """
+    try:
+        serie, error = perso_carte.lire_serie(conn)
+    except Exception as e:
+        error_msg = str(e)
+        if "unpowered" in error_msg.lower() or "0x80100067" in error_msg:
+            return "CARD_DISCONNECTED"
+        return f"Exception: {error_msg}"
+    if error:
+        log_transaction(f"Lecture numéro de série: {error}")
+        return None
+    if serie and serie in opposition:
+        log_transaction(f"REFUS: carte {serie} en opposition")
+        return "Carte désactivée, adressez-vous à l'accueil"
+    return None
+
+
 def get_card_connection():
     """Établit la connexion avec la carte à puce"""
     try:
@@ -69,6 +141,32 @@ def get_card_connection():
         return None, f"Erreur de connexion: {error_msg}"
 
 
+def lire_etat(conn):
+    """
+    Lecture d'état groupée (PIN vérifié requis, ticket PIN non consommé).
+    Retourne ({solde, compteur, essais_pin, taille_perso}, None) ou (None, erreur).
+    """
+    try:
+        apdu = [0x82, 0x08, 0x00, 0x00, 0x06]
+        data, sw1, sw2 = conn.transmit(apdu)
+        if sw1 == 0x90 and sw2 == 0x00 and len(data) >= 6:
+            return {
+                "solde": data[0] | (data[1] << 8),
+                "compteur": data[2] | (data[3] << 8),
+                "essais_pin": data[4],
+                "taille_perso": data[5],
+            }, None
+        elif sw1 == 0x69 and sw2 == 0x82:
+            return None, "PIN non vérifié"
+        else:
+            return None, f"Erreur lecture état: SW1={sw1:02X} SW2={sw2:02X}"
+    except Exception as e:
+        error_msg = str(e)
+        if "unpowered" in error_msg.lower() or "0x80100067" in error_msg:
+            return None, "CARD_DISCONNECTED"
+        return None, f"Exception: {error_msg}"
+
+
 def lire_compteur(conn):
     """Lit le compteur anti-rejoue de la carte"""
     try:
@@ -155,138 +253,144 @@ def debiter_carte(conn, montant, ctr):
         return False, f"Exception: {error_msg}"
 
 
-def lire_perso(conn):
+def get_student_number_from_card(conn):
     """
-    Lit la perso de la carte : 'num;nom;prenom'
-    Retourne la chaîne, ou "", ou (None, erreur).
+    Récupère le Num_Etudiant (CHAR(8)) : 81 03 (4 octets BCD) si la carte
+    l'annonce, sinon depuis la perso ('num;nom;prenom' ou compacte).
     """
     try:
-        apdu = [0x81, 0x02, 0x00, 0x00, 0x05]
-        data, sw1, sw2 = conn.transmit(apdu)
-
-        # Gestion du SW1=0x6C (longueur correcte dans SW2)
-        if sw1 == 0x6C:
-            apdu[4] = sw2
-            data, sw1, sw2 = conn.transmit(apdu)
-
-        if sw1 != 0x90 or sw2 != 0x00:
-            return None, f"Erreur lecture perso: SW1={sw1:02X} SW2={sw2:02X}"
+        num_etu, error = perso_carte.lire_num_etudiant(conn)
+    except Exception as e:
+        error_msg = str(e)
+        if "unpowered" in error_msg.lower() or "0x80100067" in error_msg:
+            return None, "CARD_DISCONNECTED"
+        error = f"Erreur lecture numéro étudiant: {error_msg}"
+    if error:
+        log_transaction(f"ERREUR lecture Num_Etudiant: {error}")
+        return None, error
 
-        if not data:
-            # Aucun octet → pas de perso
-            return "", None
+    log_transaction(f"Num_Etudiant utilisé pour la BDD: '{num_etu}'")
+    return num_etu, None
 
-        # IMPORTANT: on ne coupe plus le premier octet (data[1:])
-        perso_bytes = data
 
-        # Conversion en string ASCII, en retirant d'éventuels 0x00 en fin
-        s = "".join(chr(e) for e in perso_bytes).rstrip("\x00")
+def preparer_debit_etat(conn, pin):
+    """
+    Préparation du débit avec la lecture d'état groupée (82 08) :
+    PIN puis état -> 2 échanges. Le ticket PIN reste valable pour le débit.
+    Retourne (ctr, solde, erreur).
+    """
+    success, error = verifier_pin(conn, pin)
+    if not success:
+        log_transaction(f"Échec vérification PIN: {error}")
+        return None, None, error
 
-        return s, None
+    etat, error = lire_etat(conn)
+    if error:
+        log_transaction(f"Erreur lecture état: {error}")
+        return None, None, error
 
-    except Exception as e:
-        error_msg = str(e)
-        if "unpowered" in error_msg.lower() or "0x80100067" in error_msg:
-            return None, "CARD_DISCONNECTED"
-        return None, f"Erreur lecture perso: {error_msg}"
+    return etat["compteur"], etat["solde"], None
 
 
-def get_student_number_from_card(conn):
+def preparer_debit_classique(conn, pin):
     """
-    Récupère le Num_Etudiant (CHAR(8)) depuis la perso.
-    Perso format : 'num;nom;prenom'
+    Préparation du débit pour les cartes sans lecture d'état :
+    compteur, PIN, solde, puis PIN à nouveau (la lecture du solde
+    consomme le ticket PIN) -> 4 échanges.
+    Retourne (ctr, solde, erreur).
     """
-    perso, error = lire_perso(conn)
+    ctr, error = lire_compteur(conn)
     if error:
-        log_transaction(f"ERREUR lecture perso: {error}")
-        return None, error
-    if perso == "":
-        log_transaction("Perso vide: carte non attribuée")
-        return None, "Carte non attribuée (aucune perso)"
+        log_transaction(f"Erreur lecture compteur: {error}")
+        return None, None, error
 
-    log_transaction(f"PERSO lue sur la carte: '{perso}'")
+    success, error = verifier_pin(conn, pin)
+    if not success:
+        log_transaction(f"Échec vérification PIN: {error}")
+        return None, None, error
 
-    parts = perso.split(";")
-    if len(parts) < 1:
-        msg = f"Perso invalide (pas de ';'): '{perso}'"
-        log_transaction(msg)
-        return None, msg
+    solde, error = lire_solde(conn)
+    if error:
+        log_transaction(f"Erreur lecture solde: {error}")
+        return None, None, error
 
-    raw_num = parts[0].strip()
-    hex_raw = raw_num.encode("utf-8").hex().upper()
-    log_transaction(
-        f"Num_Etudiant brut='{raw_num}' | len={len(raw_num)} | hex={hex_raw}"
-    )
+    success, error = verifier_pin(conn, pin)
+    if not success:
+        return None, None, error
 
-    if not raw_num.isdigit():
-        msg = f"Num_Etudiant invalide (pas que des chiffres): '{raw_num}'"
-        log_transaction(msg)
-        return None, msg
+    return ctr, solde, None
 
-    if len(raw_num) != 8:
-        msg = (
-            f"Num_Etudiant sur la carte doit faire 8 chiffres, "
-            f"lu='{raw_num}' (len={len(raw_num)})"
-        )
-        log_transaction(msg)
-        return None, msg
 
-    num_etu = raw_num
-    hex_final = num_etu.encode("utf-8").hex().upper()
-    log_transaction(
-        f"Num_Etudiant final utilisé pour la BDD: '{num_etu}' | "
-        f"len={len(num_etu)} | hex={hex_final}"
-    )
+# =========================
+#  DÉBIT BDD
+# =========================
 
-    return num_etu, None
+# La boisson est déjà débitée sur la carte : le débit est inséré sans
+# contrôler le solde BDD ni verrouiller le compte (la carte fait foi). Le
+# SELECT sur Compte n'insère rien si le compte n'existe pas (rowcount 0).
+# Requête préparée par executer(), un aller-retour en autocommit.
+_SQL_DEBIT = (
+    "INSERT INTO Transactions (Num_Etudiant, Montant, Type, Commentaire) "
+    "SELECT %s, %s, 'DEBIT', %s FROM Compte WHERE Num_Etudiant = %s"
+)
 
+_debit_verrou = threading.Lock()
+_debit_cnx = None
+_debit_dernier = 0.0
 
-def enregistrer_transaction(etu_num, montant_decimal, commentaire):
-    """
-    Enregistre un DEBIT dans la table Transactions.
-    montant_decimal : Decimal ou float (en euros)
-    - Vérifie d'abord l'existence du Compte pour éviter les erreurs de FK.
-    """
+
+def _fermer_debit():
+    global _debit_cnx
     try:
-        cnx = get_db()
-        cursor = cnx.cursor()
+        if _debit_cnx is not None:
+            _debit_cnx.close()
+    except Exception:
+        pass
+    _debit_cnx = None
 
-        # Vérifier que le compte existe
-        cursor.execute(
-            "SELECT COUNT(*) FROM Compte WHERE Num_Etudiant = %s",
-            (etu_num,),
-        )
-        (nb,) = cursor.fetchone()
 
-        log_transaction(
-            f"DEBUG BDD: préparation transaction pour Num_Etudiant='{etu_num}', "
-            f"len={len(etu_num)}, hex={etu_num.encode('utf-8').hex().upper()}, "
-            f"montant={montant_decimal}, commentaire='{commentaire}', compte_existant={nb}"
-        )
+def _connexion_debit():
+    """Connexion du débit, (re)ouverte si besoin (verrou tenu)."""
+    global _debit_cnx
+    if _debit_cnx is not None and time.monotonic() - _debit_dernier > DEBIT_INACTIVITE_MAX_S:
+        _fermer_debit()
+    if _debit_cnx is None:
+        _debit_cnx = purple_dragon.connect(autocommit=True, **DB_CONFIG)
+    return _debit_cnx
 
-        if nb == 0:
-            log_transaction(
-                f"ERREUR BDD Transaction: compte inexistant pour "
-                f"Num_Etudiant='{etu_num}' (INSERT Transactions annulé pour éviter la FK)"
-            )
+
+def enregistrer_transaction(etu_num, montant_decimal, commentaire):
+    """
+    Enregistre le DEBIT d'une boisson déjà débitée sur la carte.
+    montant_decimal : Decimal (en euros)
+    Seul un compte inexistant est refusé (rien n'est inséré). Retourne
+    True si le débit est enregistré.
+    """
+    global _debit_dernier
+    log_transaction(
+        f"DEBUG BDD: débit pour Num_Etudiant='{etu_num}', "
+        f"len={len(etu_num)}, hex={etu_num.encode('utf-8').hex().upper()}, "
+        f"montant={montant_decimal}, commentaire='{commentaire}'"
+    )
+    with _debit_verrou:
+        try:
+            cursor = _connexion_debit().executer(
+                _SQL_DEBIT, (etu_num, Decimal(montant_decimal), commentaire, etu_num))
+            inseres = cursor.rowcount
+            _debit_dernier = time.monotonic()
+        except mysql.connector.Error as e:
+            _fermer_debit()
+            log_transaction(f"ERREUR BDD Transaction pour {etu_num}: {e}")
+            print("Erreur MySQL:", e)
             return False
 
-        sql = """
-            INSERT INTO Transactions (Num_Etudiant, Montant, Type, Commentaire)
-            VALUES (%s, %s, 'DEBIT', %s)
-        """
-        cursor.execute(sql, (etu_num, float(montant_decimal), commentaire))
-        cnx.commit()
-        cursor.close()
-        cnx.close()
-        log_transaction(
-            f"BDD: DEBIT {montant_decimal:.2f} € enregistré pour {etu_num} - {commentaire}"
-        )
-        return True
-    except mysql.connector.Error as e:
-        log_transaction(f"ERREUR BDD Transaction pour {etu_num}: {e}")
-        print("Erreur MySQL:", e)
+    if inseres != 1:
+        log_transaction(f"ERREUR BDD Transaction pour {etu_num}: compte inexistant")
         return False
+    log_transaction(
+        f"BDD: DEBIT {montant_decimal:.2f} € enregistré pour {etu_num} - {commentaire}"
+    )
+    return True
 
 
 @app.route('/')
@@ -306,6 +410,12 @@ def check_card():
         log_transaction(f"ERREUR: {error}")
         return jsonify({"success": False, "error": error})
 
+    error = verifier_opposition(conn)
+    if error:
+        if error == "CARD_DISCONNECTED":
+            return jsonify({"success": False, "error": "Carte déconnectée", "disconnected": True})
+        return jsonify({"success": False, "error": error})
+
     log_transaction("Carte détectée")
     return jsonify({"success": True, "message": "Carte détectée"})
 
@@ -327,6 +437,12 @@ def verify_pin():
             return jsonify({"success": False, "error": "Carte déconnectée", "disconnected": True})
         return jsonify({"success": False, "error": error})
 
+    error = verifier_opposition(conn)
+    if error:
+        if error == "CARD_DISCONNECTED":
+            return jsonify({"success": False, "error": "Carte déconnectée", "disconnected": True})
+        return jsonify({"success": False, "error": error})
+
     # Vérifier le PIN
     success, error = verifier_pin(conn, pin)
     if not success:
@@ -335,8 +451,12 @@ def verify_pin():
             return jsonify({"success": False, "error": "Carte déconnectée", "disconnected": True})
         return jsonify({"success": False, "error": error})
 
-    # Lire le solde
-    solde, error = lire_solde(conn)
+    # Lire le solde (état groupé si la carte le propose)
+    if perso_carte.capacites(conn) & CAP_ETAT:
+        etat, error = lire_etat(conn)
+        solde = etat["solde"] if etat else None
+    else:
+        solde, error = lire_solde(conn)
     if error:
         log_transaction(f"Erreur lecture solde: {error}")
         if error == "CARD_DISCONNECTED":
@@ -381,26 +501,18 @@ def acheter_boisson():
             return jsonify({"success": False, "error": "Carte déconnectée", "disconnected": True})
         return jsonify({"success": False, "error": error})
 
-    # 1. Lire le compteur anti-rejoue
-    ctr, error = lire_compteur(conn)
+    error = verifier_opposition(conn)
     if error:
-        log_transaction(f"Erreur lecture compteur: {error}")
-        if error == "CARD_DISCONNECTED":
-            return jsonify({"success": False, "error": "Carte déconnectée", "disconnected": True})
-        return jsonify({"success": False, "error": error})
-
-    # 2. Vérifier le PIN
-    success, error = verifier_pin(conn, pin)
-    if not success:
-        log_transaction(f"Échec vérification PIN: {error}")
         if error == "CARD_DISCONNECTED":
             return jsonify({"success": False, "error": "Carte déconnectée", "disconnected": True})
         return jsonify({"success": False, "error": error})
 
-    # 3. Vérifier le solde
-    solde, error = lire_solde(conn)
+    # 1. Compteur + PIN + solde (échanges réduits si la carte le permet)
+    if perso_carte.capacites(conn) & CAP_ETAT:
+        ctr, solde, error = preparer_debit_etat(conn, pin)
+    else:
+        ctr, solde, error = preparer_debit_classique(conn, pin)
     if error:
-        log_transaction(f"Erreur lecture solde: {error}")
         if error == "CARD_DISCONNECTED":
             return jsonify({"success": False, "error": "Carte déconnectée", "disconnected": True})
         return jsonify({"success": False, "error": error})
@@ -412,14 +524,7 @@ def acheter_boisson():
             "error": f"Solde insuffisant ({solde/100:.2f}€)"
         })
 
-    # 4. Vérifier à nouveau le PIN pour le débit
-    success, error = verifier_pin(conn, pin)
-    if not success:
-        if error == "CARD_DISCONNECTED":
-            return jsonify({"success": False, "error": "Carte déconnectée", "disconnected": True})
-        return jsonify({"success": False, "error": error})
-
-    # 5. Débiter la carte
+    # 2. Débiter la carte
     success, error = debiter_carte(conn, PRIX_BOISSON, ctr)
     if not success:
         log_transaction(f"Erreur débit: {error}")
@@ -427,7 +532,7 @@ def acheter_boisson():
             return jsonify({"success": False, "error": "Carte déconnectée", "disconnected": True})
         return jsonify({"success": False, "error": error})
 
-    # 6. Récupérer le Num_Etudiant sur la carte
+    # 3. Récupérer le Num_Etudiant sur la carte
     etu_num, err_perso = get_student_number_from_card(conn)
     if err_perso:
         log_transaction(
@@ -435,7 +540,7 @@ def acheter_boisson():
         )
         etu_num = None
 
-    # 7. Enregistrer le débit dans la BDD (si Num_Etudiant disponible)
+    # 4. Enregistrer le débit dans la BDD (si Num_Etudiant disponible)
     montant_euros = Decimal("0.20")
     if etu_num:
         commentaire = f"LunarWhite: {boisson['nom']}"
@@ -448,7 +553,7 @@ def acheter_boisson():
     else:
         log_transaction("ATTENTION: débit carte OK mais aucun Num_Etudiant valide lu")
 
-    # 8. Nouveau solde carte (on recalcule localement)
+    # 5. Nouveau solde carte (on recalcule localement)
     nouveau_solde = solde - PRIX_BOISSON
     nouveau_solde_euros = nouveau_solde / 100.0
 
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Fiche d'un étudiant : compte, bonus en attente, historique paginé
+-----------------------------------------------------------------
+L'historique est lu du plus récent au plus ancien, par pages, sur l'index
+idx_transaction_etudiant (Num_Etudiant, Date_Transaction, id) : pagination
+par clé comme les listes (voir pagination), sans parcourir Transactions.
+
+Chaque ligne affiche le solde après la transaction. Pour la première ligne
+de la page, il vaut
+
+    dernier point de PointSolde avant elle
+    + transactions entre ce point et elle (100 au plus, plus les toutes
+      dernières, pas encore reprises par CreerPointsSolde)
+
+puis chaque ligne suivante retire le montant de la précédente. Le coût ne
+dépend pas de la longueur de l'historique.
+"""
+
+from decimal import Decimal
+
+import pagination
+
+TAILLE_PAGE = 50
+
+_SQL_COMPTE = """
+    SELECT u.Num_Etudiant, u.Nom, u.Prenom, u.Date_Creation,
+           SoldeCompte(u.Num_Etudiant) AS Solde_Actuel
+    FROM users u
+    WHERE u.Num_Etudiant = %s
+"""
+
+# mêmes critères que TransfererBonus ; 'réservé' = transfert en cours
+_SQL_BONUS = """
+    SELECT COALESCE(SUM(CASE WHEN Transfert_Bonus IS NULL THEN Montant END), 0) AS en_attente,
+           COALESCE(SUM(CASE WHEN Transfert_Bonus IS NOT NULL THEN Montant END), 0) AS reserve
+    FROM Transactions
+    WHERE Num_Etudiant = %s
+      AND Type = 'CREDIT'
+      AND Commentaire LIKE 'Bonus%%'
+      AND Commentaire NOT LIKE '%%transféré%%'
+"""
+
+_SQL_PAGE = """
+    SELECT id, Date_Transaction, Montant, Type, Commentaire, Transfert_Bonus
+    FROM Transactions
+    WHERE Num_Etudiant = %s
+"""
+
+_SQL_POINT = """
+    SELECT Date_Transaction, Id_Transaction, Solde
+    FROM PointSolde
+    WHERE Num_Etudiant = %s
+      AND (Date_Transaction < %s OR (Date_Transaction = %s AND Id_Transaction <= %s))
+    ORDER BY Date_Transaction DESC, Id_Transaction DESC
+    LIMIT 1
+"""
+
+_SQL_SOMME = """
+    SELECT COALESCE(SUM(IF(Type = 'CREDIT', Montant, -Montant)), 0)
+    FROM Transactions
+    WHERE Num_Etudiant = %s
+      AND (Date_Transaction < %s OR (Date_Transaction = %s AND id <= %s))
+"""
+
+_APRES_POINT = " AND (Date_Transaction > %s OR (Date_Transaction = %s AND id > %s))"
+
+_CLE = [("Date_Transaction", "Date_Transaction", str), ("id", "id", int)]
+
+
+def _signe(t):
+    return t["Montant"] if t["Type"] == "CREDIT" else -t["Montant"]
+
+
+def solde_apres(cnx, num, date, tid):
+    """Solde après la transaction (date, tid) : dernier point + la suite."""
+    cursor = cnx.cursor()
+    try:
+        cursor.execute(_SQL_POINT, (num, date, date, tid))
+        point = cursor.fetchone()
+        sql, params = _SQL_SOMME, [num, date, date, tid]
+        base = Decimal("0")
+        if point:
+            base = point[2]
+            sql += _APRES_POINT
+            params += [point[0], point[0], point[1]]
+        cursor.execute(sql, params)
+        (somme,) = cursor.fetchone()
+    finally:
+        cursor.close()
+    return base + Decimal(somme)
+
+
+def lire_historique(cnx, num, curseur=None, precedente=False, taille=TAILLE_PAGE):
+    """
+    Une page d'historique, la plus récente d'abord, avec "solde_apres" sur
+    chaque ligne. Retourne {"lignes", "suivante", "precedente"} (jetons).
+    """
+    valeurs = pagination.decoder_curseur(curseur, _CLE) if curseur else None
+    sql, params = _SQL_PAGE, [num]
+    # plus ancien d'abord (DESC) ; à l'envers pour revenir aux plus récents
+    vers_le_bas = not (valeurs and precedente)
+    if valeurs:
+        op = "<" if vers_le_bas else ">"
+        sql += f" AND (Date_Transaction {op} %s OR (Date_Transaction = %s AND id {op} %s))"
+        params += [valeurs[0], valeurs[0], valeurs[1]]
+    sens = "DESC" if vers_le_bas else "ASC"
+    sql += f" ORDER BY Date_Transaction {sens}, id {sens} LIMIT %s"
+    params.append(taille + 1)
+
+    cursor = cnx.cursor(dictionary=True)
+    try:
+        cursor.execute(sql, params)
+        lignes = cursor.fetchall()
+    finally:
+        cursor.close()
+
+    encore = len(lignes) > taille
+    lignes = lignes[:taille]
+    if not vers_le_bas:
+        lignes.reverse()
+    if not lignes:
+        return {"lignes": [], "suivante": None, "precedente": None}
+
+    haut = lignes[0]
+    solde = solde_apres(cnx, num, haut["Date_Transaction"], haut["id"])
+    for t in lignes:
+        t["solde_apres"] = solde
+        solde -= _signe(t)
+
+    def cle(t):
+        return pagination.encoder_curseur([t["Date_Transaction"], t["id"]])
+
+    if not vers_le_bas:
+        return {"lignes": lignes, "suivante": cle(lignes[-1]),
+                "precedente": cle(lignes[0]) if encore else None}
+    return {"lignes": lignes,
+            "suivante": cle(lignes[-1]) if encore else None,
+            "precedente": cle(lignes[0]) if valeurs else None}
+
+
+def fiche(cnx, num, curseur=None, precedente=False):
+    """
+    Compte de l'étudiant, bonus en attente / réservés et une page
+    d'historique ; None si l'étudiant n'existe pas.
+    """
+    cursor = cnx.cursor(dictionary=True)
+    try:
+        cursor.execute(_SQL_COMPTE, (num,))
+        etudiant = cursor.fetchone()
+        if etudiant is None:
+            return None
+        cursor.execute(_SQL_BONUS, (num,))
+        bonus = cursor.fetchone()
+    finally:
+        cursor.close()
+    etudiant["bonus_en_attente"] = bonus["en_attente"]
+    etudiant["bonus_reserve"] = bonus["reserve"]
+    etudiant["historique"] = lire_historique(cnx, num, curseur, precedente)
+    return etudiant
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Pagination par clé des listes Rodelika (étudiants, soldes)
+----------------------------------------------------------
+Partagé par Rodelika Web et la CLI. Une page est lue par
+
+    WHERE (clé de tri) > (clé de la dernière ligne affichée)
+    ORDER BY clé de tri
+    LIMIT taille + 1
+
+sur un index qui couvre l'ordre de tri (PRIMARY pour le numéro,
+idx_users_nom pour le nom, idx_compte_solde pour le solde) : le coût
+d'une page ne dépend pas de sa position dans la liste, contrairement à
+OFFSET. La clé de tri se termine toujours par Num_Etudiant, qui la rend
+unique. La page précédente se lit de la même façon, à l'envers.
+
+Le curseur (clé de la première ou dernière ligne) circule dans l'URL en
+base64 ; le filtre est une recherche par préfixe (numéro si la recherche
+est numérique, nom sinon), qui reste sur les index.
+
+La liste des soldes affiche SoldeCompte() (exact en mode JOURNAL), mais
+le tri par solde reste sur la colonne indexée Compte.Solde_Actuel : en
+mode JOURNAL, c'est le solde au dernier compactage (note du tri).
+"""
+
+import base64
+import json
+from decimal import Decimal
+
+TAILLE_PAGE = 50
+COMPTAGE_MAX = 1000     # au-delà, un filtre affiche "plus de 1000"
+
+# tri -> colonnes de la clé : (expression SQL, clé dans la ligne, type) ;
+# notes : avertissement affiché avec un tri
+LISTES = {
+    "etudiants": {
+        "colonnes": "u.Num_Etudiant, u.Nom, u.Prenom",
+        "depuis": "users u",
+        "tris": {
+            "num": [("u.Num_Etudiant", "Num_Etudiant", str)],
+            "nom": [("u.Nom", "Nom", str), ("u.Prenom", "Prenom", str),
+                    ("u.Num_Etudiant", "Num_Etudiant", str)],
+        },
+    },
+    "soldes": {
+        "colonnes": """u.Num_Etudiant, u.Nom, u.Prenom,
+                       c.Solde_Actuel AS Solde_Compacte,
+                       SoldeCompte(u.Num_Etudiant) AS Solde_Actuel""",
+        "depuis": "users u JOIN Compte c ON c.Num_Etudiant = u.Num_Etudiant",
+        "tris": {
+            "num": [("u.Num_Etudiant", "Num_Etudiant", str)],
+            "nom": [("u.Nom", "Nom", str), ("u.Prenom", "Prenom", str),
+                    ("u.Num_Etudiant", "Num_Etudiant", str)],
+            "solde": [("c.Solde_Actuel", "Solde_Compacte", Decimal),
+                      ("u.Num_Etudiant", "Num_Etudiant", str)],
+        },
+        "notes": {
+            "solde": "En mode JOURNAL, l'ordre suit le solde au dernier compactage.",
+        },
+    },
+}
+
+
+def encoder_curseur(valeurs):
+    """[valeurs de la clé] -> jeton URL."""
+    brut = json.dumps([str(v) for v in valeurs], ensure_ascii=False).encode("utf-8")
+    return base64.urlsafe_b64encode(brut).decode("ascii").rstrip("=")
+
+
+def decoder_curseur(jeton, colonnes):
+    """Jeton URL -> [valeurs typées], None s'il est invalide."""
+    try:
+        brut = base64.urlsafe_b64decode(jeton + "=" * (-len(jeton) % 4))
+        valeurs = json.loads(brut.decode("utf-8"))
+        if not isinstance(valeurs, list) or len(valeurs) != len(colonnes):
+            return None
+        return [type_(v) for (_, _, type_), v in zip(colonnes, valeurs)]
+    except (ValueError, ArithmeticError):
+        return None
+
+
+def _apres(colonnes, op):
+    """(a, b, c) op (x, y, z) développé pour l'optimiseur : a op x OR (a = x AND ...)."""
+    expr, _, _ = colonnes[0]
+    if len(colonnes) == 1:
+        return f"{expr} {op} %s"
+    return f"({expr} {op} %s OR ({expr} = %s AND {_apres(colonnes[1:], op)}))"
+
+
+def _parametres_apres(valeurs):
+    if len(valeurs) == 1:
+        return [valeurs[0]]
+    return [valeurs[0], valeurs[0]] + _parametres_apres(valeurs[1:])
+
+
+def _filtre(recherche):
+    """Recherche par préfixe : (condition SQL, paramètres) ou (None, [])."""
+    recherche = (recherche or "").strip()
+    if not recherche:
+        return None, []
+    motif = recherche.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+    if recherche.isdigit():
+        return "u.Num_Etudiant LIKE %s", [motif]
+    return "u.Nom LIKE %s", [motif]
+
+
+def lire_page(cnx, liste, tri="num", desc=False, recherche="",
+              curseur=None, precedente=False, taille=TAILLE_PAGE):
+    """
+    Une page de la liste `liste` (voir LISTES). curseur : jeton de la
+    dernière ligne de la page précédente, ou de la première ligne de la
+    page suivante si precedente=True. Retourne
+    {"lignes", "suivante", "precedente"} (jetons ou None).
+    """
+    definition = LISTES[liste]
+    colonnes = definition["tris"].get(tri) or definition["tris"]["num"]
+
+    conditions, params = [], []
+    filtre, params_filtre = _filtre(recherche)
+    if filtre:
+        conditions.append(filtre)
+        params += params_filtre
+
+    valeurs = decoder_curseur(curseur, colonnes) if curseur else None
+    # lecture à l'envers pour la page précédente
+    vers_le_bas = desc != bool(valeurs and precedente)
+    if valeurs:
+        conditions.append(_apres(colonnes, "<" if vers_le_bas else ">"))
+        params += _parametres_apres(valeurs)
+
+    sens = "DESC" if vers_le_bas else "ASC"
+    sql = f"SELECT {definition['colonnes']} FROM {definition['depuis']}"
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    sql += " ORDER BY " + ", ".join(f"{expr} {sens}" for expr, _, _ in colonnes)
+    sql += " LIMIT %s"
+    params.append(taille + 1)
+
+    cursor = cnx.cursor(dictionary=True)
+    try:
+        cursor.execute(sql, params)
+        lignes = cursor.fetchall()
+    finally:
+        cursor.close()
+
+    encore = len(lignes) > taille
+    lignes = lignes[:taille]
+    if valeurs and precedente:
+        lignes.reverse()
+
+    def cle(ligne):
+        return encoder_curseur([ligne[nom] for _, nom, _ in colonnes])
+
+    if not lignes:
+        return {"lignes": [], "suivante": None, "precedente": None}
+    if valeurs and precedente:
+        return {"lignes": lignes,
+                "suivante": cle(lignes[-1]),
+                "precedente": cle(lignes[0]) if encore else None}
+    return {"lignes": lignes,
+            "suivante": cle(lignes[-1]) if encore else None,
+            "precedente": cle(lignes[0]) if valeurs else None}
+
+
+def note_tri(liste, tri):
+    """Avertissement à afficher avec ce tri, None sinon."""
+    return LISTES[liste].get("notes", {}).get(tri)
+
+
+def compter(cnx, liste, recherche):
+    """
+    Nombre de lignes correspondant à un filtre, plafonné à COMPTAGE_MAX :
+    (n, plafonne). Sans filtre, utiliser les compteurs en cache.
+    """
+    definition = LISTES[liste]
+    filtre, params = _filtre(recherche)
+    # sans les colonnes : pas de SoldeCompte() par ligne comptée
+    sql = f"SELECT 1 FROM {definition['depuis']}"
+    if filtre:
+        sql += " WHERE " + filtre
+    cursor = cnx.cursor()
+    try:
+        cursor.execute(f"SELECT COUNT(*) FROM ({sql} LIMIT %s) AS l",
+                       params + [COMPTAGE_MAX + 1])
+        (n,) = cursor.fetchone()
+    finally:
+        cursor.close()
+    return min(n, COMPTAGE_MAX), n > COMPTAGE_MAX
@@ -11,7 +11,8 @@ Rodelika CLI interactif (bonus positif uniquement)
 
 import getpass
 import bcrypt
-import mysql.connector
+import purple_dragon
+import pagination
 from typing import Optional, Dict
 
 DB_CONFIG = {
@@ -24,13 +25,15 @@ DB_CONFIG = {
 
 CURRENT_AGENT: Optional[Dict] = None
 
+TAILLE_PAGE_CLI = 20    # lignes affichées par page
+
 
 # ===========================
 # DB UTILS
 # ===========================
 
 def get_db():
-    return mysql.connector.connect(**DB_CONFIG)
+    return purple_dragon.connect(**DB_CONFIG)
 
 
 def ensure_default_admin():
@@ -96,18 +99,50 @@ def login() -> Optional[Dict]:
 # ÉTUDIANTS & COMPTES
 # ===========================
 
-def list_students():
-    print("\n=== Liste des étudiants ===")
+def parcourir(liste, formater, vide):
+    """
+    Affiche une liste page par page (pagination par clé, voir pagination) :
+    une seule page en mémoire, quel que soit le nombre d'étudiants.
+    """
+    tris = list(pagination.LISTES[liste]["tris"])
+    q = input("Filtre (début du numéro ou du nom, Entrée = tous) : ").strip()
+    tri = input(f"Tri ({' / '.join(tris)}, Entrée = num) : ").strip() or "num"
+    if tri not in tris:
+        tri = "num"
+    desc = input("Ordre décroissant ? (o/N) : ").strip().lower() == "o"
+    note = pagination.note_tri(liste, tri)
+    if note:
+        print(note)
+
     try:
         cnx = get_db()
-        cur = cnx.cursor(dictionary=True)
-        cur.execute("SELECT Num_Etudiant,Nom,Prenom FROM users ORDER BY Num_Etudiant")
-        rows = cur.fetchall()
-        if not rows:
-            print("Aucun étudiant.")
-        else:
-            for r in rows:
-                print(f"- {r['Num_Etudiant']} : {r['Nom']} {r['Prenom']}")
+        total, plafonne = pagination.compter(cnx, liste, q)
+        print(f"{'plus de ' if plafonne else ''}{total} résultat(s)")
+        curseur, precedente = None, False
+        while True:
+            page = pagination.lire_page(cnx, liste, tri, desc, q,
+                                        curseur=curseur, precedente=precedente,
+                                        taille=TAILLE_PAGE_CLI)
+            if not page["lignes"]:
+                print(vide)
+                return
+            for r in page["lignes"]:
+                print(formater(r))
+
+            choix = []
+            if page["suivante"]:
+                choix.append("[Entrée] suivants")
+            if page["precedente"]:
+                choix.append("p précédents")
+            if not choix:
+                return
+            rep = input(", ".join(choix + ["q quitter"]) + " : ").strip().lower()
+            if rep == "p" and page["precedente"]:
+                curseur, precedente = page["precedente"], True
+            elif rep == "" and page["suivante"]:
+                curseur, precedente = page["suivante"], False
+            else:
+                return
     except Exception as e:
         print(f"Erreur : {e}")
     finally:
@@ -117,6 +152,13 @@ def list_students():
             pass
 
 
+def list_students():
+    print("\n=== Liste des étudiants ===")
+    parcourir("etudiants",
+              lambda r: f"- {r['Num_Etudiant']} : {r['Nom']} {r['Prenom']}",
+              "Aucun étudiant.")
+
+
 def add_student():
     print("\n=== Nouvel étudiant ===")
     num = input("Numéro étudiant (8 char) : ").strip()
@@ -155,27 +197,9 @@ def add_student():
 
 def list_balances():
     print("\n=== Soldes des comptes ===")
-    try:
-        cnx = get_db()
-        cur = cnx.cursor(dictionary=True)
-        cur.execute("""
-            SELECT users.Num_Etudiant,Nom,Prenom,Solde_Actuel
-            FROM users JOIN Compte USING(Num_Etudiant)
-            ORDER BY Num_Etudiant
-        """)
-        rows = cur.fetchall()
-        if not rows:
-            print("Aucun compte.")
-        else:
-            for r in rows:
-                print(f"{r['Num_Etudiant']} | {r['Nom']} {r['Prenom']} → {r['Solde_Actuel']:.2f} €")
-    except Exception as e:
-        print(f"Erreur : {e}")
-    finally:
-        try:
-            cnx.close()
-        except:
-            pass
+    parcourir("soldes",
+              lambda r: f"{r['Num_Etudiant']} | {r['Nom']} {r['Prenom']} → {r['Solde_Actuel']:.2f} €",
+              "Aucun compte.")
 
 
 # ===========================
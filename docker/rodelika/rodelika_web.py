@@ -8,16 +8,20 @@ Version Web du logiciel de gestion, avec :
 - Authentification via Agents (bcrypt) + rôles (ADMIN / AGENT / PROF)
 - Gestion étudiants / comptes / bonus
 - Gestion des agents/profs (ADMIN / AGENT)
+- Fiche étudiant : solde, bonus en attente, historique avec solde courant
 - Logo UVSQ IUT Vélizy dans la navbar
 - Footer corporate
-- Dashboard d'accueil (stats + dernières transactions)
+- Dashboard d'accueil (stats + dernières transactions), mis à jour en direct (SSE)
 - Liste complète des transactions avec recherche
+- Flux des nouvelles transactions (attente longue / SSE) pour les consommateurs
 
 Num_Étudiant : exactement 8 chiffres (CHAR(8) en base)
 """
 
 from flask import (
     Flask,
+    Response,
+    jsonify,
     render_template_string,
     request,
     redirect,
@@ -26,6 +30,14 @@ from flask import (
     session,
 )
 import mysql.connector
+import purple_dragon
+import flux_transactions
+import tableau_de_bord
+import pagination
+import historique
+import datetime
+import hmac
+import json
 import os
 import bcrypt
 from functools import wraps
@@ -38,6 +50,12 @@ DB_CONFIG = {
     "database": "carote_electronique",
 }
 
+# Jeton des consommateurs du flux hors navigateur (Authorization: Bearer ...)
+FLUX_TOKEN = os.environ.get("RODELIKA_FLUX_TOKEN", "")
+FLUX_ATTENTE_MAX_S = 25     # attente longue, sous les délais des proxys
+FLUX_SSE_VEILLE_S = 15      # commentaire SSE pour garder la connexion ouverte
+NB_DERNIERES = 10           # transactions affichées sur l'accueil
+
 app = Flask(__name__)
 app.secret_key = os.environ.get(
     "RODELIKA_SECRET_KEY",
@@ -46,7 +64,12 @@ app.secret_key = os.environ.get(
 
 
 def get_db():
-    return mysql.connector.connect(**DB_CONFIG)
+    return purple_dragon.connect(**DB_CONFIG)
+
+
+# Flux des transactions et tableau de bord, partagés par toutes les requêtes
+flux = flux_transactions.FluxTransactions(get_db)
+tableau = tableau_de_bord.TableauDeBord(flux, get_db, nb_transactions=NB_DERNIERES)
 
 
 # =========================
@@ -78,6 +101,20 @@ def require_roles(*roles):
     return decorator
 
 
+def api_autorisee(f):
+    """API JSON : agent ADMIN / AGENT connecté, ou jeton FLUX_TOKEN ; 401 sinon."""
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        if session.get("agent_id") and current_role() in ("ADMIN", "AGENT"):
+            return f(*args, **kwargs)
+        auth = request.headers.get("Authorization", "")
+        if FLUX_TOKEN and auth.startswith("Bearer ") \
+                and hmac.compare_digest(auth[7:].encode(), FLUX_TOKEN.encode()):
+            return f(*args, **kwargs)
+        return jsonify({"success": False, "error": "Non autorisé"}), 401
+    return wrapper
+
+
 # =========================
 # TEMPLATE GLOBAL
 # =========================
@@ -292,52 +329,21 @@ def logout():
 @app.route("/")
 @login_required
 def index():
-    stats = {
-        "nb_etudiants": 0,
-        "nb_comptes": 0,
-        "solde_total": 0.0,
-        "credits_today": 0.0,
-    }
-    transactions = []
-
-    try:
-        cnx = get_db()
-        cursor = cnx.cursor(dictionary=True)
-
-        cursor.execute("SELECT COUNT(*) AS n FROM users")
-        stats["nb_etudiants"] = cursor.fetchone()["n"]
-
-        cursor.execute("SELECT COUNT(*) AS n FROM Compte")
-        stats["nb_comptes"] = cursor.fetchone()["n"]
-
-        cursor.execute("SELECT SUM(Solde_Actuel) AS total FROM Compte")
-        stats["solde_total"] = cursor.fetchone()["total"] or 0.0
-
-        cursor.execute("""
-            SELECT SUM(Montant) AS total
-            FROM Transactions
-            WHERE Type='CREDIT'
-              AND DATE(Date_Transaction)=CURDATE()
-        """)
-        stats["credits_today"] = cursor.fetchone()["total"] or 0.0
-
-        cursor.execute("""
-            SELECT 
-                t.Date_Transaction,
-                t.Num_Etudiant,
-                t.Montant, t.Type, t.Commentaire,
-                u.Nom, u.Prenom
-            FROM Transactions t
-            JOIN users u ON u.Num_Etudiant=t.Num_Etudiant
-            ORDER BY t.Date_Transaction DESC
-            LIMIT 10
-        """)
-        transactions = cursor.fetchall()
-    except mysql.connector.Error as e:
-        flash(f"Erreur BDD : {e}", "danger")
-    finally:
-        if "cnx" in locals():
-            cnx.close()
+    etat = tableau.etat()
+    if etat is None:
+        # premier affichage avant le calcul en tâche de fond
+        try:
+            tableau.recalculer()
+            etat = tableau.etat()
+        except mysql.connector.Error as e:
+            flash(f"Erreur BDD : {e}", "danger")
+    if etat is None:
+        etat = {
+            "version": 0,
+            "stats": {"nb_etudiants": 0, "nb_comptes": 0,
+                      "solde_total": "0.00", "credits_today": "0.00"},
+            "transactions": [],
+        }
 
     tpl = """
     <div class="mb-4">
@@ -351,25 +357,25 @@ def index():
       <div class="col-md-3 mb-3">
         <div class="card card-kpi"><div class="card-body">
           <div class="fw-semibold">Étudiants</div>
-          <div class="fs-4">{{ stats.nb_etudiants }}</div>
+          <div class="fs-4" id="kpi-nb_etudiants">{{ stats.nb_etudiants }}</div>
         </div></div>
       </div>
       <div class="col-md-3 mb-3">
         <div class="card card-kpi"><div class="card-body">
           <div class="fw-semibold">Comptes</div>
-          <div class="fs-4">{{ stats.nb_comptes }}</div>
+          <div class="fs-4" id="kpi-nb_comptes">{{ stats.nb_comptes }}</div>
         </div></div>
       </div>
       <div class="col-md-3 mb-3">
         <div class="card card-kpi"><div class="card-body">
           <div class="fw-semibold">Solde total</div>
-          <div class="fs-4">{{ "%.2f"|format(stats.solde_total) }} €</div>
+          <div class="fs-4"><span id="kpi-solde_total">{{ stats.solde_total }}</span> €</div>
         </div></div>
       </div>
       <div class="col-md-3 mb-3">
         <div class="card card-kpi"><div class="card-body">
           <div class="fw-semibold">Crédits du jour</div>
-          <div class="fs-4">{{ "%.2f"|format(stats.credits_today) }} €</div>
+          <div class="fs-4"><span id="kpi-credits_today">{{ stats.credits_today }}</span> €</div>
         </div></div>
       </div>
     </div>
@@ -389,8 +395,7 @@ def index():
       <div class="col-lg-8">
         <h2>Dernières transactions</h2>
 
-        {% if transactions %}
-        <div class="table-responsive">
+        <div class="table-responsive" id="dernieres" {% if not transactions %}hidden{% endif %}>
           <table class="table table-sm table-striped">
             <thead>
               <tr>
@@ -401,83 +406,249 @@ def index():
                 <th>Commentaire</th>
               </tr>
             </thead>
-            <tbody>
-            {% for t in transactions %}
+            <tbody id="dernieres-lignes">
+            {% for t in transactions|reverse %}
               <tr>
-                <td>{{ t.Date_Transaction.strftime("%d/%m/%Y %H:%M") }}</td>
-                <td>{{ t.Num_Etudiant }} – {{ t.Prenom }} {{ t.Nom }}</td>
+                <td>{{ t.date|date_fr }}</td>
+                <td>{{ t.num_etudiant }} – {{ t.prenom or "" }} {{ t.nom or "" }}</td>
                 <td>
-                  {% if t.Type == "CREDIT" %}
+                  {% if t.type == "CREDIT" %}
                     <span class="badge bg-success">CREDIT</span>
                   {% else %}
                     <span class="badge bg-danger">DEBIT</span>
                   {% endif %}
                 </td>
                 <td class="text-end font-monospace">
-                  {% if t.Type == "DEBIT" %}
-                    -{{ "%.2f"|format(t.Montant) }} €
-                  {% else %}
-                    +{{ "%.2f"|format(t.Montant) }} €
-                  {% endif %}
+                  {% if t.type == "DEBIT" %}-{% else %}+{% endif %}{{ t.montant }} €
                 </td>
-                <td>{{ t.Commentaire }}</td>
+                <td>{{ t.commentaire or "" }}</td>
               </tr>
             {% endfor %}
             </tbody>
           </table>
         </div>
+        <p class="text-muted" id="aucune" {% if transactions %}hidden{% endif %}>
+          Aucune transaction enregistrée.
+        </p>
 
         <a href="{{ url_for('list_transactions') }}" class="btn btn-outline-secondary btn-sm mt-2">
           Voir toutes les transactions
         </a>
-        {% else %}
-          <p class="text-muted">Aucune transaction enregistrée.</p>
-        {% endif %}
       </div>
     </div>
+
+    <script>
+    // Mises à jour poussées par le serveur (SSE) : indicateurs + nouvelles lignes
+    (function () {
+      const NB_LIGNES = {{ nb_lignes }};
+      let version = {{ version }};
+
+      function texte(v) {
+        const d = document.createElement("div");
+        d.textContent = v == null ? "" : String(v);
+        return d.innerHTML;
+      }
+
+      function dateFr(iso) {
+        return iso.slice(8, 10) + "/" + iso.slice(5, 7) + "/" + iso.slice(0, 4)
+          + " " + iso.slice(11, 16);
+      }
+
+      function ligne(t) {
+        const tr = document.createElement("tr");
+        const badge = t.type === "CREDIT"
+          ? '<span class="badge bg-success">CREDIT</span>'
+          : '<span class="badge bg-danger">DEBIT</span>';
+        tr.innerHTML =
+          "<td>" + dateFr(t.date) + "</td>" +
+          "<td>" + texte(t.num_etudiant) + " – " + texte(t.prenom) + " " + texte(t.nom) + "</td>" +
+          "<td>" + badge + "</td>" +
+          '<td class="text-end font-monospace">' + (t.type === "DEBIT" ? "-" : "+")
+            + texte(t.montant) + " €</td>" +
+          "<td>" + texte(t.commentaire) + "</td>";
+        return tr;
+      }
+
+      function appliquer(data, complet) {
+        version = data.version;
+        for (const [cle, valeur] of Object.entries(data.stats)) {
+          const el = document.getElementById("kpi-" + cle);
+          if (el) el.textContent = valeur;
+        }
+        const tbody = document.getElementById("dernieres-lignes");
+        if (complet) tbody.innerHTML = "";
+        for (const t of data.transactions) tbody.prepend(ligne(t));
+        while (tbody.rows.length > NB_LIGNES) tbody.deleteRow(-1);
+        document.getElementById("dernieres").hidden = tbody.rows.length === 0;
+        document.getElementById("aucune").hidden = tbody.rows.length > 0;
+      }
+
+      if (!window.EventSource) return;
+      let source;
+      function connecter() {
+        source = new EventSource("{{ url_for('tableau_sse') }}?version=" + version);
+        source.addEventListener("delta", e => appliquer(JSON.parse(e.data), false));
+        source.addEventListener("etat", e => appliquer(JSON.parse(e.data), true));
+        source.onerror = () => {
+          // reconnexion avec la dernière version reçue (pas Last-Event-ID)
+          source.close();
+          setTimeout(connecter, 3000);
+        };
+      }
+      connecter();
+    })();
+    </script>
     """
     inner_html = render_template_string(
         tpl,
-        stats=stats,
-        transactions=transactions,
+        stats=etat["stats"],
+        transactions=etat["transactions"],
+        version=etat["version"],
+        nb_lignes=NB_DERNIERES,
         agent_prenom=session.get("agent_prenom"),
         agent_nom=session.get("agent_nom"),
     )
     return render_template_string(BASE_HTML, content=inner_html)
 
 
+@app.template_filter("date_fr")
+def date_fr(iso):
+    """'2025-11-25T11:20:18' -> '25/11/2025 11:20'."""
+    return datetime.datetime.fromisoformat(iso).strftime("%d/%m/%Y %H:%M")
+
+
+@app.route("/tableau-de-bord/sse")
+@login_required
+def tableau_sse():
+    """
+    Indicateurs et nouvelles transactions poussés au navigateur : `delta`
+    depuis ?version=, `etat` (complet) s'il est trop en retard. Tous les
+    navigateurs lisent le même état en mémoire : aucune requête BDD ici.
+    """
+    try:
+        version = int(request.args.get("version", 0))
+    except ValueError:
+        version = 0
+
+    def evenements(version):
+        yield "retry: 3000\n\n"
+        while True:
+            genre, data = tableau.attendre(version, FLUX_SSE_VEILLE_S)
+            if genre is None:
+                yield ": veille\n\n"
+                continue
+            version = data["version"]
+            yield f"event: {genre}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+    return Response(evenements(version), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
 # =========================
 # LISTE ÉTUDIANTS
 # =========================
 
-@app.route("/etudiants")
-@login_required
-def list_students():
-    etudiants = []
+# Filtre, tri et pagination communs à /etudiants et /soldes
+LISTE_HTML_FILTRE = """
+    <form class="row g-2 mb-3" method="get">
+      <input type="hidden" name="tri" value="{{ p.tri }}">
+      <input type="hidden" name="sens" value="{{ p.sens }}">
+      <div class="col-md-4">
+        <input class="form-control" type="text" name="q"
+               placeholder="Début du numéro ou du nom" value="{{ p.q }}">
+      </div>
+      <div class="col-md-2">
+        <button class="btn btn-primary">Filtrer</button>
+      </div>
+      {% if p.q %}
+      <div class="col-md-2">
+        <a class="btn btn-outline-secondary" href="{{ url_for(request.endpoint) }}">Réinitialiser</a>
+      </div>
+      {% endif %}
+      <div class="col-md-4 text-end text-muted align-self-center">
+        {% if p.plafonne %}plus de {% endif %}{{ p.total }} résultat(s)
+      </div>
+    </form>
+"""
+
+LISTE_HTML_PAGES = """
+    <nav class="d-flex justify-content-between">
+      {% if p.precedente %}
+        <a class="btn btn-outline-secondary btn-sm"
+           href="{{ url_for(request.endpoint, q=p.q, tri=p.tri, sens=p.sens, avant=p.precedente) }}">← Précédents</a>
+      {% else %}<span></span>{% endif %}
+      {% if p.suivante %}
+        <a class="btn btn-outline-secondary btn-sm"
+           href="{{ url_for(request.endpoint, q=p.q, tri=p.tri, sens=p.sens, apres=p.suivante) }}">Suivants →</a>
+      {% endif %}
+    </nav>
+"""
+
+# En-tête de colonne triable : {{ entete("nom", "Nom") }}
+LISTE_HTML_ENTETE = """
+    {% macro entete(tri, titre) -%}
+      <a class="text-reset text-decoration-none"
+         href="{{ url_for(request.endpoint, q=p.q, tri=tri,
+                          sens='desc' if p.tri == tri and p.sens == 'asc' else 'asc') }}">
+        {{ titre }}{% if p.tri == tri %} {{ "▲" if p.sens == "asc" else "▼" }}{% endif %}
+      </a>
+    {%- endmacro %}
+"""
+
+
+def page_liste(liste, compteur):
+    """
+    Page demandée par ?q=&tri=&sens=&apres=|avant= (voir pagination).
+    Le total sans filtre vient du tableau de bord (compteur de stats) ;
+    avec un filtre, il est compté et plafonné.
+    """
+    q = request.args.get("q", "").strip()
+    tri = request.args.get("tri", "num")
+    if tri not in pagination.LISTES[liste]["tris"]:
+        tri = "num"
+    sens = "desc" if request.args.get("sens") == "desc" else "asc"
+    avant = request.args.get("avant")
+    p = {"q": q, "tri": tri, "sens": sens, "lignes": [], "suivante": None,
+         "precedente": None, "total": 0, "plafonne": False,
+         "note": pagination.note_tri(liste, tri)}
     try:
         cnx = get_db()
-        cursor = cnx.cursor(dictionary=True)
-        cursor.execute("SELECT Num_Etudiant, Nom, Prenom FROM users ORDER BY Num_Etudiant")
-        etudiants = cursor.fetchall()
+        try:
+            p.update(pagination.lire_page(
+                cnx, liste, tri, sens == "desc", q,
+                curseur=avant or request.args.get("apres"),
+                precedente=bool(avant),
+            ))
+            etat = None if q else tableau.etat()
+            if etat is not None:
+                p["total"] = etat["stats"][compteur]
+            else:
+                p["total"], p["plafonne"] = pagination.compter(cnx, liste, q)
+        finally:
+            cnx.close()
     except mysql.connector.Error as e:
         flash(f"Erreur BDD : {e}", "danger")
-    finally:
-        if "cnx" in locals():
-            cnx.close()
+    return p
 
-    tpl = """
-    <h2>Liste des étudiants</h2>
 
-    {% if etudiants %}
+@app.route("/etudiants")
+@login_required
+def list_students():
+    p = page_liste("etudiants", "nb_etudiants")
+
+    tpl = LISTE_HTML_ENTETE + """
+    <h2>Liste des étudiants</h2>
+    """ + LISTE_HTML_FILTRE + """
+    {% if p.lignes %}
     <div class="table-responsive">
       <table class="table table-striped table-sm">
         <thead>
-          <tr><th>Numéro</th><th>Nom</th><th>Prénom</th></tr>
+          <tr><th>{{ entete("num", "Numéro") }}</th><th>{{ entete("nom", "Nom") }}</th><th>Prénom</th></tr>
         </thead>
         <tbody>
-        {% for e in etudiants %}
+        {% for e in p.lignes %}
           <tr>
-            <td>{{ e.Num_Etudiant }}</td>
+            <td><a href="{{ url_for('detail_etudiant', num=e.Num_Etudiant) }}">{{ e.Num_Etudiant }}</a></td>
             <td>{{ e.Nom }}</td>
             <td>{{ e.Prenom }}</td>
           </tr>
@@ -485,11 +656,12 @@ def list_students():
         </tbody>
       </table>
     </div>
+    """ + LISTE_HTML_PAGES + """
     {% else %}
       <p class="text-muted">Aucun étudiant.</p>
     {% endif %}
     """
-    inner_html = render_template_string(tpl, etudiants=etudiants)
+    inner_html = render_template_string(tpl, p=p)
     return render_template_string(BASE_HTML, content=inner_html)
 
 
@@ -500,36 +672,23 @@ def list_students():
 @app.route("/soldes")
 @login_required
 def list_soldes():
-    soldes = []
-    try:
-        cnx = get_db()
-        cursor = cnx.cursor(dictionary=True)
-        cursor.execute("""
-            SELECT u.Num_Etudiant, u.Nom, u.Prenom, c.Solde_Actuel
-            FROM users u
-            JOIN Compte c ON c.Num_Etudiant = u.Num_Etudiant
-            ORDER BY u.Num_Etudiant
-        """)
-        soldes = cursor.fetchall()
-    except mysql.connector.Error as e:
-        flash(f"Erreur BDD : {e}", "danger")
-    finally:
-        if "cnx" in locals():
-            cnx.close()
+    p = page_liste("soldes", "nb_comptes")
 
-    tpl = """
+    tpl = LISTE_HTML_ENTETE + """
     <h2>Solde des étudiants</h2>
-
-    {% if soldes %}
+    """ + LISTE_HTML_FILTRE + """
+    {% if p.note %}<p class="text-muted small">{{ p.note }}</p>{% endif %}
+    {% if p.lignes %}
     <div class="table-responsive">
       <table class="table table-striped table-sm">
         <thead>
-          <tr><th>Numéro</th><th>Nom</th><th>Prénom</th><th>Solde</th></tr>
+          <tr><th>{{ entete("num", "Numéro") }}</th><th>{{ entete("nom", "Nom") }}</th>
+              <th>Prénom</th><th>{{ entete("solde", "Solde") }}</th></tr>
         </thead>
         <tbody>
-        {% for s in soldes %}
+        {% for s in p.lignes %}
           <tr>
-            <td>{{ s.Num_Etudiant }}</td>
+            <td><a href="{{ url_for('detail_etudiant', num=s.Num_Etudiant) }}">{{ s.Num_Etudiant }}</a></td>
             <td>{{ s.Nom }}</td>
             <td>{{ s.Prenom }}</td>
             <td>{{ "%.2f"|format(s.Solde_Actuel) }} €</td>
@@ -538,14 +697,159 @@ def list_soldes():
         </tbody>
       </table>
     </div>
+    """ + LISTE_HTML_PAGES + """
     {% else %}
       <p class="text-muted">Aucun compte.</p>
     {% endif %}
     """
-    inner_html = render_template_string(tpl, soldes=soldes)
+    inner_html = render_template_string(tpl, p=p)
+    return render_template_string(BASE_HTML, content=inner_html)
+
+
+# =========================
+# FICHE ÉTUDIANT (HISTORIQUE)
+# =========================
+
+def fiche_etudiant(num):
+    """Fiche de ?apres=|avant= (voir historique) ; None si inconnu."""
+    avant = request.args.get("avant")
+    cnx = get_db()
+    try:
+        return historique.fiche(cnx, num, curseur=avant or request.args.get("apres"),
+                                precedente=bool(avant))
+    finally:
+        cnx.close()
+
+
+@app.route("/etudiants/<num>")
+@login_required
+def detail_etudiant(num):
+    if len(num) != 8 or not num.isdigit():
+        flash("Numéro étudiant : exactement 8 chiffres.", "danger")
+        return redirect(url_for("list_students"))
+    try:
+        f = fiche_etudiant(num)
+    except mysql.connector.Error as e:
+        flash(f"Erreur BDD : {e}", "danger")
+        return redirect(url_for("list_students"))
+    if f is None:
+        flash(f"Étudiant {num} inconnu.", "warning")
+        return redirect(url_for("list_students"))
+
+    tpl = """
+    <h2>{{ f.Prenom }} {{ f.Nom }} <small class="text-muted">{{ f.Num_Etudiant }}</small></h2>
+
+    <div class="row mb-4">
+      <div class="col-md-4 mb-3">
+        <div class="card card-kpi"><div class="card-body">
+          <div class="fw-semibold">Solde du compte</div>
+          <div class="fs-4">
+            {% if f.Solde_Actuel is none %}—{% else %}{{ "%.2f"|format(f.Solde_Actuel) }} €{% endif %}
+          </div>
+        </div></div>
+      </div>
+      <div class="col-md-4 mb-3">
+        <div class="card card-kpi"><div class="card-body">
+          <div class="fw-semibold">Bonus en attente</div>
+          <div class="fs-4">{{ "%.2f"|format(f.bonus_en_attente) }} €</div>
+        </div></div>
+      </div>
+      <div class="col-md-4 mb-3">
+        <div class="card card-kpi"><div class="card-body">
+          <div class="fw-semibold">Bonus en cours de transfert</div>
+          <div class="fs-4">{{ "%.2f"|format(f.bonus_reserve) }} €</div>
+        </div></div>
+      </div>
+    </div>
+
+    <h3>Historique</h3>
+    {% set h = f.historique %}
+    {% if h.lignes %}
+    <div class="table-responsive">
+      <table class="table table-sm table-striped">
+        <thead>
+          <tr>
+            <th>Date</th><th>Type</th><th class="text-end">Montant</th>
+            <th class="text-end">Solde après</th><th>Commentaire</th>
+          </tr>
+        </thead>
+        <tbody>
+        {% for t in h.lignes %}
+          <tr>
+            <td>{{ t.Date_Transaction.strftime("%d/%m/%Y %H:%M") }}</td>
+            <td>
+              {% if t.Type == "CREDIT" %}
+                <span class="badge bg-success">CREDIT</span>
+              {% else %}
+                <span class="badge bg-danger">DEBIT</span>
+              {% endif %}
+            </td>
+            <td class="text-end font-monospace">
+              {% if t.Type == "DEBIT" %}-{% else %}+{% endif %}{{ "%.2f"|format(t.Montant) }} €
+            </td>
+            <td class="text-end font-monospace">{{ "%.2f"|format(t.solde_apres) }} €</td>
+            <td>{{ t.Commentaire or "" }}</td>
+          </tr>
+        {% endfor %}
+        </tbody>
+      </table>
+    </div>
+    <nav class="d-flex justify-content-between">
+      {% if h.precedente %}
+        <a class="btn btn-outline-secondary btn-sm"
+           href="{{ url_for('detail_etudiant', num=f.Num_Etudiant, avant=h.precedente) }}">← Plus récentes</a>
+      {% else %}<span></span>{% endif %}
+      {% if h.suivante %}
+        <a class="btn btn-outline-secondary btn-sm"
+           href="{{ url_for('detail_etudiant', num=f.Num_Etudiant, apres=h.suivante) }}">Plus anciennes →</a>
+      {% endif %}
+    </nav>
+    {% else %}
+      <p class="text-muted">Aucune transaction.</p>
+    {% endif %}
+    """
+    inner_html = render_template_string(tpl, f=f)
     return render_template_string(BASE_HTML, content=inner_html)
 
 
+@app.route("/api/etudiants/<num>")
+@api_autorisee
+def api_etudiant(num):
+    """Même fiche en JSON : montants en chaîne, dates ISO, curseurs de page."""
+    if len(num) != 8 or not num.isdigit():
+        return jsonify({"success": False, "error": "Numéro étudiant invalide"}), 400
+    try:
+        f = fiche_etudiant(num)
+    except mysql.connector.Error as e:
+        return jsonify({"success": False, "error": f"Erreur BDD : {e}"}), 503
+    if f is None:
+        return jsonify({"success": False, "error": "Étudiant inconnu"}), 404
+
+    def euros(v):
+        return None if v is None else f"{v:.2f}"
+
+    h = f["historique"]
+    return jsonify({
+        "success": True,
+        "num_etudiant": f["Num_Etudiant"],
+        "nom": f["Nom"],
+        "prenom": f["Prenom"],
+        "solde": euros(f["Solde_Actuel"]),
+        "bonus_en_attente": euros(f["bonus_en_attente"]),
+        "bonus_reserve": euros(f["bonus_reserve"]),
+        "historique": [{
+            "id": t["id"],
+            "date": t["Date_Transaction"].isoformat(),
+            "type": t["Type"],
+            "montant": euros(t["Montant"]),
+            "solde_apres": euros(t["solde_apres"]),
+            "commentaire": t["Commentaire"],
+        } for t in h["lignes"]],
+        "suivante": h["suivante"],
+        "precedente": h["precedente"],
+    })
+
+
 # =========================
 # CRÉER ÉTUDIANT (ADMIN/AGENT)
 # =========================
@@ -588,6 +892,7 @@ def new_student():
                 )
 
                 cnx.commit()
+                tableau.etudiant_cree()
                 flash("Étudiant créé avec une offre de bienvenue de 1,00 €.", "success")
                 return redirect(url_for("list_students"))
             except mysql.connector.Error as e:
@@ -976,6 +1281,153 @@ def new_agent():
     return render_template_string(BASE_HTML, content=inner_html)
 
 
+# =========================
+# FLUX DES TRANSACTIONS (API)
+# =========================
+
+@app.before_request
+def demarrer_flux():
+    """
+    Suivi de Transactions et tableau de bord lancés à la première requête
+    plutôt qu'à l'import, pour ne pas tourner dans le processus de
+    surveillance du rechargement automatique.
+    """
+    flux.demarrer()
+    tableau.demarrer()
+
+
+def _entier(nom, defaut, mini, maxi):
+    try:
+        valeur = int(request.args.get(nom, defaut))
+    except (TypeError, ValueError):
+        valeur = defaut
+    return max(mini, min(valeur, maxi))
+
+
+def _position_depart():
+    """
+    apres=<id> explicite, sinon Last-Event-ID (reconnexion SSE), sinon la
+    position enregistrée du consommateur nommé, sinon la tête du flux.
+    """
+    if "apres" in request.args:
+        return _entier("apres", 0, 0, 2**63 - 1)
+    if request.headers.get("Last-Event-ID", "").isdigit():
+        return int(request.headers["Last-Event-ID"])
+    nom = request.args.get("consommateur", "").strip()
+    if nom:
+        cnx = get_db()
+        try:
+            return flux_transactions.lire_position(cnx, nom)
+        finally:
+            cnx.close()
+    return flux.tete or 0
+
+
+@app.route("/api/flux/transactions")
+@api_autorisee
+def flux_transactions_api():
+    """
+    Attente longue : ?apres=<id>&limite=<n>&attente=<s>. Répond dès qu'il
+    y a des lignes d'id > apres (au plus limite), sinon au bout de attente
+    secondes avec une liste vide. Le client reprend à dernier_id.
+    """
+    limite = _entier("limite", 100, 1, flux_transactions.LOT_MAX)
+    attente = _entier("attente", FLUX_ATTENTE_MAX_S, 0, FLUX_ATTENTE_MAX_S)
+    try:
+        apres = _position_depart()
+        lignes, dernier_id = flux.lire(apres, limite, attente)
+    except mysql.connector.Error as e:
+        return jsonify({"success": False, "error": f"Erreur BDD : {e}"}), 503
+    return jsonify({"success": True, "transactions": lignes, "dernier_id": dernier_id})
+
+
+@app.route("/api/flux/transactions/sse")
+@api_autorisee
+def flux_transactions_sse():
+    """
+    Même flux en server-sent events : un événement `transactions` par lot,
+    d'id le dernier id du lot (repris par le navigateur en Last-Event-ID).
+    """
+    limite = _entier("limite", 100, 1, flux_transactions.LOT_MAX)
+    try:
+        apres = _position_depart()
+    except mysql.connector.Error as e:
+        return jsonify({"success": False, "error": f"Erreur BDD : {e}"}), 503
+
+    def evenements(apres):
+        yield "retry: 3000\n\n"
+        while True:
+            try:
+                lignes, apres = flux.lire(apres, limite, FLUX_SSE_VEILLE_S)
+            except mysql.connector.Error as e:
+                yield f"event: erreur\ndata: {json.dumps(str(e))}\n\n"
+                return
+            if lignes:
+                yield (f"id: {apres}\nevent: transactions\n"
+                       f"data: {json.dumps(lignes, ensure_ascii=False)}\n\n")
+            else:
+                yield ": veille\n\n"
+
+    return Response(evenements(apres), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.route("/api/flux/consommateurs/<nom>", methods=["GET", "POST"])
+@api_autorisee
+def flux_consommateur(nom):
+    """
+    Position d'un consommateur nommé : GET la lit, POST {"dernier_id": n}
+    l'avance une fois les lignes traitées (jamais en arrière).
+    """
+    if len(nom) > 64 or not nom.isascii():
+        return jsonify({"success": False, "error": "Nom de consommateur invalide"}), 400
+    try:
+        cnx = get_db()
+        try:
+            if request.method == "POST":
+                data = request.get_json(silent=True) or {}
+                try:
+                    dernier_id = int(data.get("dernier_id"))
+                except (TypeError, ValueError):
+                    return jsonify({"success": False, "error": "dernier_id invalide"}), 400
+                flux_transactions.enregistrer_position(cnx, nom, dernier_id)
+            position = flux_transactions.lire_position(cnx, nom)
+        finally:
+            cnx.close()
+    except mysql.connector.Error as e:
+        return jsonify({"success": False, "error": f"Erreur BDD : {e}"}), 503
+    return jsonify({"success": True, "consommateur": nom, "dernier_id": position})
+
+
+# =========================
+# ÉTAT DE LA BDD (API)
+# =========================
+
+@app.errorhandler(purple_dragon.BddIndisponible)
+def bdd_indisponible(e):
+    """Disjoncteur ouvert : réponse immédiate au lieu d'attendre la BDD."""
+    if request.path.startswith("/api/"):
+        return jsonify({"success": False, "error": str(e)}), 503
+    return render_template_string(BASE_HTML, content=(
+        '<div class="alert alert-danger">Base de données indisponible, '
+        'réessayez dans quelques secondes.</div>')), 503
+
+
+@app.route("/api/bdd/etat")
+def bdd_etat():
+    """Disjoncteur de la BDD (sans authentification, pour la supervision) ; 503 s'il est ouvert."""
+    etat = purple_dragon.etat_bdd()
+    code = 503 if etat["etat"] == "OUVERT" else 200
+    return jsonify({"success": code == 200, "bdd": etat, "flux_tete": flux.tete}), code
+
+
+@app.route("/api/bdd/preparees")
+@api_autorisee
+def bdd_preparees():
+    """Préparations et réutilisations des requêtes préparées de ce processus."""
+    return jsonify({"success": True, **purple_dragon.stats_preparees()})
+
+
 # =========================
 # MAIN
 # =========================
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Tableau de bord de Rodelika Web, tenu à jour en mémoire
+-------------------------------------------------------
+Les indicateurs de l'accueil (étudiants, comptes, solde total, crédits
+du jour) et les dernières transactions sont calculés une fois, puis mis
+à jour par les lots du flux des transactions (flux_transactions) :
+
+    CREDIT  solde total + montant, crédits du jour + montant (si du jour)
+    DEBIT   solde total - montant
+
+Le solde des comptes n'est modifié que par le trigger d'insertion de
+Transactions : ces deux règles suffisent. Les créations d'étudiants par
+Rodelika Web sont comptées par etudiant_cree() ; celles d'autres
+processus (CLI) et le changement de jour sont repris par le recalcul
+complet, toutes les resynchro_s secondes ou à la première transaction
+du jour.
+
+Chaque mise à jour incrémente `version` et garde le lot de nouvelles
+transactions ; un navigateur connecté en SSE reçoit les indicateurs et
+les transactions arrivées depuis sa version. Aucune requête BDD n'est
+faite par navigateur ni par affichage de l'accueil.
+"""
+
+import collections
+import datetime
+import threading
+import time
+from decimal import Decimal
+
+import flux_transactions
+
+_SQL_INDICATEURS = """
+    SELECT
+        (SELECT COUNT(*) FROM users)                      AS nb_etudiants,
+        (SELECT COUNT(*) FROM Compte)                     AS nb_comptes,
+        (SELECT COALESCE(SUM(Solde_Actuel), 0) FROM Compte)
+          + (SELECT COALESCE(SUM(IF(Type = 'CREDIT', Montant, -Montant)), 0)
+               FROM Transactions
+              WHERE Compacte = 0)                         AS solde_total,
+        (SELECT COALESCE(SUM(Montant), 0)
+           FROM Transactions
+          WHERE Type = 'CREDIT'
+            AND Date_Transaction >= CURDATE())            AS credits_today,
+        (SELECT COALESCE(MAX(id), 0) FROM Transactions)   AS dernier_id,
+        CURDATE()                                         AS jour
+"""
+
+
+class TableauDeBord:
+    """Indicateurs et dernières transactions, partagés par tous les navigateurs."""
+
+    def __init__(self, flux, connecter, nb_transactions=10, resynchro_s=300):
+        self.flux = flux
+        self.connecter = connecter
+        self.resynchro_s = resynchro_s
+        self.stats = None           # None tant que le premier calcul n'a pas abouti
+        self.version = 0
+        self._jour = None
+        self._dernier_id = 0        # transactions déjà comptées dans stats
+        self._transactions = collections.deque(maxlen=nb_transactions)
+        self._lots = collections.deque(maxlen=50)      # (version, transactions)
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def demarrer(self):
+        """Abonnement au flux puis recalcul périodique (une fois)."""
+        with self._condition:
+            if self._thread is not None:
+                return
+            self.flux.abonner(self._appliquer)
+            self._thread = threading.Thread(target=self._boucle, daemon=True)
+            self._thread.start()
+
+    # -------------------------
+    #  CALCUL
+    # -------------------------
+
+    def _boucle(self):
+        while True:
+            try:
+                self.recalculer()
+            except Exception as e:
+                print(f"[tableau] recalcul impossible : {e}")
+                time.sleep(5)
+                continue
+            time.sleep(self.resynchro_s)
+
+    def recalculer(self):
+        """Indicateurs et dernières transactions relus d'un même instantané."""
+        cnx = self.connecter()
+        try:
+            cnx.commit()
+            cnx.start_transaction(consistent_snapshot=True, readonly=True)
+            cursor = cnx.cursor(dictionary=True)
+            cursor.execute(_SQL_INDICATEURS)
+            row = cursor.fetchone()
+            cursor.close()
+            dernieres = flux_transactions.lire_dernieres(cnx, self._transactions.maxlen)
+            cnx.commit()
+        finally:
+            cnx.close()
+
+        with self._condition:
+            self.stats = {
+                "nb_etudiants": row["nb_etudiants"],
+                "nb_comptes": row["nb_comptes"],
+                "solde_total": Decimal(row["solde_total"]),
+                "credits_today": Decimal(row["credits_today"]),
+            }
+            self._jour = row["jour"]
+            self._dernier_id = row["dernier_id"]
+            self._transactions.clear()
+            self._transactions.extend(dernieres)
+            self._publier(None)
+
+    def _appliquer(self, lignes):
+        """Lot du flux : mise à jour incrémentale (thread du flux)."""
+        nouvelles = []
+        recalcul = False
+        with self._condition:
+            if self.stats is None:
+                return
+            for t in lignes:
+                if t["id"] <= self._dernier_id:
+                    continue    # déjà dans le dernier recalcul
+                date = datetime.datetime.fromisoformat(t["date"]).date()
+                if date > self._jour:
+                    recalcul = True
+                    break
+                montant = Decimal(t["montant"])
+                if t["type"] == "CREDIT":
+                    self.stats["solde_total"] += montant
+                    if date == self._jour:
+                        self.stats["credits_today"] += montant
+                else:
+                    self.stats["solde_total"] -= montant
+                self._dernier_id = t["id"]
+                self._transactions.append(t)
+                nouvelles.append(t)
+            if nouvelles:
+                self._publier(nouvelles)
+        if recalcul:
+            self.recalculer()
+
+    def etudiant_cree(self):
+        """Création d'un étudiant et de son compte par Rodelika Web."""
+        with self._condition:
+            if self.stats is None:
+                return
+            self.stats["nb_etudiants"] += 1
+            self.stats["nb_comptes"] += 1
+            self._publier([])
+
+    def _publier(self, transactions):
+        """Nouvelle version (verrou tenu) ; transactions None = état complet."""
+        self.version += 1
+        self._lots.append((self.version, transactions))
+        self._condition.notify_all()
+
+    # -------------------------
+    #  LECTURE
+    # -------------------------
+
+    def _stats_json(self):
+        return {
+            "nb_etudiants": self.stats["nb_etudiants"],
+            "nb_comptes": self.stats["nb_comptes"],
+            "solde_total": f"{self.stats['solde_total']:.2f}",
+            "credits_today": f"{self.stats['credits_today']:.2f}",
+        }
+
+    def etat(self):
+        """État complet {version, stats, transactions} ou None (pas encore calculé)."""
+        with self._condition:
+            if self.stats is None:
+                return None
+            return {
+                "version": self.version,
+                "stats": self._stats_json(),
+                "transactions": list(self._transactions),
+            }
+
+    def attendre(self, version, attente_s):
+        """
+        Ce qui a changé depuis `version`, après au plus attente_s secondes :
+        ("delta", {version, stats, transactions nouvelles}), ("etat", état
+        complet) si le client est trop en retard ou après un recalcul, ou
+        (None, None) si rien n'a changé.
+        """
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self.stats is not None and self.version > version,
+                timeout=attente_s,
+            )
+            if self.stats is None or self.version <= version:
+                return None, None
+            lots = [(v, t) for v, t in self._lots if v > version]
+            if not lots or lots[0][0] != version + 1 or any(t is None for _, t in lots):
+                return "etat", {
+                    "version": self.version,
+                    "stats": self._stats_json(),
+                    "transactions": list(self._transactions),
+                }
+            return "delta", {
+                "version": self.version,
+                "stats": self._stats_json(),
+                "transactions": [l for _, t in lots for l in t],
+            }
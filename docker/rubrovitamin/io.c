@@ -4,6 +4,7 @@
 // prototype des fonctions définies dans ce fichier :
 // uint8_t recbytet0();		// reçoit un octet t=0
 // void sendbytet0(uint8_t);	// émet un octet t=0
+// void setdit0(uint8_t);	// change de vitesse après un PPS
 //
 // Les entrées-sorties sont synchronisées sur l'horloge externe.
 // Ce programme utilise le compteur asynchrone TCNT2 pour fonctionner y compris lorsque
@@ -20,29 +21,94 @@
 // un bit tous les 372 clocks -- 1 etu = 372 clock de l'entrée clock externe
 // Un etu (elementary time unit) fait théoriquement 372 coups d'horloge externe, soit
 // environ 46 itérations du compteur CNT2 cadencé à CK/8
-// 8 * 46.5 = 372
-// 8 * 46 =  368	cette valeur semble convenir sur tous les lecteurs
+// 8 * 46.5 = 372	valeur exacte, tenue en quarts d'itération (voir plus bas)
 // La fréquence standard des lecteurs est de 3.58 MHz = 104uS pour 372 cycles = 9600 bauds
 // la plupart des lecteurs ont une fréquence plus élevée, de 3,7 à 4,7 MHz.
 
 // broche I/O sur le port b
 #define IOPIN 4
 
+// Après un PPS, l'etu vaut 372/Di coups d'horloge externe (Fi = 372) :
+//  Di = 1 : CNT2 sur CK/8, 46,5 itérations
+//  Di = 2 : CK/8, 23,25 itérations
+//  Di = 4 : CK/1, 93 itérations
+// Les échéances sont absolues : le compteur n'est relancé qu'au début d'un
+// caractère (front du bit start, fin du signal d'erreur) et chaque bit est
+// daté depuis ce point, en quarts d'itération de CNT2. Les fractions d'etu
+// ne se perdent plus d'un bit à l'autre, et le temps passé entre deux
+// attentes ne s'ajoute pas à la durée du bit : relancer TCNT2 à chaque
+// etu décalait chaque bit de quelques coups d'horloge, et à Di = 4 l'écart
+// cumulé sur un caractère devenait une part notable de l'etu.
+// L'attente d'une échéance passe par la comparaison OCR2A (drapeau OCF2A),
+// qui ne manque pas l'instant même si la boucle lit TCNT2 trop tard.
+// Aucune attente ne dépasse un etu (moins de 128 itérations).
+static uint16_t etu = 186;      // durée d'un etu en quarts d'itération de CNT2
+static uint8_t prediv = 2;      // valeur de TCCR2B : 2 = CK/8, 1 = CK/1
+static uint16_t echeance;       // début du bit en cours, en quarts d'itération
+                                // depuis la relance (modulo 2^16)
+
+// relance le compteur : les échéances suivantes partent de maintenant
+static void relancer(void)
+{
+    TCNT2 = 0;
+    TCNT2 = 0; // /!\ nécessaire si la fréquence du lecteur est trop faible
+    echeance = 0;
+}
+
+// attend l'instant t (en quarts d'itération depuis la relance)
+static void attendre(uint16_t t)
+{
+    uint8_t cible = (uint8_t)(t >> 2);
+
+    // compteur asynchrone : OCR2A n'est pris en compte qu'après recopie
+    OCR2A = cible;
+    do
+        ;
+    while (ASSR & (1 << OCR2AUB));
+    TIFR2 = 1 << OCF2A; // efface une comparaison antérieure
+    // égalité vue par le comparateur, ou échéance déjà dépassée
+    do
+        ;
+    while (!(TIFR2 & (1 << OCF2A)) && (int8_t)(TCNT2 - cible) < 0);
+}
+
+// passe à l'etu suivant : attend la fin du bit en cours
+static void etu_suivant(void)
+{
+    echeance += etu;
+    attendre(echeance);
+}
+
+// change de vitesse ; di = champ DI de PPS1 (1, 2 ou 3, soit Di = 1, 2, 4)
+void setdit0(uint8_t di)
+{
+    switch (di)
+    {
+    case 2:
+        etu = 93;
+        prediv = 2;
+        break;
+    case 3:
+        etu = 372;
+        prediv = 1;
+        break;
+    default:
+        etu = 186;
+        prediv = 2;
+        break;
+    }
+}
+
 // envoi d'un bit sur le lien série
 static void sendbit(uint8_t b)
 {
     uint8_t outB;
     // calcule la valeur à sortir
     outB = (b & 1) << IOPIN;
-    // attend la fin de l'envoi de l'octet précédent
-    do
-        ;
-    while (TCNT2 < 46);
+    // attend la fin de l'envoi du bit précédent
+    etu_suivant();
     // écriture du bit
     PORTB = outB; // pendant les 4 clocks dispos de l'horloge externe
-    // relance le compteur
-    TCNT2 = 0;
-    TCNT2 = 0; // /!\ nécessaire si la fréquence du lecteur est trop faible
 }
 
 // envoi d'un octet sur le lien série
@@ -53,8 +119,9 @@ void sendbytet0(uint8_t b)
     uint8_t b_save; // valeur sauvegardée en cas d'erreur
 
     b_save = b;
-    TCCR2B = 2; // lance le compteur sur CK/8
-    TCNT2 = 40; // initialise TCNT2 pour attente lors du premier envoi
+    TCCR2B = prediv;           // lance le compteur (CK/8 ou CK/1)
+    relancer();
+    echeance = (etu >> 3) - etu; // premier envoi dans 1/8 etu
 reenvoyer:
     PORTB |= 1 << IOPIN; // affecter la valeur
     DDRB |= 1 << IOPIN;  // avant de positionner le port en sortie
@@ -69,22 +136,19 @@ reenvoyer:
     }
     sendbit(p); // bit de parité
     sendbit(1); // bit stop
-    do
-        ;
-    while (TCNT2 < 46); // attendre fin du bit stop
+    etu_suivant(); // attendre fin du bit stop
     // commuter en mode entrée pour lire si le lecteur demande la réémission
     DDRB &= ~(1 << IOPIN);
     PORTB &= ~(1 << IOPIN);
-    do
-        ;
-    while (TCNT2 < 93); // attendre encore 1 etu
+    etu_suivant(); // attendre encore 1 etu
     // lire le signal d'erreur
     if ((PINB & (1 << IOPIN)) == 0)
     { // si on lit 0
         do
             ;
         while ((PINB & (1 << IOPIN)) == 0); // attendre la fin du signal d'erreur
-        TCNT2 = 22; // positionner le compteur pour attendre encore 1/2 etu avant envoi
+        relancer();
+        echeance = (etu >> 1) - etu; // attendre encore 1/2 etu avant envoi
         b = b_save; // restaurer l'octet à envoyer
         goto reenvoyer;
     }
@@ -96,24 +160,15 @@ reenvoyer:
 static uint8_t getbit()
 {
     uint8_t b;
-    // attendre la fin du bit précédent
-    do
-        ;
-    while (TCNT2 < 46);
-    TCNT2 = 0;
-    TCNT2 = 0; // réinitialise le compteur
-    // vote majoritaire sur lecture à trois instants
-    do
-        ;
-    while (TCNT2 < 12);
+    uint16_t q = etu >> 2;
+    // début du bit, une fois le précédent terminé
+    echeance += etu;
+    // vote majoritaire sur lecture à trois instants (1/4, 1/2, 3/4 etu)
+    attendre(echeance + q);
     b = (PINB & (1 << IOPIN));
-    do
-        ;
-    while (TCNT2 < 23);
+    attendre(echeance + 2 * q);
     b += (PINB & (1 << IOPIN));
-    do
-        ;
-    while (TCNT2 < 34);
+    attendre(echeance + 3 * q);
     b += (PINB & (1 << IOPIN)); // le bit reçu est en position IOPIN+1 si la somme des trois bits est >=2
     // positionner le bit reçu en b7
     return (b << (6 - IOPIN)) & 0x80;
@@ -127,7 +182,7 @@ uint8_t recbytet0()
     uint8_t p; // parité
     uint8_t b; // bit reçu
 
-    TCCR2B = 2; // démarre CNT2 sur CKEXT/8
+    TCCR2B = prediv; // démarre CNT2 sur CKEXT/8 (CKEXT après PPS à Di = 4)
 relire:
     DDRB &= ~(1 << IOPIN); // mode entrée sur pb4
     PORTB |= (1 << IOPIN); // pull-up sur IOPIN
@@ -139,8 +194,7 @@ relire:
     do
         ;
     while ((PINB & (1 << IOPIN)) != 0); // anti rebond
-    TCNT2 = 0; // initialisation double du compteur
-    TCNT2 = 0;
+    relancer(); // les bits de l'octet sont datés depuis le front du start
     p = 0;
     for (i = 0; i < 8; i++)
     { // boucle de lecture des 8 bits d'un octet lsb first
@@ -150,26 +204,23 @@ relire:
     }
     p ^= getbit(); // p contient 0x80 si erreur de parité
     // attendre la fin du bit de parité + 1 etu
-    do
-        ;
-    while (TCNT2 < 93);
+    etu_suivant();
+    etu_suivant();
     // si erreur de parité, demander une réémission en mettant la ligne à 0 pendant environ 1.5 etu
     if (p)
     {
 
         PORTB &= ~(1 << IOPIN); // signal 0
         DDRB |= (1 << IOPIN);   // sortie
-        do
-            ;
-        while (TCNT2 < 162); // pendant 1.5 etu
+        etu_suivant();
+        echeance += etu >> 1; // pendant 1.5 etu
+        attendre(echeance);
         goto relire;
     }
     else
     {
         // sinon, attendre  1 etu du bit stop
-        do
-            ;
-        while (TCNT2 < 139);
+        etu_suivant();
     }
     TCCR2B = 0; // arrêter le compteur
     return r;
@@ -1,7 +1,9 @@
 #include <avr/io.h>
 #include <stdint.h>
+#include <stddef.h>
 #include <avr/eeprom.h>
 #include <avr/pgmspace.h>
+#include <util/crc16.h>
 #include <stdarg.h>
 
 //---------------------
@@ -12,9 +14,10 @@
 
 
 // déclaration des fonctions d'entrée/sortie
-// écrites en assembleur dans le fichier io.s
+// écrites dans le fichier io.c
 extern void sendbytet0(uint8_t b);
 extern uint8_t recbytet0(void);
+extern void setdit0(uint8_t di);
 
 // variables globales en static ram
 uint8_t cla, ins, p1, p2, p3;  // header de commande
@@ -25,8 +28,21 @@ uint8_t sw1, sw2;              // status word
 // ATR
 //======================================================================
 
+// Capacités annoncées dans le dernier octet d'historique de l'ATR
+// (les cartes plus anciennes y envoient le 0x00 final de "rubro" :
+// aucune capacité, les hôtes reviennent aux anciennes commandes)
+#define CAP_ETAT     0x01   // INS 0x08 : lecture d'état groupée
+#define CAP_SESSION  0x02   // INS 0x04 : P1 = taille de la session PIN
+#define CAP_NUM_ETU  0x04   // 81 03 : numéro étudiant seul, en BCD
+#define CAP_SERIE    0x08   // 81 04 / 81 05 : numéro de série de la carte
+#define CAPACITES    (CAP_ETAT | CAP_SESSION | CAP_NUM_ETU | CAP_SERIE)
+
+// TA1 : Fi = 372, Di = 4 au plus ; la carte démarre à Di = 1 et le
+// lecteur demande une vitesse supérieure par PPS (voir pps)
+#define TA1          0x03
+
 #define size_atr 0x6
-const char atr_str[size_atr] PROGMEM = "rubro";
+const char atr_str[size_atr - 1] PROGMEM = "rubro";
 
 // Procédure qui renvoie l'ATR
 void atr(void)
@@ -36,17 +52,67 @@ void atr(void)
     sendbytet0(0x3b);              // définition du protocole
     uint8_t n = 0xF0 + size_atr + 1;
     sendbytet0(n);                 // nombre d'octets d'historique
-    sendbytet0(0x01);              // TA
+    sendbytet0(TA1);               // TA : Fi/Di max
     sendbytet0(0x05);              // TB
     sendbytet0(0x05);              // TC
     sendbytet0(0x00);              // TD protocole t=0
     sendbytet0(0x00);              // CAT
 
     // Boucle d'envoi des octets d'historique
-    for (i = 0; i < size_atr; i++)
+    for (i = 0; i < size_atr - 1; i++)
     {
         sendbytet0(pgm_read_byte(atr_str + i));
     }
+    sendbytet0(CAPACITES);
+}
+
+//======================================================================
+// PPS
+//======================================================================
+
+// Négociation de vitesse, seulement en premier échange après l'ATR
+// (PPSS = 0xFF à la place de CLA). Le lecteur envoie
+// PPSS PPS0 [PPS1] [PPS2] [PPS3] PCK. Réponse à la vitesse courante :
+//  - PPS1 acceptée (Fi = 372, 1 <= DI <= DI de TA1) : écho de PPS1,
+//    puis passage à la nouvelle vitesse
+//  - sinon, réponse sans PPS1 : la vitesse par défaut est conservée
+// PPS2/PPS3 ne sont jamais repris. PCK faux : pas de réponse, le lecteur
+// réinitialise la carte.
+void pps(void)
+{
+    uint8_t pps0, pps1 = 0, x, di = 0;
+
+    pps0 = recbytet0();
+    x = 0xFF ^ pps0;
+    if (pps0 & 0x10)
+    {
+        pps1 = recbytet0();
+        x ^= pps1;
+    }
+    if (pps0 & 0x20)
+        x ^= recbytet0();
+    if (pps0 & 0x40)
+        x ^= recbytet0();
+    x ^= recbytet0();               // PCK
+    if (x != 0 || (pps0 & 0x0F) != 0)
+        return;                     // PCK faux ou autre protocole que T=0
+
+    if ((pps0 & 0x10) && (pps1 >> 4) <= 1 &&
+        (pps1 & 0x0F) >= 1 && (pps1 & 0x0F) <= (TA1 & 0x0F))
+    {
+        di = pps1 & 0x0F;
+        pps0 = 0x10;
+    }
+    else
+        pps0 = 0x00;
+
+    sendbytet0(0xFF);
+    sendbytet0(pps0);
+    if (di)
+        sendbytet0(pps1);
+    sendbytet0(0xFF ^ pps0 ^ (di ? pps1 : 0));
+    if (di)
+        setdit0(di);
 }
 
 //======================================================================
@@ -80,9 +146,18 @@ void version(void)
 
 
 //======================================================================
-// Transactions anti-arrachement
+// Image EEPROM
 //======================================================================
 
+// Les variables EEPROM sont regroupées dans une seule structure : leur
+// place ne dépend plus de l'ordre choisi par l'éditeur de liens. Les
+// champs de l'ancienne image (avant le numéro de série et le double
+// tampon) gardent exactement leurs adresses, relevées sur l'ancien
+// rubro_v2.elf ; les champs ajoutés depuis viennent après. Une ancienne
+// carte reprogrammée (FLASH seule, EEPROM conservée) garde donc sa
+// perso, son PIN et son PUK, et son solde est repris une fois par
+// charge_compte() (voir FORMAT_EE).
+
 // nombre maximal d'opérations par transaction
 #define max_ope     8
 // taille maximale totale des données échangées lors d'une transaction
@@ -90,16 +165,83 @@ void version(void)
 // définition de l'état du buffer -- plein est une valeur aléatoire
 typedef enum { vide = 0, plein = 0x1c } state_t;
 
-// la variable buffer de transaction mémorisée en eeprom
-struct
+// buffer de transaction
+typedef struct
 {
     state_t  state;                 // état
     uint8_t  nb_ope;                // nombre d'opération dans la transaction
     uint8_t  tt[max_ope];           // table des tailles des transferts
     uint8_t* p_dst[max_ope];        // table des adresses de destination des transferts
     uint8_t  buffer[max_data];      // données à transférer
-}
-ee_trans EEMEM = { vide };          // l'état doit être initialisé à "vide"
+} trans_t;
+
+#define MAX_PERSO    32
+#define SERIE_LEN    6
+#define PIN_LEN      4
+#define PUK_LEN      6
+#define PIN_TRY_MAX  3
+#define PUK_TRY_MAX  5
+
+// PIN par défaut
+#define DEFAULT_PIN0  1
+#define DEFAULT_PIN1  2
+#define DEFAULT_PIN2  3
+#define DEFAULT_PIN3  4
+
+// emplacement solde/compteur du double tampon (voir ecrit_compte)
+typedef struct
+{
+    uint8_t  seq;       // numéro de séquence (modulo 256)
+    uint16_t solde;     // solde en centimes (little endian)
+    uint16_t ctr;       // compteur anti-rejoue (little endian)
+    uint8_t  crc;       // CRC8 de seq, solde et ctr
+} compte_t;
+
+// format de l'image : absent (0xFF) sur une ancienne carte
+#define FORMAT_EE   0x01
+
+typedef struct
+{
+    // --- ancienne image : ne rien insérer ni déplacer ici
+    uint16_t      solde_ancien;         // 0x00 ancien solde, lu par migre_compte
+    uint16_t      ctr_ancien;           // 0x02 ancien compteur, idem
+    uint8_t       puk_tries;            // 0x04
+    uint8_t       pin_tries;            // 0x05
+    uint8_t       puk[PUK_LEN];         // 0x06
+    uint8_t       pin[PIN_LEN];         // 0x0C
+    unsigned char perso[MAX_PERSO];     // 0x10
+    uint8_t       taille_perso;         // 0x30
+    trans_t       trans;                // 0x31 .. 0x8B
+    // --- ajouts : numéro de série, double tampon, format
+    uint8_t       serie[SERIE_LEN];     // 0x8C
+    compte_t      compte[2];            // 0x92
+    uint8_t       format;               // 0x9E, écrit en dernier
+} eeprom_t;
+
+// l'ancienne image ne doit pas bouger (tailles avr-gcc : enum et pointeur
+// sur 2 octets)
+_Static_assert(offsetof(eeprom_t, taille_perso) == 0x30, "ancienne image EEPROM decalee");
+_Static_assert(offsetof(eeprom_t, serie) == 0x8C, "ancienne image EEPROM decalee");
+
+eeprom_t ee EEMEM = {
+    .puk_tries    = PUK_TRY_MAX,
+    .pin_tries    = PIN_TRY_MAX,
+    .puk          = { '9','9','9','9','9','9' },    // écrasé par intro_perso
+    .pin          = { DEFAULT_PIN0, DEFAULT_PIN1, DEFAULT_PIN2, DEFAULT_PIN3 },
+    .taille_perso = 0,
+    .trans        = { vide },           // l'état doit être initialisé à "vide"
+    .serie        = { 0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF },
+    // deux emplacements nuls : valides (CRC8 de zéros = 0)
+    .compte       = { { 0, 0, 0, 0 }, { 0, 0, 0, 0 } },
+    .format       = FORMAT_EE
+};
+
+
+//======================================================================
+// Transactions anti-arrachement
+//======================================================================
+
+// buffer de transaction mémorisé en eeprom : ee.trans (voir "Image EEPROM")
 
 // validation d'une transaction
 void valide(void)
@@ -112,32 +254,35 @@ void valide(void)
     uint8_t tt;         // taille des données à transférer
 
     // lecture de l'état du buffer
-    e = eeprom_read_byte((uint8_t*)&ee_trans.state);
+    e = eeprom_read_byte((uint8_t*)&ee.trans.state);
     // s'il y a quelque chose dans le buffer, transférer les données aux destinations
     if (e == plein)     // un état non plein est interprété comme vide
     {
         // lecture du nombre d'opérations
-        nb_ope = eeprom_read_byte(&ee_trans.nb_ope);
-        p_src  = ee_trans.buffer;
+        nb_ope = eeprom_read_byte(&ee.trans.nb_ope);
+        p_src  = ee.trans.buffer;
         // boucle sur le nombre d'opérations
         for (i = 0; i < nb_ope; i++)
         {
             // lecture de la taille à transférer
-            tt = eeprom_read_byte(&ee_trans.tt[i]);
+            tt = eeprom_read_byte(&ee.trans.tt[i]);
             // lecture de la destination
-            p_dst = (uint8_t*)eeprom_read_word((uint16_t*)&ee_trans.p_dst[i]);
+            p_dst = (uint8_t*)eeprom_read_word((uint16_t*)&ee.trans.p_dst[i]);
             // transfert eeprom -> eeprom du buffer vers la destination
             for (j = 0; j < tt; j++)
             {
-                eeprom_write_byte(p_dst++, eeprom_read_byte(p_src++));
+                eeprom_update_byte(p_dst++, eeprom_read_byte(p_src++));
             }
         }
     }
-    eeprom_write_byte((uint8_t*)&ee_trans.state, vide);
+    // update : pas d'écriture si le buffer était déjà vide (cas du reset)
+    eeprom_update_byte((uint8_t*)&ee.trans.state, vide);
 }
 
 // engagement d'une transaction
 // appel de la forme engage(n1, p_src1, p_dst1, n2, p_src2, p_dst2, ... 0)
+// Les eeprom_update_* n'écrivent que les octets qui changent : l'état du
+// buffer est le même, seul le coût (quelques ms par octet) diminue.
 void engage(int tt, ...)
 {
     va_list args;
@@ -146,30 +291,30 @@ void engage(int tt, ...)
     uint8_t *p_buf;
 
     // mettre l'état à "vide"
-    eeprom_write_byte((uint8_t*)&ee_trans.state, vide);
+    eeprom_update_byte((uint8_t*)&ee.trans.state, vide);
 
     va_start(args, tt);
     nb_ope = 0;
-    p_buf  = ee_trans.buffer;
+    p_buf  = ee.trans.buffer;
     while (tt != 0)
     {
         // transférer les données dans le buffer
         p_src = va_arg(args, uint8_t*);
-        eeprom_write_block(p_src, p_buf, tt);
+        eeprom_update_block(p_src, p_buf, tt);
         p_buf += tt;
         // écriture de l'adresse de destination
-        eeprom_write_word((uint16_t*)&ee_trans.p_dst[nb_ope],
-                          (uint16_t)va_arg(args, uint8_t*));
+        eeprom_update_word((uint16_t*)&ee.trans.p_dst[nb_ope],
+                           (uint16_t)va_arg(args, uint8_t*));
         // écriture de la taille des données
-        eeprom_write_byte(&ee_trans.tt[nb_ope], tt);
+        eeprom_update_byte(&ee.trans.tt[nb_ope], tt);
         nb_ope++;
         tt = va_arg(args, int);   // taille suivante dans la liste
     }
     // écriture du nombre de transactions
-    eeprom_write_byte(&ee_trans.nb_ope, nb_ope);
+    eeprom_update_byte(&ee.trans.nb_ope, nb_ope);
     va_end(args);
     // mettre l'état à "data"
-    eeprom_write_byte((uint8_t*)&ee_trans.state, plein);
+    eeprom_write_byte((uint8_t*)&ee.trans.state, plein);
 }
 
 
@@ -177,42 +322,42 @@ void engage(int tt, ...)
 // Personnalisation + PUK généré
 //======================================================================
 
-#define MAX_PERSO 32
-uint8_t ee_taille_perso EEMEM = 0;
-unsigned char ee_perso[MAX_PERSO] EEMEM;
+// Deux formats de perso, stockés tels quels (la carte ne les interprète
+// que pour 81 03) :
+//  - historique : ASCII "num;nom;prenom"
+//  - compact v1 : PERSO_V1 | num BCD (4 octets) | longueur nom | nom | prénom
+#define PERSO_V1  0xC1
+
+// Numéro de série : écrit une fois à l'émission (81 05), conservé par
+// les persos suivantes ; sert de clé Num_Carte dans la table Carte
+// (ee.serie, 0xFF partout tant qu'il n'est pas écrit)
 
 
 //======================================================================
 // PIN / PUK + anti-rejoue + solde
 //======================================================================
 
-#define PIN_LEN      4
-#define PUK_LEN      6
-#define PIN_TRY_MAX  3
-#define PUK_TRY_MAX  5
+// nombre maximal d'opérations sensibles par session PIN
+#define PIN_SESSION_MAX  8
 
-// PIN par défaut
-#define DEFAULT_PIN0  1
-#define DEFAULT_PIN1  2
-#define DEFAULT_PIN2  3
-#define DEFAULT_PIN3  4
+// Solde (centimes) et compteur anti-rejoue : double tampon
+// -----------------------------------------------------------
+// Les deux valeurs changent ensemble à chaque crédit/débit. Plutôt que de
+// passer par engage()/valide() (~13 octets écrits) plus une écriture du
+// compteur, chaque mise à jour est écrite dans l'emplacement INACTIF avec
+// un numéro de séquence et un CRC8. Au reset, l'emplacement valide le
+// plus récent fait foi : un arrachement pendant l'écriture laisse l'ancien
+// emplacement intact. Au plus 6 octets écrits, souvent 4.
+// Les deux emplacements sont ee.compte[0] et ee.compte[1].
 
-// PIN/PUK stockés en EEPROM
-uint8_t ee_pin[PIN_LEN] EEMEM = { DEFAULT_PIN0, DEFAULT_PIN1, DEFAULT_PIN2, DEFAULT_PIN3 };
-// PUK initial, sera écrasé par intro_perso
-uint8_t ee_puk[PUK_LEN] EEMEM = { '9','9','9','9','9','9' };
+// copie RAM de l'emplacement actif (lectures sans accès EEPROM)
+compte_t compte;
+uint8_t  compte_actif;
 
-// Compteurs d'essais PIN/PUK
-uint8_t ee_pin_tries EEMEM = PIN_TRY_MAX;
-uint8_t ee_puk_tries EEMEM = PUK_TRY_MAX;
+void charge_compte(void);
 
-// Compteur anti-rejoue (16 bits, little endian)
-uint16_t ee_ctr EEMEM = 0;
-
-// Solde en centimes
-uint16_t ee_solde EEMEM = 0;
-
-// Flag RAM : PIN vérifié pour la prochaine opération sensible
+// Session PIN en RAM : nombre d'opérations sensibles encore autorisées
+// (0 = PIN non vérifié). Perdue au reset de la carte.
 uint8_t pin_ok = 0;
 
 
@@ -278,8 +423,9 @@ void intro_perso(void)
     };
     uint8_t pin_tries = PIN_TRY_MAX;
     uint8_t puk_tries = PUK_TRY_MAX;
-    uint16_t ctr0 = 0;      // compteur anti-rejoue remis à 0
-    uint16_t solde0 = 0;    // solde remis à 0
+    // les deux emplacements solde/compteur remis à 0
+    compte_t compte0[2] = { { 0, 0, 0, 0 }, { 0, 0, 0, 0 } };
+    uint8_t format = FORMAT_EE;
 
     if (p3 > MAX_PERSO)
     {
@@ -307,18 +453,20 @@ void intro_perso(void)
     //  - compteurs d'essais PIN / PUK
     //  - compteur anti-rejoue = 0
     //  - solde = 0
+    //  - format courant (pas de reprise de l'ancien solde au reset suivant)
     engage(
-        1,  &p3,               &ee_taille_perso,
-        p3, perso,             ee_perso,
-        PUK_LEN, puk,          ee_puk,
-        PIN_LEN, def_pin,      ee_pin,
-        1,  &pin_tries,        &ee_pin_tries,
-        1,  &puk_tries,        &ee_puk_tries,
-        2,  (uint8_t*)&ctr0,   (uint8_t*)&ee_ctr,
-        2,  (uint8_t*)&solde0, (uint8_t*)&ee_solde,
+        1,  &p3,               &ee.taille_perso,
+        p3, perso,             ee.perso,
+        PUK_LEN, puk,          ee.puk,
+        PIN_LEN, def_pin,      ee.pin,
+        1,  &pin_tries,        &ee.pin_tries,
+        1,  &puk_tries,        &ee.puk_tries,
+        sizeof(compte0), (uint8_t*)compte0, (uint8_t*)ee.compte,
+        1,  &format,           &ee.format,
         0
     );
     valide();
+    charge_compte();
 
     // en RAM, pas de PIN vérifié
     pin_ok = 0;
@@ -335,7 +483,7 @@ void lire_perso(void)
     int i;
     uint8_t t;
 
-    t = eeprom_read_byte(&ee_taille_perso);
+    t = eeprom_read_byte(&ee.taille_perso);
     if (p3 != t)
     {
         sw1 = 0x6c;
@@ -345,13 +493,156 @@ void lire_perso(void)
     sendbytet0(ins);
     for (i = 0; i < p3; i++)
     {
-        sendbytet0(eeprom_read_byte(ee_perso + i));
+        sendbytet0(eeprom_read_byte(ee.perso + i));
     }
     sw1 = 0x90;
     sw2 = 0x00;
 }
 
 
+// lecture du numéro étudiant seul, 8 chiffres en BCD
+// CLA = 0x81, INS = 0x03
+// APDU : 81 03 00 00 04
+// Perso compacte : octets 1 à 4. Perso historique : chiffres avant le
+// ';' (8 au plus, zéros à gauche). 6A 88 si la carte n'a pas de numéro.
+void lire_num_etudiant(void)
+{
+    uint8_t bcd[4] = { 0, 0, 0, 0 };
+    uint8_t t, i, j, c, n = 0;
+
+    if (p3 != 4)
+    {
+        sw1 = 0x6c;
+        sw2 = 4;
+        return;
+    }
+    t = eeprom_read_byte(&ee.taille_perso);
+    if (t >= 5 && eeprom_read_byte(ee.perso) == PERSO_V1)
+    {
+        eeprom_read_block(bcd, ee.perso + 1, 4);
+        n = 8;
+    }
+    else
+    {
+        for (i = 0; i < t; i++)
+        {
+            c = eeprom_read_byte(ee.perso + i);
+            if (c == ';')
+                break;
+            if (c < '0' || c > '9' || n == 8)
+            {
+                n = 0;
+                break;
+            }
+            // décalage d'un chiffre vers la gauche, nouveau chiffre à droite
+            for (j = 0; j < 3; j++)
+                bcd[j] = (bcd[j] << 4) | (bcd[j + 1] >> 4);
+            bcd[3] = (bcd[3] << 4) | (c - '0');
+            n++;
+        }
+    }
+    if (n == 0)
+    {
+        sw1 = 0x6a;
+        sw2 = 0x88;
+        return;
+    }
+
+    sendbytet0(ins);
+    for (i = 0; i < 4; i++)
+    {
+        sendbytet0(bcd[i]);
+    }
+    sw1 = 0x90;
+    sw2 = 0x00;
+}
+
+
+// numéro de série vierge : tous les octets à FF (EEPROM effacée)
+static uint8_t serie_vierge(void)
+{
+    uint8_t i;
+
+    for (i = 0; i < SERIE_LEN; i++)
+    {
+        if (eeprom_read_byte(ee.serie + i) != 0xFF)
+            return 0;
+    }
+    return 1;
+}
+
+// lecture du numéro de série
+// CLA = 0x81, INS = 0x04
+// APDU : 81 04 00 00 06
+// 6A 88 si la carte n'a pas encore de numéro de série.
+void lire_serie(void)
+{
+    uint8_t i;
+
+    if (p3 != SERIE_LEN)
+    {
+        sw1 = 0x6c;
+        sw2 = SERIE_LEN;
+        return;
+    }
+    if (serie_vierge())
+    {
+        sw1 = 0x6a;
+        sw2 = 0x88;
+        return;
+    }
+    sendbytet0(ins);
+    for (i = 0; i < SERIE_LEN; i++)
+    {
+        sendbytet0(eeprom_read_byte(ee.serie + i));
+    }
+    sw1 = 0x90;
+    sw2 = 0x00;
+}
+
+// écriture du numéro de série, une seule fois
+// CLA = 0x81, INS = 0x05
+// APDU : 81 05 00 00 06 [série]
+// 69 85 si la carte a déjà un numéro ; un numéro tout à FF est refusé
+// (6A 80), il se confondrait avec une carte vierge.
+void ecrire_serie(void)
+{
+    uint8_t serie[SERIE_LEN];
+    uint8_t i, ff = 0xFF;
+
+    if (p3 != SERIE_LEN)
+    {
+        sw1 = 0x6c;
+        sw2 = SERIE_LEN;
+        return;
+    }
+    if (!serie_vierge())
+    {
+        sw1 = 0x69;
+        sw2 = 0x85;
+        return;
+    }
+    sendbytet0(ins);
+    for (i = 0; i < SERIE_LEN; i++)
+    {
+        serie[i] = recbytet0();
+        ff &= serie[i];
+    }
+    if (ff == 0xFF)
+    {
+        sw1 = 0x6a;
+        sw2 = 0x80;
+        return;
+    }
+    // écriture atomique : un arrachement laisse la carte vierge, jamais
+    // un numéro à moitié écrit
+    engage(SERIE_LEN, serie, ee.serie, 0);
+    valide();
+    sw1 = 0x90;
+    sw2 = 0x00;
+}
+
+
 //======================================================================
 // PIN / PUK : vérification, changement, reset par PUK
 // (CLA = 0x82)
@@ -359,19 +650,22 @@ void lire_perso(void)
 
 uint8_t pin_est_bloque(void)
 {
-    uint8_t t = eeprom_read_byte(&ee_pin_tries);
+    uint8_t t = eeprom_read_byte(&ee.pin_tries);
     return (t == 0);
 }
 
 uint8_t puk_est_bloque(void)
 {
-    uint8_t t = eeprom_read_byte(&ee_puk_tries);
+    uint8_t t = eeprom_read_byte(&ee.puk_tries);
     return (t == 0);
 }
 
 // Vérification du PIN
 // CLA = 0x82, INS = 0x04
-// APDU : 82 04 00 00 04 [PIN(4 octets)]
+// APDU : 82 04 P1 00 04 [PIN(4 octets)]
+//   P1 = 0    : une seule opération sensible (comportement historique)
+//   P1 = n    : session de n opérations sensibles (max PIN_SESSION_MAX)
+// APDU : 82 04 FF 00 00 : fermeture de la session en cours
 void verifier_pin(void)
 {
     uint8_t i;
@@ -379,6 +673,14 @@ void verifier_pin(void)
     uint8_t ok = 1;
     uint8_t v, ref;
 
+    if (p1 == 0xFF)
+    {
+        pin_ok = 0;
+        sw1 = 0x90;
+        sw2 = 0x00;
+        return;
+    }
+
     if (pin_est_bloque())
     {
         sw1 = 0x69;    // PIN bloqué
@@ -395,27 +697,36 @@ void verifier_pin(void)
 
     sendbytet0(ins);  // acquittement
 
-    tries = eeprom_read_byte(&ee_pin_tries);
+    tries = eeprom_read_byte(&ee.pin_tries);
 
     for (i = 0; i < PIN_LEN; i++)
     {
         v   = recbytet0();
-        ref = eeprom_read_byte(&ee_pin[i]);
+        ref = eeprom_read_byte(&ee.pin[i]);
         if (v != ref)
             ok = 0;
     }
 
     if (ok)
     {
-        pin_ok = 1;  // autorisation pour UNE prochaine opération
-        eeprom_write_byte(&ee_pin_tries, PIN_TRY_MAX);
+        // ouverture de la session : P1 opérations (1 si P1 = 0)
+        if (p1 == 0)
+            pin_ok = 1;
+        else if (p1 > PIN_SESSION_MAX)
+            pin_ok = PIN_SESSION_MAX;
+        else
+            pin_ok = p1;
+        // l'écriture EEPROM (plusieurs ms) n'est faite que si un essai
+        // avait été décompté auparavant
+        if (tries != PIN_TRY_MAX)
+            eeprom_write_byte(&ee.pin_tries, PIN_TRY_MAX);
         sw1 = 0x90;
         sw2 = 0x00;
     }
     else
     {
         if (tries > 0) tries--;
-        eeprom_write_byte(&ee_pin_tries, tries);
+        eeprom_write_byte(&ee.pin_tries, tries);
         pin_ok = 0;
 
         if (tries == 0)
@@ -458,13 +769,13 @@ void changer_pin(void)
 
     sendbytet0(ins);
 
-    tries = eeprom_read_byte(&ee_pin_tries);
+    tries = eeprom_read_byte(&ee.pin_tries);
 
     // vérification ancien PIN
     for (i = 0; i < PIN_LEN; i++)
     {
         v   = recbytet0();
-        ref = eeprom_read_byte(&ee_pin[i]);
+        ref = eeprom_read_byte(&ee.pin[i]);
         if (v != ref)
             ok = 0;
     }
@@ -478,7 +789,7 @@ void changer_pin(void)
     if (!ok)
     {
         if (tries > 0) tries--;
-        eeprom_write_byte(&ee_pin_tries, tries);
+        eeprom_write_byte(&ee.pin_tries, tries);
         pin_ok = 0;
 
         if (tries == 0)
@@ -495,13 +806,14 @@ void changer_pin(void)
     }
 
     // ancien PIN correct -> on met à jour le PIN
-    engage(PIN_LEN, new_pin, ee_pin, 0);
+    engage(PIN_LEN, new_pin, ee.pin, 0);
     valide();
 
     // on peut considérer que le PIN est vérifié pour UNE op (changer_pin lui-même)
-    pin_ok = 0; // et on le consomme
+    pin_ok = 0; // et on le consomme, la session éventuelle est fermée
 
-    eeprom_write_byte(&ee_pin_tries, PIN_TRY_MAX);
+    if (tries != PIN_TRY_MAX)
+        eeprom_write_byte(&ee.pin_tries, PIN_TRY_MAX);
     sw1 = 0x90;
     sw2 = 0x00;
 }
@@ -533,7 +845,7 @@ void reset_pin_par_puk(void)
 
     sendbytet0(ins);
 
-    tries = eeprom_read_byte(&ee_puk_tries);
+    tries = eeprom_read_byte(&ee.puk_tries);
     if (tries == 0)
     {
         sw1 = 0x69;   // PUK bloqué
@@ -545,7 +857,7 @@ void reset_pin_par_puk(void)
     for (i = 0; i < PUK_LEN; i++)
     {
         v   = recbytet0();
-        ref = eeprom_read_byte(&ee_puk[i]);
+        ref = eeprom_read_byte(&ee.puk[i]);
         if (v != ref)
             ok = 0;
     }
@@ -559,7 +871,7 @@ void reset_pin_par_puk(void)
     if (!ok)
     {
         if (tries > 0) tries--;
-        eeprom_write_byte(&ee_puk_tries, tries);
+        eeprom_write_byte(&ee.puk_tries, tries);
 
         if (tries == 0)
         {
@@ -575,10 +887,10 @@ void reset_pin_par_puk(void)
     }
 
     // PUK correct -> on réinitialise le PIN + essais PIN/PUK
-    engage(PIN_LEN, new_pin, ee_pin, 0);
+    engage(PIN_LEN, new_pin, ee.pin, 0);
     valide();
-    eeprom_write_byte(&ee_pin_tries, PIN_TRY_MAX);
-    eeprom_write_byte(&ee_puk_tries, PUK_TRY_MAX);
+    eeprom_write_byte(&ee.pin_tries, PIN_TRY_MAX);
+    eeprom_write_byte(&ee.puk_tries, PUK_TRY_MAX);
     pin_ok = 0;   // pas de PIN “ouvert” après, il faudra faire un VERIFY
 
     sw1 = 0x90;
@@ -597,29 +909,129 @@ uint8_t check_pin_ok(void)
     return 1;
 }
 
+// consomme une opération de la session PIN
+void consomme_pin(void)
+{
+    if (pin_ok)
+        pin_ok--;
+}
+
 // anti-rejoue : vérifie que le compteur de transaction reçu en P1/P2
-// correspond au compteur stocké en EEPROM, puis l'incrémente.
-uint8_t check_and_update_ctr(void)
+// correspond au compteur courant. L'incrément est écrit par l'appelant,
+// dans la même mise à jour que le solde (ecrit_compte).
+uint8_t check_ctr(void)
 {
-    uint16_t ctr_eep;
     uint16_t ctr_req;
 
-    ctr_eep = eeprom_read_word(&ee_ctr);
     ctr_req = (uint16_t)p1 | ((uint16_t)p2 << 8);
 
-    if (ctr_req != ctr_eep)
+    if (ctr_req != compte.ctr)
     {
         sw1 = 0x69;
         sw2 = 0x84;  // données incorrectes / anti-rejoue
         return 0;
     }
-
-    ctr_eep++;
-    eeprom_write_word(&ee_ctr, ctr_eep);
     return 1;
 }
 
 
+//======================================================================
+// Double tampon solde/compteur
+//======================================================================
+
+// CRC8 (polynôme CCITT) des champs seq, solde, ctr
+uint8_t crc_compte(const compte_t *c)
+{
+    const uint8_t *p = (const uint8_t*)c;
+    uint8_t crc = 0;
+    uint8_t i;
+
+    for (i = 0; i < sizeof(compte_t) - 1; i++)
+        crc = _crc8_ccitt_update(crc, p[i]);
+    return crc;
+}
+
+// Reprise d'une ancienne carte reprogrammée sans son EEPROM : ee.format
+// vaut encore 0xFF. L'ancien solde et l'ancien compteur passent dans
+// l'emplacement 0 (séquence 1, plus récent que l'emplacement 1 remis à
+// zéro), puis le format est écrit en dernier. Les anciens champs ne sont
+// jamais réécrits : une reprise interrompue par un arrachement
+// recommence au reset suivant.
+static void migre_compte(void)
+{
+    compte_t n;
+    compte_t zero = { 0, 0, 0, 0 };
+
+    n.seq   = 1;
+    n.solde = eeprom_read_word(&ee.solde_ancien);
+    n.ctr   = eeprom_read_word(&ee.ctr_ancien);
+    n.crc   = crc_compte(&n);
+
+    eeprom_update_block(&zero, &ee.compte[1], sizeof(compte_t));
+    eeprom_update_block(&n, &ee.compte[0], sizeof(compte_t));
+    eeprom_write_byte(&ee.format, FORMAT_EE);
+}
+
+// choix de l'emplacement actif, au reset et après une personnalisation
+void charge_compte(void)
+{
+    compte_t a, b;
+    uint8_t va, vb;
+
+    if (eeprom_read_byte(&ee.format) != FORMAT_EE)
+        migre_compte();
+
+    eeprom_read_block(&a, &ee.compte[0], sizeof(compte_t));
+    eeprom_read_block(&b, &ee.compte[1], sizeof(compte_t));
+    va = (crc_compte(&a) == a.crc);
+    vb = (crc_compte(&b) == b.crc);
+
+    // les deux valides : le plus récent (écart de séquence modulo 256),
+    // l'emplacement 0 en cas d'égalité
+    if (va && (!vb || (uint8_t)(a.seq - b.seq) < 0x80))
+    {
+        compte = a;
+        compte_actif = 0;
+    }
+    else if (vb)
+    {
+        compte = b;
+        compte_actif = 1;
+    }
+    else
+    {
+        // EEPROM effacée : solde et compteur nuls, écriture suivante en 0
+        compte.seq   = 0;
+        compte.solde = 0;
+        compte.ctr   = 0;
+        compte.crc   = 0;
+        compte_actif = 1;
+    }
+}
+
+// nouvelle valeur du solde et du compteur, écrite dans l'emplacement
+// inactif. Le numéro de séquence est écrit EN DERNIER : tant qu'il n'est
+// pas écrit, l'emplacement reste plus ancien que l'actif, même si un
+// arrachement laisse par hasard un CRC correct.
+void ecrit_compte(uint16_t solde, uint16_t ctr)
+{
+    compte_t n;
+    compte_t *dst;
+
+    n.seq   = compte.seq + 1;
+    n.solde = solde;
+    n.ctr   = ctr;
+    n.crc   = crc_compte(&n);
+
+    dst = &ee.compte[compte_actif ^ 1];
+    eeprom_update_block(&n.solde, &dst->solde, sizeof(compte_t) - 1);
+    eeprom_update_byte(&dst->seq, n.seq);
+
+    compte = n;
+    compte_actif ^= 1;
+}
+
+
 //======================================================================
 // Gestion du solde (CLA 0x82)
 //======================================================================
@@ -634,8 +1046,8 @@ void lire_solde(void)
     // il faut être authentifié par PIN pour CETTE opération
     if (!check_pin_ok())
         return;
-    // on consomme le ticket PIN pour ne pas réutiliser l'authentification
-    pin_ok = 0;
+    // on consomme une opération de la session PIN
+    consomme_pin();
 
     if (p3 != 2)
     {
@@ -644,7 +1056,7 @@ void lire_solde(void)
         return;
     }
     sendbytet0(ins);
-    s = eeprom_read_word(&ee_solde);
+    s = compte.solde;
     sendbytet0(s & 0xff);   // little endian
     sendbytet0(s >> 8);
     sw1 = 0x90;
@@ -662,15 +1074,18 @@ void credit(void)
     // PIN obligatoire pour CETTE opération
     if (!check_pin_ok())
         return;
-    // on consomme l'autorisation PIN
-    pin_ok = 0;
+    // on consomme une opération de la session PIN
+    consomme_pin();
 
     // anti-rejoue
-    if (!check_and_update_ctr())
+    if (!check_ctr())
         return;
 
+    // une fois le compteur accepté, il est consommé même si la suite
+    // échoue : la mise à jour ne porte alors que sur le compteur
     if (p3 != 2)
     {
+        ecrit_compte(compte.solde, compte.ctr + 1);
         sw1 = 0x6c;
         sw2 = 2;
         return;
@@ -679,15 +1094,15 @@ void credit(void)
     // lire le montant à créditer (little endian)
     c  = recbytet0();
     c |= (uint16_t)recbytet0() << 8;
-    s = eeprom_read_word(&ee_solde);
-    s += c;
+    s = compte.solde + c;
     if (s < c)
     {
+        ecrit_compte(compte.solde, compte.ctr + 1);
         sw1 = 0x61;   // overflow
         sw2 = 0x00;
         return;
     }
-    eeprom_write_word(&ee_solde, s);
+    ecrit_compte(s, compte.ctr + 1);
     sw1 = 0x90;
     sw2 = 0x00;
 }
@@ -703,15 +1118,16 @@ void debit(void)
     // PIN obligatoire pour CETTE opération
     if (!check_pin_ok())
         return;
-    // on consomme l'autorisation PIN
-    pin_ok = 0;
+    // on consomme une opération de la session PIN
+    consomme_pin();
 
     // anti-rejoue
-    if (!check_and_update_ctr())
+    if (!check_ctr())
         return;
 
     if (p3 != 2)
     {
+        ecrit_compte(compte.solde, compte.ctr + 1);
         sw1 = 0x6c;
         sw2 = 2;
         return;
@@ -719,16 +1135,15 @@ void debit(void)
     sendbytet0(ins);
     d  = recbytet0();
     d |= (uint16_t)recbytet0() << 8;
-    s = eeprom_read_word(&ee_solde);
+    s = compte.solde;
     if (d > s)
     {
+        ecrit_compte(s, compte.ctr + 1);
         sw1 = 0x61;   // solde insuffisant
         sw2 = 0x00;
         return;
     }
-    s -= d;
-    engage(2, (uint8_t*)&s, (uint8_t*)&ee_solde, 0);
-    valide();
+    ecrit_compte(s - d, compte.ctr + 1);
     sw1 = 0x90;
     sw2 = 0x00;
 }
@@ -748,7 +1163,7 @@ void lire_compteur(void)
     }
 
     sendbytet0(ins);
-    ctr = eeprom_read_word(&ee_ctr);
+    ctr = compte.ctr;
     sendbytet0(ctr & 0xFF);      // LSB
     sendbytet0(ctr >> 8);        // MSB
     sw1 = 0x90;
@@ -756,12 +1171,51 @@ void lire_compteur(void)
 }
 
 
+// Lecture d'état groupée : solde, compteur, essais PIN, taille perso
+// CLA = 0x82, INS = 0x08
+// APDU : 82 08 00 00 06
+// Réponse : [solde LSB][solde MSB][ctr LSB][ctr MSB][essais PIN][taille perso]
+// Évite 2 à 3 échanges T=0 (compteur, solde, ...) avant un crédit/débit.
+void lire_etat(void)
+{
+    uint16_t s;
+    uint16_t ctr;
+
+    // le solde n'est lisible qu'après vérification du PIN ...
+    if (!check_pin_ok())
+        return;
+    // ... mais la lecture ne modifie rien : la session PIN n'est pas
+    // décomptée, elle reste valable pour le crédit/débit qui suit
+
+    if (p3 != 6)
+    {
+        sw1 = 0x6C;
+        sw2 = 6;
+        return;
+    }
+
+    sendbytet0(ins);
+    s   = compte.solde;
+    ctr = compte.ctr;
+    sendbytet0(s & 0xFF);
+    sendbytet0(s >> 8);
+    sendbytet0(ctr & 0xFF);
+    sendbytet0(ctr >> 8);
+    sendbytet0(eeprom_read_byte(&ee.pin_tries));
+    sendbytet0(eeprom_read_byte(&ee.taille_perso));
+    sw1 = 0x90;
+    sw2 = 0x00;
+}
+
+
 //======================================================================
 // Programme principal
 //======================================================================
 
 int main(void)
 {
+    uint8_t pps_possible;   // PPS autorisé jusqu'à la première commande
+
     // initialisation des ports
     ACSR  = 0x80;
     PRR   = 0x87;
@@ -776,14 +1230,23 @@ int main(void)
     // ATR
     atr();
     valide();
+    charge_compte();
     sw2    = 0;      // pour éviter de le répéter dans toutes les commandes
     pin_ok = 0;      // PIN non vérifié au reset
+    pps_possible = 1;
 
     // boucle de traitement des commandes
     for (;;)
     {
         // lecture de l'entête
         cla = recbytet0();
+        if (cla == 0xFF && pps_possible)
+        {
+            pps();
+            pps_possible = 0;
+            continue;
+        }
+        pps_possible = 0;
         ins = recbytet0();
         p1  = recbytet0();
         p2  = recbytet0();
@@ -804,6 +1267,15 @@ int main(void)
             case 0x02:
                 lire_perso();
                 break;
+            case 0x03:
+                lire_num_etudiant();
+                break;
+            case 0x04:
+                lire_serie();
+                break;
+            case 0x05:
+                ecrire_serie();
+                break;
             default:
                 sw1 = 0x6d; // INS inconnu
                 sw2 = 0x00;
@@ -835,6 +1307,9 @@ int main(void)
             case 0x07:
                 lire_compteur();
                 break;
+            case 0x08:
+                lire_etat();
+                break;
             default:
                 sw1 = 0x6d; // INS inconnu
                 sw2 = 0x00;
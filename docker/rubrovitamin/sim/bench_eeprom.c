@@ -0,0 +1,376 @@
+// fichier "bench_eeprom.c"
+//-------------------------
+// Banc de mesure du crédit / débit sous simavr :
+//  - cycles (total et traitement carte) et octets EEPROM écrits par commande,
+//    durée estimée avec 3,4 ms par octet EEPROM
+//  - arrachement : coupure à chaque écriture EEPROM d'un crédit puis
+//    d'un débit, l'octet coupé étant écrit, effacé (0xFF) ou à moitié
+//    programmé ; reset, relecture : le couple (solde, compteur) doit
+//    être soit l'ancien, soit le nouveau
+//  - vitesse : perso, lecture de perso, solde, crédit, débit à chaque Di
+//    accepté par PPS ; la lecture de perso (20 octets, sans EEPROM) doit
+//    aller au moins deux fois plus vite à Di = 4 qu'à Di = 1
+//
+// usage : ./bench_eeprom [-n iterations] firmware.elf [autre.elf ...]
+// Plusieurs firmwares (ex. avant/après une modification) sont comparés
+// dans le même tableau. Code de retour 1 si une coupure est incohérente
+// ou si le PPS n'accélère pas les échanges.
+
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <unistd.h>
+
+#include "carte.h"
+
+static const uint8_t PERSO[] = {
+    0x81, 0x01, 0x00, 0x00, 20,
+    '2', '2', '0', '0', '1', '2', '3', '4', ';',
+    'D', 'U', 'P', 'O', 'N', 'T', ';', 'J', 'e', 'a', 'n'
+};
+static const uint8_t VERIFIER_PIN[] = { 0x82, 0x04, 0x00, 0x00, 0x04, 1, 2, 3, 4 };
+static const uint8_t LIRE_SOLDE[]   = { 0x82, 0x01, 0x00, 0x00, 0x02 };
+static const uint8_t LIRE_CTR[]     = { 0x82, 0x07, 0x00, 0x00, 0x02 };
+static const uint8_t LIRE_PERSO[]   = { 0x81, 0x02, 0x00, 0x00, 20 };
+static const uint8_t SESSION_PIN[]  = { 0x82, 0x04, 0x08, 0x00, 0x04, 1, 2, 3, 4 };
+
+// PPS1 proposés (FI = 0, Fi = 372) et Di correspondants
+static const uint8_t PPS1[] = { 0x00, 0x02, 0x03 };   // 0 : pas de PPS
+static const int     DI[]   = { 1, 2, 4 };
+#define NB_VITESSES 3
+
+#define INS_CREDIT  0x02
+#define INS_DEBIT   0x03
+
+// états de l'octet coupé essayés à chaque écriture
+static const int   MI_OCTET[]     = { CARTE_OCTET_ECRIT, CARTE_OCTET_EFFACE,
+                                      CARTE_OCTET_PARTIEL };
+static const char *NOM_MI_OCTET[] = { "après", "pendant (effacé)",
+                                      "pendant (à moitié)" };
+#define NB_MI_OCTET 3
+
+typedef struct
+{
+    const char *nom;
+    uint8_t     ins;
+    uint16_t    montant;
+    mesure_t    total;
+    int         nb;
+    int         coupures;
+    int         coherentes;
+} bench_t;
+
+
+// commande sans mesure, SW attendu 90 00
+static int commande(carte_t *c, const uint8_t *apdu, int n, uint8_t *rep)
+{
+    uint8_t tmp[256], sw1, sw2;
+    int nrep;
+
+    if (carte_apdu(c, apdu, n, rep ? rep : tmp, &nrep, &sw1, &sw2, NULL) != CARTE_OK)
+        return -1;
+    if (sw1 != 0x90 || sw2 != 0x00)
+    {
+        fprintf(stderr, "  %02X %02X : SW %02X %02X\n", apdu[0], apdu[1], sw1, sw2);
+        return -1;
+    }
+    return 0;
+}
+
+static int lire_mot(carte_t *c, const uint8_t *apdu, uint16_t *v)
+{
+    uint8_t rep[2];
+
+    if (commande(c, apdu, 5, rep) != 0)
+        return -1;
+    *v = rep[0] | (rep[1] << 8);
+    return 0;
+}
+
+// état (solde, compteur) après un reset ; la lecture du solde exige le PIN
+static int lire_compte(carte_t *c, uint16_t *solde, uint16_t *ctr)
+{
+    if (carte_reset(c) != CARTE_OK)
+        return -1;
+    if (commande(c, VERIFIER_PIN, sizeof(VERIFIER_PIN), NULL) != 0)
+        return -1;
+    if (lire_mot(c, LIRE_SOLDE, solde) != 0)
+        return -1;
+    return lire_mot(c, LIRE_CTR, ctr);
+}
+
+// PIN + compteur, puis crédit/débit mesuré, coupé pendant la coupure-ième
+// écriture EEPROM de la commande (-1 = pas de coupure), l'octet étant
+// laissé dans l'état mi_octet
+static int operation(carte_t *c, bench_t *b, long coupure, int mi_octet,
+                     mesure_t *m, uint8_t *sw1, uint8_t *sw2)
+{
+    uint8_t apdu[7], rep[2];
+    uint16_t ctr;
+    int nrep, r;
+
+    if (commande(c, VERIFIER_PIN, sizeof(VERIFIER_PIN), NULL) != 0)
+        return -1;
+    if (lire_mot(c, LIRE_CTR, &ctr) != 0)
+        return -1;
+
+    apdu[0] = 0x82;
+    apdu[1] = b->ins;
+    apdu[2] = ctr & 0xFF;
+    apdu[3] = ctr >> 8;
+    apdu[4] = 2;
+    apdu[5] = b->montant & 0xFF;
+    apdu[6] = b->montant >> 8;
+    carte_raz_mesures(c);
+    c->coupure = coupure;
+    c->mi_octet = mi_octet;
+    r = carte_apdu(c, apdu, sizeof(apdu), rep, &nrep, sw1, sw2, m);
+    c->coupure = -1;
+    c->mi_octet = CARTE_OCTET_ECRIT;
+    return r;
+}
+
+static int mesurer(carte_t *c, bench_t *b, int iterations)
+{
+    mesure_t m;
+    uint8_t sw1, sw2;
+    int i;
+
+    memset(&b->total, 0, sizeof(b->total));
+    for (i = 0; i < iterations; i++)
+    {
+        if (operation(c, b, -1, CARTE_OCTET_ECRIT, &m, &sw1, &sw2) != CARTE_OK ||
+            sw1 != 0x90)
+        {
+            fprintf(stderr, "  %s : échec (SW %02X %02X)\n", b->nom, sw1, sw2);
+            return -1;
+        }
+        b->total.cycles += m.cycles;
+        b->total.cycles_carte += m.cycles_carte;
+        b->total.ecritures_ee += m.ecritures_ee;
+    }
+    b->nb = iterations;
+    return 0;
+}
+
+// coupure à la k-ième écriture, pour k = 1 .. écritures d'une opération,
+// dans chacun des états de l'octet coupé
+static int arracher(carte_t *c, bench_t *b)
+{
+    uint8_t ee[CARTE_TAILLE_EE];
+    uint16_t s0, c0, s1, c1, s, k_ctr;
+    mesure_t m;
+    uint8_t sw1, sw2;
+    uint32_t k, n;
+    int r, e;
+
+    // état de départ et état attendu après l'opération complète
+    if (lire_compte(c, &s0, &c0) != 0 || carte_reset(c) != CARTE_OK)
+        return -1;
+    carte_lire_eeprom(c, ee);
+    if (operation(c, b, -1, CARTE_OCTET_ECRIT, &m, &sw1, &sw2) != CARTE_OK ||
+        sw1 != 0x90)
+        return -1;
+    n = m.ecritures_ee;
+    if (lire_compte(c, &s1, &c1) != 0)
+        return -1;
+
+    b->coupures = b->coherentes = 0;
+    for (k = 1; k <= n; k++)
+    {
+        for (e = 0; e < NB_MI_OCTET; e++)
+        {
+            carte_ecrire_eeprom(c, ee);
+            if (carte_reset(c) != CARTE_OK)
+                return -1;
+            r = operation(c, b, (long)k, MI_OCTET[e], &m, &sw1, &sw2);
+            if (r != CARTE_ARRACHEE && r != CARTE_OK)
+                return -1;
+            if (lire_compte(c, &s, &k_ctr) != 0)
+                return -1;
+            b->coupures++;
+            if ((s == s0 && k_ctr == c0) || (s == s1 && k_ctr == c1))
+                b->coherentes++;
+            else
+                printf("  %s coupé %s l'écriture %u : solde %u ctr %u "
+                       "(attendu %u/%u ou %u/%u)\n",
+                       b->nom, NOM_MI_OCTET[e], k, s, k_ctr, s0, c0, s1, c1);
+        }
+    }
+    return 0;
+}
+
+static void afficher(const bench_t *b)
+{
+    mesure_t moy;
+
+    moy.cycles = b->total.cycles / b->nb;
+    moy.cycles_carte = b->total.cycles_carte / b->nb;
+    moy.ecritures_ee = (b->total.ecritures_ee + b->nb / 2) / b->nb;
+    printf("  %-8s %10llu %12llu %12.1f %10.1f ms\n", b->nom,
+           (unsigned long long)moy.cycles,
+           (unsigned long long)moy.cycles_carte,
+           (double)b->total.ecritures_ee / b->nb,
+           carte_duree_ms(&moy));
+}
+
+// commande mesurée, SW attendu 90 00
+static int chrono(carte_t *c, const uint8_t *apdu, int n, double *ms, uint64_t *cycles)
+{
+    uint8_t rep[256], sw1, sw2;
+    mesure_t m;
+    int nrep;
+
+    carte_raz_mesures(c);
+    if (carte_apdu(c, apdu, n, rep, &nrep, &sw1, &sw2, &m) != CARTE_OK ||
+        sw1 != 0x90 || sw2 != 0x00)
+        return -1;
+    *ms = carte_duree_ms(&m);
+    if (cycles)
+        *cycles = m.cycles;
+    return 0;
+}
+
+// reset puis PPS (v = 0 : vitesse par défaut)
+static int demarrer(carte_t *c, int v)
+{
+    if (carte_reset(c) != CARTE_OK)
+        return -1;
+    if (PPS1[v] && carte_pps(c, PPS1[v]) != CARTE_OK)
+        return -1;
+    return 0;
+}
+
+static int vitesses(carte_t *c)
+{
+    uint8_t ee[CARTE_TAILLE_EE], op[7];
+    uint64_t lecture[NB_VITESSES];
+    double ms[5];
+    uint16_t ctr;
+    int v, i;
+
+    carte_lire_eeprom(c, ee);
+    printf("  %-4s %10s %12s %10s %10s %10s   (ms)\n",
+           "Di", "perso", "lire perso", "solde", "crédit", "débit");
+    for (v = 0; v < NB_VITESSES; v++)
+    {
+        carte_ecrire_eeprom(c, ee);
+        if (demarrer(c, v) != 0 ||
+            chrono(c, PERSO, sizeof(PERSO), &ms[0], NULL) != 0 ||
+            demarrer(c, v) != 0 ||
+            chrono(c, LIRE_PERSO, sizeof(LIRE_PERSO), &ms[1], &lecture[v]) != 0 ||
+            commande(c, SESSION_PIN, sizeof(SESSION_PIN), NULL) != 0 ||
+            chrono(c, LIRE_SOLDE, sizeof(LIRE_SOLDE), &ms[2], NULL) != 0 ||
+            lire_mot(c, LIRE_CTR, &ctr) != 0)
+        {
+            fprintf(stderr, "  Di = %d : échec\n", DI[v]);
+            return -1;
+        }
+        // crédit 1,00 € puis débit 0,50 €
+        for (i = 0; i < 2; i++)
+        {
+            op[0] = 0x82;
+            op[1] = i ? INS_DEBIT : INS_CREDIT;
+            op[2] = (ctr + i) & 0xFF;
+            op[3] = (ctr + i) >> 8;
+            op[4] = 2;
+            op[5] = i ? 50 : 100;
+            op[6] = 0;
+            if (chrono(c, op, sizeof(op), &ms[3 + i], NULL) != 0)
+            {
+                fprintf(stderr, "  Di = %d : échec\n", DI[v]);
+                return -1;
+            }
+        }
+        printf("  %-4d %10.1f %12.1f %10.1f %10.1f %10.1f\n",
+               DI[v], ms[0], ms[1], ms[2], ms[3], ms[4]);
+    }
+    carte_ecrire_eeprom(c, ee);
+
+    printf("  lecture de perso : Di = 4 en %.0f %% du temps à Di = 1\n",
+           100.0 * lecture[NB_VITESSES - 1] / lecture[0]);
+    return (2 * lecture[NB_VITESSES - 1] <= lecture[0]) ? 0 : 1;
+}
+
+static int banc(const char *elf, int iterations)
+{
+    bench_t ops[2] = {
+        { "crédit", INS_CREDIT, 100 },
+        { "débit",  INS_DEBIT,   50 },
+    };
+    carte_t c;
+    int i, ok = 1;
+
+    if (carte_ouvrir(&c, elf) != 0)
+        return -1;
+    if (carte_reset(&c) != CARTE_OK ||
+        commande(&c, PERSO, sizeof(PERSO), NULL) != 0 ||
+        carte_reset(&c) != CARTE_OK)
+    {
+        fprintf(stderr, "%s : personnalisation impossible\n", elf);
+        carte_fermer(&c);
+        return -1;
+    }
+
+    printf("== %s (capacités 0x%02X)\n", elf, carte_capacites(&c));
+    printf("  %-8s %10s %12s %12s %13s\n",
+           "commande", "cycles", "dont carte", "écritures EE", "durée est.");
+    for (i = 0; i < 2; i++)
+    {
+        if (mesurer(&c, &ops[i], iterations) != 0)
+        {
+            carte_fermer(&c);
+            return -1;
+        }
+        afficher(&ops[i]);
+    }
+    for (i = 0; i < 2; i++)
+    {
+        if (arracher(&c, &ops[i]) != 0)
+        {
+            fprintf(stderr, "%s : test d'arrachement interrompu\n", ops[i].nom);
+            carte_fermer(&c);
+            return -1;
+        }
+        printf("  arrachement %-8s : %d/%d coupures cohérentes\n",
+               ops[i].nom, ops[i].coherentes, ops[i].coupures);
+        ok &= (ops[i].coherentes == ops[i].coupures);
+    }
+    if (vitesses(&c) != 0)
+    {
+        printf("  PPS : pas d'accélération\n");
+        ok = 0;
+    }
+    carte_fermer(&c);
+    return ok ? 0 : 1;
+}
+
+int main(int argc, char *argv[])
+{
+    int iterations = 10;
+    int opt, ret = 0, r;
+
+    while ((opt = getopt(argc, argv, "n:")) != -1)
+    {
+        if (opt == 'n')
+            iterations = atoi(optarg);
+        else
+        {
+            fprintf(stderr, "usage : %s [-n iterations] firmware.elf ...\n", argv[0]);
+            return 2;
+        }
+    }
+    if (optind >= argc || iterations < 1)
+    {
+        fprintf(stderr, "usage : %s [-n iterations] firmware.elf ...\n", argv[0]);
+        return 2;
+    }
+
+    for (; optind < argc; optind++)
+    {
+        r = banc(argv[optind], iterations);
+        if (r != 0)
+            ret = 1;
+    }
+    return ret;
+}
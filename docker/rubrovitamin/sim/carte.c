@@ -0,0 +1,450 @@
+// fichier "carte.c"
+//------------------
+// Carte Rubrovitamin simulée sous simavr + lecteur T=0 minimal
+// (voir carte.h).
+//
+// Le lecteur ne passe pas par les IRQ de port de simavr : le niveau qu'il
+// impose est recopié dans PINB avant chaque instruction tant que la carte
+// a la broche en entrée, et la sortie de la carte est lue dans PORTB/DDRB.
+// Un caractère T=0 : start + 8 bits (lsb d'abord) + parité paire + stop,
+// 1 etu par bit.
+
+#include <stdio.h>
+#include <string.h>
+
+#include "sim_avr.h"
+#include "sim_elf.h"
+#include "sim_io.h"
+#include "avr_eeprom.h"
+#include "avr_timer.h"
+
+#include "carte.h"
+
+// registres de l'ATmega328p, adresses dans l'espace de données
+#define PINB_A     0x23
+#define DDRB_A     0x24
+#define PORTB_A    0x25
+#define EECR_A     0x3F
+#define EEDR_A     0x40
+#define EEARL_A    0x41
+#define EEARH_A    0x42
+#define EEPE_M     (1 << 1)
+
+// broche I/O de la carte : PB4 (voir io.c)
+#define IO_M       (1 << 4)
+
+// délai maximal de réponse de la carte : 5 s (crédit avec écritures EEPROM
+// compris, simavr ne simulant pas leur durée)
+#define DELAI_MAX  ((uint64_t)CARTE_F_CPU * 5)
+// délai entre un caractère de la carte et le suivant du lecteur (16 etu)
+#define GARDE_SENS (16 * (uint64_t)c->etu)
+
+// Di selon le champ DI de TA1 / PPS1 (0 = non géré)
+static const int di_code[16] = { 0, 1, 2, 4, 8, 16, 32, 64, 12, 20 };
+
+
+//======================================================================
+// Exécution
+//======================================================================
+
+// compte les écritures EEPROM : chaque octet écrit passe par EEPE
+static void surveille_eecr(struct avr_t *avr, avr_io_addr_t addr,
+                           uint8_t v, void *param)
+{
+    carte_t *c = (carte_t *)param;
+
+    (void)avr;
+    (void)addr;
+    if (v & EEPE_M)
+    {
+        c->ecritures_ee++;
+        if (c->coupure >= 0 && c->ecritures_ee >= (uint32_t)c->coupure &&
+            !c->arrachee)
+            c->arrachee = 1;
+    }
+}
+
+// coupure au milieu de l'octet : simavr l'a déjà écrit en entier, on le
+// remplace par ce que laisse une programmation interrompue
+static void abimer_octet(carte_t *c)
+{
+    avr_t *avr = c->avr;
+    avr_eeprom_desc_t d;
+    uint8_t v;
+
+    if (c->mi_octet == CARTE_OCTET_EFFACE)
+        v = 0xFF;
+    else if (c->mi_octet == CARTE_OCTET_PARTIEL)
+        v = avr->data[EEDR_A] | 0x55;
+    else
+        return;
+    d.ee = &v;
+    d.offset = avr->data[EEARL_A] | (avr->data[EEARH_A] << 8);
+    d.size = 1;
+    avr_ioctl(avr, AVR_IOCTL_EEPROM_SET, &d);
+}
+
+// niveau de la ligne I/O : la carte si elle est en sortie, sinon le lecteur
+static uint8_t ligne(carte_t *c)
+{
+    avr_t *avr = c->avr;
+
+    if (avr->data[DDRB_A] & IO_M)
+        return (avr->data[PORTB_A] & IO_M) ? 1 : 0;
+    return c->niveau;
+}
+
+// exécution d'une instruction
+static int pas(carte_t *c)
+{
+    avr_t *avr = c->avr;
+    int etat;
+
+    if (!(avr->data[DDRB_A] & IO_M))
+        avr->data[PINB_A] = (avr->data[PINB_A] & ~IO_M) | (c->niveau ? IO_M : 0);
+
+    etat = avr_run(avr);
+    if (etat == cpu_Done || etat == cpu_Crashed)
+        return CARTE_PLANTEE;
+    if (c->arrachee)
+    {
+        // l'instruction qui a lancé l'écriture est terminée : l'octet est
+        // en EEPROM, on peut l'abîmer (une seule fois)
+        if (c->arrachee == 1)
+            abimer_octet(c);
+        c->arrachee = 2;
+        return CARTE_ARRACHEE;
+    }
+    return CARTE_OK;
+}
+
+// exécution jusqu'à l'instant t (en cycles)
+static int attendre(carte_t *c, uint64_t t)
+{
+    int r;
+
+    while (c->avr->cycle < t)
+    {
+        if ((r = pas(c)) != CARTE_OK)
+            return r;
+    }
+    return CARTE_OK;
+}
+
+
+// horloge de TCNT2 : le firmware le passe sur l'horloge externe (ASSR),
+// que simavr remplace par une horloge virtuelle de fréquence donnée, ici
+// celle du lecteur (= CPU simulé) ; à refaire après chaque avr_reset()
+static void horloge_externe(carte_t *c)
+{
+    float f = CARTE_F_CPU;
+    uint8_t virt = 1;
+
+    avr_ioctl(c->avr, AVR_IOCTL_TIMER_SET_FREQCLK('2'), &f);
+    avr_ioctl(c->avr, AVR_IOCTL_TIMER_SET_VIRTCLK('2'), &virt);
+}
+
+
+//======================================================================
+// Caractères T=0
+//======================================================================
+
+// envoi d'un octet lecteur -> carte
+static int envoie(carte_t *c, uint8_t b)
+{
+    uint64_t t0;
+    uint8_t p = 0;
+    int i, r;
+
+    if ((r = attendre(c, c->prochain)) != CARTE_OK)
+        return r;
+
+    t0 = c->avr->cycle;
+    c->niveau = 0;                                  // start
+    for (i = 0; i < 8; i++)
+    {
+        if ((r = attendre(c, t0 + (uint64_t)(i + 1) * c->etu)) != CARTE_OK)
+            return r;
+        c->niveau = (b >> i) & 1;
+        p ^= c->niveau;
+    }
+    if ((r = attendre(c, t0 + 9 * c->etu)) != CARTE_OK)
+        return r;
+    c->niveau = p;                                  // parité paire
+    if ((r = attendre(c, t0 + 10 * c->etu)) != CARTE_OK)
+        return r;
+    c->niveau = 1;                                  // stop
+    r = attendre(c, t0 + 11 * c->etu);
+    c->prochain = t0 + 12 * c->etu;
+    return r;
+}
+
+// réception d'un octet carte -> lecteur
+static int recoit(carte_t *c, uint8_t *b)
+{
+    uint64_t appel, t0;
+    uint8_t v = 0, p = 0, bit;
+    int i, r;
+
+    // attente du bit start : c'est le temps de traitement de la carte
+    appel = c->avr->cycle;
+    while (ligne(c))
+    {
+        if (c->avr->cycle - appel > DELAI_MAX)
+            return CARTE_MUETTE;
+        if ((r = pas(c)) != CARTE_OK)
+            return r;
+    }
+    t0 = c->avr->cycle;
+    c->cycles_attente += t0 - appel;
+
+    // échantillonnage au milieu de chaque bit
+    for (i = 1; i <= 9; i++)
+    {
+        if ((r = attendre(c, t0 + (uint64_t)i * c->etu + c->etu / 2)) != CARTE_OK)
+            return r;
+        bit = ligne(c);
+        p ^= bit;
+        if (i <= 8)
+            v |= bit << (i - 1);
+    }
+    if ((r = attendre(c, t0 + 10 * c->etu + c->etu / 2)) != CARTE_OK)
+        return r;
+
+    c->prochain = t0 + 10 * c->etu + GARDE_SENS;
+    *b = v;
+    return p ? CARTE_PARITE : CARTE_OK;
+}
+
+
+//======================================================================
+// API
+//======================================================================
+
+int carte_ouvrir(carte_t *c, const char *elf)
+{
+    elf_firmware_t f;
+
+    memset(c, 0, sizeof(*c));
+    memset(&f, 0, sizeof(f));
+    if (elf_read_firmware(elf, &f) != 0)
+    {
+        fprintf(stderr, "impossible de lire %s\n", elf);
+        return -1;
+    }
+    c->avr = avr_make_mcu_by_name(f.mmcu[0] ? f.mmcu : "atmega328p");
+    if (!c->avr)
+        return -1;
+    avr_init(c->avr);
+    f.frequency = CARTE_F_CPU;
+    avr_load_firmware(c->avr, &f);
+    avr_register_io_write(c->avr, EECR_A, surveille_eecr, c);
+    c->coupure = -1;
+    c->mi_octet = CARTE_OCTET_ECRIT;
+    c->niveau = 1;
+    c->di = 1;
+    c->etu = CARTE_ETU;
+    return 0;
+}
+
+void carte_fermer(carte_t *c)
+{
+    if (c->avr)
+        avr_terminate(c->avr);
+    c->avr = NULL;
+}
+
+void carte_raz_mesures(carte_t *c)
+{
+    c->ecritures_ee = 0;
+    c->cycles_attente = 0;
+    c->arrachee = 0;
+}
+
+int carte_reset(carte_t *c)
+{
+    uint8_t y, k, td, tck = 0;
+    int i, r;
+
+    avr_reset(c->avr);
+    horloge_externe(c);
+    c->niveau = 1;
+    c->arrachee = 0;
+    c->taille_atr = 0;
+    c->prochain = 0;
+    c->di = 1;
+    c->etu = CARTE_ETU;
+
+    // TS, T0
+    for (i = 0; i < 2; i++)
+    {
+        if ((r = recoit(c, &c->atr[c->taille_atr++])) != CARTE_OK)
+            return r;
+    }
+    y = c->atr[1] >> 4;
+    k = c->atr[1] & 0x0F;
+    // octets d'interface TAi, TBi, TCi, TDi
+    while (y)
+    {
+        for (i = 0; i < 3; i++)
+        {
+            if ((y & (1 << i)) &&
+                (r = recoit(c, &c->atr[c->taille_atr++])) != CARTE_OK)
+                return r;
+        }
+        if (!(y & 0x08))
+            break;
+        if ((r = recoit(c, &td)) != CARTE_OK)
+            return r;
+        c->atr[c->taille_atr++] = td;
+        if (td & 0x0F)
+            tck = 1;                                // autre protocole que T=0
+        y = td >> 4;
+    }
+    // historique, puis TCK éventuel
+    for (i = 0; i < k + tck; i++)
+    {
+        if ((r = recoit(c, &c->atr[c->taille_atr++])) != CARTE_OK)
+            return r;
+    }
+    return CARTE_OK;
+}
+
+uint8_t carte_capacites(const carte_t *c)
+{
+    int i;
+
+    for (i = 0; i + 5 < c->taille_atr; i++)
+    {
+        if (memcmp(c->atr + i, "rubro", 5) == 0)
+            return c->atr[i + 5];
+    }
+    return 0;
+}
+
+uint8_t carte_ta1(const carte_t *c)
+{
+    if (c->taille_atr > 2 && (c->atr[1] & 0x10))
+        return c->atr[2];
+    return 0x11;
+}
+
+int carte_pps(carte_t *c, uint8_t pps1)
+{
+    uint8_t req[4] = { 0xFF, 0x10, pps1, 0 };
+    uint8_t rep[4];
+    int i, n, r, di = di_code[pps1 & 0x0F];
+
+    if (di == 0)
+        return CARTE_REFUS;             // DI réservé : rien à proposer
+    req[3] = req[0] ^ req[1] ^ req[2];
+    for (i = 0; i < 4; i++)
+    {
+        if ((r = envoie(c, req[i])) != CARTE_OK)
+            return r;
+    }
+    // PPSS, PPS0, [PPS1], PCK
+    for (n = 0; n < 2; n++)
+    {
+        if ((r = recoit(c, &rep[n])) != CARTE_OK)
+            return r;
+    }
+    if (rep[1] & 0x10)
+    {
+        if ((r = recoit(c, &rep[n++])) != CARTE_OK)
+            return r;
+    }
+    if ((r = recoit(c, &rep[n++])) != CARTE_OK)
+        return r;
+    if (rep[0] != 0xFF || (rep[0] ^ rep[1] ^ (n == 4 ? rep[2] : 0) ^ rep[n - 1]) != 0)
+        return CARTE_PARITE;
+    if (n != 4 || rep[2] != pps1)
+        return CARTE_REFUS;
+
+    c->di = di;
+    c->etu = CARTE_ETU / di;
+    return CARTE_OK;
+}
+
+int carte_apdu(carte_t *c, const uint8_t *apdu, int n,
+               uint8_t *rep, int *nrep, uint8_t *sw1, uint8_t *sw2,
+               mesure_t *m)
+{
+    uint64_t debut = c->avr->cycle;
+    uint64_t attente = c->cycles_attente;
+    uint32_t ecritures = c->ecritures_ee;
+    int nd = n > 5 ? n - 5 : 0;     // octets à envoyer après l'entête
+    int ne = n > 5 ? 0 : apdu[4];   // octets attendus de la carte
+    uint8_t b;
+    int i, r;
+
+    *nrep = 0;
+    *sw1 = *sw2 = 0;
+
+    for (i = 0; i < 5; i++)
+    {
+        if ((r = envoie(c, apdu[i])) != CARTE_OK)
+            goto fin;
+    }
+    for (;;)
+    {
+        if ((r = recoit(c, &b)) != CARTE_OK)
+            goto fin;
+        if (b == 0x60)                  // octet NULL : la carte demande du temps
+            continue;
+        if (b == apdu[1])               // acquittement : transfert des données
+        {
+            for (i = 0; i < nd; i++)
+            {
+                if ((r = envoie(c, apdu[5 + i])) != CARTE_OK)
+                    goto fin;
+            }
+            for (i = 0; i < ne; i++)
+            {
+                if ((r = recoit(c, &rep[i])) != CARTE_OK)
+                    goto fin;
+            }
+            *nrep = ne;
+            nd = ne = 0;
+            continue;
+        }
+        *sw1 = b;
+        r = recoit(c, sw2);
+        break;
+    }
+
+fin:
+    if (m)
+    {
+        m->cycles = c->avr->cycle - debut;
+        m->cycles_carte = c->cycles_attente - attente;
+        m->ecritures_ee = c->ecritures_ee - ecritures;
+    }
+    return r;
+}
+
+double carte_duree_ms(const mesure_t *m)
+{
+    return (double)m->cycles * 1000.0 / CARTE_F_CPU
+           + m->ecritures_ee * CARTE_EE_MS;
+}
+
+int carte_lire_eeprom(carte_t *c, uint8_t *ee)
+{
+    avr_eeprom_desc_t d;
+
+    d.ee = ee;
+    d.offset = 0;
+    d.size = CARTE_TAILLE_EE;
+    return avr_ioctl(c->avr, AVR_IOCTL_EEPROM_GET, &d);
+}
+
+int carte_ecrire_eeprom(carte_t *c, const uint8_t *ee)
+{
+    avr_eeprom_desc_t d;
+
+    d.ee = (uint8_t *)ee;
+    d.offset = 0;
+    d.size = CARTE_TAILLE_EE;
+    return avr_ioctl(c->avr, AVR_IOCTL_EEPROM_SET, &d);
+}
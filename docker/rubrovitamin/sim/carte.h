@@ -0,0 +1,108 @@
+// fichier "carte.h"
+//------------------
+// Carte Rubrovitamin simulée sous simavr + lecteur T=0 minimal.
+//
+// Le firmware est exécuté tel quel (rubro_v2.c lié avec io.c). Les délais
+// d'io.c sont comptés par TCNT2 sur l'horloge externe ; la simulation lui
+// donne la fréquence du CPU, soit 372 cycles par etu à 3,58 MHz.
+// Le "lecteur" pilote la broche I/O (PB4) directement dans l'espace
+// d'adresses simulé, sans passer par une carte réelle ni par pcscd.
+//
+// Les écritures EEPROM sont comptées par octet (bit EEPE de EECR).
+// simavr écrit l'octet immédiatement et ne modélise pas les ~3,4 ms de
+// programmation : la durée estimée d'une commande ajoute donc ce temps
+// à chaque écriture (voir carte_duree_ms).
+
+#ifndef CARTE_H
+#define CARTE_H
+
+#include <stdint.h>
+#include "sim_avr.h"
+
+// fréquence de l'horloge carte (lecteur standard) et durée d'un etu
+// après le reset (Fi = 372, Di = 1) ; un PPS la divise par Di
+#define CARTE_F_CPU      3579545
+#define CARTE_ETU        372
+// temps de programmation d'un octet EEPROM (ATmega328p, datasheet)
+#define CARTE_EE_MS      3.4
+
+// codes de retour
+#define CARTE_OK         0
+#define CARTE_MUETTE    -1   // la carte ne répond pas dans le délai
+#define CARTE_ARRACHEE  -2   // coupure simulée (voir carte_t.coupure)
+#define CARTE_PLANTEE   -3   // simavr a arrêté le CPU
+#define CARTE_PARITE    -4   // erreur de parité sur un octet reçu
+#define CARTE_REFUS     -5   // PPS refusé, vitesse inchangée
+
+// état de l'octet EEPROM en cours d'écriture au moment d'une coupure :
+// l'ATmega328p l'efface (0xFF) puis le programme (des bits passent à 0)
+#define CARTE_OCTET_ECRIT    0   // programmation terminée
+#define CARTE_OCTET_EFFACE   1   // coupé après l'effacement : 0xFF
+#define CARTE_OCTET_PARTIEL  2   // coupé pendant la programmation :
+                                 // la moitié des bits à 0 seulement
+
+typedef struct
+{
+    avr_t   *avr;
+    uint8_t  niveau;            // niveau imposé par le lecteur sur I/O
+    uint8_t  atr[33];
+    int      taille_atr;
+    int      di;                // Di courant (1 après reset, puis PPS)
+    int      etu;               // cycles par etu : CARTE_ETU / di
+
+    // mesures (cumulées, remises à zéro par carte_raz_mesures)
+    uint32_t ecritures_ee;      // octets écrits en EEPROM
+    uint64_t cycles_attente;    // cycles passés à attendre la carte
+
+    // arrachement : coupure pendant la N-ième écriture EEPROM
+    // (comptée depuis carte_raz_mesures), -1 = jamais ; mi_octet dit où
+    // en était l'octet coupé (CARTE_OCTET_*)
+    long     coupure;
+    int      mi_octet;
+    int      arrachee;
+
+    // (interne) instant au plus tôt du prochain envoi du lecteur
+    uint64_t prochain;
+} carte_t;
+
+// mesure d'une commande
+typedef struct
+{
+    uint64_t cycles;            // de l'octet CLA à la fin de SW2
+    uint64_t cycles_carte;      // dont temps de traitement côté carte
+    uint32_t ecritures_ee;      // octets EEPROM écrits
+} mesure_t;
+
+int  carte_ouvrir(carte_t *c, const char *elf);
+void carte_fermer(carte_t *c);
+
+// reset (EEPROM conservée) puis lecture de l'ATR
+int  carte_reset(carte_t *c);
+
+// envoie une APDU à la manière de scriptor :
+//  - plus de 5 octets : commande entrante, les données suivent l'entête
+//  - 5 octets : commande sortante, la carte renvoie P3 octets
+int  carte_apdu(carte_t *c, const uint8_t *apdu, int n,
+                uint8_t *rep, int *nrep, uint8_t *sw1, uint8_t *sw2,
+                mesure_t *m);
+
+// octet de capacités : octet qui suit "rubro" dans l'historique de l'ATR
+uint8_t carte_capacites(const carte_t *c);
+
+// TA1 de l'ATR (0x11 s'il est absent : Fi = 372, Di = 1)
+uint8_t carte_ta1(const carte_t *c);
+
+// PPS juste après le reset : propose PPS1 (FI/DI) ; CARTE_OK si la carte
+// l'accepte (le lecteur passe alors à Di), CARTE_REFUS si elle répond
+// sans PPS1
+int  carte_pps(carte_t *c, uint8_t pps1);
+
+void   carte_raz_mesures(carte_t *c);
+double carte_duree_ms(const mesure_t *m);
+
+// copie de l'EEPROM simulée (1 Ko sur ATmega328p)
+#define CARTE_TAILLE_EE  1024
+int  carte_lire_eeprom(carte_t *c, uint8_t *ee);
+int  carte_ecrire_eeprom(carte_t *c, const uint8_t *ee);
+
+#endif
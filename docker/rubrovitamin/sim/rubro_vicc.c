@@ -0,0 +1,357 @@
+// fichier "rubro_vicc.c"
+//-----------------------
+// Carte virtuelle pour vpcd (projet vsmartcard) : le firmware rubro_v2
+// tourne sous simavr (voir carte.c) et apparaît dans pcscd comme une carte
+// insérée dans le lecteur "Virtual PCD". Lubiana, Berlicum et Lunar White
+// s'en servent sans modification, via pyscard.
+//
+// usage : ./rubro_vicc [-s hôte] [-p port] [-e eeprom.bin] [-l] [-x] [-v] firmware.elf
+//   -s  hôte où tourne pcscd + vpcd (localhost)
+//   -p  port vpcd (35963)
+//   -e  image EEPROM chargée au démarrage et sauvegardée après chaque
+//       écriture : la carte garde solde, perso et PIN d'un lancement à l'autre
+//   -l  pas de PPS : la carte reste à 9600 bauds (par défaut, comme un
+//       lecteur CCID, la vitesse maximale annoncée par TA1 est négociée
+//       après chaque reset)
+//   -x  pas de cadencement : répond dès que la simulation est finie
+//       (par défaut, chaque réponse attend la durée réelle de l'échange
+//       sur une vraie carte : cycles à 3,58 MHz + 3,4 ms par octet EEPROM)
+//   -v  journal de chaque APDU avec sa durée simulée
+//
+// Protocole vpcd : messages préfixés par leur longueur (2 octets, gros
+// boutien). Un message d'un octet est une commande : 0 hors tension,
+// 1 sous tension, 2 reset, 4 demande d'ATR. Tout autre message est une
+// APDU, à laquelle on répond par les données suivies de SW1 SW2.
+
+#include <errno.h>
+#include <netdb.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <time.h>
+#include <unistd.h>
+#include <sys/socket.h>
+
+#include "carte.h"
+
+#define VPCD_PORT       "35963"
+#define VPCD_HORS       0x00
+#define VPCD_SOUS       0x01
+#define VPCD_RESET      0x02
+#define VPCD_ATR        0x04
+
+#define MAX_MESSAGE     (5 + 255 + 1)
+
+static int bavard;
+static int cadence = 1;
+static int pps = 1;
+static const char *fichier_ee;
+
+
+//======================================================================
+// Réseau
+//======================================================================
+
+static int connecter(const char *hote, const char *port)
+{
+    struct addrinfo indic, *res, *a;
+    int s = -1, r;
+
+    memset(&indic, 0, sizeof(indic));
+    indic.ai_family = AF_UNSPEC;
+    indic.ai_socktype = SOCK_STREAM;
+
+    // vpcd démarre avec pcscd : on réessaie tant qu'il n'écoute pas
+    for (;;)
+    {
+        if ((r = getaddrinfo(hote, port, &indic, &res)) == 0)
+        {
+            for (a = res; a; a = a->ai_next)
+            {
+                s = socket(a->ai_family, a->ai_socktype, a->ai_protocol);
+                if (s < 0)
+                    continue;
+                if (connect(s, a->ai_addr, a->ai_addrlen) == 0)
+                    break;
+                close(s);
+                s = -1;
+            }
+            freeaddrinfo(res);
+            if (s >= 0)
+                return s;
+        }
+        fprintf(stderr, "vpcd %s:%s injoignable, nouvel essai dans 1 s\n", hote, port);
+        sleep(1);
+    }
+}
+
+static int lire_tout(int s, uint8_t *buf, size_t n)
+{
+    ssize_t r;
+
+    while (n)
+    {
+        r = recv(s, buf, n, 0);
+        if (r <= 0)
+        {
+            if (r < 0 && errno == EINTR)
+                continue;
+            return -1;
+        }
+        buf += r;
+        n -= r;
+    }
+    return 0;
+}
+
+static int recevoir(int s, uint8_t *msg, int *n)
+{
+    uint8_t lg[2];
+
+    if (lire_tout(s, lg, 2) != 0)
+        return -1;
+    *n = (lg[0] << 8) | lg[1];
+    if (*n > MAX_MESSAGE)
+        return -1;
+    return lire_tout(s, msg, *n);
+}
+
+static int envoyer(int s, const uint8_t *msg, int n)
+{
+    uint8_t lg[2] = { (uint8_t)(n >> 8), (uint8_t)n };
+
+    if (send(s, lg, 2, 0) != 2 || send(s, msg, n, 0) != n)
+        return -1;
+    return 0;
+}
+
+
+//======================================================================
+// Temps réel et EEPROM
+//======================================================================
+
+static double maintenant_ms(void)
+{
+    struct timespec t;
+
+    clock_gettime(CLOCK_MONOTONIC, &t);
+    return t.tv_sec * 1000.0 + t.tv_nsec / 1e6;
+}
+
+// attend que la durée réelle de l'échange sur une vraie carte soit écoulée
+static void cadencer(double debut_ms, double duree_ms)
+{
+    double reste = debut_ms + duree_ms - maintenant_ms();
+    struct timespec t;
+
+    if (!cadence)
+        return;
+    if (reste <= 0)
+    {
+        if (bavard)
+            printf("  (simulation plus lente que la carte de %.1f ms)\n", -reste);
+        return;
+    }
+    t.tv_sec = (time_t)(reste / 1000.0);
+    t.tv_nsec = (long)((reste - t.tv_sec * 1000.0) * 1e6);
+    nanosleep(&t, NULL);
+}
+
+static void charger_eeprom(carte_t *c)
+{
+    uint8_t ee[CARTE_TAILLE_EE];
+    FILE *f;
+
+    if (!fichier_ee || !(f = fopen(fichier_ee, "rb")))
+        return;
+    if (fread(ee, 1, sizeof(ee), f) == sizeof(ee))
+    {
+        carte_ecrire_eeprom(c, ee);
+        printf("EEPROM chargée depuis %s\n", fichier_ee);
+    }
+    fclose(f);
+}
+
+static void sauver_eeprom(carte_t *c)
+{
+    uint8_t ee[CARTE_TAILLE_EE];
+    char tmp[512];
+    FILE *f;
+    int ok;
+
+    if (!fichier_ee)
+        return;
+    carte_lire_eeprom(c, ee);
+    // écriture dans un fichier temporaire puis renommage : l'image reste
+    // cohérente si le programme est arrêté pendant la sauvegarde
+    snprintf(tmp, sizeof(tmp), "%s.tmp", fichier_ee);
+    if (!(f = fopen(tmp, "wb")))
+        return;
+    ok = (fwrite(ee, 1, sizeof(ee), f) == sizeof(ee));
+    if (fclose(f) == 0 && ok)
+        rename(tmp, fichier_ee);
+}
+
+
+//======================================================================
+// Carte
+//======================================================================
+
+// reset ; la durée cadencée est celle de l'émission de l'ATR (12 etu par
+// octet), le démarrage du firmware étant négligeable devant elle
+static int reset(carte_t *c)
+{
+    double debut = maintenant_ms();
+    int r;
+
+    r = carte_reset(c);
+    if (r == CARTE_OK)
+        cadencer(debut, c->taille_atr * 12.0 * CARTE_ETU * 1000.0 / CARTE_F_CPU);
+    if (bavard)
+        printf("reset : %s\n", r == CARTE_OK ? "ATR reçu" : "carte muette");
+    // PPS vers le TA1 annoncé ; refus ou carte sans TA1 : reste à Di = 1
+    if (r == CARTE_OK && pps && (carte_ta1(c) & 0x0F) > 1)
+    {
+        if (carte_pps(c, carte_ta1(c)) == CARTE_OK)
+        {
+            if (bavard)
+                printf("PPS %02X : Di = %d\n", carte_ta1(c), c->di);
+        }
+        else if ((r = carte_reset(c)) != CARTE_OK)
+            return r;
+    }
+    return r;
+}
+
+// APDU PC/SC -> TPDU T=0 : cas 1 (4 octets) complété par P3 = 0,
+// cas 4 ramené au cas 3 (le Le final est ignoré, la carte n'a pas de
+// commande à la fois entrante et sortante)
+static int traiter_apdu(carte_t *c, const uint8_t *msg, int n,
+                        uint8_t *rep, int *nrep)
+{
+    uint8_t apdu[MAX_MESSAGE];
+    uint8_t sw1, sw2;
+    mesure_t m;
+    double debut = maintenant_ms();
+    int i, r, lg;
+
+    if (n < 4)
+        return -1;
+    memcpy(apdu, msg, n);
+    lg = n;
+    if (n == 4)
+        apdu[lg++] = 0x00;
+    else if (n > 5 && n == 5 + msg[4] + 1)
+        lg = n - 1;
+
+    carte_raz_mesures(c);
+    r = carte_apdu(c, apdu, lg, rep, nrep, &sw1, &sw2, &m);
+    if (r != CARTE_OK)
+    {
+        fprintf(stderr, "carte muette (%d) : reset\n", r);
+        reset(c);
+        return -1;
+    }
+    rep[(*nrep)++] = sw1;
+    rep[(*nrep)++] = sw2;
+
+    if (m.ecritures_ee)
+        sauver_eeprom(c);
+    cadencer(debut, carte_duree_ms(&m));
+
+    if (bavard)
+    {
+        for (i = 0; i < lg; i++)
+            printf("%02X ", apdu[i]);
+        printf("-> %02X %02X  (%.1f ms, %u octet(s) EEPROM)\n",
+               sw1, sw2, carte_duree_ms(&m), m.ecritures_ee);
+    }
+    return 0;
+}
+
+static void usage(const char *prog)
+{
+    fprintf(stderr, "usage : %s [-s hôte] [-p port] [-e eeprom.bin] [-l] [-x] [-v] "
+                    "firmware.elf\n", prog);
+}
+
+int main(int argc, char *argv[])
+{
+    const char *hote = "localhost";
+    const char *port = VPCD_PORT;
+    uint8_t msg[MAX_MESSAGE], rep[MAX_MESSAGE + 2];
+    int opt, s, n, nrep, sous_tension = 0;
+    carte_t c;
+
+    while ((opt = getopt(argc, argv, "s:p:e:lxv")) != -1)
+    {
+        switch (opt)
+        {
+        case 's': hote = optarg; break;
+        case 'p': port = optarg; break;
+        case 'e': fichier_ee = optarg; break;
+        case 'l': pps = 0; break;
+        case 'x': cadence = 0; break;
+        case 'v': bavard = 1; break;
+        default:
+            usage(argv[0]);
+            return 2;
+        }
+    }
+    if (optind != argc - 1)
+    {
+        usage(argv[0]);
+        return 2;
+    }
+    setvbuf(stdout, NULL, _IOLBF, 0);
+
+    if (carte_ouvrir(&c, argv[optind]) != 0)
+        return 2;
+    charger_eeprom(&c);
+
+    for (;;)
+    {
+        s = connecter(hote, port);
+        printf("connecté à vpcd %s:%s\n", hote, port);
+
+        while (recevoir(s, msg, &n) == 0)
+        {
+            if (n == 1)
+            {
+                switch (msg[0])
+                {
+                case VPCD_HORS:
+                    sous_tension = 0;
+                    break;
+                case VPCD_SOUS:
+                case VPCD_RESET:
+                    sous_tension = (reset(&c) == CARTE_OK);
+                    break;
+                case VPCD_ATR:
+                    if (!sous_tension)
+                        sous_tension = (reset(&c) == CARTE_OK);
+                    if (envoyer(s, c.atr, c.taille_atr) != 0)
+                        goto perdu;
+                    break;
+                default:
+                    break;
+                }
+                continue;
+            }
+
+            if (!sous_tension)
+                sous_tension = (reset(&c) == CARTE_OK);
+            if (traiter_apdu(&c, msg, n, rep, &nrep) != 0)
+                nrep = 0;           // réponse vide : erreur de transmission
+            if (envoyer(s, rep, nrep) != 0)
+                goto perdu;
+        }
+perdu:
+        close(s);
+        sous_tension = 0;
+        fprintf(stderr, "connexion vpcd perdue\n");
+    }
+
+    carte_fermer(&c);
+    return 0;
+}
@@ -0,0 +1,437 @@
+// fichier "rubrosim.c"
+//---------------------
+// Tests du firmware sous simavr, à partir de scripts d'APDU.
+//
+// usage : ./rubrosim [-v] [-b reference] [-w] [-t tolérance%] firmware.elf script.apdu ...
+//   -v  affiche chaque commande
+//   -b  compare les mesures à un fichier de référence (baseline.txt) :
+//       échec si le fichier manque, si le maximum de cycles d'une
+//       instruction dépasse la référence de plus de la tolérance (2 % par
+//       défaut) ou si elle écrit plus d'octets EEPROM
+//   -w  réécrit le fichier de référence avec les mesures courantes,
+//       seulement si tous les scripts passent
+//
+// Format des scripts (proche de scriptor, voir tests/*.apdu) :
+//   # commentaire
+//   reset
+//   pps 13              PPS juste après un reset (PPS1 = 13 : Di = 4),
+//   pps 14 refus        ... ou refus attendu (vitesse inchangée)
+//   ee 00 96 00 07 00   écrit ces octets dans l'EEPROM simulée à partir
+//                       de l'adresse 00 (premier octet) ; la carte ne
+//                       les relit qu'au reset suivant
+//   82 04 00 00 04 01 02 03 04 => 90 00
+//   82 07 00 00 02 => .. .. 90 00
+// Après "=>" : réponse attendue (données puis SW1 SW2), ".." accepte
+// n'importe quel octet. Sans "=>", la commande est seulement exécutée.
+// Chaque script part de l'EEPROM initiale du firmware, après un reset.
+// Les mesures sont séparées par vitesse (Di) : une même instruction à
+// Di = 1 et après PPS donne deux lignes de référence.
+//
+// Code de retour : 0 si tout passe, 1 sinon (test ou régression).
+
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <ctype.h>
+#include <unistd.h>
+
+#include "carte.h"
+
+#define MAX_LIGNE   512
+#define MAX_APDU    261
+#define MAX_INSTR   64
+#define JOKER       0x100
+
+// mesures cumulées par instruction (CLA INS) et par vitesse
+typedef struct
+{
+    uint8_t  cla, ins;
+    int      di;
+    uint32_t nb;
+    uint64_t cycles, cycles_max;
+    uint64_t carte;
+    uint32_t ee, ee_max;
+} stat_t;
+
+static stat_t stats[MAX_INSTR];
+static int    nb_stats;
+static int    bavard;
+
+
+//======================================================================
+// Mesures
+//======================================================================
+
+static stat_t *stat_instr(uint8_t cla, uint8_t ins, int di)
+{
+    int i;
+
+    for (i = 0; i < nb_stats; i++)
+    {
+        if (stats[i].cla == cla && stats[i].ins == ins && stats[i].di == di)
+            return &stats[i];
+    }
+    if (nb_stats == MAX_INSTR)
+        return NULL;
+    memset(&stats[nb_stats], 0, sizeof(stat_t));
+    stats[nb_stats].cla = cla;
+    stats[nb_stats].ins = ins;
+    stats[nb_stats].di = di;
+    return &stats[nb_stats++];
+}
+
+static void cumuler(uint8_t cla, uint8_t ins, int di, const mesure_t *m)
+{
+    stat_t *s = stat_instr(cla, ins, di);
+
+    if (!s)
+        return;
+    s->nb++;
+    s->cycles += m->cycles;
+    s->carte += m->cycles_carte;
+    s->ee += m->ecritures_ee;
+    if (m->cycles > s->cycles_max)
+        s->cycles_max = m->cycles;
+    if (m->ecritures_ee > s->ee_max)
+        s->ee_max = m->ecritures_ee;
+}
+
+static void afficher_stats(void)
+{
+    int i;
+
+    printf("== mesures par instruction (%d Hz, EEPROM %.1f ms/octet)\n",
+           CARTE_F_CPU, CARTE_EE_MS);
+    printf("  instr  Di    nb  cycles moy  cycles max   carte moy  EE moy  EE max\n");
+    for (i = 0; i < nb_stats; i++)
+    {
+        stat_t *s = &stats[i];
+        printf("  %02X %02X %3d %5u %11llu %11llu %11llu %7.1f %7u\n",
+               s->cla, s->ins, s->di, s->nb,
+               (unsigned long long)(s->cycles / s->nb),
+               (unsigned long long)s->cycles_max,
+               (unsigned long long)(s->carte / s->nb),
+               (double)s->ee / s->nb, s->ee_max);
+    }
+}
+
+
+//======================================================================
+// Référence
+//======================================================================
+
+static int ecrire_reference(const char *fichier, const char *elf)
+{
+    FILE *f = fopen(fichier, "w");
+    int i;
+
+    if (!f)
+    {
+        perror(fichier);
+        return -1;
+    }
+    fprintf(f, "# référence des mesures simavr (make baseline) - %s\n", elf);
+    fprintf(f, "# CLA INS Di cycles_max ecritures_ee_max\n");
+    for (i = 0; i < nb_stats; i++)
+        fprintf(f, "%02X %02X %d %llu %u\n", stats[i].cla, stats[i].ins,
+                stats[i].di, (unsigned long long)stats[i].cycles_max,
+                stats[i].ee_max);
+    fclose(f);
+    printf("== référence écrite dans %s\n", fichier);
+    return 0;
+}
+
+static int comparer_reference(const char *fichier, double tolerance)
+{
+    FILE *f = fopen(fichier, "r");
+    char ligne[MAX_LIGNE];
+    unsigned cla, ins, ee;
+    unsigned long long cycles;
+    int i, di, regressions = 0;
+
+    // sans référence, make test ne verrait aucune régression : échec
+    if (!f)
+    {
+        printf("== pas de référence (%s) : lancer make baseline  ÉCHEC\n", fichier);
+        return 1;
+    }
+    printf("== comparaison à %s (tolérance %.1f %%)\n", fichier, tolerance);
+    while (fgets(ligne, sizeof(ligne), f))
+    {
+        if (ligne[0] == '#' ||
+            sscanf(ligne, "%x %x %d %llu %u", &cla, &ins, &di, &cycles, &ee) != 5)
+            continue;
+        for (i = 0; i < nb_stats; i++)
+        {
+            stat_t *s = &stats[i];
+            if (s->cla != cla || s->ins != ins || s->di != di)
+                continue;
+            if (s->cycles_max > cycles * (1.0 + tolerance / 100.0))
+            {
+                printf("  %02X %02X Di %d : cycles max %llu > %llu (+%.1f %%)  RÉGRESSION\n",
+                       cla, ins, di, (unsigned long long)s->cycles_max, cycles,
+                       100.0 * ((double)s->cycles_max - cycles) / cycles);
+                regressions++;
+            }
+            else if (s->cycles_max < cycles)
+                printf("  %02X %02X Di %d : cycles max %llu < %llu (%.1f %%)\n",
+                       cla, ins, di, (unsigned long long)s->cycles_max, cycles,
+                       100.0 * ((double)s->cycles_max - cycles) / cycles);
+            if (s->ee_max > ee)
+            {
+                printf("  %02X %02X Di %d : écritures EEPROM %u > %u  RÉGRESSION\n",
+                       cla, ins, di, s->ee_max, ee);
+                regressions++;
+            }
+            else if (s->ee_max < ee)
+                printf("  %02X %02X Di %d : écritures EEPROM %u < %u\n",
+                       cla, ins, di, s->ee_max, ee);
+        }
+    }
+    fclose(f);
+    if (!regressions)
+        printf("  aucune régression\n");
+    return regressions;
+}
+
+
+//======================================================================
+// Scripts
+//======================================================================
+
+// lecture d'une suite d'octets hexadécimaux (".." = joker), rend le nombre
+static int lire_hex(char *s, int *octets, int max)
+{
+    char *tok;
+    int n = 0;
+
+    for (tok = strtok(s, " \t\r\n"); tok; tok = strtok(NULL, " \t\r\n"))
+    {
+        if (n == max)
+            return -1;
+        if (strcmp(tok, "..") == 0)
+            octets[n++] = JOKER;
+        else if (strlen(tok) == 2 && isxdigit((unsigned char)tok[0]) &&
+                 isxdigit((unsigned char)tok[1]))
+            octets[n++] = (int)strtol(tok, NULL, 16);
+        else
+            return -1;
+    }
+    return n;
+}
+
+static void afficher_octets(const char *titre, const uint8_t *o, int n)
+{
+    int i;
+
+    printf("%s", titre);
+    for (i = 0; i < n; i++)
+        printf(" %02X", o[i]);
+}
+
+// exécute un script, rend le nombre d'échecs
+static int executer(carte_t *c, const char *fichier, const uint8_t *ee_initiale)
+{
+    FILE *f = fopen(fichier, "r");
+    char ligne[MAX_LIGNE], *fleche, *p;
+    int cmd[MAX_APDU], att[MAX_APDU + 2];
+    uint8_t apdu[MAX_APDU], rep[MAX_APDU + 2];
+    int n, na, nrep, i, r, num = 0, echecs = 0, ok;
+    uint8_t sw1, sw2;
+    mesure_t m;
+
+    if (!f)
+    {
+        perror(fichier);
+        return 1;
+    }
+    printf("-- %s\n", fichier);
+
+    carte_ecrire_eeprom(c, ee_initiale);
+    if (carte_reset(c) != CARTE_OK)
+    {
+        printf("  ÉCHEC : pas d'ATR\n");
+        fclose(f);
+        return 1;
+    }
+
+    while (fgets(ligne, sizeof(ligne), f))
+    {
+        num++;
+        for (p = ligne; isspace((unsigned char)*p); p++)
+            ;
+        if (*p == '#' || *p == '\0')
+            continue;
+        if (strncmp(p, "reset", 5) == 0)
+        {
+            if (carte_reset(c) != CARTE_OK)
+            {
+                printf("  ÉCHEC ligne %d : pas d'ATR\n", num);
+                echecs++;
+                break;
+            }
+            continue;
+        }
+        if (strncmp(p, "ee", 2) == 0 && isspace((unsigned char)p[2]))
+        {
+            uint8_t ee[CARTE_TAILLE_EE];
+
+            n = lire_hex(p + 2, cmd, MAX_APDU);
+            for (i = 0; i < n && cmd[i] != JOKER; i++)
+                ;
+            if (n < 2 || i < n)
+            {
+                printf("  ÉCHEC ligne %d : syntaxe\n", num);
+                echecs++;
+                continue;
+            }
+            carte_lire_eeprom(c, ee);
+            for (i = 1; i < n; i++)
+                ee[cmd[0] + i - 1] = (uint8_t)cmd[i];
+            carte_ecrire_eeprom(c, ee);
+            continue;
+        }
+        if (strncmp(p, "pps", 3) == 0)
+        {
+            unsigned pps1;
+            int refus = (strstr(p, "refus") != NULL);
+
+            if (sscanf(p + 3, "%x", &pps1) != 1)
+            {
+                printf("  ÉCHEC ligne %d : syntaxe\n", num);
+                echecs++;
+                continue;
+            }
+            r = carte_pps(c, (uint8_t)pps1);
+            if ((refus && r != CARTE_REFUS) || (!refus && r != CARTE_OK))
+            {
+                printf("  ÉCHEC ligne %d : PPS %02X %s (%d)\n", num, pps1,
+                       refus ? "accepté" : "refusé", r);
+                echecs++;
+                if (r != CARTE_OK && r != CARTE_REFUS && carte_reset(c) != CARTE_OK)
+                    break;
+            }
+            else if (bavard)
+                printf("  ok PPS %02X : Di = %d, %d cycles par etu\n",
+                       pps1, c->di, c->etu);
+            continue;
+        }
+
+        na = -1;
+        fleche = strstr(p, "=>");
+        if (fleche)
+        {
+            *fleche = '\0';
+            na = lire_hex(fleche + 2, att, MAX_APDU + 2);
+        }
+        n = lire_hex(p, cmd, MAX_APDU);
+        if (n < 5 || (fleche && na < 2))
+        {
+            printf("  ÉCHEC ligne %d : syntaxe\n", num);
+            echecs++;
+            continue;
+        }
+        for (i = 0; i < n; i++)
+            apdu[i] = (uint8_t)cmd[i];
+
+        r = carte_apdu(c, apdu, n, rep, &nrep, &sw1, &sw2, &m);
+        if (r != CARTE_OK)
+        {
+            printf("  ÉCHEC ligne %d : carte muette ou plantée (%d)\n", num, r);
+            echecs++;
+            // la carte n'est plus synchronisée : reset avant la suite
+            if (carte_reset(c) != CARTE_OK)
+                break;
+            continue;
+        }
+        cumuler(apdu[0], apdu[1], c->di, &m);
+        rep[nrep] = sw1;
+        rep[nrep + 1] = sw2;
+
+        ok = 1;
+        if (na >= 0)
+        {
+            ok = (na == nrep + 2);
+            for (i = 0; ok && i < na; i++)
+                ok = (att[i] == JOKER || att[i] == rep[i]);
+        }
+        if (!ok)
+        {
+            printf("  ÉCHEC ligne %d :", num);
+            afficher_octets("", apdu, n);
+            afficher_octets("\n    reçu    :", rep, nrep + 2);
+            printf("\n    attendu :");
+            for (i = 0; i < na; i++)
+                printf(att[i] == JOKER ? " .." : " %02X", att[i]);
+            printf("\n");
+            echecs++;
+        }
+        else if (bavard)
+        {
+            printf("  ok ");
+            afficher_octets("", apdu, n);
+            afficher_octets(" =>", rep, nrep + 2);
+            printf("   (%llu cycles, %u octet(s) EEPROM)\n",
+                   (unsigned long long)m.cycles, m.ecritures_ee);
+        }
+    }
+    fclose(f);
+    return echecs;
+}
+
+static void usage(const char *prog)
+{
+    fprintf(stderr, "usage : %s [-v] [-b reference] [-w] [-t tolérance%%] "
+                    "firmware.elf script.apdu ...\n", prog);
+}
+
+int main(int argc, char *argv[])
+{
+    const char *reference = NULL;
+    double tolerance = 2.0;
+    int reecrire = 0;
+    uint8_t ee[CARTE_TAILLE_EE];
+    carte_t c;
+    int opt, echecs = 0, regressions = 0;
+    const char *elf;
+
+    while ((opt = getopt(argc, argv, "vb:wt:")) != -1)
+    {
+        switch (opt)
+        {
+        case 'v': bavard = 1; break;
+        case 'b': reference = optarg; break;
+        case 'w': reecrire = 1; break;
+        case 't': tolerance = atof(optarg); break;
+        default:
+            usage(argv[0]);
+            return 2;
+        }
+    }
+    if (argc - optind < 2 || (reecrire && !reference))
+    {
+        usage(argv[0]);
+        return 2;
+    }
+
+    elf = argv[optind++];
+    if (carte_ouvrir(&c, elf) != 0)
+        return 2;
+    carte_lire_eeprom(&c, ee);
+
+    for (; optind < argc; optind++)
+        echecs += executer(&c, argv[optind], ee);
+    carte_fermer(&c);
+
+    afficher_stats();
+    if (reference && reecrire && echecs)
+        printf("== %s non écrit : référence refusée tant qu'un test échoue\n",
+               reference);
+    else if (reference && reecrire)
+        regressions = ecrire_reference(reference, elf) ? 1 : 0;
+    else if (reference)
+        regressions = comparer_reference(reference, tolerance);
+
+    printf("== %d échec(s), %d régression(s)\n", echecs, regressions);
+    return (echecs || regressions) ? 1 : 0;
+}